@@ -0,0 +1,212 @@
+"""
+缓存包：把本地状态库导出为一个带清单的压缩包，在另一台机器（或下一次 Actions 运行）启动时导入
+
+新机器上状态库是空的，PE 历史、指数序列、K线、全市场快照都要重新下载。缓存包让新机器从上一次运行的状态热启动：
+仍在有效期内的数据（由各缓存原有的新鲜度判断决定）不再发起任何网络请求。
+
+包格式（tar.gz）：
+    manifest.json  {"format", "version", "schema_version", "exported_at", "database": {"name", "bytes", "sha256"},
+                    "namespaces": [state_store.cache_stats() 的各命名空间统计：条目数、最早/最新时间]}
+    state.db       用 SQLite 备份接口导出的一致副本（不含 WAL）
+
+导入时校验：格式和版本、状态库结构版本（SCHEMA_VERSION）、sha256、SQLite 完整性检查，任一不通过则抛出 BundleError，
+本地状态库保持不变。校验通过后在一个事务中合并到本地状态库，本地已有且更新的数据优先：
+
+| 命名空间 | 合并方式 |
+|----------|----------|
+| snapshot / fundamentals | 按快照名 / 股票代码整体替换，只在包中的获取时间更新时 |
+| pe_series / valuation_history | 只补充本地没有的数据点 |
+| price_bars | 包中的更新时间更新时覆盖该代码的K线，否则只补充 |
+| fx / run_meta | 按货币 / 键，包中的时间更新时覆盖 |
+| signals | 本地没有任何信号值时才导入 |
+| lookups | 不导入（只在导出它的那次分片运行内有效） |
+
+    SYNC_CACHE_BUNDLE=cache-bundle/state.tar.gz python pipeline.py   # 启动时导入（如存在），运行结束时导出
+    python scripts/manage_cache.py export state.tar.gz
+    python scripts/manage_cache.py import state.tar.gz
+"""
+import io
+import os
+import json
+import time
+import shutil
+import sqlite3
+import tarfile
+import hashlib
+import tempfile
+
+import file_lock
+import state_store
+
+BUNDLE_FORMAT = "stock-sync-cache-bundle"
+BUNDLE_VERSION = 1
+MANIFEST_NAME = "manifest.json"
+DATABASE_NAME = "state.db"
+
+
+class BundleError(ValueError):
+    """缓存包无法使用（格式、版本、校验和或完整性检查不通过）"""
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def export_bundle(store, path):
+    """导出 store 为缓存包（原子替换 path），返回清单"""
+    with tempfile.TemporaryDirectory(prefix="cache-bundle-") as tmpdir:
+        db_path = os.path.join(tmpdir, DATABASE_NAME)
+        store.backup(db_path)
+        manifest = {
+            "format": BUNDLE_FORMAT,
+            "version": BUNDLE_VERSION,
+            "schema_version": state_store.SCHEMA_VERSION,
+            "exported_at": time.time(),
+            "database": {"name": DATABASE_NAME, "bytes": os.path.getsize(db_path), "sha256": _sha256(db_path)},
+            "namespaces": store.cache_stats(),
+        }
+        payload = json.dumps(manifest, ensure_ascii=False, indent=2).encode("utf-8")
+        with file_lock.atomic_write(path, "wb") as raw, tarfile.open(fileobj=raw, mode="w:gz") as bundle:
+            info = tarfile.TarInfo(MANIFEST_NAME)
+            info.size = len(payload)
+            info.mtime = int(manifest["exported_at"])
+            bundle.addfile(info, io.BytesIO(payload))
+            bundle.add(db_path, arcname=DATABASE_NAME)
+    return manifest
+
+
+def read_manifest(path):
+    """读取并校验缓存包的清单（不解压状态库）"""
+    try:
+        with tarfile.open(path, mode="r:gz") as bundle:
+            return _check_manifest(_read_member(bundle, MANIFEST_NAME))
+    except (OSError, tarfile.TarError) as e:
+        raise BundleError(f"无法读取缓存包 {path}: {e}")
+
+
+def _read_member(bundle, name):
+    try:
+        member = bundle.getmember(name)
+    except KeyError:
+        raise BundleError(f"缓存包中缺少 {name}")
+    if not member.isfile():
+        raise BundleError(f"缓存包中的 {name} 不是普通文件")
+    return bundle.extractfile(member)
+
+
+def _check_manifest(stream):
+    try:
+        manifest = json.load(stream)
+    except ValueError as e:
+        raise BundleError(f"缓存包清单无法解析: {e}")
+    if manifest.get("format") != BUNDLE_FORMAT:
+        raise BundleError(f"不是缓存包: format={manifest.get('format')}")
+    if manifest.get("version") != BUNDLE_VERSION:
+        raise BundleError(f"缓存包版本不兼容: {manifest.get('version')} (需要 {BUNDLE_VERSION})")
+    if manifest.get("schema_version") != state_store.SCHEMA_VERSION:
+        raise BundleError(f"状态库结构版本不兼容: {manifest.get('schema_version')} (需要 {state_store.SCHEMA_VERSION})")
+    return manifest
+
+
+def _extract_database(bundle, manifest, directory):
+    """把状态库解压到 directory 并校验 sha256 和 SQLite 完整性，返回路径"""
+    db_path = os.path.join(directory, DATABASE_NAME)
+    with _read_member(bundle, manifest["database"]["name"]) as source, open(db_path, "wb") as target:
+        shutil.copyfileobj(source, target)
+    if _sha256(db_path) != manifest["database"]["sha256"]:
+        raise BundleError("缓存包中的状态库校验和不一致")
+    conn = sqlite3.connect(db_path)
+    try:
+        result = conn.execute("PRAGMA integrity_check").fetchone()[0]
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+    except sqlite3.DatabaseError as e:
+        raise BundleError(f"缓存包中的状态库无法打开: {e}")
+    finally:
+        conn.close()
+    if result != "ok":
+        raise BundleError(f"缓存包中的状态库完整性检查失败: {result}")
+    if version != state_store.SCHEMA_VERSION:
+        raise BundleError(f"缓存包中的状态库结构版本不兼容: {version}")
+    return db_path
+
+
+# (命名空间, SQL)；b 为附加的缓存包状态库
+_MERGE_STATEMENTS = (
+    ("snapshot", """
+        DELETE FROM quotes WHERE snapshot IN (
+            SELECT bs.snapshot FROM b.snapshots bs LEFT JOIN main.snapshots s USING (snapshot)
+            WHERE s.fetched_at IS NULL OR bs.fetched_at > s.fetched_at)"""),
+    ("snapshot", """
+        INSERT INTO quotes SELECT bq.* FROM b.quotes bq JOIN b.snapshots bs USING (snapshot)
+        LEFT JOIN main.snapshots s USING (snapshot)
+        WHERE s.fetched_at IS NULL OR bs.fetched_at > s.fetched_at"""),
+    ("snapshot", """
+        INSERT INTO snapshots SELECT * FROM b.snapshots WHERE true
+        ON CONFLICT (snapshot) DO UPDATE SET fetched_at = excluded.fetched_at, row_count = excluded.row_count
+        WHERE excluded.fetched_at > snapshots.fetched_at"""),
+    ("pe_series", "INSERT OR IGNORE INTO valuation_series SELECT * FROM b.valuation_series WHERE series IN ({pe_series})"),
+    ("valuation_history", "INSERT OR IGNORE INTO valuation_series SELECT * FROM b.valuation_series WHERE series NOT IN ({pe_series})"),
+    ("price_bars", """
+        INSERT OR REPLACE INTO price_bars SELECT bb.* FROM b.price_bars bb JOIN b.price_bar_sync bs USING (symbol, interval)
+        LEFT JOIN main.price_bar_sync s USING (symbol, interval)
+        WHERE s.checked_at IS NULL OR bs.checked_at > s.checked_at"""),
+    ("price_bars", "INSERT OR IGNORE INTO price_bars SELECT * FROM b.price_bars"),
+    ("price_bars", """
+        INSERT INTO price_bar_sync SELECT * FROM b.price_bar_sync WHERE true
+        ON CONFLICT (symbol, interval) DO UPDATE SET checked_at = excluded.checked_at
+        WHERE excluded.checked_at > price_bar_sync.checked_at"""),
+    ("fundamentals", """
+        DELETE FROM fundamentals WHERE symbol IN (
+            SELECT symbol FROM b.fundamentals GROUP BY symbol
+            HAVING MIN(fetched_at) > COALESCE((SELECT MAX(f.fetched_at) FROM main.fundamentals f WHERE f.symbol = b.fundamentals.symbol), 0))"""),
+    ("fundamentals", "INSERT OR IGNORE INTO fundamentals SELECT * FROM b.fundamentals"),
+    ("fx", """
+        INSERT INTO fx SELECT * FROM b.fx WHERE true
+        ON CONFLICT (currency) DO UPDATE SET rate = excluded.rate, fetched_at = excluded.fetched_at
+        WHERE excluded.fetched_at > fx.fetched_at"""),
+    ("signals", "INSERT INTO signals SELECT * FROM b.signals WHERE NOT EXISTS (SELECT 1 FROM main.signals)"),
+    ("run_meta", """
+        INSERT INTO run_meta SELECT * FROM b.run_meta WHERE true
+        ON CONFLICT (key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at
+        WHERE excluded.updated_at > run_meta.updated_at"""),
+)
+
+
+def import_bundle(store, path):
+    """
+    校验缓存包并合并到 store（本地更新的数据优先，见模块说明）
+    返回：
+        (清单, {命名空间: 写入的行数})；校验不通过时抛出 BundleError，store 不变
+    """
+    pe_series = ", ".join(f"'{series}'" for series in state_store.PE_SERIES)
+    with tempfile.TemporaryDirectory(prefix="cache-bundle-") as tmpdir:
+        try:
+            with tarfile.open(path, mode="r:gz") as bundle:
+                manifest = _check_manifest(_read_member(bundle, MANIFEST_NAME))
+                db_path = _extract_database(bundle, manifest, tmpdir)
+        except (OSError, tarfile.TarError) as e:
+            raise BundleError(f"无法读取缓存包 {path}: {e}")
+        changes = store.merge_database(db_path, [(namespace, sql.format(pe_series=pe_series))
+                                                 for namespace, sql in _MERGE_STATEMENTS])
+    return manifest, changes
+
+
+def import_once(store, path):
+    """
+    启动时导入缓存包：同一个包只导入一次（记录在 run_meta 的 cache_bundle 中），多个进程同时启动时只有一个导入
+    返回：
+        (清单, {命名空间: 写入的行数})；该包已导入过时返回 (清单, None)
+    """
+    manifest = read_manifest(path)
+    with file_lock.FileLock(file_lock.lock_path(store.lock_dir(), "cache_bundle")):
+        imported = store.get_meta("cache_bundle", {})
+        if imported.get("sha256") == manifest["database"]["sha256"]:
+            return manifest, None
+        manifest, changes = import_bundle(store, path)
+        store.set_meta("cache_bundle", {"sha256": manifest["database"]["sha256"], "exported_at": manifest["exported_at"],
+                                        "imported_at": time.time()})
+    return manifest, changes
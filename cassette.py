@@ -0,0 +1,269 @@
+"""
+录制/回放层（cassette）
+
+把一次真实运行中所有外部数据请求（akshare、yfinance、乐咕乐股网页、Notion）的返回结果
+录制到本地磁带文件，之后可以离线回放整次运行，用于性能分析和问题复现。
+
+环境变量：
+    CASSETTE_MODE     record / replay，为空时关闭（默认直连真实数据源）
+    CASSETTE_FILE     磁带文件路径，默认 ./cassettes/latest.cassette
+    CASSETTE_LATENCY  回放延时：zero（立即返回，默认）/ recorded（按录制时的耗时等待）
+
+磁带格式：gzip 压缩的 pickle，内容为
+    {"version": 1, "recorded_at": ..., "meta": {...}, "tracks": {key: [(ok, value, elapsed), ...]}}
+同一个 key 多次调用时按录制顺序依次回放，超出后重复最后一条。
+"""
+import os
+import gzip
+import time
+import pickle
+import inspect
+import datetime
+import functools
+import threading
+
+import file_lock
+
+CASSETTE_VERSION = 1
+DEFAULT_CASSETTE_FILE = "./cassettes/latest.cassette"
+
+MODES = ("record", "replay")
+LATENCY_MODES = ("zero", "recorded")
+
+_active = None
+
+
+class CassetteMiss(KeyError):
+    """回放时磁带中没有对应的录制记录"""
+
+
+class RecordedError(RuntimeError):
+    """录制时抛出但无法序列化的异常，回放时以此类型重新抛出"""
+
+
+class Cassette:
+    def __init__(self, path, mode, latency="zero"):
+        if mode not in MODES:
+            raise ValueError(f"未知的 cassette 模式: {mode}")
+        if latency not in LATENCY_MODES:
+            raise ValueError(f"未知的回放延时模式: {latency}")
+        self.path = path
+        self.mode = mode
+        self.latency = latency
+        self.meta = {}
+        self.tracks = {}
+        self._cursor = {}
+        self._lock = threading.Lock()
+        if mode == "replay":
+            self.load()
+
+    def load(self):
+        with gzip.open(self.path, "rb") as f:
+            data = pickle.load(f)
+        if data.get("version") != CASSETTE_VERSION:
+            raise ValueError(f"磁带版本不兼容: {data.get('version')} (需要 {CASSETTE_VERSION})")
+        self.meta = data.get("meta", {})
+        self.tracks = data.get("tracks", {})
+
+    def save(self):
+        """原子替换磁带文件：录制中途崩溃不会留下截断的磁带"""
+        data = {
+            "version": CASSETTE_VERSION,
+            "recorded_at": datetime.datetime.now().isoformat(),
+            "meta": self.meta,
+            "tracks": self.tracks,
+        }
+        with file_lock.atomic_write(self.path, "wb") as raw, gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=6) as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        total = sum(len(v) for v in self.tracks.values())
+        print(f"📼 已保存磁带 {self.path}: {len(self.tracks)} 个请求键, {total} 条记录")
+
+    def call(self, key, func, *args, **kwargs):
+        """按当前模式执行（录制）或回放一次调用"""
+        if self.mode == "replay":
+            return self._replay(key)
+
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            self._record(key, False, _picklable_error(e), time.perf_counter() - start)
+            raise
+        self._record(key, True, result, time.perf_counter() - start)
+        return result
+
+    def _record(self, key, ok, value, elapsed):
+        with self._lock:
+            self.tracks.setdefault(key, []).append((ok, value, elapsed))
+
+    def _replay(self, key):
+        with self._lock:
+            entries = self.tracks.get(key)
+            if not entries:
+                raise CassetteMiss(key)
+            idx = self._cursor.get(key, 0)
+            self._cursor[key] = idx + 1
+            ok, value, elapsed = entries[min(idx, len(entries) - 1)]
+        if self.latency == "recorded" and elapsed > 0:
+            time.sleep(elapsed)
+        if not ok:
+            raise value
+        return value
+
+
+def _picklable_error(e):
+    try:
+        pickle.loads(pickle.dumps(e))
+        return e
+    except Exception:
+        return RecordedError(f"{type(e).__name__}: {e}")
+
+
+def make_key(name, args=(), kwargs=None):
+    parts = [repr(a) for a in args]
+    parts += [f"{k}={v!r}" for k, v in sorted((kwargs or {}).items())]
+    return f"{name}({', '.join(parts)})"
+
+
+def activate(path=DEFAULT_CASSETTE_FILE, mode="replay", latency="zero"):
+    global _active
+    _active = Cassette(path, mode, latency)
+    return _active
+
+
+def activate_from_env():
+    """根据环境变量启用 cassette，未设置 CASSETTE_MODE 时返回 None"""
+    mode = os.getenv("CASSETTE_MODE", "").strip().lower()
+    if not mode:
+        return None
+    path = os.getenv("CASSETTE_FILE") or DEFAULT_CASSETTE_FILE
+    latency = os.getenv("CASSETTE_LATENCY", "zero").strip().lower() or "zero"
+    tape = activate(path, mode, latency)
+    if mode == "record":
+        print(f"📼 录制模式: 外部请求将写入 {path}")
+    else:
+        print(f"📼 回放模式: 从 {path} 读取 ({latency} 延时)")
+    return tape
+
+
+def deactivate():
+    global _active
+    _active = None
+
+
+def active():
+    return _active
+
+
+def is_active():
+    return _active is not None
+
+
+def call(name, func, *args, **kwargs):
+    """包装单次外部调用；未启用 cassette 时直接调用"""
+    if _active is None:
+        return func(*args, **kwargs)
+    return _active.call(make_key(name, args, kwargs), func, *args, **kwargs)
+
+
+def tape(name, ignore=()):
+    """
+    装饰数据获取函数，使其参与录制/回放。
+
+    ignore: 不参与请求键计算的参数名（如体积很大的行情缓存 dict、yfinance Ticker 对象）
+    """
+    def decorator(func):
+        sig = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _active is None:
+                return func(*args, **kwargs)
+            bound = sig.bind(*args, **kwargs)
+            key_kwargs = {k: v for k, v in bound.arguments.items() if k not in ignore}
+            return _active.call(make_key(name, (), key_kwargs), func, *args, **kwargs)
+
+        return wrapper
+    return decorator
+
+
+class _FastInfoProxy:
+    def __init__(self, ticker):
+        self._ticker = ticker
+
+    @property
+    def last_price(self):
+        t = self._ticker
+        return call(f"yf.fast_info.last_price[{t.symbol}]", lambda: t._real().fast_info.last_price)
+
+
+# yfinance Ticker.history 的前几个位置参数
+_HISTORY_PARAMS = ("period", "interval", "start", "end")
+
+
+class _TickerProxy:
+    """yfinance Ticker 代理：只录制同步流程中用到的 fast_info / info / history"""
+
+    def __init__(self, symbol, factory):
+        self.symbol = symbol
+        self._factory = factory
+        self._ticker = None
+
+    def _real(self):
+        if self._ticker is None:
+            self._ticker = self._factory(self.symbol)
+        return self._ticker
+
+    @property
+    def fast_info(self):
+        return _FastInfoProxy(self)
+
+    @property
+    def info(self):
+        return call(f"yf.info[{self.symbol}]", lambda: self._real().info)
+
+    def history(self, *args, **kwargs):
+        # 请求键包含全部参数：同一代码的 history(period="1d") 与 history(period="5y", interval="1mo") 是不同的请求；
+        # 位置参数按 yfinance 的参数顺序转为关键字参数，两种写法使用同一个键
+        kwargs = {**dict(zip(_HISTORY_PARAMS, args)), **kwargs}
+        return call(f"yf.history[{self.symbol}]", lambda **kw: self._real().history(**kw), **kwargs)
+
+
+def ticker(symbol, factory):
+    """返回 yfinance Ticker；启用 cassette 时返回可录制/回放的代理"""
+    if _active is None:
+        return factory(symbol)
+    return _TickerProxy(symbol, factory)
+
+
+class _EndpointProxy:
+    def __init__(self, client, endpoint):
+        self._client = client
+        self._endpoint = endpoint
+
+    def __getattr__(self, method):
+        name = f"notion.{self._endpoint}.{method}"
+
+        def invoke(**kwargs):
+            def real(**kw):
+                if self._client is None:
+                    raise CassetteMiss(make_key(name, (), kw))
+                return getattr(getattr(self._client, self._endpoint), method)(**kw)
+            return call(name, real, **kwargs)
+        return invoke
+
+
+class NotionProxy:
+    """Notion 客户端代理：回放模式下不需要真实的 token"""
+
+    def __init__(self, client):
+        self._client = client
+        self.databases = _EndpointProxy(client, "databases")
+        self.data_sources = _EndpointProxy(client, "data_sources")
+        self.pages = _EndpointProxy(client, "pages")
+
+
+def wrap_notion(client):
+    if _active is None:
+        return client
+    return NotionProxy(client)
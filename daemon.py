@@ -0,0 +1,177 @@
+"""
+常驻服务模式：内部调度 + 本地 HTTP 触发
+
+python main.py --daemon 启动后进程常驻，热缓存（warm_cache.py）中的快照、指数序列、基本面等保存在内存中，
+每次同步只获取真正过期的数据：
+
+- 调度：在各市场（CN/HK/US）收盘后 SESSION_GRACE 自动运行一次 auto 同步（只处理已收盘的市场）
+- 触发：本地 HTTP 接口（只监听 127.0.0.1）
+    POST /sync?markets=CN,HK   排队一次同步（markets 缺省为 all，也可以是 auto）
+    POST /sync?refresh=1       同上，并重新查询持仓页面索引（在 Notion 中手动增删持仓、修改持仓数量之后）
+    GET  /status               返回下次调度时间、最近几次同步结果和热缓存统计
+    GET  /metrics              当前/最近一次同步的运行指标（OpenMetrics 格式，见 metrics.py）
+
+同步在主线程中串行执行，HTTP 线程只负责排队，多次触发不会并发写入 Notion。
+持仓页面索引和数据源属性定义也常驻内存（DAILY）：本进程写入的属性直接同步到索引，
+Notion 中的手动修改在第二天或 refresh=1 触发时生效。
+"""
+import os
+import json
+import queue
+import datetime
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import market_calendar
+import metrics
+import warm_cache
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = int(os.getenv("SYNC_DAEMON_PORT", "8765"))
+# 收盘后等待数据源更新收盘数据的时间
+SESSION_GRACE = datetime.timedelta(minutes=10)
+# 找不到下一个收盘时间时（节假日表之外）最长的休眠时间
+MAX_IDLE = datetime.timedelta(hours=6)
+# /status 中保留的最近同步记录条数
+HISTORY_SIZE = 20
+
+
+def _utcnow():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+class SyncDaemon:
+    def __init__(self, sync, host=DEFAULT_HOST, port=DEFAULT_PORT, clock=_utcnow):
+        """
+        sync: 执行一次同步的函数，参数为市场选择（'auto'/'all'/'CN,HK' 等）
+        """
+        self._sync = sync
+        self._clock = clock
+        self._requests = queue.Queue()
+        self._history = deque(maxlen=HISTORY_SIZE)
+        self._running = None
+        self._stopped = threading.Event()
+        self.server = ThreadingHTTPServer((host, port), _make_handler(self))
+
+    @property
+    def address(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def next_wake(self, now=None):
+        """下一次自动同步的时间：最近一个市场收盘 + SESSION_GRACE"""
+        now = now or self._clock()
+        closes = [
+            market_calendar.next_session_close(m, now - SESSION_GRACE)
+            for m in market_calendar.MARKETS
+            if m != market_calendar.CRYPTO
+        ]
+        closes = [c + SESSION_GRACE for c in closes if c is not None]
+        return min(closes, default=now + MAX_IDLE)
+
+    def trigger(self, markets="all", refresh=False):
+        """排队一次同步；refresh 时先丢弃常驻的持仓页面索引；markets 无效时抛出 ValueError"""
+        market_calendar.parse_market_selection(markets)
+        if refresh:
+            warm_cache.discard(warm_cache.PAGE_INDEX_KEY)
+        self._requests.put(markets)
+        return self._requests.qsize()
+
+    def status(self):
+        return {
+            "running": self._running,
+            "queued": self._requests.qsize(),
+            "next_wake": self.next_wake().isoformat(),
+            "history": list(self._history),
+            "cache": warm_cache.active().stats() if warm_cache.is_active() else None,
+        }
+
+    def run_once(self, markets):
+        started = self._clock()
+        self._running = markets
+        record = {"markets": markets, "started_at": started.isoformat()}
+        try:
+            self._sync(markets)
+            record["ok"] = True
+        except Exception as e:
+            print(f"❌ 同步失败: {e}")
+            record["ok"] = False
+            record["error"] = str(e)
+        finally:
+            self._running = None
+        record["seconds"] = round((self._clock() - started).total_seconds(), 1)
+        self._history.append(record)
+        return record
+
+    def next_request(self):
+        """等待下一次同步：HTTP 触发的请求优先，否则到点后执行 auto 同步"""
+        timeout = max(0.0, (self.next_wake() - self._clock()).total_seconds())
+        try:
+            return self._requests.get(timeout=timeout)
+        except queue.Empty:
+            return "auto"
+
+    def serve_forever(self):
+        threading.Thread(target=self.server.serve_forever, name="sync-trigger", daemon=True).start()
+        print(f"🛰️ 常驻模式已启动，触发地址: {self.address}/sync ，下次自动同步: {self.next_wake().astimezone():%m-%d %H:%M}")
+        try:
+            while not self._stopped.is_set():
+                markets = self.next_request()
+                if self._stopped.is_set():
+                    break
+                print(f"\n{'=' * 60}\n🛰️ 开始同步 ({markets})")
+                self.run_once(markets)
+                print(f"🛰️ 下次自动同步: {self.next_wake().astimezone():%m-%d %H:%M}")
+        except KeyboardInterrupt:
+            print("\n🛰️ 收到中断，退出常驻模式")
+        finally:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def stop(self):
+        self._stopped.set()
+        self._requests.put(None)
+
+
+def _make_handler(daemon):
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, code, payload):
+            self._send(code, json.dumps(payload, ensure_ascii=False).encode("utf-8"), "application/json; charset=utf-8")
+
+        def _send(self, code, body, content_type):
+            self.send_response(code)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            path = urlparse(self.path).path
+            if path == "/status":
+                self._reply(200, daemon.status())
+            elif path == "/metrics":
+                self._send(200, metrics.render().encode("utf-8"), metrics.OPENMETRICS_CONTENT_TYPE)
+            else:
+                self._reply(404, {"error": "not found"})
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path != "/sync":
+                self._reply(404, {"error": "not found"})
+                return
+            query = parse_qs(url.query)
+            markets = query.get("markets", ["all"])[0]
+            refresh = query.get("refresh", ["0"])[0].lower() in ("1", "true", "yes")
+            try:
+                queued = daemon.trigger(markets, refresh=refresh)
+            except ValueError as e:
+                self._reply(400, {"error": str(e)})
+                return
+            self._reply(202, {"queued": queued, "markets": markets})
+
+        def log_message(self, format, *args):
+            pass  # 不输出每个请求的访问日志
+
+    return Handler
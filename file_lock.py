@@ -0,0 +1,150 @@
+"""
+跨进程的文件锁（advisory lock）与原子写入
+
+缓存已经都在本地状态库（SQLite 事务，写入中途崩溃会回滚），但还有两个问题：
+
+- 文件输出（磁带、指标文本文件、分片报告）直接覆盖写入，写到一半崩溃会留下截断的文件
+- 同时运行的多个进程（分片工作进程、定时任务与手动触发重叠、常驻模式与一次性运行）
+  在同一个缓存未命中时各自请求上游，全市场快照这类大请求会重复多次
+
+约定：
+
+- atomic_write()：先写同目录下的临时文件并 fsync，再 os.replace 替换，读取方只会看到旧文件或完整的新文件
+- single_writer()：单写多读。读取不加锁（SQLite WAL 下读写互不阻塞）；未命中时按缓存键获取排他锁，
+  拿到锁后先重新读取一次（等待期间其他进程可能已经写入），仍未命中才由本进程请求上游并写入，
+  其他进程等待后直接复用
+- 锁是 flock 建议锁，持有锁的进程退出（包括崩溃）时由操作系统释放，不会留下需要手动清理的死锁；
+  锁文件本身（空文件）保留在锁目录中
+- 等锁超时时不再等待，由本进程自己请求（最坏情况退化为以前的重复请求，不会阻塞同步）
+- 没有 fcntl 的平台（Windows）上锁为空操作，只保证单进程内的正确性
+"""
+import os
+import re
+import time
+import tempfile
+import contextlib
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# 等锁的默认超时（秒）与轮询间隔
+DEFAULT_TIMEOUT = 60
+POLL_INTERVAL = 0.1
+
+
+class LockTimeout(TimeoutError):
+    """在超时时间内没有拿到锁"""
+
+
+@contextlib.contextmanager
+def atomic_write(path, mode="w", encoding=None):
+    """
+    原子写入 path：with atomic_write(path) as f: f.write(...)
+    正常退出时替换目标文件；抛出异常时删除临时文件，目标文件保持不变
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    if "b" not in mode and encoding is None:
+        encoding = "utf-8"
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode, encoding=encoding) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
+
+
+class FileLock:
+    """
+    基于 flock 的跨进程锁：with FileLock(path): ...
+    shared=True 为共享锁（多个读取方可同时持有），否则为排他锁
+    timeout 为 None 时一直等待；超时抛出 LockTimeout
+    """
+
+    def __init__(self, path, shared=False, timeout=DEFAULT_TIMEOUT, poll=POLL_INTERVAL):
+        self.path = path
+        self.shared = shared
+        self.timeout = timeout
+        self.poll = poll
+        self.waited = 0.0
+        self._fd = None
+
+    def acquire(self):
+        if fcntl is None:
+            return self
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        operation = (fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX) | fcntl.LOCK_NB
+        started = time.monotonic()
+        while True:
+            try:
+                fcntl.flock(fd, operation)
+                break
+            except (BlockingIOError, PermissionError):
+                self.waited = time.monotonic() - started
+                if self.timeout is not None and self.waited >= self.timeout:
+                    os.close(fd)
+                    raise LockTimeout(f"等待锁超时（{self.timeout:.0f}s）: {self.path}")
+                time.sleep(self.poll)
+        self.waited = time.monotonic() - started
+        self._fd = fd
+        return self
+
+    def release(self):
+        if self._fd is None:
+            return
+        fd, self._fd = self._fd, None
+        try:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+        return False
+
+
+def lock_path(lock_dir, name):
+    """缓存键 → 锁文件路径（键中不能用作文件名的字符替换为 _）"""
+    return os.path.join(lock_dir, re.sub(r"[^\w.\-]", "_", name) + ".lock")
+
+
+def single_writer(lock_dir, name, load, fill, is_missing=None, timeout=DEFAULT_TIMEOUT):
+    """
+    单写多读地读取缓存
+    参数：
+        load: 读取缓存，未命中时返回 None / 空值
+        fill: 请求上游并写入缓存，返回新值
+        is_missing: 判断 load() 的结果是否未命中，默认为“假值”
+    返回：
+        (值, 是否由本进程调用了 fill)
+    """
+    is_missing = is_missing or (lambda value: not value)
+    value = load()
+    if not is_missing(value):
+        return value, False
+    # 只有等锁超时才自己请求；fill() 内部（如嵌套的缓存）抛出的 LockTimeout 照常传给调用方
+    lock = FileLock(lock_path(lock_dir, name), timeout=timeout)
+    try:
+        lock.acquire()
+    except LockTimeout as e:
+        print(f"   ⚠️ {e}，直接请求")
+        return fill(), True
+    try:
+        # 第一次读取之后、拿到锁之前，其他进程可能已经写入
+        value = load()
+        if not is_missing(value):
+            return value, False
+        return fill(), True
+    finally:
+        lock.release()
@@ -0,0 +1,41 @@
+"""
+延迟导入工具
+
+akshare / yfinance / pandas 导入很慢（akshare 单独就要数秒），而很多场景（单元测试、只有美股的运行、
+辅助脚本）根本用不到其中一部分。LazyModule 在第一次访问属性时才真正导入模块。
+
+对 LazyModule 设置的属性只保存在代理对象上、不会写入真实模块，
+因此 unittest.mock.patch('main.ak.xxx') 这类用法照常工作，退出 patch 后自动恢复。
+"""
+import importlib
+import importlib.util
+
+
+class LazyModule:
+    def __init__(self, name):
+        self._lazy_name = name
+        self._lazy_module = None
+
+    def _load(self):
+        if self._lazy_module is None:
+            self._lazy_module = importlib.import_module(self._lazy_name)
+        return self._lazy_module
+
+    @property
+    def is_loaded(self):
+        return self._lazy_module is not None
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        state = "loaded" if self.is_loaded else "not loaded"
+        return f"<LazyModule {self._lazy_name!r} ({state})>"
+
+
+def is_installed(name):
+    """只检查模块是否可导入，不执行导入"""
+    try:
+        return importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        return False
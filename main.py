@@ -2,44 +2,33 @@ import os
 import sys
 import time
 import datetime
-import json
-import pickle
-
-# --- 虚拟环境检查 ---
-# 强烈建议在虚拟环境中运行，以避免与系统库冲突
-# 在 CI/CD 或 Docker 环境中，可以设置环境变量 SKIP_VENV_CHECK=1 来跳过
-if os.getenv("SKIP_VENV_CHECK") != "1" and sys.prefix == sys.base_prefix:
-    print("🛑 错误: 检测到您正在使用系统 Python 环境。")
-    print("为了避免依赖冲突，请在虚拟环境中运行此脚本。")
-    print("\n请按照以下步骤操作:")
-    print("1. 创建虚拟环境 (在项目根目录): python3 -m venv venv")
-    print("2. 激活虚拟环境: source venv/bin/activate")
-    print("3. 安装依赖: pip install -r requirements.txt")
-    print("4. 运行脚本: python3 main.py\n")
-    sys.exit(1)
-
-try:
-    import pandas as pd
-except ImportError:
-    print("🛑 错误: 'pandas' 模块未找到。请在激活虚拟环境后，运行 'pip install -r requirements.txt' 安装依赖。")
-    sys.exit(1)
-
-try:
-    import yfinance as yf
-except ImportError:
-    yf = None
-    print("⚠️ yfinance 未安装，将无法获取美股/港股/加密货币数据（可选安装: pip install yfinance）")
-
-from notion_client import Client
-
-# 尝试导入 akshare（用于获取中国ETF基金数据）
-try:
-    import akshare as ak
-    AKSHARE_AVAILABLE = True
-except ImportError:
-    ak = None
-    AKSHARE_AVAILABLE = False
-    print("⚠️ akshare 未安装，将跳过中国ETF基金数据获取（可选安装: pip install akshare）")
+import atexit
+import inspect
+import functools
+
+import cassette
+import resilience
+import market_calendar
+import warm_cache
+import notion_query
+import notifier
+import write_queue
+import providers
+import quote_record
+import valuation_history
+import profiling
+import metrics
+import state_store
+import file_lock
+import cache_bundle
+from lazy_import import LazyModule, is_installed
+
+# 重量级数据处理库延迟到第一次使用时才导入（akshare 单独导入就要数秒）
+pd = LazyModule("pandas")
+yf = LazyModule("yfinance") if is_installed("yfinance") else None
+# akshare 用于获取中国ETF基金数据
+AKSHARE_AVAILABLE = is_installed("akshare")
+ak = LazyModule("akshare") if AKSHARE_AVAILABLE else None
 
 # --- 环境变量配置 (CI/CD 注入) ---
 NOTION_TOKEN = os.getenv("NOTION_TOKEN")
@@ -47,12 +36,44 @@ DATABASE_ID = os.getenv("DATABASE_ID")
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
 
-# 初始化 Notion (允许为空，以便单元测试导入此文件时不报错)
-if NOTION_TOKEN and DATABASE_ID:
-    notion = Client(auth=NOTION_TOKEN, notion_version="2025-09-03")
-else:
-    notion = None
-    print("⚠️ 环境变量未设置，Notion 客户端未初始化 (仅供测试或本地开发)")
+# Notion 客户端在第一次使用时创建 (导入此文件时不创建，以便单元测试和脚本快速导入)
+notion = None
+
+
+def check_runtime_environment():
+    """运行前检查：虚拟环境和依赖（仅在作为脚本运行时调用，导入时无副作用）"""
+    # --- 虚拟环境检查 ---
+    # 强烈建议在虚拟环境中运行，以避免与系统库冲突
+    # 在 CI/CD 或 Docker 环境中，可以设置环境变量 SKIP_VENV_CHECK=1 来跳过
+    if os.getenv("SKIP_VENV_CHECK") != "1" and sys.prefix == sys.base_prefix:
+        print("🛑 错误: 检测到您正在使用系统 Python 环境。")
+        print("为了避免依赖冲突，请在虚拟环境中运行此脚本。")
+        print("\n请按照以下步骤操作:")
+        print("1. 创建虚拟环境 (在项目根目录): python3 -m venv venv")
+        print("2. 激活虚拟环境: source venv/bin/activate")
+        print("3. 安装依赖: pip install -r requirements.txt")
+        print("4. 运行脚本: python3 main.py\n")
+        sys.exit(1)
+
+    if not is_installed("pandas"):
+        print("🛑 错误: 'pandas' 模块未找到。请在激活虚拟环境后，运行 'pip install -r requirements.txt' 安装依赖。")
+        sys.exit(1)
+    if yf is None:
+        print("⚠️ yfinance 未安装，将无法获取美股/港股/加密货币数据（可选安装: pip install yfinance）")
+    if not AKSHARE_AVAILABLE:
+        print("⚠️ akshare 未安装，将跳过中国ETF基金数据获取（可选安装: pip install akshare）")
+
+
+def get_notion_client():
+    """按需创建 Notion 客户端；环境变量未设置时返回 None"""
+    global notion
+    if notion is None:
+        if not (NOTION_TOKEN and DATABASE_ID):
+            print("⚠️ 环境变量未设置，Notion 客户端未初始化 (仅供测试或本地开发)")
+            return None
+        from notion_client import Client
+        notion = Client(auth=NOTION_TOKEN, notion_version="2025-09-03")
+    return notion
 
 # 常见数字货币代码列表（需要添加 -USD 后缀）
 CRYPTO_SYMBOLS = {
@@ -120,47 +141,147 @@ HK_ETF_INDEX_MAPPING = {
     '159920': 'HSI',       # A股恒生ETF → 恒生指数
 }
 
-# PE 缓存目录
+# 旧版 PE 缓存目录（首次使用状态库时导入，见 state_store.py）
 CACHE_DIR = "./pe_cache"
-# Akshare 数据缓存目录
+# Akshare 数据缓存目录（状态库 state.db 所在目录）
 AKSHARE_CACHE_DIR = "./akshare_cache"
-# 信号缓存文件（用于检测变化）
-SIGNAL_CACHE_FILE = os.path.join(AKSHARE_CACHE_DIR, "signal_cache.json")
+
+# 交易流水表数据源 ID
+TRADE_LOG_DATA_SOURCE_ID = "2db4538c-fc22-8082-a3b1-000bf0590459"
+
+# 熔断重试轮最多等待数据源恢复的秒数
+RETRY_PASS_MAX_WAIT = 90
 
 # 需要监控的信号字段
 SIGNAL_FIELDS = ["🚦 平安动态信号", "🚦雪盈风险等级"]
 
+# 各阶段读取的 Notion 属性（查询时只返回这些属性）
+# 持仓循环：代码、货币、名称（信号通知）和信号字段
+HOLDING_PROPERTIES = ["股票代码", "Ticker", "货币", "股票名称"] + SIGNAL_FIELDS
+# 交易流水阶段：持仓表的现价和持仓数量
+PRICE_PROPERTIES = ["现价", "持仓数量 (自动)"]
+# 交易流水表（含已写入的涨跌幅，数值未变化时不重复写入）
+TRADE_LOG_PROPERTIES = ["动作类型", "交易日期", "成交单价", "关联标的", "卖出后涨跌幅", "买入后涨跌幅"]
+# 交易流水表的动作类型 → 对应的涨跌幅字段
+TRADE_RETURN_FIELDS = {"卖出": "卖出后涨跌幅", "买入": "买入后涨跌幅"}
+
 
 def send_telegram_message(message):
+    """把消息放入后台通知队列后立即返回（发送、分段和重试见 notifier.py），不阻塞行情同步"""
     if not TELEGRAM_BOT_TOKEN or not TELEGRAM_CHAT_ID:
         print("⚠️ Telegram 配置缺失，跳过推送")
         return False
 
+    notifier.start(TELEGRAM_BOT_TOKEN, TELEGRAM_CHAT_ID)
+    return notifier.notify(message)
+
+
+def get_state_store():
+    """本地状态库（首次使用时导入旧的 JSON/CSV 状态文件和缓存包）"""
+    store = state_store.get_store()
+    state_store.import_legacy_files(store, AKSHARE_CACHE_DIR, CACHE_DIR)
+    load_cache_bundle(store)
+    return store
+
+
+# 缓存包路径（见 cache_bundle.py）：启动时导入，运行结束时导出；未设置时不使用
+CACHE_BUNDLE_ENV = "SYNC_CACHE_BUNDLE"
+_cache_bundle_checked = False
+
+
+def load_cache_bundle(store):
+    """导入 SYNC_CACHE_BUNDLE 指定的缓存包（每个进程只检查一次）；不存在或校验不通过时冷启动"""
+    global _cache_bundle_checked
+    if _cache_bundle_checked:
+        return
+    _cache_bundle_checked = True
+    path = os.getenv(CACHE_BUNDLE_ENV)
+    # 录制/回放时以磁带为准
+    if not path or not os.path.exists(path) or cassette.is_active():
+        return
     try:
-        import requests
-        url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-        payload = {
-            "chat_id": TELEGRAM_CHAT_ID,
-            "text": message,
-            "parse_mode": "HTML"
-        }
-        resp = requests.post(url, json=payload, timeout=10)
-        if resp.status_code == 200:
-            print(f"📤 Telegram 推送成功")
-            return True
-        else:
-            print(f"⚠️ Telegram 推送失败: {resp.text}")
-            return False
+        manifest, changes = cache_bundle.import_once(store, path)
     except Exception as e:
-        print(f"⚠️ Telegram 推送异常: {e}")
-        return False
+        print(f"⚠️ 缓存包不可用，冷启动: {e}")
+        return
+    if changes is None:
+        return
+    exported_at = datetime.datetime.fromtimestamp(manifest["exported_at"]).strftime("%Y-%m-%d %H:%M")
+    summary = ", ".join(f"{namespace} {count} 行" for namespace, count in changes.items() if count)
+    print(f"🗄️ 已导入缓存包 (导出于 {exported_at}): {summary or '没有更新的数据'}")
+
+
+def save_cache_bundle():
+    """运行结束时把状态库导出为 SYNC_CACHE_BUNDLE 指定的缓存包；导出失败只打印警告"""
+    path = os.getenv(CACHE_BUNDLE_ENV)
+    if not path or cassette.is_active():
+        return
+    try:
+        manifest = cache_bundle.export_bundle(get_state_store(), path)
+        print(f"🗄️ 已导出缓存包 {path} ({manifest['database']['bytes'] / 1024:.0f} KiB 状态库)")
+    except Exception as e:
+        print(f"⚠️ 导出缓存包失败: {e}")
+
+
+def fill_cache_once(name, load, fill, is_missing=None):
+    """
+    多个进程（分片工作进程、重叠的运行）同时未命中同一缓存时，只有一个进程请求上游，其余等待后复用（见 file_lock.py）
+    返回：
+        (值, 是否由本进程请求了上游)
+    """
+    budget = resilience.budget()
+    timeout = file_lock.DEFAULT_TIMEOUT if budget is None else max(resilience.MIN_CALL_TIMEOUT, min(file_lock.DEFAULT_TIMEOUT, budget.remaining()))
+    return file_lock.single_writer(get_state_store().lock_dir(), name, load, fill, is_missing, timeout=timeout)
+
+
+# 分片运行的开始时间戳（协调进程设置，见 shared_lookup）
+SHARED_LOOKUPS_ENV = "SYNC_SHARED_LOOKUPS"
+
+
+def shared_lookup(func):
+    """
+    分片运行时各工作进程共用的上游查询（指数估值、QDII 参考 ETF、基金净值增长率）
+
+    这些结果在每个进程内由 warm_cache 缓存，但分片的 N 个工作进程会各自请求一次。
+    协调进程把本次运行的开始时间戳写入环境变量 SYNC_SHARED_LOOKUPS（见 pipeline.shard_worker_env），
+    工作进程把结果保存到本地状态库（lookups），只采用本次运行中获取的结果；
+    同一查询只有一个进程请求上游（fill_cache_once）。获取失败（空结果）不保存。
+    未设置该变量（单进程运行）或录制/回放时直接调用原函数。
+    """
+    sig = inspect.signature(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        since = os.getenv(SHARED_LOOKUPS_ENV)
+        if not since or cassette.is_active():
+            return func(*args, **kwargs)
+        name = func.__name__
+        key = repr(tuple(sig.bind(*args, **kwargs).arguments.values()))
+        store = get_state_store()
+
+        def fill():
+            value = func(*args, **kwargs)
+            if not warm_cache.is_empty(value):
+                store.put_lookup(name, key, value)
+            return value
+
+        value, fetched = fill_cache_once(f"lookup-{name}-{key}", lambda: store.get_lookup(name, key, fresh_after=float(since)), fill)
+        metrics.inc(metrics.CACHE_LOOKUPS, cache="lookups", result="miss" if fetched else "hit")
+        # JSON 中元组保存为数组
+        return tuple(value) if isinstance(value, list) else value
+
+    return wrapper
+
+
+def start_of_today():
+    """今天零点的时间戳（状态库中按天失效的数据以此为界）"""
+    return datetime.datetime.combine(datetime.date.today(), datetime.time()).timestamp()
 
 
 def load_signal_cache():
+    """读取上次的信号值 {(代码, 字段): 值}"""
     try:
-        if os.path.exists(SIGNAL_CACHE_FILE):
-            with open(SIGNAL_CACHE_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
+        return get_state_store().get_signals()
     except Exception as e:
         print(f"⚠️ 加载信号缓存失败: {e}")
     return {}
@@ -168,9 +289,7 @@ def load_signal_cache():
 
 def save_signal_cache(cache):
     try:
-        os.makedirs(AKSHARE_CACHE_DIR, exist_ok=True)
-        with open(SIGNAL_CACHE_FILE, 'w', encoding='utf-8') as f:
-            json.dump(cache, f, ensure_ascii=False, indent=2)
+        get_state_store().replace_signals(cache)
     except Exception as e:
         print(f"⚠️ 保存信号缓存失败: {e}")
 
@@ -224,7 +343,7 @@ def check_and_notify_signal_changes(pages):
 
         for field_name in SIGNAL_FIELDS:
             current_value = get_signal_value(props, field_name)
-            cache_key = f"{ticker}|{field_name}"
+            cache_key = (ticker, field_name)
             old_value = old_cache.get(cache_key)
             new_cache[cache_key] = current_value
 
@@ -246,10 +365,11 @@ def check_and_notify_signal_changes(pages):
             lines.append(f"   {c['old']} → {c['new']}\n")
         message = "\n".join(lines)
         send_telegram_message(message)
-        print(f"📡 检测到 {len(changes)} 个信号变化，已推送通知")
+        print(f"📡 检测到 {len(changes)} 个信号变化，已加入推送队列")
     else:
         print("📡 信号无变化")
 
+@warm_cache.memoize(warm_cache.DAILY)
 def get_exchange_rates():
     """
     获取实时汇率 (基准: CNY)
@@ -257,22 +377,22 @@ def get_exchange_rates():
     """
     print("💱 正在获取实时汇率...")
     
-    # 检查缓存
-    os.makedirs(AKSHARE_CACHE_DIR, exist_ok=True)
-    rates_cache_file = os.path.join(AKSHARE_CACHE_DIR, "exchange_rates.json")
-    
+    # 检查缓存（今天获取过的汇率）
     try:
-        if os.path.exists(rates_cache_file):
-            # 检查文件修改时间是否是今天
-            mod_time = os.path.getmtime(rates_cache_file)
-            if datetime.date.fromtimestamp(mod_time) == datetime.date.today():
-                with open(rates_cache_file, 'r') as f:
-                    rates = json.load(f)
-                print("   - 从缓存加载汇率")
-                return rates
+        store = get_state_store()
+        rates, fetched = fill_cache_once("fx", lambda: store.get_rates(fresh_after=start_of_today()),
+                                         lambda: _fetch_exchange_rates(store))
     except Exception:
-        pass # 缓存读取失败，则重新获取
+        # 缓存读取失败，则重新获取
+        return _fetch_exchange_rates(None)
+    metrics.inc(metrics.CACHE_LOOKUPS, cache="fx", result="miss" if fetched else "hit")
+    if not fetched:
+        print("   - 从缓存加载汇率")
+    return rates
 
+
+def _fetch_exchange_rates(store):
+    """从 yfinance 获取汇率并写入缓存（store 为 None 时不写入）"""
     rates = {"CNY": 1.0}
     
     if yf is None:
@@ -289,8 +409,8 @@ def get_exchange_rates():
     
     for currency, ticker_code in pairs.items():
         try:
-            ticker = yf.Ticker(ticker_code)
-            price = ticker.fast_info.last_price
+            ticker = _yf_ticker(ticker_code)
+            price = resilience.guarded("yfinance", lambda: ticker.fast_info.last_price)
             rates[currency] = price
             print(f"   - {currency}/CNY: {price:.4f}")
         except Exception as e:
@@ -300,13 +420,186 @@ def get_exchange_rates():
     
     # 写入缓存
     try:
-        with open(rates_cache_file, 'w') as f:
-            json.dump(rates, f)
+        if store is not None:
+            store.put_rates(rates)
     except Exception:
         pass # 缓存写入失败，不影响主流程
             
     return rates
 
+# akshare 接口所属的上游数据源（用于熔断）。未列出的接口按后缀推断：_em 东方财富、_sina 新浪、_lg 乐咕乐股
+AKSHARE_SOURCE_OVERRIDES = {
+    'bond_zh_hs_daily': 'sina',
+    'stock_financial_analysis_indicator': 'sina',
+    'stock_a_lg_indicator': 'legulegu',
+    'stock_hk_indicator': 'legulegu',
+    'stock_zh_index_hist_csindex': 'csindex',
+}
+
+
+def akshare_source(api_name):
+    """返回 akshare 接口对应的上游数据源名称"""
+    if api_name in AKSHARE_SOURCE_OVERRIDES:
+        return AKSHARE_SOURCE_OVERRIDES[api_name]
+    if api_name.endswith('_em'):
+        return 'eastmoney'
+    if api_name.endswith('_sina'):
+        return 'sina'
+    if api_name.endswith('_lg'):
+        return 'legulegu'
+    return 'akshare'
+
+
+def call_akshare(api_name, *args, **kwargs):
+    """经对应数据源的熔断器调用 akshare 接口；熔断中抛出 resilience.CircuitOpenError"""
+    return resilience.guarded(akshare_source(api_name), getattr(ak, api_name), *args, **kwargs)
+
+
+def _yf_ticker(symbol):
+    """创建 yfinance Ticker（启用 cassette 时返回可录制/回放的代理）"""
+    return cassette.ticker(symbol, yf.Ticker)
+
+
+def to_yf_symbol(ticker_symbol):
+    """持仓代码 → yfinance 代码"""
+    yf_ticker = ticker_symbol.upper()  # 转换为大写
+
+    # 0. 处理点号：yfinance 需要连字符而不是点号（如 BRK.B -> BRK-B）
+    if '.' in yf_ticker:
+        yf_ticker = yf_ticker.replace('.', '-')
+
+    # 1. 处理数字货币：添加 -USD 后缀
+    if yf_ticker in CRYPTO_SYMBOLS:
+        yf_ticker = f"{yf_ticker}-USD"
+    # 2. 处理 A 股代码：自动添加市场后缀
+    # 60开头是上海（.SS），00/30开头是深圳（.SZ）
+    elif ticker_symbol.isdigit() and len(ticker_symbol) == 6:
+        if ticker_symbol.startswith('60'):
+            yf_ticker = f"{ticker_symbol}.SS"
+        elif ticker_symbol.startswith(('00', '30')):
+            yf_ticker = f"{ticker_symbol}.SZ"
+    return yf_ticker
+
+
+# 计算 PE 百分位（价格近似法）使用的K线：最近 5 年月线
+PRICE_HISTORY_INTERVAL = "1mo"
+PRICE_HISTORY_DAYS = 5 * 365
+
+
+def _bars_from_history(hist):
+    """yfinance history 的 DataFrame → [(日期, open, high, low, close, volume), ...]"""
+    bars = []
+    for ts, row in hist.iterrows():
+        date = ts.strftime("%Y-%m-%d") if hasattr(ts, "strftime") else str(ts)[:10]
+        bars.append((date, *(_finite(row.get(column)) for column in ("Open", "High", "Low", "Close", "Volume"))))
+    return bars
+
+
+def _finite(value):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return None if value != value else value
+
+
+def get_history_closes(yf_symbol, stock, market):
+    """
+    最近 5 年的月线收盘价（pd.Series，按日期升序），来自本地K线库（state_store.price_bars）
+    首次下载 5 年月线；之后 market 每次收盘后最多增量更新一次，只下载最后一根已保存K线（当期，可能未收盘）及之后的K线
+    下载失败时使用已保存的K线
+    """
+    # 录制/回放时以磁带为准，不读写本地K线库
+    if cassette.is_active():
+        hist = resilience.guarded("yfinance", stock.history, period="5y", interval=PRICE_HISTORY_INTERVAL)
+        if hist is None or hist.empty:
+            return pd.Series([], dtype=float)
+        return hist['Close'].dropna()
+
+    store = get_state_store()
+    now = datetime.datetime.now(datetime.timezone.utc)
+    last_close = market_calendar.last_session_close(market, now)
+
+    def fresh():
+        checked_at = store.bars_checked_at(yf_symbol, PRICE_HISTORY_INTERVAL)
+        return checked_at is not None and not (last_close and checked_at < last_close.timestamp())
+
+    def update():
+        last_date = store.last_bar_date(yf_symbol, PRICE_HISTORY_INTERVAL)
+        try:
+            if last_date:
+                hist = resilience.guarded("yfinance", stock.history, start=last_date, interval=PRICE_HISTORY_INTERVAL)
+            else:
+                hist = resilience.guarded("yfinance", stock.history, period="5y", interval=PRICE_HISTORY_INTERVAL)
+            bars = _bars_from_history(hist) if hist is not None and not hist.empty else []
+            store.upsert_bars(yf_symbol, PRICE_HISTORY_INTERVAL, bars, checked_at=now.timestamp())
+        except Exception as e:
+            print(f"      ⚠️ {yf_symbol} K线更新失败，使用本地K线: {e}")
+        return True
+
+    _, updated = fill_cache_once(f"price_bars-{yf_symbol}", fresh, update)
+    metrics.inc(metrics.CACHE_LOOKUPS, cache="price_bars", result="miss" if updated else "hit")
+
+    since = (now - datetime.timedelta(days=PRICE_HISTORY_DAYS)).strftime("%Y-%m-%d")
+    bars = store.get_bars(yf_symbol, PRICE_HISTORY_INTERVAL, since=since)
+    return pd.Series([bar[4] for bar in bars], index=[bar[0] for bar in bars], dtype=float).dropna()
+
+
+def price_proxy_pe_percentile(closes, current_pe, trailing_eps):
+    """
+    用历史收盘价近似历史 PE，计算当前 PE 的百分位：历史PE = 收盘价 / EPS
+    有 trailingEps 时直接使用，否则用最新收盘价 / 当前PE 反推 EPS
+    返回：
+        (百分位, 是否为估算EPS)；无法计算时百分位为 None
+    """
+    if closes is None or closes.empty:
+        return None, False
+    estimated = trailing_eps is None or trailing_eps == 0
+    if estimated:
+        current_price_for_calc = closes.iloc[-1]
+        if not (current_price_for_calc > 0 and current_pe > 0):
+            return None, True
+        eps = current_price_for_calc / current_pe
+    else:
+        eps = float(trailing_eps)
+    hist_pe_ratios = closes / eps
+    hist_pe_ratios = hist_pe_ratios[hist_pe_ratios > 0]
+    if hist_pe_ratios.empty:
+        return None, estimated
+    return float((hist_pe_ratios < current_pe).sum()) / len(hist_pe_ratios) * 100, estimated
+
+
+@shared_lookup
+def get_qdii_reference_pe(us_etf_ticker):
+    """
+    QDII ETF 参考的美股 ETF（如 QQQ/SPY）的 (PE, PE百分位)
+    PE 来自 yfinance info；PE百分位用本地K线库中的5年月线近似（见 price_proxy_pe_percentile）
+    """
+    if not yf:
+        return None, None
+    us_etf_stock = _yf_ticker(us_etf_ticker)
+    us_etf_info = resilience.guarded("yfinance", lambda: us_etf_stock.info)
+    us_pe = us_etf_info.get("trailingPE") or us_etf_info.get("forwardPE")
+    if us_pe is None:
+        return None, None
+    us_pe = float(us_pe)
+    try:
+        closes = get_history_closes(us_etf_ticker, us_etf_stock, market_calendar.US)
+        us_pe_percentile, _ = price_proxy_pe_percentile(closes, us_pe, us_etf_info.get("trailingEps"))
+    except Exception as e:
+        print(f"      [QDII ETF] 计算{us_etf_ticker} PE百分位失败: {e}")
+        us_pe_percentile = None
+    return us_pe, us_pe_percentile
+
+
+def download_yf_prices(yf_symbols):
+    """一次 yf.download 请求获取多个代码最近几天的日线（用于批量获取最新价）"""
+    if not yf:
+        return None
+    return cassette.call("yf.download", lambda symbols: resilience.guarded(
+        "yfinance", yf.download, symbols, period="5d", interval="1d", group_by="ticker",
+        auto_adjust=False, progress=False, threads=True), list(yf_symbols))
+
 def auto_detect_currency(ticker_name):
     """
     根据股票代码后缀，自动判断使用什么货币结算
@@ -321,6 +614,7 @@ def auto_detect_currency(ticker_name):
     else:
         return "USD"  # 美股/加密货币/默认
 
+@cassette.tape("get_price_from_akshare", ignore=("spot_cache", "etf_cache"))
 def get_price_from_akshare(ticker_symbol, spot_cache=None, etf_cache=None):
     """
     使用 akshare 获取中国基金价格（备选数据源）
@@ -347,20 +641,13 @@ def get_price_from_akshare(ticker_symbol, spot_cache=None, etf_cache=None):
         
         # 方法1: 尝试使用实时行情接口（东方财富 - ETF基金）
         # 优先查缓存
-        if etf_cache is not None and ticker_symbol in etf_cache:
-            row = etf_cache[ticker_symbol]
-            for field in ['最新价', '收盘', '现价', 'close', 'current']:
-                val = row.get(field)
-                if val is not None and val != '-' and val != '':
-                    try:
-                        return float(val)
-                    except:
-                        continue
+        if etf_cache is not None and ticker_symbol in etf_cache and etf_cache[ticker_symbol].last:
+            return etf_cache[ticker_symbol].last
         
         # 如果缓存没命中且没传缓存，才去请求
         if etf_cache is None:
             try:
-                df = ak.fund_etf_spot_em()
+                df = call_akshare("fund_etf_spot_em")
                 if df is not None and not df.empty:
                     # 查找匹配的代码（精确匹配）
                     match = df[df['代码'] == ticker_symbol]
@@ -374,7 +661,7 @@ def get_price_from_akshare(ticker_symbol, spot_cache=None, etf_cache=None):
                             if price is not None and price != '-' and price != '':
                                 try:
                                     return float(price)
-                                except:
+                                except Exception:
                                     continue
             except Exception as e:
                 pass
@@ -383,7 +670,7 @@ def get_price_from_akshare(ticker_symbol, spot_cache=None, etf_cache=None):
         if ticker_symbol.startswith('10'):
             try:
                 # 尝试获取债券基金行情（使用股票接口，因为债券基金可能也在那里）
-                df = ak.bond_zh_hs_daily(symbol=ticker_symbol)
+                df = call_akshare("bond_zh_hs_daily", symbol=ticker_symbol)
                 if df is not None and not df.empty:
                     for field in ['收盘', 'close', '收盘价', '最新价']:
                         if field in df.columns:
@@ -391,25 +678,18 @@ def get_price_from_akshare(ticker_symbol, spot_cache=None, etf_cache=None):
                             if close_price is not None:
                                 try:
                                     return float(close_price)
-                                except:
+                                except Exception:
                                     continue
-            except:
+            except Exception:
                 pass
         
         # 方法2: 尝试使用股票实时行情（有些ETF和债券基金可能在这里）
-        if spot_cache is not None and ticker_symbol in spot_cache:
-            row = spot_cache[ticker_symbol]
-            for field in ['最新价', '收盘', '现价', 'current', 'close']:
-                val = row.get(field)
-                if val is not None and val != '-' and val != '':
-                    try:
-                        return float(val)
-                    except:
-                        continue
+        if spot_cache is not None and ticker_symbol in spot_cache and spot_cache[ticker_symbol].last:
+            return spot_cache[ticker_symbol].last
         
         if spot_cache is None:
             try:
-                df = ak.stock_zh_a_spot_em()
+                df = call_akshare("stock_zh_a_spot_em")
                 if df is not None and not df.empty:
                     match = df[df['代码'] == ticker_symbol]
                     if not match.empty:
@@ -418,9 +698,9 @@ def get_price_from_akshare(ticker_symbol, spot_cache=None, etf_cache=None):
                             if price is not None and price != '-' and price != '':
                                 try:
                                     return float(price)
-                                except:
+                                except Exception:
                                     continue
-            except:
+            except Exception:
                 pass
         
         # --- 优化：针对 0 开头的代码（通常是开放式基金），优先尝试开放式基金接口 ---
@@ -428,7 +708,7 @@ def get_price_from_akshare(ticker_symbol, spot_cache=None, etf_cache=None):
         if ticker_symbol.startswith('0'):
             # 场外基金：使用 fund_open_fund_info_em 获取净值走势（注意：参数名是 symbol 不是 fund）
             try:
-                df = ak.fund_open_fund_info_em(symbol=ticker_symbol, indicator="单位净值走势")
+                df = call_akshare("fund_open_fund_info_em", symbol=ticker_symbol, indicator="单位净值走势")
                 if df is not None and not df.empty:
                     # 尝试多个可能的字段名
                     for field in ['净值', 'y', 'nav', '单位净值']:
@@ -439,7 +719,7 @@ def get_price_from_akshare(ticker_symbol, spot_cache=None, etf_cache=None):
                                     price = float(nav)
                                     print(f"      [场外基金] 从 fund_open_fund_info_em 获取净值: {price}")
                                     return price
-                                except:
+                                except Exception:
                                     continue
                     print(f"      [场外基金] fund_open_fund_info_em 数据字段: {df.columns.tolist()}")
                     print(f"      [场外基金] 未找到有效净值字段")
@@ -456,7 +736,7 @@ def get_price_from_akshare(ticker_symbol, spot_cache=None, etf_cache=None):
             end_date = datetime.datetime.now().strftime("%Y%m%d")
             start_date = (datetime.datetime.now() - timedelta(days=5)).strftime("%Y%m%d")
             
-            df = ak.fund_etf_hist_em(
+            df = call_akshare("fund_etf_hist_em", 
                 symbol=ticker_symbol,
                 period="daily",
                 start_date=start_date,
@@ -471,7 +751,7 @@ def get_price_from_akshare(ticker_symbol, spot_cache=None, etf_cache=None):
                         if close_price is not None:
                             try:
                                 return float(close_price)
-                            except:
+                            except Exception:
                                 continue
         except Exception as e:
             pass
@@ -479,7 +759,7 @@ def get_price_from_akshare(ticker_symbol, spot_cache=None, etf_cache=None):
         # 方法4: 尝试使用新浪接口（备选）
         if full_code:
             try:
-                df = ak.fund_etf_hist_sina(symbol=full_code, period="daily", adjust="qfq")
+                df = call_akshare("fund_etf_hist_sina", symbol=full_code, period="daily", adjust="qfq")
                 if df is not None and not df.empty:
                     # 返回最新收盘价
                     for field in ['close', '收盘', '收盘价']:
@@ -488,14 +768,14 @@ def get_price_from_akshare(ticker_symbol, spot_cache=None, etf_cache=None):
                             if close_price is not None:
                                 try:
                                     return float(close_price)
-                                except:
+                                except Exception:
                                     continue
-            except:
+            except Exception:
                 pass
         
         # 方法5: 尝试使用ETF基金净值接口
         try:
-            df = ak.fund_etf_fund_info_em(fund=ticker_symbol, indicator="单位净值走势")
+            df = call_akshare("fund_etf_fund_info_em", fund=ticker_symbol, indicator="单位净值走势")
             if df is not None and not df.empty:
                 # 获取最新净值
                 for field in ['净值', '单位净值', 'nav']:
@@ -504,16 +784,16 @@ def get_price_from_akshare(ticker_symbol, spot_cache=None, etf_cache=None):
                         if nav is not None:
                             try:
                                 return float(nav)
-                            except:
+                            except Exception:
                                 continue
-        except:
+        except Exception:
             pass
 
         # 方法6: 尝试作为开放式基金获取净值 (通用兜底，不限制代码前缀)
         # 即使上面针对0开头尝试过，如果失败了，这里作为最后的兜底再试一次也无妨
         # 且对于非0开头的开放式基金（极少见但可能存在），这里是唯一入口
         try:
-            df = ak.fund_open_fund_daily_em(symbol=ticker_symbol)
+            df = call_akshare("fund_open_fund_daily_em", symbol=ticker_symbol)
             if df is not None and not df.empty:
                 for field in ['单位净值', 'nav']:
                     if field in df.columns:
@@ -521,13 +801,13 @@ def get_price_from_akshare(ticker_symbol, spot_cache=None, etf_cache=None):
                         if nav is not None:
                             try:
                                 return float(nav)
-                            except:
+                            except Exception:
                                 continue
-        except:
+        except Exception:
             pass
         
         try:
-            df = ak.fund_open_fund_info_em(fund=ticker_symbol, indicator="单位净值走势")
+            df = call_akshare("fund_open_fund_info_em", fund=ticker_symbol, indicator="单位净值走势")
             if df is not None and not df.empty:
                 for field in ['y', 'nav', '单位净值']:
                     if field in df.columns:
@@ -535,23 +815,23 @@ def get_price_from_akshare(ticker_symbol, spot_cache=None, etf_cache=None):
                         if nav is not None:
                             try:
                                 return float(nav)
-                            except:
+                            except Exception:
                                 continue
-        except:
+        except Exception:
             pass
         
         # 方法7: 尝试作为货币基金获取净值 (针对货币基金)
         try:
-            df = ak.fund_money_fund_daily_em(symbol=ticker_symbol)
+            df = call_akshare("fund_money_fund_daily_em", symbol=ticker_symbol)
             if df is not None and not df.empty:
                 # 货币基金通常净值为1
                 return 1.0
-        except:
+        except Exception:
             pass
 
         # 方法8: 尝试作为理财型基金
         try:
-            df = ak.fund_financial_fund_daily_em(symbol=ticker_symbol)
+            df = call_akshare("fund_financial_fund_daily_em", symbol=ticker_symbol)
             if df is not None and not df.empty:
                 for field in ['单位净值', 'nav']:
                     if field in df.columns:
@@ -559,9 +839,9 @@ def get_price_from_akshare(ticker_symbol, spot_cache=None, etf_cache=None):
                         if nav is not None:
                             try:
                                 return float(nav)
-                            except:
+                            except Exception:
                                 continue
-        except:
+        except Exception:
             pass
             
     except Exception as e:
@@ -571,50 +851,63 @@ def get_price_from_akshare(ticker_symbol, spot_cache=None, etf_cache=None):
     return None
 
 
+@warm_cache.memoize(warm_cache.MONTHLY)
+@cassette.tape("get_hk_pe_series_cached")
 def get_hk_pe_series_cached(symbol):
-    """从 akshare 获取港股历史 PE 数据并缓存到本地"""
+    """从 akshare 获取港股历史 PE 数据并缓存到本地状态库"""
     symbol = symbol.replace(".HK", "").zfill(5)
-    cache_file = os.path.join(CACHE_DIR, f"{symbol}_pe.csv")
-    if os.path.exists(cache_file):
-        df = pd.read_csv(cache_file)
-        return df['pe_ratio']
-    
-    try:
-        if hasattr(ak, 'stock_hk_indicator'):
-            df = ak.stock_hk_indicator(symbol=symbol)
-            if not df.empty:
-                df[['trade_date', 'pe_ratio']].to_csv(cache_file, index=False)
-                return df['pe_ratio']
-    except Exception as e:
-        print(f"抓取港股{symbol}历史PE失败：{e}")
-    
-    return pd.Series([])
+    store = get_state_store()
+
+    def fetch():
+        try:
+            if hasattr(ak, 'stock_hk_indicator'):
+                df = call_akshare("stock_hk_indicator", symbol=symbol)
+                if not df.empty:
+                    store.upsert_series("hk_pe_ratio", symbol, zip(df['trade_date'].astype(str), df['pe_ratio']))
+                    return df['pe_ratio']
+        except Exception as e:
+            print(f"抓取港股{symbol}历史PE失败：{e}")
+        return pd.Series([])
+
+    points, fetched = fill_cache_once(f"hk_pe_ratio-{symbol}", lambda: store.get_series("hk_pe_ratio", symbol), fetch)
+    metrics.inc(metrics.CACHE_LOOKUPS, cache="pe_series", result="miss" if fetched else "hit")
+    if fetched:
+        return points
+    return pd.Series([value for _, value in points], dtype=float, name='pe_ratio')
 
 
+@warm_cache.memoize(warm_cache.MONTHLY)
+@cassette.tape("get_pe_series_cached")
 def get_pe_series_cached(symbol):
-    """从 akshare 获取历史 PE 数据并缓存到本地"""
+    """从 akshare 获取历史 PE 数据并缓存到本地状态库"""
     # 过滤非股票代码（简单的判断：ETF/基金通常以1, 5开头，债券基金等）
     # A股股票通常以 0, 3, 6, 4, 8 开头
     if not (symbol.startswith('0') or symbol.startswith('3') or symbol.startswith('6') or symbol.startswith('4') or symbol.startswith('8')):
          return pd.Series([])
 
-    cache_file = os.path.join(CACHE_DIR, f"{symbol}_pe.csv")
-    if os.path.exists(cache_file):
-        df = pd.read_csv(cache_file)
-        return df['pe_ttm']
-    
-    try:
-        if hasattr(ak, 'stock_a_lg_indicator'):
-            df = ak.stock_a_lg_indicator(symbol=symbol)
-            if not df.empty:
-                df[['date', 'pe_ttm']].to_csv(cache_file, index=False)
-                return df['pe_ttm']
-    except Exception as e:
-        print(f"抓取{symbol}历史PE失败：{e}")
-    
-    return pd.Series([])
+    store = get_state_store()
+
+    def fetch():
+        try:
+            if hasattr(ak, 'stock_a_lg_indicator'):
+                df = call_akshare("stock_a_lg_indicator", symbol=symbol)
+                if not df.empty:
+                    store.upsert_series("pe_ttm", symbol, zip(df['date'].astype(str), df['pe_ttm']))
+                    return df['pe_ttm']
+        except Exception as e:
+            print(f"抓取{symbol}历史PE失败：{e}")
+        return pd.Series([])
+
+    points, fetched = fill_cache_once(f"pe_ttm-{symbol}", lambda: store.get_series("pe_ttm", symbol), fetch)
+    metrics.inc(metrics.CACHE_LOOKUPS, cache="pe_series", result="miss" if fetched else "hit")
+    if fetched:
+        return points
+    return pd.Series([value for _, value in points], dtype=float, name='pe_ttm')
 
 
+@warm_cache.memoize(warm_cache.MONTHLY)
+@shared_lookup
+@cassette.tape("get_hk_etf_index_pe")
 def get_hk_etf_index_pe(etf_code):
     """
     获取港股ETF对应的恒生指数PE和PE百分位
@@ -648,8 +941,12 @@ def get_hk_etf_index_pe(etf_code):
             'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36'
         }
 
-        response = requests.get(url, headers=headers, timeout=10)
-        response.raise_for_status()
+        def fetch_page():
+            response = requests.get(url, headers=headers, timeout=10)
+            response.raise_for_status()
+            return response
+
+        response = resilience.guarded("legulegu", fetch_page)
 
         soup = BeautifulSoup(response.text, 'html.parser')
 
@@ -695,6 +992,9 @@ def get_hk_etf_index_pe(etf_code):
         return None, None
 
 
+@warm_cache.memoize(warm_cache.MONTHLY)
+@shared_lookup
+@cassette.tape("get_hk_index_pb_from_etf")
 def get_hk_index_pb_from_etf(index_code):
     """
     通过港股 ETF 获取恒生指数的 PB（市净率）
@@ -709,11 +1009,12 @@ def get_hk_index_pb_from_etf(index_code):
         # 目前只支持恒生指数
         return None
 
-    try:
-        import yfinance as yf
+    if yf is None:
+        return None
 
+    try:
         # 使用盈富基金 2800.HK 的 PB 作为恒生指数 PB 的代理
-        ticker = yf.Ticker('2800.HK')
+        ticker = _yf_ticker('2800.HK')
         info = ticker.info
         pb = info.get('priceToBook')
 
@@ -728,6 +1029,9 @@ def get_hk_index_pb_from_etf(index_code):
         return None
 
 
+@warm_cache.memoize(warm_cache.MONTHLY)
+@shared_lookup
+@cassette.tape("_get_pe_from_legulegu")
 def _get_pe_from_legulegu(symbol, index_name):
     """
     从乐咕乐股获取指数PE数据
@@ -743,7 +1047,7 @@ def _get_pe_from_legulegu(symbol, index_name):
     pb_percentile = None
 
     try:
-        df = ak.stock_index_pe_lg(symbol=symbol)
+        df = call_akshare("stock_index_pe_lg", symbol=symbol)
         if df is not None and not df.empty:
             # 获取最新滚动市盈率
             pe = df['滚动市盈率'].iloc[-1]
@@ -768,7 +1072,7 @@ def _get_pe_from_legulegu(symbol, index_name):
 
     # 尝试获取PB数据
     try:
-        df_pb = ak.stock_index_pb_lg(symbol=symbol)
+        df_pb = call_akshare("stock_index_pb_lg", symbol=symbol)
         if df_pb is not None and not df_pb.empty:
             pb = df_pb['市净率'].iloc[-1]
             if pb is not None:
@@ -788,6 +1092,9 @@ def _get_pe_from_legulegu(symbol, index_name):
     return pe, pb, pe_percentile, pb_percentile
 
 
+@warm_cache.memoize(warm_cache.MONTHLY)
+@shared_lookup
+@cassette.tape("_get_market_pe_from_legulegu")
 def _get_market_pe_from_legulegu(symbol, market_name):
     """
     从乐咕乐股获取市场整体PE数据（使用 stock_market_pe_lg 接口）
@@ -798,7 +1105,7 @@ def _get_market_pe_from_legulegu(symbol, market_name):
     pb_percentile = None
 
     try:
-        df = ak.stock_market_pe_lg(symbol=symbol)
+        df = call_akshare("stock_market_pe_lg", symbol=symbol)
         if df is not None and not df.empty:
             pe = df['平均市盈率'].iloc[-1]
             if pe is not None:
@@ -822,6 +1129,9 @@ def _get_market_pe_from_legulegu(symbol, market_name):
     return pe, pb, pe_percentile, pb_percentile
 
 
+@warm_cache.memoize(warm_cache.MONTHLY)
+@shared_lookup
+@cassette.tape("get_etf_index_pe_pb")
 def get_etf_index_pe_pb(etf_code):
     """
     获取ETF对应指数的PE、PB和PE/PB百分位
@@ -872,7 +1182,7 @@ def get_etf_index_pe_pb(etf_code):
         end_date = datetime.now().strftime('%Y%m%d')
         start_date = (datetime.now() - timedelta(days=3650)).strftime('%Y%m%d')  # 10年前
 
-        df = ak.stock_zh_index_hist_csindex(symbol=index_code, start_date=start_date, end_date=end_date)
+        df = call_akshare("stock_zh_index_hist_csindex", symbol=index_code, start_date=start_date, end_date=end_date)
         if df is not None and not df.empty:
             latest = df.iloc[-1]
             pe = latest.get('滚动市盈率')
@@ -907,7 +1217,7 @@ def get_etf_index_pe_pb(etf_code):
         index_name = index_name_map.get(index_code)
 
         if index_name:
-            df_pb = ak.stock_index_pb_lg(symbol=index_name)
+            df_pb = call_akshare("stock_index_pb_lg", symbol=index_name)
             if df_pb is not None and not df_pb.empty:
                 latest_pb = df_pb.iloc[-1]['市净率']
                 if latest_pb is not None:
@@ -928,6 +1238,7 @@ def get_etf_index_pe_pb(etf_code):
     return pe, pb, pe_percentile, pb_percentile
 
 
+@warm_cache.memoize(warm_cache.DAILY, ignore=("stock",))
 def get_pb_ratio(ticker_symbol, calc_currency, stock):
     """
     获取市净率（PB）
@@ -943,7 +1254,7 @@ def get_pb_ratio(ticker_symbol, calc_currency, stock):
     # 方法1: 从yfinance获取（适用于美股、港股）
     if stock and calc_currency in ['USD', 'HKD']:
         try:
-            stock_info = stock.info
+            stock_info = resilience.guarded("yfinance", lambda: stock.info)
             pb_ratio = stock_info.get('priceToBook')
             if pb_ratio is not None:
                 try:
@@ -960,6 +1271,29 @@ def get_pb_ratio(ticker_symbol, calc_currency, stock):
     return pb_ratio
 
 
+def get_cn_financial_indicator(symbol):
+    """
+    A股最新一期财务指标 {字段: 值}（ROE、PEG 等都来自这里）
+    每只股票每天最多请求一次 stock_financial_analysis_indicator，结果保存在本地状态库
+    """
+    store = get_state_store()
+
+    def fetch():
+        df = call_akshare("stock_financial_analysis_indicator", symbol=symbol)
+        if df is None or df.empty:
+            return {}
+        latest = df.iloc[-1].to_dict()
+        store.put_fundamentals(symbol, latest)
+        return latest
+
+    latest, fetched = fill_cache_once(f"fundamentals-{symbol}", lambda: store.get_fundamentals(symbol, fresh_after=start_of_today()),
+                                      fetch, is_missing=lambda value: value is None)
+    metrics.inc(metrics.CACHE_LOOKUPS, cache="fundamentals", result="miss" if fetched else "hit")
+    return latest
+
+
+@warm_cache.memoize(warm_cache.DAILY, ignore=("stock", "spot_cache", "hk_cache"))
+@cassette.tape("get_roe", ignore=("stock", "spot_cache", "hk_cache"))
 def get_roe(ticker_symbol, calc_currency, stock, spot_cache, hk_cache):
     """
     获取净资产收益率（ROE）
@@ -977,7 +1311,7 @@ def get_roe(ticker_symbol, calc_currency, stock, spot_cache, hk_cache):
     # 方法1: 从yfinance获取（适用于美股、港股）
     if stock and calc_currency in ['USD', 'HKD']:
         try:
-            stock_info = stock.info
+            stock_info = resilience.guarded("yfinance", lambda: stock.info)
             roe_value = stock_info.get('returnOnEquity')
             if roe_value is not None:
                 try:
@@ -1002,12 +1336,12 @@ def get_roe(ticker_symbol, calc_currency, stock, spot_cache, hk_cache):
     if roe is None and calc_currency == 'CNY' and AKSHARE_AVAILABLE:
         try:
             # 使用股票财务指标接口获取ROE
-            df = ak.stock_financial_analysis_indicator(symbol=ticker_symbol)
-            if df is not None and not df.empty:
+            latest = get_cn_financial_indicator(ticker_symbol)
+            if latest:
                 # 获取最新的ROE数据（优先使用加权净资产收益率）
                 for field in ['加权净资产收益率(%)', '净资产收益率(%)', 'ROE']:
-                    if field in df.columns:
-                        latest_roe = df.iloc[-1].get(field) if len(df) > 0 else None
+                    if field in latest:
+                        latest_roe = latest.get(field)
                         if latest_roe is not None and str(latest_roe) != 'nan' and latest_roe != '-':
                             try:
                                 roe = float(latest_roe)
@@ -1018,27 +1352,13 @@ def get_roe(ticker_symbol, calc_currency, stock, spot_cache, hk_cache):
         except Exception as e:
             pass  # 静默失败，很多股票可能没有财务数据
 
-    # 方法3: 从akshare获取港股ROE（hk_cache可能有ROE字段）
-    if roe is None and calc_currency == 'HKD' and AKSHARE_AVAILABLE:
-        hk_code = ticker_symbol.replace(".HK", "").zfill(5)
-        if hk_code in hk_cache:
-            try:
-                row = hk_cache[hk_code]
-                for field in ['ROE', 'roe', '净资产收益率', '加权净资产收益率']:
-                    roe_value = row.get(field)
-                    if roe_value is not None and roe_value != '-' and str(roe_value) != 'nan':
-                        try:
-                            roe = float(roe_value)
-                            print(f"      [港股] 从hk_cache获取ROE: {roe:.2f}%")
-                            break
-                        except:
-                            continue
-            except Exception as e:
-                pass
+    # 注意：港股行情快照（hk_cache）中没有ROE字段
 
     return roe
 
 
+@warm_cache.memoize(warm_cache.DAILY, ignore=("stock", "spot_cache", "hk_cache"))
+@cassette.tape("get_peg", ignore=("stock", "spot_cache", "hk_cache"))
 def get_peg(ticker_symbol, calc_currency, stock, spot_cache, hk_cache):
     """
     获取PEG比率（Price/Earnings to Growth ratio，市盈率相对盈利增长比率）
@@ -1057,7 +1377,7 @@ def get_peg(ticker_symbol, calc_currency, stock, spot_cache, hk_cache):
     # 方法1: 从yfinance获取（适用于美股、港股）
     if stock and calc_currency in ['USD', 'HKD']:
         try:
-            stock_info = stock.info
+            stock_info = resilience.guarded("yfinance", lambda: stock.info)
             # 优先使用trailingPegRatio，因为pegRatio通常为None
             peg_value = stock_info.get('trailingPegRatio') or stock_info.get('pegRatio')
             if peg_value is not None:
@@ -1074,12 +1394,12 @@ def get_peg(ticker_symbol, calc_currency, stock, spot_cache, hk_cache):
     if peg is None and calc_currency == 'CNY' and AKSHARE_AVAILABLE:
         try:
             # 使用股票财务指标接口获取PEG
-            df = ak.stock_financial_analysis_indicator(symbol=ticker_symbol)
-            if df is not None and not df.empty:
+            latest = get_cn_financial_indicator(ticker_symbol)
+            if latest:
                 # 获取最新的PEG数据
                 for field in ['PEG比率', 'PEG', 'peg']:
-                    if field in df.columns:
-                        latest_peg = df.iloc[-1].get(field) if len(df) > 0 else None
+                    if field in latest:
+                        latest_peg = latest.get(field)
                         if latest_peg is not None and str(latest_peg) != 'nan' and latest_peg != '-':
                             try:
                                 peg = float(latest_peg)
@@ -1090,27 +1410,14 @@ def get_peg(ticker_symbol, calc_currency, stock, spot_cache, hk_cache):
         except Exception as e:
             pass  # 静默失败，很多股票可能没有财务数据
 
-    # 方法3: 从akshare获取港股PEG（hk_cache可能有PEG字段）
-    if peg is None and calc_currency == 'HKD' and AKSHARE_AVAILABLE:
-        hk_code = ticker_symbol.replace(".HK", "").zfill(5)
-        if hk_code in hk_cache:
-            try:
-                row = hk_cache[hk_code]
-                for field in ['PEG', 'peg', 'PEG比率']:
-                    peg_value = row.get(field)
-                    if peg_value is not None and peg_value != '-' and str(peg_value) != 'nan':
-                        try:
-                            peg = float(peg_value)
-                            print(f"      [港股] 从hk_cache获取PEG: {peg:.2f}")
-                            break
-                        except:
-                            continue
-            except Exception as e:
-                pass
+    # 注意：港股行情快照（hk_cache）中没有PEG字段
 
     return peg
 
 
+@warm_cache.memoize(warm_cache.DAILY)
+@shared_lookup
+@cassette.tape("calculate_fund_nav_growth")
 def calculate_fund_nav_growth(fund_code):
     """
     计算基金净值增长率
@@ -1131,7 +1438,7 @@ def calculate_fund_nav_growth(fund_code):
         import pandas as pd
         from datetime import datetime, timedelta
 
-        df = ak.fund_open_fund_info_em(symbol=fund_code, indicator='单位净值走势')
+        df = call_akshare("fund_open_fund_info_em", symbol=fund_code, indicator='单位净值走势')
         if df is None or df.empty:
             return {}
 
@@ -1170,780 +1477,1214 @@ def get_name_price(symbol, currency, spot_cache, etf_cache, hk_cache, open_fund_
     # A股
     if currency == "CNY":
         if symbol in spot_cache:
-            row = spot_cache[symbol]; return row.get('名称', ''), row.get('最新价', None)
+            record = spot_cache[symbol]; return record.name, record.last
         if symbol in etf_cache:
-            row = etf_cache[symbol]; return row.get('名称', ''), row.get('最新价', None)
+            record = etf_cache[symbol]; return record.name, record.last
         if symbol in open_fund_cache:
             # 开放式基金列表没有实时价格，只有名称
-            row = open_fund_cache[symbol]; return row.get('基金简称', ''), None
+            return open_fund_cache[symbol].name, None
     # 港股
     if currency == "HKD":
         hk_code = symbol.replace(".HK", "").zfill(5)
         if hk_code in hk_cache:
-            row = hk_cache[hk_code]; return row.get('名称', ''), row.get('最新价', None)
+            record = hk_cache[hk_code]; return record.name, record.last
     return '', None
 
 
-def update_portfolio():
-    if not notion:
-        raise ValueError("❌ 错误: 未找到 NOTION_TOKEN 或 DATABASE_ID 环境变量")
-
-    # 1. 获取汇率
-    rates = get_exchange_rates()
-    
-    # 2. 预加载 Akshare 行情数据 (加速查询)
-    spot_cache = {}
-    etf_cache = {}
-    hk_cache = {}
-    open_fund_cache = {}
-    
-    if AKSHARE_AVAILABLE:
-        print("🚀 正在预加载 A股/ETF/港股 行情数据 (加速查询)...")
-        os.makedirs(AKSHARE_CACHE_DIR, exist_ok=True)
-        
-        # --- A股行情缓存 ---
-        spot_cache_file = os.path.join(AKSHARE_CACHE_DIR, "spot_cache.pkl")
-        try:
-            if os.path.exists(spot_cache_file) and datetime.date.fromtimestamp(os.path.getmtime(spot_cache_file)) == datetime.date.today():
-                with open(spot_cache_file, 'rb') as f:
-                    spot_cache = pickle.load(f)
-                print(f"   - (缓存) 已加载 {len(spot_cache)} 只A股行情")
-            else:
-                df_spot = ak.stock_zh_a_spot_em()
-                if df_spot is not None and not df_spot.empty:
-                    spot_cache = {str(row['代码']): row for _, row in df_spot.iterrows()}
-                    with open(spot_cache_file, 'wb') as f: pickle.dump(spot_cache, f)
-                print(f"   - (实时) 已缓存 {len(spot_cache)} 只A股行情")
-        except Exception as e:
-            print(f"   ⚠️ 预加载A股行情失败: {e}")
+def preload_akshare_cache(cache_name, api_name, code_field, unit, label, market):
+    """
+    预加载 akshare 全市场行情快照为 {代码: QuoteRecord} 字典（见 quote_record.py），并缓存到本地状态库（快照名为 cache_name）
+    缓存在 market 下一次收盘前有效；常驻模式下同时保存在内存中
+    参数：
+        cache_name: 快照名
+        api_name: akshare 接口名，如 'stock_zh_a_spot_em'
+        code_field: 代码列名
+        unit / label: 日志文案
+        market: 快照所属市场（market_calendar.CN / HK），决定缓存何时失效
+    """
+    if warm_cache.is_active():
+        return warm_cache.cached(
+            warm_cache.SESSION, f"snapshot[{cache_name}]",
+            lambda: _load_akshare_snapshot(cache_name, api_name, code_field, unit, label, market),
+            market=market,
+        )
+    return _load_akshare_snapshot(cache_name, api_name, code_field, unit, label, market)
 
-        # --- ETF行情缓存 ---
-        etf_cache_file = os.path.join(AKSHARE_CACHE_DIR, "etf_cache.pkl")
-        try:
-            if os.path.exists(etf_cache_file) and datetime.date.fromtimestamp(os.path.getmtime(etf_cache_file)) == datetime.date.today():
-                with open(etf_cache_file, 'rb') as f:
-                    etf_cache = pickle.load(f)
-                print(f"   - (缓存) 已加载 {len(etf_cache)} 只ETF行情")
-            else:
-                df_etf = ak.fund_etf_spot_em()
-                if df_etf is not None and not df_etf.empty:
-                    etf_cache = {str(row['代码']): row for _, row in df_etf.iterrows()}
-                    with open(etf_cache_file, 'wb') as f: pickle.dump(etf_cache, f)
-                print(f"   - (实时) 已缓存 {len(etf_cache)} 只ETF行情")
-        except Exception as e:
-            print(f"   ⚠️ 预加载ETF行情失败: {e}")
-            
-        # --- 港股行情缓存 ---
-        hk_cache_file = os.path.join(AKSHARE_CACHE_DIR, "hk_cache.pkl")
-        try:
-            if os.path.exists(hk_cache_file) and datetime.date.fromtimestamp(os.path.getmtime(hk_cache_file)) == datetime.date.today():
-                with open(hk_cache_file, 'rb') as f:
-                    hk_cache = pickle.load(f)
-                print(f"   - (缓存) 已加载 {len(hk_cache)} 只港股行情")
-            else:
-                df_hk = ak.stock_hk_spot_em()
-                if df_hk is not None and not df_hk.empty:
-                    hk_cache = {str(row['代码']): row for _, row in df_hk.iterrows()}
-                    with open(hk_cache_file, 'wb') as f: pickle.dump(hk_cache, f)
-                print(f"   - (实时) 已缓存 {len(hk_cache)} 只港股行情")
-        except Exception as e:
-            print(f"   ⚠️ 预加载港股行情失败: {e}")
-            
-        # --- 开放式基金名称缓存 ---
-        open_fund_cache_file = os.path.join(AKSHARE_CACHE_DIR, "open_fund_cache.pkl")
-        try:
-            if os.path.exists(open_fund_cache_file) and datetime.date.fromtimestamp(os.path.getmtime(open_fund_cache_file)) == datetime.date.today():
-                with open(open_fund_cache_file, 'rb') as f:
-                    open_fund_cache = pickle.load(f)
-                print(f"   - (缓存) 已加载 {len(open_fund_cache)} 只开放式基金名称")
-            else:
-                df_open_fund = ak.fund_name_em()
-                if df_open_fund is not None and not df_open_fund.empty:
-                    open_fund_cache = {str(row['基金代码']): row for _, row in df_open_fund.iterrows()}
-                    with open(open_fund_cache_file, 'wb') as f: pickle.dump(open_fund_cache, f)
-                print(f"   - (实时) 已缓存 {len(open_fund_cache)} 只开放式基金名称")
-        except Exception as e:
-            print(f"   ⚠️ 预加载开放式基金列表失败: {e}")
 
-    # 3. 查询 Notion 数据库
-    print(f"📥 正在查询 Notion 数据库: {DATABASE_ID} ...")
+def _load_akshare_snapshot(cache_name, api_name, code_field, unit, label, market):
+    cache = {}
     try:
-        # 先获取数据库信息
-        database = notion.databases.retrieve(database_id=DATABASE_ID)
-        # 检查是否有数据源（多数据源数据库）
-        if 'data_sources' in database and database['data_sources']:
-            # 使用多数据源查询方式
-            data_source_id = database['data_sources'][0]['id']
-            response = notion.data_sources.query(data_source_id=data_source_id)
-            pages = response.get("results", [])
+        store = get_state_store()
+        last_close = market_calendar.last_session_close(market, datetime.datetime.now(datetime.timezone.utc))
+
+        def load():
+            # 录制/回放时以磁带为准，不读本地缓存
+            if cassette.is_active() or not last_close:
+                return {}
+            return quote_record.from_payloads(store.get_snapshot(cache_name, fresh_after=last_close.timestamp()) or {})
+
+        def fetch():
+            df = cassette.call(f"ak.{api_name}", lambda: call_akshare(api_name))
+            if df is None or df.empty:
+                return {}
+            rows = quote_record.from_records(df.to_dict('records'), code_field)
+            store.put_snapshot(cache_name, quote_record.to_payloads(rows))
+            return rows
+
+        cache, fetched = fill_cache_once(f"snapshot-{cache_name}", load, fetch)
+        metrics.inc(metrics.CACHE_LOOKUPS, cache="snapshot", result="miss" if fetched else "hit")
+        if fetched:
+            print(f"   - (实时) 已缓存 {len(cache)} {unit}")
         else:
-            # 单数据源数据库，尝试使用 search 或其他方法
-            # 注意：新版 API 可能不再支持直接 query，需要查询页面
-            raise Exception("单数据源数据库暂不支持，请使用多数据源数据库")
+            print(f"   - (缓存) 已加载 {len(cache)} {unit}")
     except Exception as e:
-        print(f"❌ Notion 连接失败: {e}")
-        return
+        print(f"   ⚠️ {label}失败: {e}")
+    return cache
+
+
+def parse_ticker_symbol(props):
+    """
+    从持仓页面属性中解析股票代码（兼容 "股票代码" 和 "Ticker" 两种列名）
+    空行返回 None；结构异常时抛出 KeyError/IndexError/AttributeError
+    """
+    ticker_obj = props.get("股票代码") or props.get("Ticker")
+    if not ticker_obj:
+        return None
+    ticker_list = ticker_obj["title"]
+    if not ticker_list:
+        return None
+    return ticker_list[0]["text"]["content"]
+
+
+def resolve_currency(props, ticker_symbol):
+    """
+    确定货币类型
+    返回：
+        (Notion 中的货币名称, 计算用货币 CNY/HKD/USD)
+    """
+    current_currency_name = "USD"  # 默认
+    try:
+        currency_prop = props.get("货币")
+        if currency_prop and currency_prop.get("select"):
+            current_currency_name = currency_prop["select"]["name"]
+        else:
+            # 如果为空，自动判断
+            current_currency_name = auto_detect_currency(ticker_symbol)
+    except:
+        current_currency_name = auto_detect_currency(ticker_symbol)
+
+    # 简单的清洗逻辑：只要包含 "CNY" 或 "人民币" 就当做 CNY
+    if "CNY" in current_currency_name or "人民币" in current_currency_name or "🇨🇳" in current_currency_name:
+        calc_currency = "CNY"
+    elif "HKD" in current_currency_name or "港币" in current_currency_name or "🇭🇰" in current_currency_name:
+        calc_currency = "HKD"
+    else:
+        calc_currency = "USD"
+    return current_currency_name, calc_currency
+
+
+def holding_market(page):
+    """持仓所属市场（CN/HK/US/CRYPTO）；无法识别股票代码时返回 None"""
+    props = page["properties"]
+    try:
+        ticker_symbol = parse_ticker_symbol(props)
+    except (KeyError, IndexError, AttributeError):
+        return None
+    if not ticker_symbol:
+        return None
+    _, calc_currency = resolve_currency(props, ticker_symbol)
+    return market_calendar.market_of(ticker_symbol, calc_currency, CRYPTO_SYMBOLS)
 
-    print(f"🔍 找到 {len(pages)} 条持仓记录，开始更新...")
 
-    check_and_notify_signal_changes(pages)
+def hk_code_of(ticker_symbol):
+    """港股代码 → 东方财富港股行情中的 5 位代码（如 0700.HK -> 00700）"""
+    return ticker_symbol.replace(".HK", "").zfill(5)
 
-    # 准备 PE 缓存目录
-    os.makedirs(CACHE_DIR, exist_ok=True)
 
-    # 4. 遍历更新股票价格
+def is_open_fund_code(ticker_symbol):
+    """0 开头的 6 位代码按场外基金处理"""
+    return ticker_symbol.startswith('0') and len(ticker_symbol) == 6 and ticker_symbol.isdigit()
+
+
+INDEX_VALUATION_FIELDS = (providers.INDEX_PE, providers.INDEX_PB, providers.INDEX_PE_PERCENTILE, providers.INDEX_PB_PERCENTILE)
+HK_INDEX_FIELDS = (providers.HK_INDEX_PE, providers.HK_INDEX_PE_PERCENTILE)
+QDII_FIELDS = (providers.QDII_PE, providers.QDII_PE_PERCENTILE)
+INDEX_VALUATION_PROVIDER = "csindex/legulegu"
+HK_INDEX_PROVIDER = "sina-hk-index"
+QDII_PROVIDER = "yfinance-qdii"
+FUND_NAV_PROVIDER = "eastmoney-fund-nav"
+PE_HISTORY_PROVIDER = "akshare-pe-history"
+HK_PE_HISTORY_PROVIDER = "akshare-hk-pe-history"
+FUNDAMENTALS_PROVIDER = "akshare-fundamentals"
+
+
+def build_providers(spot_cache, etf_cache, hk_cache):
+    """
+    持仓同步使用的数据源，按优先级排列（同一字段先返回的优先）
+    价格：yfinance 批量下载 → 东方财富 A股/ETF/港股快照；指数估值、QDII 参考 ETF 按指数/参考代码合并请求；
+    基金净值、历史 PE、财务指标没有批量接口，逐个并发请求
+    """
+    return [
+        providers.YFinanceProvider(to_yf_symbol, download_yf_prices),
+        providers.SnapshotProvider("eastmoney-a", spot_cache),
+        providers.SnapshotProvider("eastmoney-etf", etf_cache),
+        providers.SnapshotProvider("eastmoney-hk", hk_cache, to_code=hk_code_of),
+        providers.GroupedProvider(INDEX_VALUATION_PROVIDER, INDEX_VALUATION_FIELDS, ETF_INDEX_MAPPING, get_etf_index_pe_pb),
+        providers.GroupedProvider(HK_INDEX_PROVIDER, HK_INDEX_FIELDS, HK_ETF_INDEX_MAPPING, get_hk_etf_index_pe),
+        providers.GroupedProvider(QDII_PROVIDER, QDII_FIELDS, QDII_ETF_MAPPING,
+                                  lambda etf: get_qdii_reference_pe(QDII_ETF_MAPPING[etf])),
+        providers.PerSymbolProvider(FUND_NAV_PROVIDER, providers.NAV_GROWTH, is_open_fund_code, calculate_fund_nav_growth),
+        providers.PerSymbolProvider(PE_HISTORY_PROVIDER, providers.PE_HISTORY, lambda s: s in spot_cache, get_pe_series_cached),
+        # 港股代码不是 6 位数字（A股已由上一个数据源覆盖）
+        providers.PerSymbolProvider(HK_PE_HISTORY_PROVIDER, providers.PE_HISTORY,
+                                    lambda s: not (s.isdigit() and len(s) == 6), get_hk_pe_series_cached),
+        providers.PerSymbolProvider(FUNDAMENTALS_PROVIDER, providers.FUNDAMENTALS, lambda s: s in spot_cache, get_cn_financial_indicator),
+    ]
+
+
+def plan_prefetch(pages, spot_cache, etf_cache, hk_cache):
+    """
+    预取计划：读取所有持仓，按代码类型登记需要的远程数据（去重见 providers.Plan）
+    - 所有持仓：价格
+    - A股 ETF：跟踪指数的 PE/PB 及百分位；恒生系 ETF：恒生指数 PE；QDII ETF：参考美股 ETF 的 PE 及百分位
+    - 场外基金：净值增长率
+    - A股个股：历史 PE、财务指标（ROE/PEG）；港股：历史 PE
+    时间预算不足时只预取价格（与逐条处理时的 allowed() 判断一致）
+    """
+    plan = providers.Plan(build_providers(spot_cache, etf_cache, hk_cache))
+    optional = resilience.allow_optional("批量估值")
     for page in pages:
-        page_id = page["id"]
-        props = page["properties"]
-        
-        # --- 解析股票代码 ---
         try:
-            # 兼容 "股票代码" 和 "Ticker" 两种列名
-            ticker_obj = props.get("股票代码") or props.get("Ticker")
-            if not ticker_obj:
-                continue
-            ticker_list = ticker_obj["title"]
-            if not ticker_list:
-                continue  # 跳过空行
-            ticker_symbol = ticker_list[0]["text"]["content"]
+            ticker_symbol = parse_ticker_symbol(page["properties"])
         except (KeyError, IndexError, AttributeError):
-            print("⚠️ 跳过无法识别的行 (缺少股票代码)")
             continue
-        
-        # --- 确定货币类型 ---
-        current_currency_name = "USD"  # 默认
-        try:
-            currency_prop = props.get("货币")
-            if currency_prop and currency_prop.get("select"):
-                current_currency_name = currency_prop["select"]["name"]
-            else:
-                # 如果为空，自动判断
-                current_currency_name = auto_detect_currency(ticker_symbol)
-        except:
-            current_currency_name = auto_detect_currency(ticker_symbol)
-        
-        # 简单的清洗逻辑：只要包含 "CNY" 或 "人民币" 就当做 CNY
-        if "CNY" in current_currency_name or "人民币" in current_currency_name or "🇨🇳" in current_currency_name:
-            calc_currency = "CNY"
-        elif "HKD" in current_currency_name or "港币" in current_currency_name or "🇭🇰" in current_currency_name:
-            calc_currency = "HKD"
-        else:
-            calc_currency = "USD"
-        
-        # 确定汇率
-        target_rate = rates.get(calc_currency, 1.0)
+        if not ticker_symbol:
+            continue
+        _, calc_currency = resolve_currency(page["properties"], ticker_symbol)
+        fields = [providers.PRICE]
+        if optional:
+            if calc_currency == "CNY" and ticker_symbol in ETF_INDEX_MAPPING:
+                fields += INDEX_VALUATION_FIELDS
+            if ticker_symbol in HK_ETF_INDEX_MAPPING:
+                fields += HK_INDEX_FIELDS
+            if ticker_symbol in QDII_ETF_MAPPING:
+                fields += QDII_FIELDS
+            if is_open_fund_code(ticker_symbol):
+                fields.append(providers.NAV_GROWTH)
+            if (calc_currency == "CNY" and ticker_symbol in spot_cache) or calc_currency == "HKD":
+                fields.append(providers.PE_HISTORY)
+            # 财务指标只写入本地状态库（get_roe/get_peg 从状态库读取）；录制/回放时以磁带中的 get_roe/get_peg 为准
+            if calc_currency == "CNY" and ticker_symbol in spot_cache and not cassette.is_active():
+                fields.append(providers.FUNDAMENTALS)
+        plan.add(ticker_symbol, fields)
+    return plan
+
+
+def prefetch_quotes(pages, spot_cache, etf_cache, hk_cache):
+    """执行预取计划：同一批次的数据源并发请求，结果供逐条处理时使用"""
+    plan = plan_prefetch(pages, spot_cache, etf_cache, hk_cache)
+    print(plan.describe())
+    started = time.monotonic()
+    quotes = providers.execute(plan)
+    print(f"📦 预取完成: {sum(quotes.calls.values())} 次请求, {time.monotonic() - started:.1f}s")
+    return quotes
+
+
+def prefetched(quotes, provider_name, ticker_symbol, fields, load, default=None):
+    """
+    预取过该代码时使用预取结果（fields 为元组时返回元组），否则调用 load() 逐个查询
+    """
+    if quotes is None or not quotes.asked(provider_name, ticker_symbol):
+        return load()
+    if isinstance(fields, tuple):
+        return tuple(quotes.get(ticker_symbol, field) for field in fields)
+    return quotes.get(ticker_symbol, fields, default)
+
+
+def record_valuation(symbol, pe=None, pb=None, pe_percentile=None, pb_percentile=None):
+    """把当天的估值记录到每日估值轨迹（valuation_history.py）；录制/回放时不记录"""
+    if cassette.is_active():
+        return
+    try:
+        valuation_history.get_history().record(symbol, pe=pe, pb=pb, pe_percentile=pe_percentile, pb_percentile=pb_percentile)
+    except Exception as e:
+        print(f"      ⚠️ 记录 {symbol} 估值轨迹失败: {e}")
+
+
+def index_valuation(ticker_symbol, quotes=None):
+    """ETF 跟踪指数的 (PE, PB, PE百分位, PB百分位)：优先使用预取结果"""
+    values = prefetched(quotes, INDEX_VALUATION_PROVIDER, ticker_symbol, INDEX_VALUATION_FIELDS,
+                        lambda: get_etf_index_pe_pb(ticker_symbol))
+    record_valuation(valuation_history.index_symbol(ETF_INDEX_MAPPING[ticker_symbol]), *values)
+    return values
+
+
+def hk_index_pe(ticker_symbol, quotes=None):
+    """恒生指数系 ETF 的 (指数PE, PE百分位)：优先使用预取结果"""
+    values = prefetched(quotes, HK_INDEX_PROVIDER, ticker_symbol, HK_INDEX_FIELDS, lambda: get_hk_etf_index_pe(ticker_symbol))
+    index_pe, index_pe_percentile = values
+    record_valuation(valuation_history.index_symbol(HK_ETF_INDEX_MAPPING[ticker_symbol]), pe=index_pe, pe_percentile=index_pe_percentile)
+    return values
+
+
+def fund_nav_growth(ticker_symbol, quotes=None):
+    """场外基金净值增长率：优先使用预取结果"""
+    return prefetched(quotes, FUND_NAV_PROVIDER, ticker_symbol, providers.NAV_GROWTH,
+                      lambda: calculate_fund_nav_growth(ticker_symbol), default={})
+
+
+def qdii_reference_pe(ticker_symbol, quotes=None):
+    """QDII ETF 参考的美股 ETF 的 (PE, PE百分位)：优先使用预取结果"""
+    return prefetched(quotes, QDII_PROVIDER, ticker_symbol, QDII_FIELDS,
+                      lambda: get_qdii_reference_pe(QDII_ETF_MAPPING[ticker_symbol]))
+
+
+def pe_history(ticker_symbol, calc_currency, quotes=None):
+    """A股/港股历史 PE 序列：优先使用预取结果"""
+    provider_name, load = (PE_HISTORY_PROVIDER, get_pe_series_cached) if calc_currency == "CNY" else (HK_PE_HISTORY_PROVIDER, get_hk_pe_series_cached)
+    return prefetched(quotes, provider_name, ticker_symbol, providers.PE_HISTORY,
+                      lambda: load(ticker_symbol), default=pd.Series([], dtype=float))
+
+
+def quoted_price(ticker_symbol, stock, quotes=None):
+    """
+    yfinance 价格：优先使用批量获取的价格，没有时逐个查询 fast_info、history
+    yf.download 不报告单个代码的失败（限流、代码错误时该列全为 NaN），批量下载查询过但没有价格的代码仍逐个查询
+    返回：
+        (价格, 来源)；都失败时为 (None, None)
+    """
+    # 方法0: 批量获取的价格（yfinance 批量下载 / 东方财富快照，见 providers.py）
+    if quotes is not None:
+        current_price = quotes.get(ticker_symbol, providers.PRICE)
+        if current_price is not None:
+            return current_price, quotes.source(ticker_symbol, providers.PRICE)
+    if not stock:
+        return None, None
+
+    # 方法1: 使用 yfinance 的 fast_info
+    try:
+        current_price = resilience.guarded("yfinance", lambda: stock.fast_info.last_price)
+        if current_price is not None:
+            return current_price, "yfinance-fast-info"
+    except Exception:
+        pass
+
+    # 方法2: 如果 fast_info 失败，尝试获取历史数据
+    try:
+        hist = resilience.guarded("yfinance", stock.history, period="1d")
+        if not hist.empty:
+            return hist['Close'].iloc[-1], "yfinance-history"
+    except Exception:
+        pass
+    return None, None
+
+
+def update_holding(page, rates, spot_cache, etf_cache, hk_cache, open_fund_cache, writes, quotes=None):
+    """
+    获取单条持仓记录的价格、PE、PB、ROE、PEG 等数据，放入写入队列 writes（见 write_queue.py）
+    quotes: prefetch_quotes 批量获取的价格和指数估值，没有的数据仍逐个查询
+    返回：
+        True 成功 / False 失败 / None 跳过（空行或缺少股票代码）
+    """
+    page_id = page["id"]
+    props = page["properties"]
+
+    # --- 解析股票代码 ---
+    try:
+        ticker_symbol = parse_ticker_symbol(props)
+        if not ticker_symbol:
+            return None  # 跳过空行
+    except (KeyError, IndexError, AttributeError):
+        print("⚠️ 跳过无法识别的行 (缺少股票代码)")
+        return None
+
+    # --- 确定货币类型 ---
+    current_currency_name, calc_currency = resolve_currency(props, ticker_symbol)
+
+    # 确定汇率
+    target_rate = rates.get(calc_currency, 1.0)
+
+    # 时间预算不足时跳过的可选补充数据（PE历史/PB/ROE/PEG 等），价格写入不受影响
+    budget_skips = []
+
+    def allowed(feature):
+        if resilience.allow_optional(feature, ticker_symbol):
+            return True
+        budget_skips.append(feature)
+        return False
+
+    # --- 核心逻辑：获取并更新股票价格 ---
+    try:
+        print(f"🔄 处理: {ticker_symbol} ({calc_currency})...", end="", flush=True)
+
+        # 抓取股价
+        stock = None
+        if yf:
+            stock = _yf_ticker(to_yf_symbol(ticker_symbol))
+
+        # 尝试多种方式获取价格（price_source 记录价格来源，用于运行指标）
+        current_price, price_source = quoted_price(ticker_symbol, stock, quotes)
+
+        # 方法3: 如果是中国基金代码且yfinance失败，尝试使用akshare
+        # 注意：yfinance 有时会返回 0.0 (例如暂停交易或数据缺失)，这也应该视为失败
+        if (current_price is None or (isinstance(current_price, (int, float)) and current_price == 0)) and calc_currency == "CNY":
+            # 检查是否是基金代码（只要是6位数字，都尝试去查，包括00开头的场外基金）
+            if ticker_symbol.isdigit() and len(ticker_symbol) == 6:
+                try:
+                    print(f"\n   [尝试akshare获取 {ticker_symbol}]")
+                    # 传入缓存进行查询
+                    akshare_price = get_price_from_akshare(ticker_symbol, spot_cache=spot_cache, etf_cache=etf_cache)
+                    if akshare_price:
+                        current_price = akshare_price
+                        price_source = "akshare"
+                        print(f" [使用akshare成功: {akshare_price}]", end="", flush=True)
+                    else:
+                        print(f"   [akshare返回None]")
+                except Exception as e:
+                    print(f"   [akshare异常: {e}]")
+
+        # 方法4: 如果是港股且yfinance失败，尝试使用akshare
+        if (current_price is None or (isinstance(current_price, (int, float)) and current_price == 0)) and calc_currency == "HKD":
+            # 尝试从 hk_cache 获取
+            # Akshare 港股代码通常是 5位数字，例如 00700
+            # Notion/Yfinance 可能是 0700 或 00700
+            hk_code = ticker_symbol.replace(".HK", "")
+            if len(hk_code) < 5:
+                hk_code = hk_code.zfill(5)
+
+            if hk_code in hk_cache and hk_cache[hk_code].last:
+                current_price = hk_cache[hk_code].last
+                price_source = "akshare-hk"
+                print(f" [使用akshare-hk]", end="", flush=True)
+
+        # 如果仍然无法获取价格，抛出异常
+        if current_price is None or (isinstance(current_price, float) and current_price == 0):
+            raise ValueError(f"无法获取 {ticker_symbol} 的价格数据，可能是基金代码或已退市")
+        metrics.inc(metrics.TICKERS_PRICED, source=price_source or "unknown", currency=calc_currency)
+
+        # 更新 Notion（使用中文列名）
+        # 获取股票名称、PE和PE百分位
+        stock_name = ""
+        pe_ratio = None
+        pe_percentile = None
 
-        # --- 核心逻辑：获取并更新股票价格 ---
         try:
-            print(f"🔄 处理: {ticker_symbol} ({calc_currency})...", end="", flush=True)
-            
-            # 处理不同类型的代码
-            yf_ticker = ticker_symbol.upper()  # 转换为大写
-            
-            # 0. 处理点号：yfinance 需要连字符而不是点号（如 BRK.B -> BRK-B）
-            if '.' in yf_ticker:
-                yf_ticker = yf_ticker.replace('.', '-')
-            
-            # 1. 处理数字货币：添加 -USD 后缀
-            if yf_ticker in CRYPTO_SYMBOLS:
-                yf_ticker = f"{yf_ticker}-USD"
-            # 2. 处理 A 股代码：自动添加市场后缀
-            # 60开头是上海（.SS），00/30开头是深圳（.SZ）
-            elif ticker_symbol.isdigit() and len(ticker_symbol) == 6:
-                if ticker_symbol.startswith('60'):
-                    yf_ticker = f"{ticker_symbol}.SS"
-                elif ticker_symbol.startswith(('00', '30')):
-                    yf_ticker = f"{ticker_symbol}.SZ"
-            
-            # 抓取股价
-            stock = None
-            if yf:
-                stock = yf.Ticker(yf_ticker)
-            
-            # 尝试多种方式获取价格
-            current_price = None
-            
-            # 方法1: 使用 yfinance 的 fast_info
-            try:
-                if stock:
-                    current_price = stock.fast_info.last_price
-            except:
-                pass
-            
-            # 方法2: 如果 fast_info 失败，尝试获取历史数据
-            if current_price is None:
+            stock_name, current_price_a = get_name_price(ticker_symbol, calc_currency, spot_cache, etf_cache, hk_cache, open_fund_cache)
+
+            # 若行情查不到则降级原逻辑 (但通常缓存应该有了)
+            if not stock_name:
                 try:
-                    if stock:
-                        hist = stock.history(period="1d")
-                        if not hist.empty:
-                            current_price = hist['Close'].iloc[-1]
+                    # 尝试模糊匹配或其他方式，这里简单处理，如果缓存没有，可能就是没有
+                    pass
                 except:
                     pass
-            
-            # 方法3: 如果是中国基金代码且yfinance失败，尝试使用akshare
-            # 注意：yfinance 有时会返回 0.0 (例如暂停交易或数据缺失)，这也应该视为失败
-            if (current_price is None or (isinstance(current_price, (int, float)) and current_price == 0)) and calc_currency == "CNY":
-                # 检查是否是基金代码（只要是6位数字，都尝试去查，包括00开头的场外基金）
-                if ticker_symbol.isdigit() and len(ticker_symbol) == 6:
-                    try:
-                        print(f"\n   [尝试akshare获取 {ticker_symbol}]")
-                        # 传入缓存进行查询
-                        akshare_price = get_price_from_akshare(ticker_symbol, spot_cache=spot_cache, etf_cache=etf_cache)
-                        if akshare_price:
-                            current_price = akshare_price
-                            print(f" [使用akshare成功: {akshare_price}]", end="", flush=True)
-                        else:
-                            print(f"   [akshare返回None]")
-                    except Exception as e:
-                        print(f"   [akshare异常: {e}]")
-            
-            # 方法4: 如果是港股且yfinance失败，尝试使用akshare
-            if (current_price is None or (isinstance(current_price, (int, float)) and current_price == 0)) and calc_currency == "HKD":
-                # 尝试从 hk_cache 获取
-                # Akshare 港股代码通常是 5位数字，例如 00700
-                # Notion/Yfinance 可能是 0700 或 00700
-                hk_code = ticker_symbol.replace(".HK", "")
-                if len(hk_code) < 5:
-                    hk_code = hk_code.zfill(5)
-                
-                if hk_code in hk_cache:
-                    row = hk_cache[hk_code]
-                    for field in ['最新价', '收盘', '现价', 'current', 'close']:
-                        val = row.get(field)
-                        if val is not None and val != '-' and val != '':
-                            try:
-                                current_price = float(val)
-                                print(f" [使用akshare-hk]", end="", flush=True)
-                                break
-                            except:
-                                continue
 
-            # 如果仍然无法获取价格，抛出异常
-            if current_price is None or (isinstance(current_price, float) and current_price == 0):
-                raise ValueError(f"无法获取 {ticker_symbol} 的价格数据，可能是基金代码或已退市")
-            
-            # 更新 Notion（使用中文列名）
-            # 获取股票名称、PE和PE百分位
-            stock_name = ""
+            # 批量缓存A股历史PE并计算百分位
             pe_ratio = None
             pe_percentile = None
-            
-            try:
-                stock_name, current_price_a = get_name_price(ticker_symbol, calc_currency, spot_cache, etf_cache, hk_cache, open_fund_cache)
-                
-                # 若行情查不到则降级原逻辑 (但通常缓存应该有了)
-                if not stock_name:
-                    try:
-                        # 尝试模糊匹配或其他方式，这里简单处理，如果缓存没有，可能就是没有
-                        pass
-                    except:
-                        pass
-                
-                # 批量缓存A股历史PE并计算百分位
-                pe_ratio = None
-                pe_percentile = None
-                
-                # 仅当货币为 CNY 时才尝试作为 A 股获取 PE
-                if calc_currency == 'CNY':
-                    # 1. 尝试获取历史PE计算百分位
-                    try:
-                        pe_series = get_pe_series_cached(ticker_symbol)
-                        pe_series = pe_series.dropna()
-                        if not pe_series.empty:
-                            pe_ratio = float(pe_series.iloc[-1])
-                            pe_percentile = float((pe_series < pe_ratio).sum()) / len(pe_series) * 100
-                    except Exception as e:
-                        print(f"{ticker_symbol} 百分位计算异常: {e}")
-                    
-                    # 2. 如果历史PE获取失败，尝试从实时行情中获取当前PE
-                    if pe_ratio is None:
-                        # 检查 A股 spot_cache
-                        if ticker_symbol in spot_cache:
-                            val = spot_cache[ticker_symbol].get('市盈率-动态')
-                            if val is not None:
-                                try:
-                                    pe_ratio = float(val)
-                                    print(f"      [A股] 从spot_cache获取PE: {pe_ratio}")
-                                except:
-                                    pass
-                        # 检查 ETF etf_cache
-                        if pe_ratio is None and ticker_symbol in etf_cache:
-                            # 注意：大多数ETF本身没有PE，但可以尝试查找
-                            val = etf_cache[ticker_symbol].get('市盈率-动态') or etf_cache[ticker_symbol].get('市盈率')
-                            if val is not None and val != '-' and str(val) != 'nan':
-                                try:
-                                    pe_ratio = float(val)
-                                    print(f"      [ETF] 从etf_cache获取PE: {pe_ratio}")
-                                except Exception as e:
-                                    print(f"      [ETF] PE转换失败: {val}, 错误: {e}")
-                            else:
-                                print(f"      [ETF] {ticker_symbol} 缓存中无PE数据（ETF通常无PE指标）")
-
-                        # 3. 如果A股ETF仍然没有PE，尝试从恒生指数获取（如159920）
-                        if pe_ratio is None and ticker_symbol in HK_ETF_INDEX_MAPPING:
-                            index_pe, index_pe_percentile = get_hk_etf_index_pe(ticker_symbol)
-                            if index_pe is not None:
-                                pe_ratio = index_pe
-                                if index_pe_percentile is not None:
-                                    pe_percentile = index_pe_percentile
-
-                # 尝试获取港股 PE (从 Akshare 缓存)
-                if calc_currency == 'HKD':
-                    # 1. 尝试获取历史PE计算百分位
-                    try:
-                        pe_series = get_hk_pe_series_cached(ticker_symbol)
-                        pe_series = pe_series.dropna()
-                        if not pe_series.empty:
-                            pe_ratio = float(pe_series.iloc[-1])
-                            pe_percentile = float((pe_series < pe_ratio).sum()) / len(pe_series) * 100
-                    except Exception as e:
-                        print(f"{ticker_symbol} 港股百分位计算异常: {e}")
 
-                    # 2. 如果历史PE获取失败，尝试从实时行情中获取当前PE
-                    if pe_ratio is None:
-                        hk_code = ticker_symbol.replace(".HK", "").zfill(5)
-                        if hk_code in hk_cache:
-                            val = hk_cache[hk_code].get('市盈率-动态') or hk_cache[hk_code].get('市盈率')
-                            if val is not None:
-                                try:
-                                    pe_ratio = float(val)
-                                except:
-                                    pass
+            # 仅当货币为 CNY 时才尝试作为 A 股获取 PE
+            if calc_currency == 'CNY':
+                # 1. 尝试获取历史PE计算百分位
+                try:
+                    pe_series = pe_history(ticker_symbol, calc_currency, quotes) if allowed("PE历史百分位") else pd.Series([], dtype=float)
+                    pe_series = pe_series.dropna()
+                    if not pe_series.empty:
+                        pe_ratio = float(pe_series.iloc[-1])
+                        pe_percentile = float((pe_series < pe_ratio).sum()) / len(pe_series) * 100
+                except Exception as e:
+                    print(f"{ticker_symbol} 百分位计算异常: {e}")
+
+                # 2. 如果历史PE获取失败，尝试从实时行情中获取当前PE
+                if pe_ratio is None:
+                    # 检查 A股 spot_cache
+                    if ticker_symbol in spot_cache and spot_cache[ticker_symbol].pe_ttm is not None:
+                        pe_ratio = spot_cache[ticker_symbol].pe_ttm
+                        print(f"      [A股] 从spot_cache获取PE: {pe_ratio}")
+                    # 检查 ETF etf_cache
+                    if pe_ratio is None and ticker_symbol in etf_cache:
+                        # 注意：大多数ETF本身没有PE，但可以尝试查找
+                        if etf_cache[ticker_symbol].pe_ttm is not None:
+                            pe_ratio = etf_cache[ticker_symbol].pe_ttm
+                            print(f"      [ETF] 从etf_cache获取PE: {pe_ratio}")
+                        else:
+                            print(f"      [ETF] {ticker_symbol} 缓存中无PE数据（ETF通常无PE指标）")
 
-                    # 3. 如果港股ETF仍然没有PE，尝试从恒生指数获取
-                    if pe_ratio is None and ticker_symbol in HK_ETF_INDEX_MAPPING:
-                        index_pe, index_pe_percentile = get_hk_etf_index_pe(ticker_symbol)
+                    # 3. 如果A股ETF仍然没有PE，尝试从恒生指数获取（如159920）
+                    if pe_ratio is None and ticker_symbol in HK_ETF_INDEX_MAPPING and allowed("恒生指数PE"):
+                        index_pe, index_pe_percentile = hk_index_pe(ticker_symbol, quotes)
                         if index_pe is not None:
                             pe_ratio = index_pe
                             if index_pe_percentile is not None:
                                 pe_percentile = index_pe_percentile
 
-                # 尝试使用 yfinance 补充名称、PE、PE百分位
-                if stock:
-                    try:
-                        stock_info = stock.info
-                        if not stock_name:
-                            stock_name = stock_info.get("shortName", "") or stock_info.get("longName", "")
-                        
-                        import numpy as np
-                        # 如果 PE 未获取到，则从 yfinance 获取
-                        if pe_ratio is None:
-                            pe_ratio = stock_info.get("trailingPE") or stock_info.get("forwardPE")
-                            if pe_ratio is not None:
-                                try:
-                                    pe_ratio = float(pe_ratio)
-                                except (ValueError, TypeError):
-                                    pe_ratio = None
-                        
-                        # 如果 PE 百分位未获取到，则从 yfinance 计算
-                        if pe_percentile is None and pe_ratio is not None and pe_ratio > 0:
+            # 尝试获取港股 PE (从 Akshare 缓存)
+            if calc_currency == 'HKD':
+                # 1. 尝试获取历史PE计算百分位
+                try:
+                    pe_series = pe_history(ticker_symbol, calc_currency, quotes) if allowed("PE历史百分位") else pd.Series([], dtype=float)
+                    pe_series = pe_series.dropna()
+                    if not pe_series.empty:
+                        pe_ratio = float(pe_series.iloc[-1])
+                        pe_percentile = float((pe_series < pe_ratio).sum()) / len(pe_series) * 100
+                except Exception as e:
+                    print(f"{ticker_symbol} 港股百分位计算异常: {e}")
+
+                # 2. 如果历史PE获取失败，尝试从实时行情中获取当前PE
+                if pe_ratio is None:
+                    hk_code = ticker_symbol.replace(".HK", "").zfill(5)
+                    if hk_code in hk_cache:
+                        pe_ratio = hk_cache[hk_code].pe_ttm
+
+                # 3. 如果港股ETF仍然没有PE，尝试从恒生指数获取
+                if pe_ratio is None and ticker_symbol in HK_ETF_INDEX_MAPPING and allowed("恒生指数PE"):
+                    index_pe, index_pe_percentile = hk_index_pe(ticker_symbol, quotes)
+                    if index_pe is not None:
+                        pe_ratio = index_pe
+                        if index_pe_percentile is not None:
+                            pe_percentile = index_pe_percentile
+
+            # 尝试使用 yfinance 补充名称、PE、PE百分位
+            if stock and allowed("yfinance基本面"):
+                try:
+                    stock_info = resilience.guarded("yfinance", lambda: stock.info)
+                    if not stock_name:
+                        stock_name = stock_info.get("shortName", "") or stock_info.get("longName", "")
+
+                    # 如果 PE 未获取到，则从 yfinance 获取
+                    if pe_ratio is None:
+                        pe_ratio = stock_info.get("trailingPE") or stock_info.get("forwardPE")
+                        if pe_ratio is not None:
                             try:
-                                hist = stock.history(period="5y", interval="1mo")
-                                if hist is not None and not hist.empty:
-                                    # 方法1: 使用 trailingEps（如果有）
-                                    trailing_eps = stock_info.get("trailingEps")
-                                    if trailing_eps is not None and trailing_eps != 0:
-                                        hist_pe_ratios = hist['Close'] / float(trailing_eps)
-                                        hist_pe_ratios = hist_pe_ratios[hist_pe_ratios > 0]
-                                        if not hist_pe_ratios.empty:
-                                            pe_percentile = float(np.sum(hist_pe_ratios < pe_ratio)) / len(hist_pe_ratios) * 100
-                                            print(f"      [美股] 计算PE百分位(用EPS): {pe_percentile:.2f}%")
-                                    else:
-                                        # 方法2: 如果没有EPS，使用当前价格和PE反推EPS，然后计算历史PE
-                                        # EPS = 当前价格 / 当前PE
-                                        current_price_for_calc = hist['Close'].iloc[-1]
-                                        if current_price_for_calc > 0:
-                                            estimated_eps = current_price_for_calc / pe_ratio
-                                            hist_pe_ratios = hist['Close'] / estimated_eps
-                                            hist_pe_ratios = hist_pe_ratios[hist_pe_ratios > 0]
-                                            if not hist_pe_ratios.empty:
-                                                pe_percentile = float(np.sum(hist_pe_ratios < pe_ratio)) / len(hist_pe_ratios) * 100
-                                                print(f"      [美股] 计算PE百分位(估算EPS): {pe_percentile:.2f}%")
-                            except Exception as e:
-                                print(f"      [美股] PE百分位计算失败: {e}")
-                            # yfinance 无法直接获取中国A股和无季报历史EPS，港美股可用该方法
-                    except:
-                        pass
-            except Exception as e:
-                pass
+                                pe_ratio = float(pe_ratio)
+                            except (ValueError, TypeError):
+                                pe_ratio = None
 
-            # 优先使用加速缓存获取的A股/港股现价
-            final_price = current_price
-            if calc_currency == "CNY" and current_price_a is not None:
-                final_price = current_price_a
-            elif calc_currency == "HKD" and current_price_a is not None:
-                # 如果 yfinance 失败了，或者我们想优先用 akshare (这里逻辑是如果 yfinance 拿到了就用 yfinance，除非 yfinance 没拿到)
-                # 但上面的逻辑是：如果 yfinance 拿到 current_price，就用它。
-                # 如果没拿到，才去查 akshare。
-                # 所以这里 final_price = current_price 即可，因为 current_price 已经被 akshare 填充了（如果 yfinance 失败）
-                pass
+                    # 如果 PE 百分位未获取到，则从 yfinance 计算
+                    if pe_percentile is None and pe_ratio is not None and pe_ratio > 0:
+                        try:
+                            # 方法1: 使用 trailingEps（如果有）；方法2: 没有EPS时用当前价格和PE反推EPS
+                            closes = get_history_closes(to_yf_symbol(ticker_symbol), stock,
+                                                        market_calendar.market_of(ticker_symbol, calc_currency, CRYPTO_SYMBOLS))
+                            pe_percentile, estimated = price_proxy_pe_percentile(closes, pe_ratio, stock_info.get("trailingEps"))
+                            if pe_percentile is not None:
+                                print(f"      [美股] 计算PE百分位({'估算EPS' if estimated else '用EPS'}): {pe_percentile:.2f}%")
+                        except Exception as e:
+                            print(f"      [美股] PE百分位计算失败: {e}")
+                        # yfinance 无法直接获取中国A股和无季报历史EPS，港美股可用该方法
+                except:
+                    pass
+        except Exception as e:
+            pass
 
-            update_props = {
-                "现价": {"number": round(final_price, 2) if final_price is not None else None},
-                "汇率": {"number": round(target_rate, 4)},
-                "货币": {"select": {"name": current_currency_name}}
-            }
-            if stock_name:
-                update_props["股票名称"] = {"rich_text": [{"text": {"content": stock_name}}]}
-            
-            # 更新 PE 和 PE 百分位 (如果获取不到则清空)
+        # 优先使用加速缓存获取的A股/港股现价
+        final_price = current_price
+        if calc_currency == "CNY" and current_price_a is not None:
+            final_price = current_price_a
+        elif calc_currency == "HKD" and current_price_a is not None:
+            # 如果 yfinance 失败了，或者我们想优先用 akshare (这里逻辑是如果 yfinance 拿到了就用 yfinance，除非 yfinance 没拿到)
+            # 但上面的逻辑是：如果 yfinance 拿到 current_price，就用它。
+            # 如果没拿到，才去查 akshare。
+            # 所以这里 final_price = current_price 即可，因为 current_price 已经被 akshare 填充了（如果 yfinance 失败）
+            pass
+
+        update_props = {
+            "现价": {"number": round(final_price, 2) if final_price is not None else None},
+            "汇率": {"number": round(target_rate, 4)},
+            "货币": {"select": {"name": current_currency_name}}
+        }
+        if stock_name:
+            update_props["股票名称"] = {"rich_text": [{"text": {"content": stock_name}}]}
+
+        # 更新 PE 和 PE 百分位 (如果获取不到则清空；因时间预算跳过了估值数据时保留原值)
+        if pe_ratio is not None or not budget_skips:
             update_props["PE"] = {"number": round(pe_ratio, 2) if pe_ratio is not None else None}
             update_props["PE百分位"] = {"number": round(pe_percentile, 2) if pe_percentile is not None else None}
 
-            # === 新增：获取PB市净率 ===
-            pb_ratio = get_pb_ratio(ticker_symbol, calc_currency, stock)
+        # === 新增：获取PB市净率 ===
+        pb_ratio = get_pb_ratio(ticker_symbol, calc_currency, stock) if allowed("PB") else None
+
+        # 对于恒生 ETF（如 159920），如果 PB 未获取到，尝试从 2800.HK ETF 获取
+        if pb_ratio is None and ticker_symbol in HK_ETF_INDEX_MAPPING and "PB" not in budget_skips:
+            index_code = HK_ETF_INDEX_MAPPING.get(ticker_symbol)
+            if index_code == 'HSI':
+                pb_ratio = get_hk_index_pb_from_etf(index_code)
+
+        if pb_ratio is not None:
+            update_props["PB"] = {"number": round(pb_ratio, 2)}
+
+        # === 新增：获取ROE净资产收益率 ===
+        roe = get_roe(ticker_symbol, calc_currency, stock, spot_cache, hk_cache) if allowed("ROE") else None
+        if roe is not None:
+            update_props["ROE"] = {"number": round(roe, 2)}
+
+        # === 新增：获取PEG比率 ===
+        peg = get_peg(ticker_symbol, calc_currency, stock, spot_cache, hk_cache) if allowed("PEG") else None
+        if peg is not None:
+            update_props["PEG"] = {"number": round(peg, 2)}
+
+        # === 新增：对于A股ETF，尝试获取对应指数的PE/PB和百分位（作为估值参考）===
+        if calc_currency == "CNY" and pe_ratio is None and ticker_symbol in ETF_INDEX_MAPPING and allowed("指数PE/PB"):
+            index_pe, index_pb, index_pe_percentile, index_pb_percentile = index_valuation(ticker_symbol, quotes)
+            if index_pe is not None:
+                index_name = ETF_INDEX_MAPPING.get(ticker_symbol, '')
+                print(f"      [ETF] 使用指数({index_name})")
+                # 使用指数PE作为ETF的参考PE
+                update_props["PE"] = {"number": round(index_pe, 2)}
+                # 如果有PE百分位，也更新
+                if index_pe_percentile is not None:
+                    pe_percentile = index_pe_percentile
+                    update_props["PE百分位"] = {"number": round(index_pe_percentile, 2)}
+                # 如果有指数PB，也更新
+                if index_pb is not None and pb_ratio is None:
+                    pb_ratio = index_pb
+                    update_props["PB"] = {"number": round(index_pb, 2)}
+
+        # === 新增：对于QDII ETF（如纳指ETF/标普500ETF），使用美股对应ETF的PE数据 ===
+        if ticker_symbol in QDII_ETF_MAPPING and allowed("QDII PE"):
+            us_etf_ticker = QDII_ETF_MAPPING[ticker_symbol]
+            print(f"      [QDII ETF] 使用美股ETF({us_etf_ticker})数据")
+            try:
+                us_pe, us_pe_percentile = qdii_reference_pe(ticker_symbol, quotes)
+                if us_pe is not None:
+                    pe_ratio = us_pe
+                    update_props["PE"] = {"number": round(us_pe, 2)}
+                    print(f"      [QDII ETF] 获取{us_etf_ticker} PE: {us_pe:.2f}")
+                    if us_pe_percentile is not None:
+                        pe_percentile = us_pe_percentile
+                        update_props["PE百分位"] = {"number": round(us_pe_percentile, 2)}
+                        print(f"      [QDII ETF] {us_etf_ticker} PE百分位: {us_pe_percentile:.2f}%")
+            except Exception as e:
+                print(f"      [QDII ETF] 获取{us_etf_ticker}数据失败: {e}")
 
-            # 对于恒生 ETF（如 159920），如果 PB 未获取到，尝试从 2800.HK ETF 获取
-            if pb_ratio is None and ticker_symbol in HK_ETF_INDEX_MAPPING:
-                index_code = HK_ETF_INDEX_MAPPING.get(ticker_symbol)
-                if index_code == 'HSI':
-                    pb_ratio = get_hk_index_pb_from_etf(index_code)
+        # === 新增：对于场外基金，计算净值增长率 ===
+        growth_rates = {}
+        if ticker_symbol.startswith('0') and len(ticker_symbol) == 6 and ticker_symbol.isdigit() and allowed("净值增长率"):
+            growth_rates = fund_nav_growth(ticker_symbol, quotes)
+            # 计算增长率仅用于日志输出，不写入Notion
+            # 如果需要写入，请在Notion添加"年化收益"字段并取消下面的注释：
+            # if growth_rates and '1y' in growth_rates:
+            #     update_props["年化收益"] = {"number": round(growth_rates['1y'], 2)}
+
+        # 如果 Notion 数据库中有"最后更新时间"字段，取消下面的注释并修改字段名
+        # update_props["最后更新时间"] = {"date": {"start": datetime.datetime.now().isoformat()}}
+
+        writes.put(page_id, update_props, label=ticker_symbol)
+        record_valuation(
+            ticker_symbol,
+            pe=_number_value(update_props.get("PE")),
+            pb=_number_value(update_props.get("PB")),
+            pe_percentile=_number_value(update_props.get("PE百分位")),
+        )
+
+        log_message = f"价格: {final_price:.2f} | 汇率: {target_rate:.4f}"
+        if pe_ratio is not None:
+            log_message += f" | PE: {pe_ratio:.2f}"
+        if pe_percentile is not None:
+            log_message += f" | PE百分位: {pe_percentile:.2f}%"
+        if pb_ratio is not None:
+            log_message += f" | PB: {pb_ratio:.2f}"
+        if roe is not None:
+            log_message += f" | ROE: {roe:.2f}%"
+        if peg is not None:
+            log_message += f" | PEG: {peg:.2f}"
+
+        if ticker_symbol.startswith('0') and len(ticker_symbol) == 6 and growth_rates and '1y' in growth_rates:
+            log_message += f" | 年化: {growth_rates['1y']:.2f}%"
+
+        print(f" ✅ 成功 ({log_message})")
+        return True
 
-            if pb_ratio is not None:
-                update_props["PB"] = {"number": round(pb_ratio, 2)}
-
-            # === 新增：获取ROE净资产收益率 ===
-            roe = get_roe(ticker_symbol, calc_currency, stock, spot_cache, hk_cache)
-            if roe is not None:
-                update_props["ROE"] = {"number": round(roe, 2)}
-
-            # === 新增：获取PEG比率 ===
-            peg = get_peg(ticker_symbol, calc_currency, stock, spot_cache, hk_cache)
-            if peg is not None:
-                update_props["PEG"] = {"number": round(peg, 2)}
-
-            # === 新增：对于A股ETF，尝试获取对应指数的PE/PB和百分位（作为估值参考）===
-            if calc_currency == "CNY" and pe_ratio is None and ticker_symbol in ETF_INDEX_MAPPING:
-                index_pe, index_pb, index_pe_percentile, index_pb_percentile = get_etf_index_pe_pb(ticker_symbol)
-                if index_pe is not None:
-                    index_name = ETF_INDEX_MAPPING.get(ticker_symbol, '')
-                    print(f"      [ETF] 使用指数({index_name})")
-                    # 使用指数PE作为ETF的参考PE
-                    update_props["PE"] = {"number": round(index_pe, 2)}
-                    # 如果有PE百分位，也更新
-                    if index_pe_percentile is not None:
-                        pe_percentile = index_pe_percentile
-                        update_props["PE百分位"] = {"number": round(index_pe_percentile, 2)}
-                    # 如果有指数PB，也更新
-                    if index_pb is not None and pb_ratio is None:
-                        pb_ratio = index_pb
-                        update_props["PB"] = {"number": round(index_pb, 2)}
-
-            # === 新增：对于QDII ETF（如纳指ETF/标普500ETF），使用美股对应ETF的PE数据 ===
-            if ticker_symbol in QDII_ETF_MAPPING:
-                us_etf_ticker = QDII_ETF_MAPPING[ticker_symbol]
-                print(f"      [QDII ETF] 使用美股ETF({us_etf_ticker})数据")
-                try:
-                    if yf:
-                        us_etf_stock = yf.Ticker(us_etf_ticker)
-                        us_etf_info = us_etf_stock.info
+    except Exception as e:
+        error_msg = str(e)
+        # 如果只是字段不存在，给出更友好的提示
+        if "is not a property that exists" in error_msg:
+            print(f" ❌ 失败: 字段不存在，请检查 Notion 数据库中的字段名")
+        elif "无法获取" in error_msg or "currentTradingPeriod" in error_msg or "Not Found" in error_msg:
+            print(f" ❌ 失败: 无法获取价格数据（可能是基金代码、已退市或数据源不支持）")
+        else:
+            print(f" ❌ 失败: {e}")
+        return False
 
-                        # 获取PE
-                        us_pe = us_etf_info.get("trailingPE") or us_etf_info.get("forwardPE")
-                        if us_pe is not None:
-                            try:
-                                us_pe = float(us_pe)
-                                pe_ratio = us_pe
-                                update_props["PE"] = {"number": round(us_pe, 2)}
-                                print(f"      [QDII ETF] 获取{us_etf_ticker} PE: {us_pe:.2f}")
-
-                                # 计算PE百分位（使用5年历史数据）
-                                import numpy as np
-                                hist = us_etf_stock.history(period="5y", interval="1mo")
-                                if hist is not None and not hist.empty:
-                                    trailing_eps = us_etf_info.get("trailingEps")
-                                    if trailing_eps is not None and trailing_eps != 0:
-                                        hist_pe_ratios = hist['Close'] / float(trailing_eps)
-                                        hist_pe_ratios = hist_pe_ratios[hist_pe_ratios > 0]
-                                        if not hist_pe_ratios.empty:
-                                            us_pe_percentile = float(np.sum(hist_pe_ratios < us_pe)) / len(hist_pe_ratios) * 100
-                                            pe_percentile = us_pe_percentile
-                                            update_props["PE百分位"] = {"number": round(us_pe_percentile, 2)}
-                                            print(f"      [QDII ETF] 计算{us_etf_ticker} PE百分位: {us_pe_percentile:.2f}%")
-                                    else:
-                                        # 使用当前价格和PE反推EPS
-                                        current_price_for_calc = hist['Close'].iloc[-1]
-                                        if current_price_for_calc > 0 and us_pe > 0:
-                                            estimated_eps = current_price_for_calc / us_pe
-                                            hist_pe_ratios = hist['Close'] / estimated_eps
-                                            hist_pe_ratios = hist_pe_ratios[hist_pe_ratios > 0]
-                                            if not hist_pe_ratios.empty:
-                                                us_pe_percentile = float(np.sum(hist_pe_ratios < us_pe)) / len(hist_pe_ratios) * 100
-                                                pe_percentile = us_pe_percentile
-                                                update_props["PE百分位"] = {"number": round(us_pe_percentile, 2)}
-                                                print(f"      [QDII ETF] 计算{us_etf_ticker} PE百分位(估算): {us_pe_percentile:.2f}%")
-                            except Exception as e:
-                                print(f"      [QDII ETF] 处理PE数据失败: {e}")
-                except Exception as e:
-                    print(f"      [QDII ETF] 获取{us_etf_ticker}数据失败: {e}")
-
-            # === 新增：对于场外基金，计算净值增长率 ===
-            growth_rates = {}
-            if ticker_symbol.startswith('0') and len(ticker_symbol) == 6 and ticker_symbol.isdigit():
-                growth_rates = calculate_fund_nav_growth(ticker_symbol)
-                # 计算增长率仅用于日志输出，不写入Notion
-                # 如果需要写入，请在Notion添加"年化收益"字段并取消下面的注释：
-                # if growth_rates and '1y' in growth_rates:
-                #     update_props["年化收益"] = {"number": round(growth_rates['1y'], 2)}
-
-            # 如果 Notion 数据库中有"最后更新时间"字段，取消下面的注释并修改字段名
-            # update_props["最后更新时间"] = {"date": {"start": datetime.datetime.now().isoformat()}}
-
-            notion.pages.update(
-                page_id=page_id,
-                properties=update_props
-            )
-            
-            log_message = f"价格: {final_price:.2f} | 汇率: {target_rate:.4f}"
-            if pe_ratio is not None:
-                log_message += f" | PE: {pe_ratio:.2f}"
-            if pe_percentile is not None:
-                log_message += f" | PE百分位: {pe_percentile:.2f}%"
-            if pb_ratio is not None:
-                log_message += f" | PB: {pb_ratio:.2f}"
-            if roe is not None:
-                log_message += f" | ROE: {roe:.2f}%"
-            if peg is not None:
-                log_message += f" | PEG: {peg:.2f}"
 
-            if ticker_symbol.startswith('0') and len(ticker_symbol) == 6 and growth_rates and '1y' in growth_rates:
-                log_message += f" | 年化: {growth_rates['1y']:.2f}%"
+def retry_deferred_holdings(deferred_pages, rates, spot_cache, etf_cache, hk_cache, open_fund_cache, writes, quotes=None):
+    """
+    对因数据源熔断而失败的持仓做最后一轮重试
+    先等待相关数据源冷却结束（最多 RETRY_PASS_MAX_WAIT 秒），熔断器半开后重新处理这些持仓
+    返回：
+        {页面 ID: update_holding 的结果}
+    """
+    sources = set()
+    for _, skipped in deferred_pages:
+        sources.update(skipped)
+    print(f"\n🔁 {len(deferred_pages)} 条持仓因数据源熔断失败 ({', '.join(sorted(sources))})，等待恢复后重试...")
+    budget = resilience.budget()
+    max_wait = RETRY_PASS_MAX_WAIT
+    if budget is not None:
+        budget.pending = len(deferred_pages)
+        max_wait = max(0, min(max_wait, budget.remaining() - budget.reserve()))
+    waited = resilience.wait_for_recovery(sources, max_wait)
+    if waited:
+        print(f"   已等待 {waited:.0f}s")
+
+    results = {}
+    for page, _ in deferred_pages:
+        results[page["id"]] = update_holding(page, rates, spot_cache, etf_cache, hk_cache, open_fund_cache, writes, quotes)
+    print(f"🔁 重试完成: {sum(1 for result in results.values() if result)}/{len(deferred_pages)} 条成功")
+
+    tripped = resilience.summary()
+    if tripped:
+        for name, stats in tripped.items():
+            print(f"   🔌 {name}: 熔断 {stats['trips']} 次, 跳过 {stats['skipped']} 次调用, 当前状态 {stats['state']}")
+    return results
+
+
+def write_notion_page(page_id, properties):
+    notion.pages.update(page_id=page_id, properties=properties)
+
+
+def describe_write_error(error):
+    error_msg = str(error)
+    # 如果只是字段不存在，给出更友好的提示
+    if "is not a property that exists" in error_msg:
+        return "字段不存在，请检查 Notion 数据库中的字段名"
+    return error_msg
+
+
+def flush_writes(writes, stage):
+    """写入队列中的所有更新并打印统计"""
+    stats = writes.flush()
+    metrics.inc(metrics.NOTION_WRITES, stats["requests"] - len(stats["failed"]), stage=stage, result="sent")
+    metrics.inc(metrics.NOTION_WRITES, stats["coalesced"], stage=stage, result="coalesced")
+    metrics.inc(metrics.NOTION_WRITES, len(stats["failed"]), stage=stage, result="failed")
+    if stats["requests"]:
+        line = f"📝 {stage}写入 Notion: {stats['requests']} 个请求"
+        if stats["coalesced"]:
+            line += f"（合并 {stats['coalesced']} 次更新）"
+        if stats["failed"]:
+            line += f"，失败 {len(stats['failed'])} 个"
+        print(line)
+    for label, error in stats["failed"]:
+        print(f"   ❌ {label} 写入失败: {describe_write_error(error)}")
+    return stats
+
+
+@warm_cache.memoize(warm_cache.FOREVER)
+def resolve_data_source_id(database_id):
+    """获取数据库的数据源 ID（常驻模式下只查询一次）"""
+    # 先获取数据库信息
+    database = notion.databases.retrieve(database_id=database_id)
+    # 检查是否有数据源（多数据源数据库）
+    if 'data_sources' in database and database['data_sources']:
+        return database['data_sources'][0]['id']
+    # 单数据源数据库，尝试使用 search 或其他方法
+    # 注意：新版 API 可能不再支持直接 query，需要查询页面
+    raise Exception("单数据源数据库暂不支持，请使用多数据源数据库")
+
+
+@warm_cache.memoize(warm_cache.DAILY)
+def get_property_schema(data_source_id):
+    """数据源的属性定义（用于条件下推和属性投影）；获取失败时返回空 dict"""
+    return notion_query.property_schema(notion, data_source_id)
+
+
+def trade_log_query(schema):
+    """
+    交易流水表中动作类型（select）包含“卖出”或“买入”的记录
+    schema 为交易流水表的属性定义，用于把条件下推到 Notion 服务端
+    """
+    def is_trade(page):
+        action_prop = page["properties"].get("动作类型") or {}
+        if action_prop.get("type") == "select" and action_prop.get("select"):
+            return any(action in action_prop["select"]["name"] for action in TRADE_RETURN_FIELDS)
+        return False
+
+    return (notion_query.Query(TRADE_LOG_DATA_SOURCE_ID)
+            .where_contains_any(schema, "动作类型", list(TRADE_RETURN_FIELDS))
+            .select(schema, *TRADE_LOG_PROPERTIES)
+            .matching(is_trade))
 
-            print(f" ✅ 成功 ({log_message})")
-            
-        except Exception as e:
-            error_msg = str(e)
-            # 如果只是字段不存在，给出更友好的提示
-            if "is not a property that exists" in error_msg:
-                print(f" ❌ 失败: 字段不存在，请检查 Notion 数据库中的字段名")
-            elif "无法获取" in error_msg or "currentTradingPeriod" in error_msg or "Not Found" in error_msg:
-                print(f" ❌ 失败: 无法获取价格数据（可能是基金代码、已退市或数据源不支持）")
-            else:
-                print(f" ❌ 失败: {e}")
-        
-        # 礼貌性延时，防止 API 速率限制
-        time.sleep(0.5)
 
-    # === 卖出后涨跌幅更新 (交易流水表) ===
-    print("\n📊 正在更新交易流水表中的卖出后涨跌幅...")
-    try:
-        # 交易流水表数据源 ID
-        TRADE_LOG_DATA_SOURCE_ID = "2db4538c-fc22-8082-a3b1-000bf0590459"
-        
-        # 查询交易流水表
-        trade_response = notion.data_sources.query(data_source_id=TRADE_LOG_DATA_SOURCE_ID)
-        trade_pages = trade_response.get("results", [])
-        
+def _number_value(prop):
+    if not prop or prop.get("number") is None:
+        return None
+    return float(prop["number"])
+
+
+def _rollup_number(prop):
+    if not prop or not prop.get("rollup") or prop["rollup"].get("number") is None:
+        return None
+    return float(prop["rollup"]["number"])
+
+
+def _first_relation(prop):
+    if not prop or not prop.get("relation"):
+        return None
+    return prop["relation"][0]["id"]
+
+
+def decode_holding_prices(pages):
+    """持仓页面 → 以 page_id 为索引的表格（current_price 现价、position_qty 持仓数量）"""
+    rows = [
+        (page["id"], _number_value(page["properties"].get("现价")), _rollup_number(page["properties"].get("持仓数量 (自动)")))
+        for page in pages
+    ]
+    frame = pd.DataFrame(rows, columns=["page_id", "current_price", "position_qty"])
+    return frame.set_index("page_id").astype(float)
+
+
+def decode_trade_log(trade_pages):
+    """
+    交易流水页面 → 表格，每行一条交易：
+    page_id、action 动作类型、trade_date 交易日期、trade_price 成交单价、related_id 关联标的，
+    以及 Notion 中已有的涨跌幅（列名与字段名相同）
+    """
+    rows = []
+    for page in trade_pages:
+        props = page["properties"]
+        row = {
+            "page_id": page["id"],
+            "action": notion_query.property_text(props.get("动作类型")) or "",
+            "trade_date": notion_query.property_text(props.get("交易日期")) or "",
+            "trade_price": _number_value(props.get("成交单价")),
+            "related_id": _first_relation(props.get("关联标的")),
+        }
+        for field in TRADE_RETURN_FIELDS.values():
+            row[field] = _number_value(props.get(field))
+        rows.append(row)
+    columns = ["page_id", "action", "trade_date", "trade_price", "related_id"] + list(TRADE_RETURN_FIELDS.values())
+    frame = pd.DataFrame(rows, columns=columns)
+    numeric = ["trade_price"] + list(TRADE_RETURN_FIELDS.values())
+    frame[numeric] = frame[numeric].astype(float)
+    return frame
+
+
+def compute_trade_returns(trades, prices):
+    """
+    一次性计算所有交易的卖出后/买入后涨跌幅（小数形式，如 0.05 表示 5%，保留 4 位）
+    参数：
+        trades: decode_trade_log 的结果
+        prices: decode_holding_prices 的结果
+    返回：
+        trades 加上以下列：
+        current_price / position_qty: 关联标的的现价和持仓数量
+        is_<动作>: 是否为该动作（卖出/买入）
+        skipped_<动作>: 因已清仓而跳过（仅买入：持仓数量为 0 的股票停止追踪）
+        new_<字段>: 新的涨跌幅，不适用或无法计算时为 NaN
+        changed_<字段>: 与 Notion 中已有的值不同，需要写入
+    """
+    frame = trades.join(prices, on="related_id")
+    valid_price = frame["trade_price"] > 0
+    has_current = frame["current_price"].notna()
+    change = ((frame["current_price"] - frame["trade_price"]) / frame["trade_price"]).round(4)
+    fully_sold = frame["position_qty"] == 0
+
+    for action, field in TRADE_RETURN_FIELDS.items():
+        is_action = frame["action"].str.contains(action, regex=False)
+        skipped = is_action & fully_sold if action == "买入" else pd.Series(False, index=frame.index)
+        target = is_action & ~skipped & valid_price & has_current
+        frame[f"is_{action}"] = is_action
+        frame[f"skipped_{action}"] = skipped
+        frame[f"new_{field}"] = change.where(target)
+        # 已有值为空或与新值不同（浮点误差以内视为相同）时才写入
+        unchanged = (frame[field] - frame[f"new_{field}"]).abs() <= 1e-9
+        frame[f"changed_{field}"] = target & ~unchanged
+    return frame
+
+
+def update_trade_returns(data_source_id, holding_schema, writes, price_pages=None, flush=True):
+    """
+    更新交易流水表的卖出后涨跌幅、买入后涨跌幅，只写入数值有变化的记录
+    price_pages: 已包含最新现价、持仓数量的持仓页面（流水线模式下由页面索引提供）；为 None 时重新查询
+    flush: 为 False 时更新留在写入队列中，由调用方与后续阶段的更新一起写入
+    """
+    # 交易流水表的属性定义（用于把“动作类型包含 卖出/买入”下推为服务端过滤，并只返回用到的属性）
+    trade_schema = get_property_schema(TRADE_LOG_DATA_SOURCE_ID)
+
+    if price_pages is None:
         # 重新查询股票投资组合表，获取最新的现价数据
-        # (因为上面的循环已经更新了现价，但本地 pages 变量是旧数据)
-        fresh_response = notion.data_sources.query(data_source_id=data_source_id)
-        fresh_pages = fresh_response.get("results", [])
-        
-        # 构建股票 page_id -> 现价 的映射（使用最新数据）
-        stock_prices = {}
-        for page in fresh_pages:
-            page_id = page["id"]
-            props = page["properties"]
-            current_price = None
-            if "现价" in props and props["现价"].get("number") is not None:
-                current_price = props["现价"]["number"]
-            stock_prices[page_id] = current_price
-        
-        sell_count = 0
-        update_count = 0
-        
-        for trade_page in trade_pages:
-            trade_props = trade_page["properties"]
-            
-            # 检查动作类型是否为卖出
-            action_val = None
-            if "动作类型" in trade_props:
-                action_prop = trade_props["动作类型"]
-                if action_prop.get("type") == "select" and action_prop.get("select"):
-                    action_val = action_prop["select"]["name"]
-            
-            if not action_val or "卖出" not in action_val:
+        # (因为持仓同步已经更新了现价，但之前查询的页面是旧数据)
+        price_pages = notion_query.Query(data_source_id).select(holding_schema, *PRICE_PROPERTIES).all(notion)
+    prices = decode_holding_prices(price_pages)
+    print(f"   已识别 {int((prices['position_qty'] == 0).sum())} 只已清仓的股票，其买入记录将跳过")
+
+    # 卖出、买入记录只查询一次，解码为表格后统一计算
+    trades = decode_trade_log(trade_log_query(trade_schema).stream(notion))
+    frame = compute_trade_returns(trades, prices)
+
+    for action in TRADE_RETURN_FIELDS:
+        pending = frame[frame[f"is_{action}"] & ~frame[f"skipped_{action}"]]
+        for row in pending[~(pending["trade_price"] > 0)].itertuples():
+            print(f"   ⚠️ {row.trade_date}: 成交单价无效，跳过")
+        for row in pending[(pending["trade_price"] > 0) & pending["current_price"].isna()].itertuples():
+            print(f"   ⚠️ {row.trade_date}: 无法获取关联股票现价，跳过")
+
+    # 每条交易最多写入一次（同时包含卖出、买入时在写入队列中合并为一次更新）
+    update_counts = dict.fromkeys(TRADE_RETURN_FIELDS.values(), 0)
+    for _, row in frame.iterrows():
+        for field in TRADE_RETURN_FIELDS.values():
+            if not row[f"changed_{field}"]:
                 continue
-            
-            sell_count += 1
-            
-            # 获取交易日期作为标识
-            trade_date = ""
-            if "交易日期" in trade_props:
-                t = trade_props["交易日期"]
-                if t.get("title") and len(t["title"]) > 0:
-                    trade_date = t["title"][0]["text"]["content"]
-            
-            # 获取成交单价
-            sold_price = None
-            if "成交单价" in trade_props:
-                p = trade_props["成交单价"]
-                if p.get("number") is not None:
-                    sold_price = float(p["number"])
-            
-            if sold_price is None or sold_price <= 0:
-                print(f"   ⚠️ {trade_date}: 成交单价无效，跳过")
-                continue
-            
-            # 获取关联标的的现价
-            current_price = None
-            related_id = None
-            if "关联标的" in trade_props:
-                r = trade_props["关联标的"]
-                if r.get("relation") and len(r["relation"]) > 0:
-                    related_id = r["relation"][0]["id"]
-                    current_price = stock_prices.get(related_id)
-            
-            if current_price is None:
-                print(f"   ⚠️ {trade_date}: 无法获取关联股票现价，跳过")
-                continue
-            
-            # 计算卖出后涨跌幅 (小数形式，如 0.05 表示 5%)
-            sold_change_percent = (current_price - sold_price) / sold_price
-            
-            # 更新交易流水表
-            notion.pages.update(
-                page_id=trade_page["id"],
-                properties={
-                    "卖出后涨跌幅": {"number": round(sold_change_percent, 4)}
-                }
-            )
-            update_count += 1
-            print(f"   ✅ {trade_date}: 成交价 {sold_price:.2f} → 现价 {current_price:.2f} = {sold_change_percent:+.2%}")
-            time.sleep(0.3)
-        
-        print(f"📈 卖出后涨跌幅更新完成: 共 {sell_count} 条卖出记录，更新 {update_count} 条")
+            change = float(row[f"new_{field}"])
+            writes.put(row["page_id"], {field: {"number": change}}, label=row["trade_date"] or row["page_id"])
+            update_counts[field] += 1
+            print(f"   ✅ {row['trade_date']}: 成交价 {row['trade_price']:.2f} → 现价 {row['current_price']:.2f} = {change:+.2%} ({field})")
+    if flush:
+        flush_writes(writes, "交易流水")
+
+    for action, field in TRADE_RETURN_FIELDS.items():
+        total = int(frame[f"is_{action}"].sum())
+        unchanged = int(frame[f"new_{field}"].notna().sum()) - update_counts[field]
+        message = f"📈 {field}更新完成: 共 {total} 条{action}记录，更新 {update_counts[field]} 条，未变化 {unchanged} 条"
+        skipped = int(frame[f"skipped_{action}"].sum())
+        if skipped:
+            message += f"，跳过 {skipped} 条（已清仓）"
+        print(message)
+
+
+def select_markets(selection, now):
+    """
+    解析本次运行要处理的市场
+    参数：
+        selection: 'auto'、'all' 或 'CN,HK' 这样的列表；为 None 时读取环境变量 SYNC_MARKETS（默认 all）
+        now: 当前时间（带时区）
+    返回：
+        市场元组；auto 模式下只包含自上次运行以来有新收盘的市场
+    """
+    if selection is None:
+        selection = os.getenv("SYNC_MARKETS")
+    parsed = market_calendar.parse_market_selection(selection)
+    if parsed != "auto":
+        print(f"🗓️ 处理市场: {', '.join(parsed)}")
+        return parsed
+
+    markets, skipped = market_calendar.select_due_markets(now, load_market_runs())
+    print(f"🗓️ 自动选择市场: {', '.join(markets) or '无'}")
+    for market, reason in skipped.items():
+        print(f"   - 跳过 {market}: {reason}")
+    return markets
+
+
+def load_market_runs():
+    """读取各市场上次处理的时间 {市场: ISO 时间}"""
+    try:
+        return get_state_store().get_meta("market_runs", {})
     except Exception as e:
-        print(f"⚠️ 卖出后涨跌幅更新失败: {e}")
+        print(f"⚠️ 加载市场运行记录失败: {e}")
+    return {}
+
 
-    # === 买入后涨跌幅更新 (交易流水表) ===
-    print("\n📊 正在更新交易流水表中的买入后涨跌幅...")
+def save_market_runs(markets, run_started_at):
     try:
-        # 交易流水表数据源 ID (已在上方定义)
-        # TRADE_LOG_DATA_SOURCE_ID = "2db4538c-fc22-8082-a3b1-000bf0590459"
-        
-        # 如果 trade_pages 未定义（上面 try 块失败），重新查询
-        if 'trade_pages' not in dir() or trade_pages is None:
-            trade_response = notion.data_sources.query(data_source_id=TRADE_LOG_DATA_SOURCE_ID)
-            trade_pages = trade_response.get("results", [])
-        
-        # 如果 stock_prices 未定义，重新构建
-        if 'stock_prices' not in dir() or stock_prices is None:
-            fresh_response = notion.data_sources.query(data_source_id=data_source_id)
-            fresh_pages = fresh_response.get("results", [])
-            stock_prices = {}
-            for page in fresh_pages:
-                page_id = page["id"]
-                props = page["properties"]
-                current_price = None
-                if "现价" in props and props["现价"].get("number") is not None:
-                    current_price = props["现价"]["number"]
-                stock_prices[page_id] = current_price
-        
-        # 1. 构建 股票page_id -> 持仓数量 的映射（用于判断是否清仓）
-        # 只有持仓数量为0（清仓）的股票才停止买入追踪
-        stocks_fully_sold = set()  # 已清仓的股票
-        for page in fresh_pages:
-            page_id = page["id"]
-            props = page["properties"]
-            
-            # 获取持仓数量（自动）字段
-            position_qty = None
-            if "持仓数量 (自动)" in props:
-                rollup = props["持仓数量 (自动)"]
-                if rollup.get("rollup") and rollup["rollup"].get("number") is not None:
-                    position_qty = rollup["rollup"]["number"]
-            
-            # 如果持仓数量为0，标记为已清仓
-            if position_qty is not None and position_qty == 0:
-                stocks_fully_sold.add(page_id)
-        
-        print(f"   已识别 {len(stocks_fully_sold)} 只已清仓的股票，其买入记录将跳过")
-        
-        # 2. 遍历买入记录，更新买入后涨跌幅
-        buy_count = 0
-        buy_update_count = 0
-        skip_count = 0
-        
-        for trade_page in trade_pages:
-            trade_props = trade_page["properties"]
-            
-            # 检查动作类型是否为买入
-            action_val = None
-            if "动作类型" in trade_props:
-                action_prop = trade_props["动作类型"]
-                if action_prop.get("type") == "select" and action_prop.get("select"):
-                    action_val = action_prop["select"]["name"]
-            
-            if not action_val or "买入" not in action_val:
-                continue
-            
-            buy_count += 1
-            
-            # 获取交易日期作为标识
-            trade_date = ""
-            if "交易日期" in trade_props:
-                t = trade_props["交易日期"]
-                if t.get("title") and len(t["title"]) > 0:
-                    trade_date = t["title"][0]["text"]["content"]
-            
-            # 获取关联标的 ID
-            related_id = None
-            if "关联标的" in trade_props:
-                r = trade_props["关联标的"]
-                if r.get("relation") and len(r["relation"]) > 0:
-                    related_id = r["relation"][0]["id"]
-            
-            # 检查该股票是否已清仓 → 跳过
-            if related_id and related_id in stocks_fully_sold:
-                skip_count += 1
-                continue
-            
-            # 获取成交单价
-            buy_price = None
-            if "成交单价" in trade_props:
-                p = trade_props["成交单价"]
-                if p.get("number") is not None:
-                    buy_price = float(p["number"])
-            
-            if buy_price is None or buy_price <= 0:
-                print(f"   ⚠️ {trade_date}: 成交单价无效，跳过")
-                continue
-            
-            # 获取关联标的的现价
-            current_price = None
-            if related_id:
-                current_price = stock_prices.get(related_id)
-            
-            if current_price is None:
-                print(f"   ⚠️ {trade_date}: 无法获取关联股票现价，跳过")
-                continue
-            
-            # 计算买入后涨跌幅 (小数形式，如 0.05 表示 5%)
-            buy_change_percent = (current_price - buy_price) / buy_price
-            
-            # 更新交易流水表
-            notion.pages.update(
-                page_id=trade_page["id"],
-                properties={
-                    "买入后涨跌幅": {"number": round(buy_change_percent, 4)}
-                }
-            )
-            buy_update_count += 1
-            print(f"   ✅ {trade_date}: 成交价 {buy_price:.2f} → 现价 {current_price:.2f} = {buy_change_percent:+.2%}")
-            time.sleep(0.3)
-        
-        print(f"📈 买入后涨跌幅更新完成: 共 {buy_count} 条买入记录，更新 {buy_update_count} 条，跳过 {skip_count} 条（已清仓）")
+        runs = load_market_runs()
+        for market in markets:
+            runs[market] = run_started_at.isoformat()
+        get_state_store().set_meta("market_runs", runs)
     except Exception as e:
-        print(f"⚠️ 买入后涨跌幅更新失败: {e}")
+        print(f"⚠️ 保存市场运行记录失败: {e}")
 
+
+def load_holding_pages(properties=None):
+    """
+    查询持仓数据源
+    参数：
+        properties: 要返回的属性（默认 HOLDING_PROPERTIES）
+    返回：
+        (数据源 ID, 属性定义, 页面列表)
+    """
+    data_source_id = resolve_data_source_id(DATABASE_ID)
+    holding_schema = get_property_schema(data_source_id)
+    pages = (notion_query.Query(data_source_id)
+             .select(holding_schema, *(properties or HOLDING_PROPERTIES))
+             .all(notion))
+    return data_source_id, holding_schema, pages
+
+
+def load_resident_holding_pages():
+    """
+    常驻模式下持仓页面索引保存在热缓存中（DAILY），同步之间不再重新查询 Notion；
+    非常驻模式下等同 load_holding_pages()
+    """
+    return warm_cache.cached(warm_cache.DAILY, warm_cache.PAGE_INDEX_KEY, load_holding_pages)
+
+
+def apply_properties(page, properties):
+    """把已写入 Notion 的属性同步到查询得到的页面"""
+    for name, value in properties.items():
+        page["properties"].setdefault(name, {}).update(value)
+
+
+def resident_writer(pages, write):
+    """
+    包装写入函数（常驻模式）：写入成功后把属性同步到热缓存中的页面，下次同步读取到的就是已写入的值；
+    写入失败时（页面被删除、属性被修改等）丢弃页面索引，下次同步重新查询
+    """
+    if not warm_cache.is_active():
+        return write
+    by_id = {page["id"]: page for page in pages}
+
+    def write_and_apply(page_id, properties):
+        try:
+            write(page_id, properties)
+        except Exception:
+            warm_cache.discard(warm_cache.PAGE_INDEX_KEY)
+            raise
+        page = by_id.get(page_id)
+        if page is not None:
+            apply_properties(page, properties)
+    return write_and_apply
+
+
+# 全市场行情快照：快照名 → (akshare 接口, 代码列, 单位, 说明, 所属市场)
+SNAPSHOT_SOURCES = {
+    "spot_cache": ("stock_zh_a_spot_em", "代码", "只A股行情", "预加载A股行情", market_calendar.CN),
+    "etf_cache": ("fund_etf_spot_em", "代码", "只ETF行情", "预加载ETF行情", market_calendar.CN),
+    "open_fund_cache": ("fund_name_em", "基金代码", "只开放式基金名称", "预加载开放式基金列表", market_calendar.CN),
+    "hk_cache": ("stock_hk_spot_em", "代码", "只港股行情", "预加载港股行情", market_calendar.HK),
+}
+
+
+def preload_snapshots(markets):
+    """预加载本次要处理的市场的 Akshare 行情快照，返回 (A股, ETF, 港股, 开放式基金)"""
+    snapshots = {name: {} for name in SNAPSHOT_SOURCES}
+
+    if AKSHARE_AVAILABLE and (market_calendar.CN in markets or market_calendar.HK in markets):
+        print("🚀 正在预加载 A股/ETF/港股 行情数据 (加速查询)...")
+
+        # 只预加载本次要处理的市场
+        for name, source in SNAPSHOT_SOURCES.items():
+            if source[-1] in markets:
+                snapshots[name] = preload_akshare_cache(name, *source)
+    return snapshots["spot_cache"], snapshots["etf_cache"], snapshots["hk_cache"], snapshots["open_fund_cache"]
+
+
+# update_holding 的返回值 → stock_sync_holdings_total 的 result 标签
+HOLDING_RESULTS = {True: "updated", False: "failed", None: "skipped"}
+
+
+def sync_holdings(pages, markets, writes, check_signals=True, flush=True):
+    """
+    持仓同步：获取汇率、预加载行情、检查信号变化，逐条获取价格和估值后写入 Notion
+    参数：
+        pages: 持仓页面（load_holding_pages 的结果）
+        markets: 本次处理的市场（select_markets 的结果），其他市场的持仓跳过
+        writes: 写入队列（write_queue.WriteBehind），本阶段结束前写入完毕
+        check_signals: 是否检查信号变化（分片运行时由合并步骤对全部持仓检查一次，见 sharding.py）
+        flush: 为 False 时更新留在写入队列中，由调用方与后续阶段的更新一起写入
+    """
+    budget = resilience.budget()
+
+    # 1. 获取汇率
+    rates = get_exchange_rates()
+    
+    # 2. 预加载 Akshare 行情数据 (加速查询)
+    spot_cache, etf_cache, hk_cache, open_fund_cache = preload_snapshots(markets)
+    profiling.checkpoint("preload")
+
+    print(f"🔍 找到 {len(pages)} 条持仓记录，开始更新...")
+
+    if check_signals:
+        check_and_notify_signal_changes(pages)
+
+    # 3. 遍历更新股票价格（只处理本次选择的市场）
+    holdings = [page for page in pages if holding_market(page) in markets]
+    if len(holdings) < len(pages):
+        print(f"🗓️ 本次处理 {len(holdings)}/{len(pages)} 条持仓 ({', '.join(markets) or '无'})")
+    # 按预取计划批量、并发获取价格和估值（每个数据源一次调度）
+    quotes = prefetch_quotes(holdings, spot_cache, etf_cache, hk_cache)
+
+    # 因数据源熔断而失败的持仓，留到最后统一重试
+    results = {}
+    deferred_pages = []
+    for index, page in enumerate(holdings):
+        if budget is not None:
+            budget.pending = len(holdings) - index
+        with resilience.track_skips() as skipped_sources:
+            results[page["id"]] = update_holding(page, rates, spot_cache, etf_cache, hk_cache, open_fund_cache, writes, quotes)
+        if results[page["id"]] is False and skipped_sources:
+            deferred_pages.append((page, skipped_sources))
+
+    # 4. 熔断恢复后重试
+    if deferred_pages:
+        results.update(retry_deferred_holdings(deferred_pages, rates, spot_cache, etf_cache, hk_cache, open_fund_cache, writes, quotes))
+    # 每条持仓只记录最终结果（重试成功的不再算作失败）
+    for result in results.values():
+        metrics.inc(metrics.HOLDINGS, result=HOLDING_RESULTS[result])
+
+    # 5. 写入 Notion（交易流水阶段要读取最新现价，必须先写入）
+    if flush:
+        flush_writes(writes, "持仓")
+
+
+def export_run_metrics(runner, budget):
+    """记录整次运行的耗时和结束时间，并导出指标（见 metrics.py）"""
+    metrics.set_gauge(metrics.RUN_DURATION, round(budget.elapsed(), 3), runner=runner)
+    metrics.set_gauge(metrics.RUN_COMPLETED, round(time.time(), 3), runner=runner)
+    metrics.export()
+    save_cache_stats(runner)
+
+
+# 状态库中保存最近几次运行的缓存命中统计（scripts/manage_cache.py 显示）
+CACHE_STATS_KEY = "cache_stats"
+CACHE_STATS_RUNS = 20
+
+
+def save_cache_stats(runner):
+    """把本次运行各缓存的命中/未命中次数追加到状态库（只保留最近 CACHE_STATS_RUNS 次）"""
+    lookups = {}
+    for labels, count in metrics.samples(metrics.CACHE_LOOKUPS):
+        lookups.setdefault(labels["cache"], {})[labels["result"]] = count
+    if not lookups:
+        return
+    try:
+        store = get_state_store()
+        history = store.get_meta(CACHE_STATS_KEY, [])
+        history.append({"runner": runner, "finished_at": time.time(), "lookups": lookups})
+        store.set_meta(CACHE_STATS_KEY, history[-CACHE_STATS_RUNS:])
+    except Exception as e:
+        print(f"⚠️ 记录缓存统计失败: {e}")
+
+
+def update_portfolio(markets=None):
+    """
+    同步持仓数据到 Notion
+    参数：
+        markets: 要处理的市场选择（'auto'/'all'/'CN,HK' 等，见 select_markets），默认读取 SYNC_MARKETS
+    """
+    if not get_notion_client():
+        raise ValueError("❌ 错误: 未找到 NOTION_TOKEN 或 DATABASE_ID 环境变量")
+
+    run_started_at = datetime.datetime.now(datetime.timezone.utc)
+    markets = select_markets(markets, run_started_at)
+
+    # 每次运行重新统计数据源健康状况和运行指标
+    resilience.reset_breakers()
+    metrics.reset()
+    # 整次运行的时间预算 (SYNC_DEADLINE_SECONDS)，外部调用的超时由剩余时间推算
+    budget = resilience.start_budget()
+
+    # 查询 Notion 数据库
+    print(f"📥 正在查询 Notion 数据库: {DATABASE_ID} ...")
+    try:
+        data_source_id, holding_schema, pages = load_resident_holding_pages()
+    except Exception as e:
+        print(f"❌ Notion 连接失败: {e}")
+        resilience.end_budget()
+        metrics.set_gauge(metrics.STAGE_SUCCESS, 0, stage="notion_query")
+        export_run_metrics("main", budget)
+        return
+    profiling.checkpoint("notion_query")
+
+    # 持仓的更新按页面合并后限速并发写入，不再逐条写入、逐条等待
+    writes = write_queue.WriteBehind(resident_writer(pages, write_notion_page))
+    sync_holdings(pages, markets, writes)
+    save_market_runs(markets, run_started_at)
+    profiling.checkpoint("holdings")
+
+    # === 卖出后/买入后涨跌幅更新 (交易流水表) ===
+    print("\n📊 正在更新交易流水表中的卖出后/买入后涨跌幅...")
+    try:
+        update_trade_returns(data_source_id, holding_schema, writes)
+    except Exception as e:
+        print(f"⚠️ 交易流水涨跌幅更新失败: {e}")
+    profiling.checkpoint("trades")
+
+    budget.pending = 0
+    budget.report()
+    resilience.end_budget()
+    export_run_metrics("main", budget)
+    save_cache_bundle()
     print("🎉 所有任务执行完毕。")
 
+def show_prefetch_plan(markets=None):
+    """只打印本次同步的预取计划（需要哪些远程请求），不执行、不写入 Notion"""
+    if not get_notion_client():
+        raise ValueError("❌ 错误: 未找到 NOTION_TOKEN 或 DATABASE_ID 环境变量")
+    markets = select_markets(markets, datetime.datetime.now(datetime.timezone.utc))
+    _, _, pages = load_holding_pages()
+    spot_cache, etf_cache, hk_cache, _ = preload_snapshots(markets)
+    holdings = [page for page in pages if holding_market(page) in markets]
+    print(plan_prefetch(holdings, spot_cache, etf_cache, hk_cache).describe())
+
+
+def parse_args(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="同步股票/基金行情数据到 Notion")
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="常驻服务模式：数据缓存在内存中，各市场收盘后自动同步，并通过本地 HTTP 接口触发同步",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=None,
+        help="常驻模式 HTTP 触发接口的端口（默认读取 SYNC_DAEMON_PORT，未设置时为 8765）",
+    )
+    parser.add_argument(
+        "--market",
+        default=None,
+        help="要处理的市场: auto（按交易日历选择已收盘的市场）、all，或逗号分隔的 CN,HK,US,CRYPTO；默认读取 SYNC_MARKETS，未设置时为 all",
+    )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="只打印持仓同步的预取计划（按数据源列出去重后的远程请求），不执行同步",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="性能分析模式：在各阶段边界保存 cProfile 数据和内存快照并打印摘要（也可设置 SYNC_PROFILE=1，见 profiling.py）",
+    )
+    return parser.parse_args(argv)
+
+
+def activate_cassette():
+    """录制/回放外部请求（CASSETTE_MODE=record/replay），用于离线复现和性能分析；未启用时返回 None"""
+    global DATABASE_ID, notion
+    tape = cassette.activate_from_env()
+    if tape:
+        if tape.mode == "record":
+            tape.meta["DATABASE_ID"] = DATABASE_ID
+            atexit.register(tape.save)
+        else:
+            DATABASE_ID = DATABASE_ID or tape.meta.get("DATABASE_ID")
+        notion = cassette.wrap_notion(notion or get_notion_client())
+    return tape
+
+
 if __name__ == "__main__":
+    check_runtime_environment()
+    args = parse_args()
+
+    # 0. 录制/回放外部请求；性能分析模式
+    tape = activate_cassette()
+    profiling.activate_from_env(args.profile)
+
+    if args.plan:
+        show_prefetch_plan(markets=args.market)
+        sys.exit(0)
+
+    # 常驻模式：只负责持仓同步，不执行平安证券组合同步
+    if args.daemon:
+        import daemon
+        warm_cache.activate()
+        service = daemon.SyncDaemon(
+            lambda markets: update_portfolio(markets=markets),
+            port=args.port or daemon.DEFAULT_PORT,
+        )
+        if args.market:
+            service.trigger(args.market)
+        service.serve_forever()
+        sys.exit(0)
+
     # 1. 更新所有股票价格、PE、PB等数据
-    update_portfolio()
+    update_portfolio(markets=args.market)
 
     # 2. 同步平安证券股票组合到账户总览
+    if tape and tape.mode == "replay":
+        print("\n⚠️  回放模式: 跳过平安证券组合同步（未录制）")
+        sys.exit(0)
     try:
         from scripts.update_pingan_portfolio import main as sync_pingan_portfolio
         print("\n" + "="*60)
@@ -1952,3 +2693,4 @@ if __name__ == "__main__":
         print(f"\n⚠️  跳过平安证券组合同步: 模块导入失败 ({e})")
     except Exception as e:
         print(f"\n⚠️  平安证券组合同步失败: {e}")
+    profiling.checkpoint("pingan")
@@ -0,0 +1,170 @@
+"""
+交易日历与按市场分批运行
+
+sync.yml 每天运行两次：UTC 07:00（A股收盘后）和 UTC 21:00（美股收盘后）。
+以前两次运行都处理全部持仓；按市场分批后，每次只处理“自上次运行以来完成了一个交易时段”的市场，
+休市期间没有新的收盘，对应市场整体跳过。只比较最近一次收盘与上次运行时间，不看当地“今天”是否交易：
+周五 UTC 21:00 的运行在港股/A股当地已是周六，但周五的收盘仍需要处理。
+
+市场：CN（A股/场内外基金，含 QDII）、HK（港股）、US（美股）、CRYPTO（加密货币，全天候）
+
+节假日表为手工维护的内置数据（周末自动视为休市），可以通过环境变量 MARKET_HOLIDAYS_FILE
+指定 JSON 文件覆盖/补充，格式：{"CN": ["2027-01-01", ...], "US": [...]}。
+内置表未覆盖的年份只按周末判断。
+"""
+import os
+import json
+import datetime
+from zoneinfo import ZoneInfo
+
+CN = "CN"
+HK = "HK"
+US = "US"
+CRYPTO = "CRYPTO"
+MARKETS = (CN, HK, US, CRYPTO)
+
+# 各市场收盘时间（当地时间）
+SESSION_CLOSE = {
+    CN: (ZoneInfo("Asia/Shanghai"), datetime.time(15, 0)),
+    HK: (ZoneInfo("Asia/Hong_Kong"), datetime.time(16, 0)),
+    US: (ZoneInfo("America/New_York"), datetime.time(16, 0)),
+}
+
+# 交易所休市日（仅列出工作日）
+HOLIDAYS = {
+    CN: {
+        # 2025
+        "2025-01-01", "2025-01-28", "2025-01-29", "2025-01-30", "2025-01-31", "2025-02-03", "2025-02-04",
+        "2025-04-04", "2025-05-01", "2025-05-02", "2025-05-05", "2025-06-02",
+        "2025-10-01", "2025-10-02", "2025-10-03", "2025-10-06", "2025-10-07", "2025-10-08",
+        # 2026
+        "2026-01-01", "2026-01-02", "2026-02-16", "2026-02-17", "2026-02-18", "2026-02-19", "2026-02-20",
+        "2026-02-23", "2026-04-06", "2026-05-01", "2026-05-04", "2026-05-05", "2026-06-19", "2026-09-25",
+        "2026-10-01", "2026-10-02", "2026-10-05", "2026-10-06", "2026-10-07",
+    },
+    HK: {
+        # 2025
+        "2025-01-01", "2025-01-29", "2025-01-30", "2025-01-31", "2025-04-04", "2025-04-18", "2025-04-21",
+        "2025-05-01", "2025-05-05", "2025-07-01", "2025-10-01", "2025-10-07", "2025-10-29",
+        "2025-12-25", "2025-12-26",
+        # 2026
+        "2026-01-01", "2026-02-17", "2026-02-18", "2026-02-19", "2026-04-03", "2026-04-06", "2026-04-07",
+        "2026-05-01", "2026-05-25", "2026-06-19", "2026-07-01", "2026-10-01", "2026-10-19", "2026-12-25",
+    },
+    US: {
+        # 2025
+        "2025-01-01", "2025-01-09", "2025-01-20", "2025-02-17", "2025-04-18", "2025-05-26", "2025-06-19",
+        "2025-07-04", "2025-09-01", "2025-11-27", "2025-12-25",
+        # 2026
+        "2026-01-01", "2026-01-19", "2026-02-16", "2026-04-03", "2026-05-25", "2026-06-19", "2026-07-03",
+        "2026-09-07", "2026-11-26", "2026-12-25",
+    },
+}
+
+# 从节假日表中最多往前回溯多少天寻找上一个交易日
+_MAX_LOOKBACK_DAYS = 30
+
+_extra_holidays = None
+
+
+def _load_extra_holidays():
+    global _extra_holidays
+    if _extra_holidays is None:
+        _extra_holidays = {}
+        path = os.getenv("MARKET_HOLIDAYS_FILE")
+        if path:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                _extra_holidays = {m.upper(): set(days) for m, days in data.items()}
+            except Exception as e:
+                print(f"⚠️ 加载节假日文件失败 {path}: {e}")
+    return _extra_holidays
+
+
+def is_trading_day(market, day):
+    """day 是否是 market 的交易日（CRYPTO 每天都交易）"""
+    if market == CRYPTO:
+        return True
+    if day.weekday() >= 5:
+        return False
+    key = day.isoformat()
+    return key not in HOLIDAYS.get(market, ()) and key not in _load_extra_holidays().get(market, ())
+
+
+def last_session_close(market, now):
+    """
+    now 之前（含）最近一次收盘的时间（带时区）；CRYPTO 没有收盘，返回 now
+    """
+    if market == CRYPTO:
+        return now
+    tz, close_time = SESSION_CLOSE[market]
+    day = now.astimezone(tz).date()
+    for _ in range(_MAX_LOOKBACK_DAYS):
+        close = datetime.datetime.combine(day, close_time, tzinfo=tz)
+        if close <= now and is_trading_day(market, day):
+            return close
+        day -= datetime.timedelta(days=1)
+    return None
+
+
+def next_session_close(market, now):
+    """now 之后最近一次收盘的时间（带时区），用于常驻模式的调度"""
+    tz, close_time = SESSION_CLOSE[market]
+    day = now.astimezone(tz).date()
+    for _ in range(_MAX_LOOKBACK_DAYS):
+        close = datetime.datetime.combine(day, close_time, tzinfo=tz)
+        if close > now and is_trading_day(market, day):
+            return close
+        day += datetime.timedelta(days=1)
+    return None
+
+
+def parse_market_selection(value):
+    """
+    解析市场选择：'auto'、'all' 或逗号分隔的市场列表（如 'CN,HK'）
+    返回 'auto' 或市场元组；value 为空时视为 'all'
+    """
+    value = (value or "all").strip()
+    if value.lower() == "auto":
+        return "auto"
+    if value.lower() == "all":
+        return MARKETS
+    markets = []
+    for item in value.split(","):
+        item = item.strip().upper()
+        if not item:
+            continue
+        if item not in MARKETS:
+            raise ValueError(f"未知市场: {item}（可选: {', '.join(MARKETS)}, auto, all）")
+        markets.append(item)
+    return tuple(markets)
+
+
+def select_due_markets(now, last_runs):
+    """
+    自动模式：返回 (需要处理的市场, {跳过的市场: 原因})
+    last_runs: {市场: 上次处理该市场的时间 (ISO 字符串)}
+    """
+    due = []
+    skipped = {}
+    for market in MARKETS:
+        if market == CRYPTO:
+            due.append(market)
+            continue
+        close = last_session_close(market, now)
+        last_run = last_runs.get(market)
+        if close is None:
+            skipped[market] = "无最近交易日"
+        elif last_run and datetime.datetime.fromisoformat(last_run) >= close:
+            skipped[market] = f"上次运行后尚未收盘（最近收盘 {close.strftime('%m-%d %H:%M %Z')}）"
+        else:
+            due.append(market)
+    return tuple(due), skipped
+
+
+def market_of(ticker_symbol, calc_currency, crypto_symbols=()):
+    """持仓所属市场：加密货币 → CRYPTO，其余按结算货币 CNY/HKD/USD 对应 CN/HK/US"""
+    if ticker_symbol.upper() in crypto_symbols or ticker_symbol.upper().endswith("-USD"):
+        return CRYPTO
+    return {"CNY": CN, "HKD": HK}.get(calc_currency, US)
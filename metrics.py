@@ -0,0 +1,276 @@
+"""
+运行健康度与上游延迟指标（OpenMetrics / Prometheus 文本格式）
+
+每天两次的生产运行变慢或部分失败时，以前只能等到 Notion 中的价格过期才发现。
+同步过程中在各处累计指标，运行结束时导出，用于告警（如东方财富变慢、某个数据源错误率升高）：
+
+| 指标 | 类型 | 标签 |
+|------|------|------|
+| stock_sync_upstream_requests | counter | source, outcome（ok / error / no_data / circuit_open） |
+| stock_sync_upstream_request_duration_seconds | histogram | source |
+| stock_sync_prefetch_requests / stock_sync_prefetch_failures | counter | provider |
+| stock_sync_prefetch_duration_seconds | histogram | provider |
+| stock_sync_cache_lookups | counter | cache（warm / snapshot / pe_series / price_bars / fundamentals / fx）, result（hit / miss） |
+| stock_sync_tickers_priced | counter | source, currency |
+| stock_sync_holdings | counter | result（updated / failed / skipped） |
+| stock_sync_notion_writes | counter | stage, result（sent / coalesced / failed） |
+| stock_sync_run_duration_seconds / stock_sync_run_completed_timestamp_seconds | gauge | runner |
+| stock_sync_stage_success | gauge | stage |
+
+错误率由 outcome 计算，例如 rate(stock_sync_upstream_requests_total{outcome="error"}[1d])。
+
+导出方式（环境变量，均可选）：
+    SYNC_METRICS_FILE      写入文本文件（node_exporter textfile collector，文件名以 .prom 结尾），先写临时文件再替换
+    SYNC_METRICS_PUSH_URL  PUT 到 Pushgateway 等本地接口，如 http://127.0.0.1:9091/metrics/job/stock_sync
+常驻模式下 GET /metrics 返回最近一次运行的指标（OpenMetrics 格式）。
+
+每次运行开始时 reset()，指标只描述本次运行。分片运行时各工作进程 dump() 样本写入运行报告，
+合并时 merge() 到协调进程中统一导出（见 sharding.py）。
+"""
+import os
+import math
+import threading
+import urllib.request
+
+import file_lock
+
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+
+UPSTREAM_REQUESTS = "stock_sync_upstream_requests"
+UPSTREAM_DURATION = "stock_sync_upstream_request_duration_seconds"
+PREFETCH_REQUESTS = "stock_sync_prefetch_requests"
+PREFETCH_FAILURES = "stock_sync_prefetch_failures"
+PREFETCH_DURATION = "stock_sync_prefetch_duration_seconds"
+CACHE_LOOKUPS = "stock_sync_cache_lookups"
+TICKERS_PRICED = "stock_sync_tickers_priced"
+HOLDINGS = "stock_sync_holdings"
+NOTION_WRITES = "stock_sync_notion_writes"
+RUN_DURATION = "stock_sync_run_duration_seconds"
+RUN_COMPLETED = "stock_sync_run_completed_timestamp_seconds"
+STAGE_SUCCESS = "stock_sync_stage_success"
+
+FAMILIES = {
+    UPSTREAM_REQUESTS: (COUNTER, "经熔断器的上游数据源调用次数"),
+    UPSTREAM_DURATION: (HISTOGRAM, "上游数据源调用耗时（秒）"),
+    PREFETCH_REQUESTS: (COUNTER, "预取阶段各数据源的远程请求数"),
+    PREFETCH_FAILURES: (COUNTER, "预取阶段整体失败的数据源批次数"),
+    PREFETCH_DURATION: (HISTOGRAM, "预取阶段各数据源批次的耗时（秒）"),
+    CACHE_LOOKUPS: (COUNTER, "缓存查询次数"),
+    TICKERS_PRICED: (COUNTER, "按价格来源统计的已定价持仓数"),
+    HOLDINGS: (COUNTER, "持仓处理结果"),
+    NOTION_WRITES: (COUNTER, "Notion 写入请求（coalesced 为合并掉、未单独发出的更新）"),
+    RUN_DURATION: (GAUGE, "整次运行耗时（秒）"),
+    RUN_COMPLETED: (GAUGE, "运行结束时间（Unix 时间戳）"),
+    STAGE_SUCCESS: (GAUGE, "阶段是否成功（1/0）"),
+}
+
+# 延迟直方图的分桶上限（秒），覆盖快照查找到接近调用超时（resilience.DEFAULT_CALL_TIMEOUT）
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+OPENMETRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+PUSH_TIMEOUT = 10
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Registry:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _family(self, name, expected):
+        kind, _ = FAMILIES[name]
+        if kind != expected:
+            raise ValueError(f"指标 {name} 的类型是 {kind}，不是 {expected}")
+        return self._values.setdefault(name, {})
+
+    def inc(self, name, amount=1, **labels):
+        with self._lock:
+            family = self._family(name, COUNTER)
+            key = _label_key(labels)
+            family[key] = family.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._family(name, GAUGE)[_label_key(labels)] = value
+
+    def observe(self, name, value, **labels):
+        with self._lock:
+            family = self._family(name, HISTOGRAM)
+            key = _label_key(labels)
+            # [各分桶计数（不累计）..., +Inf 分桶计数, 总和]
+            entry = family.setdefault(key, [0] * (len(self.buckets) + 1) + [0.0])
+            index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+            entry[index] += 1
+            entry[-1] += value
+
+    def value(self, name, **labels):
+        """counter/gauge 的当前值；histogram 返回观测次数（未记录时为 0）"""
+        with self._lock:
+            entry = self._values.get(name, {}).get(_label_key(labels))
+        if entry is None:
+            return 0
+        return sum(entry[:-1]) if FAMILIES[name][0] == HISTOGRAM else entry
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    def dump(self):
+        """可 JSON 序列化的全部样本 [[名称, [[标签, 值]...], 值或分桶计数]]，用于在进程间传递（见 merge）"""
+        with self._lock:
+            return [[name, [list(pair) for pair in key], list(entry) if isinstance(entry, list) else entry]
+                    for name, samples in self._values.items() for key, entry in samples.items()]
+
+    def merge(self, dumped):
+        """合并另一个进程 dump() 的样本：counter 和 histogram 累加，gauge 覆盖"""
+        with self._lock:
+            for name, pairs, entry in dumped:
+                kind = FAMILIES[name][0]
+                family = self._values.setdefault(name, {})
+                key = tuple(tuple(pair) for pair in pairs)
+                if kind == COUNTER:
+                    family[key] = family.get(key, 0) + entry
+                elif kind == GAUGE:
+                    family[key] = entry
+                else:
+                    current = family.setdefault(key, [0] * (len(self.buckets) + 1) + [0.0])
+                    family[key] = [a + b for a, b in zip(current, entry)]
+
+    def render(self, openmetrics=True):
+        """
+        openmetrics=True：OpenMetrics 格式（counter 的类型行不带 _total，以 # EOF 结尾）
+        openmetrics=False：Prometheus 文本格式 0.0.4（textfile collector / Pushgateway）
+        """
+        lines = []
+        with self._lock:
+            for name, (kind, help_text) in FAMILIES.items():
+                samples = self._values.get(name)
+                if not samples:
+                    continue
+                family = name if openmetrics or kind != COUNTER else f"{name}_total"
+                lines.append(f"# TYPE {family} {kind}")
+                lines.append(f"# HELP {family} {_escape(help_text)}")
+                for key, entry in sorted(samples.items()):
+                    if kind == COUNTER:
+                        lines.append(f"{name}_total{_format_labels(key)} {_format_value(entry)}")
+                    elif kind == GAUGE:
+                        lines.append(f"{name}{_format_labels(key)} {_format_value(entry)}")
+                    else:
+                        cumulative = 0
+                        for bound, count in zip(self.buckets + (math.inf,), entry[:-1]):
+                            cumulative += count
+                            le = "+Inf" if bound == math.inf else repr(float(bound))
+                            lines.append(f"{name}_bucket{_format_labels(key, [('le', le)])} {cumulative}")
+                        lines.append(f"{name}_count{_format_labels(key)} {cumulative}")
+                        lines.append(f"{name}_sum{_format_labels(key)} {_format_value(entry[-1])}")
+        if openmetrics:
+            lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+_registry = Registry()
+
+
+def registry():
+    return _registry
+
+
+def inc(name, amount=1, **labels):
+    _registry.inc(name, amount, **labels)
+
+
+def set_gauge(name, value, **labels):
+    _registry.set(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    _registry.observe(name, value, **labels)
+
+
+def value(name, **labels):
+    return _registry.value(name, **labels)
+
+
+def samples(name):
+    """name 的所有样本 [(标签 dict, 值)]；histogram 的值为观测次数"""
+    with _registry._lock:
+        keys = list(_registry._values.get(name, {}))
+    return [(dict(key), _registry.value(name, **dict(key))) for key in keys]
+
+
+def reset():
+    """清空所有指标（每次运行开始时调用）"""
+    _registry.reset()
+
+
+def dump():
+    return _registry.dump()
+
+
+def merge(dumped):
+    _registry.merge(dumped)
+
+
+def render(openmetrics=True):
+    return _registry.render(openmetrics)
+
+
+def write_textfile(path):
+    """写入 Prometheus 文本文件；先写临时文件再替换，textfile collector 不会读到写了一半的文件"""
+    with file_lock.atomic_write(path) as f:
+        f.write(render(openmetrics=False))
+
+
+def push(url, timeout=PUSH_TIMEOUT):
+    """PUT 到 Pushgateway 等接口（替换该 job 分组下的所有指标）"""
+    request = urllib.request.Request(url, data=render(openmetrics=False).encode("utf-8"), method="PUT",
+                                     headers={"Content-Type": PROMETHEUS_CONTENT_TYPE})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return response.status
+
+
+def export(path=None, push_url=None):
+    """
+    按 SYNC_METRICS_FILE / SYNC_METRICS_PUSH_URL 导出本次运行的指标；都未设置时不做任何事
+    导出失败只打印警告，不影响同步结果
+    """
+    path = path or os.getenv("SYNC_METRICS_FILE")
+    push_url = push_url or os.getenv("SYNC_METRICS_PUSH_URL")
+    if path:
+        try:
+            write_textfile(path)
+            print(f"📈 指标已写入 {path}")
+        except Exception as e:
+            print(f"⚠️ 指标写入失败: {e}")
+    if push_url:
+        try:
+            push(push_url)
+            print(f"📈 指标已推送到 {push_url}")
+        except Exception as e:
+            print(f"⚠️ 指标推送失败: {e}")
@@ -0,0 +1,190 @@
+"""
+后台批量发送的 Telegram 通知队列
+
+以前信号变化通知在持仓循环之前同步发送（requests.post，10s 超时），会阻塞整个同步流程；
+大量信号同时变化时拼出的单条消息还可能超过 Telegram 4096 字符的上限而发送失败。
+
+现在 notify() 只把消息放入队列并立即返回，由后台线程发送：
+- 合批：BATCH_WINDOW 秒内入队的消息合并发送
+- 分段：按段落（空行）/行边界切分，每段不超过 TELEGRAM_LIMIT
+- 重试：网络错误、429 限流和 5xx 按指数退避重试（429 优先使用 Telegram 返回的 retry_after）；
+  其他 4xx（如消息格式错误）不重试
+- 退出：进程退出时（atexit）等待队列发送完毕，最多 FLUSH_TIMEOUT 秒
+"""
+import time
+import queue
+import atexit
+import threading
+
+TELEGRAM_LIMIT = 4096
+# 入队后等待合批的时间（秒）
+BATCH_WINDOW = 1.0
+# 两条消息之间的最小间隔（Telegram 对单个会话约 1 条/秒的限制）
+MIN_INTERVAL = 1.0
+MAX_ATTEMPTS = 4
+BACKOFF_BASE = 2.0
+SEND_TIMEOUT = 10
+FLUSH_TIMEOUT = 30
+
+
+def split_message(text, limit=TELEGRAM_LIMIT):
+    """按段落、行的边界把 text 切分为不超过 limit 的若干段；单行超长时硬切"""
+    pieces = []
+    for paragraph in text.split("\n\n"):
+        if len(paragraph) <= limit:
+            pieces.append(paragraph)
+            continue
+        for line in paragraph.split("\n"):
+            while len(line) > limit:
+                pieces.append(line[:limit])
+                line = line[limit:]
+            pieces.append(line)
+
+    chunks = []
+    current = ""
+    for piece in pieces:
+        separator = "\n\n" if current else ""
+        if len(current) + len(separator) + len(piece) <= limit:
+            current += separator + piece
+        else:
+            if current:
+                chunks.append(current)
+            current = piece
+    if current.strip():
+        chunks.append(current)
+    return chunks
+
+
+class SendError(Exception):
+    def __init__(self, message, retryable=True, retry_after=None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+def telegram_sender(token, chat_id):
+    """返回通过 Telegram Bot API 发送一条 HTML 消息的函数"""
+    url = f"https://api.telegram.org/bot{token}/sendMessage"
+
+    def send(text):
+        import requests
+        try:
+            resp = requests.post(url, json={"chat_id": chat_id, "text": text, "parse_mode": "HTML"}, timeout=SEND_TIMEOUT)
+        except requests.RequestException as e:
+            raise SendError(str(e))
+        if resp.status_code == 200:
+            return
+        retry_after = None
+        try:
+            retry_after = resp.json().get("parameters", {}).get("retry_after")
+        except ValueError:
+            pass
+        retryable = resp.status_code == 429 or resp.status_code >= 500
+        raise SendError(f"HTTP {resp.status_code}: {resp.text[:200]}", retryable, retry_after)
+
+    return send
+
+
+class Notifier:
+    def __init__(self, send, batch_window=BATCH_WINDOW, sleep=time.sleep):
+        """send: 发送一条消息的函数，失败时抛出 SendError"""
+        self._send = send
+        self._batch_window = batch_window
+        self._sleep = sleep
+        self._queue = queue.Queue()
+        self.sent = 0
+        self.failed = 0
+        self._worker = threading.Thread(target=self._run, name="notifier", daemon=True)
+        self._worker.start()
+
+    def notify(self, text):
+        """入队，立即返回"""
+        self._queue.put(text)
+
+    def flush(self, timeout=FLUSH_TIMEOUT):
+        """等待已入队的消息发送完毕（或超时）；返回是否全部处理完"""
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def _collect_batch(self, first):
+        """合并 BATCH_WINDOW 内入队的消息；遇到 flush 标记立即结束合批"""
+        texts = [first]
+        markers = []
+        deadline = time.monotonic() + self._batch_window
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if isinstance(item, threading.Event):
+                markers.append(item)
+                break
+            texts.append(item)
+        return texts, markers
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if isinstance(item, threading.Event):
+                item.set()
+                continue
+            texts, markers = self._collect_batch(item)
+            for index, chunk in enumerate(split_message("\n\n".join(texts))):
+                if index:
+                    self._sleep(MIN_INTERVAL)
+                self._deliver(chunk)
+            for marker in markers:
+                marker.set()
+
+    def _deliver(self, chunk):
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            try:
+                self._send(chunk)
+                self.sent += 1
+                print(f"📤 Telegram 推送成功")
+                return True
+            except SendError as e:
+                if not e.retryable or attempt == MAX_ATTEMPTS:
+                    self.failed += 1
+                    print(f"⚠️ Telegram 推送失败: {e}")
+                    return False
+                self._sleep(e.retry_after or BACKOFF_BASE ** (attempt - 1))
+            except Exception as e:
+                self.failed += 1
+                print(f"⚠️ Telegram 推送异常: {e}")
+                return False
+
+
+_notifier = None
+_lock = threading.Lock()
+
+
+def start(token, chat_id, send=None):
+    """创建全局通知队列（重复调用返回同一个），进程退出时自动 flush"""
+    global _notifier
+    with _lock:
+        if _notifier is None:
+            _notifier = Notifier(send or telegram_sender(token, chat_id))
+            atexit.register(shutdown)
+        return _notifier
+
+
+def notify(text):
+    """入队一条消息；未调用 start() 时返回 False"""
+    if _notifier is None:
+        return False
+    _notifier.notify(text)
+    return True
+
+
+def shutdown(timeout=FLUSH_TIMEOUT):
+    """等待队列中的消息发送完毕"""
+    global _notifier
+    with _lock:
+        notifier, _notifier = _notifier, None
+    if notifier is not None and not notifier.flush(timeout):
+        print(f"⚠️ Telegram 通知队列在 {timeout}s 内未发送完毕")
@@ -0,0 +1,230 @@
+"""
+Notion 数据源查询构建器：把筛选条件下推到服务端，并分页流式读取结果
+
+以前交易流水、平安证券组合都是先下载整个数据源、再在 Python 里筛选，而且只读了第一页（最多 100 条）。
+Query 把条件转换为 data_sources.query 的 filter / sorts，只有需要的行会被传输；
+无法下推的条件用 matching() 在结果流入时逐条过滤。
+select() 声明本次读取的属性（filter_properties），返回的页面只包含这些属性，不再携带用不到的 rollup / formula。
+
+select / status / multi_select 属性在 Notion 中只支持精确匹配，“包含某段文字”的条件通过数据源的属性定义
+展开为所有包含该文字的选项的 OR；属性定义不可用时退回客户端过滤。
+
+    schema = property_schema(notion, data_source_id)
+    query = (Query(data_source_id)
+             .where_contains(schema, "动作类型", "卖出")
+             .order_by("交易日期")
+             .select(schema, "交易日期", "成交单价", "关联标的")
+             .matching(lambda page: ...))
+    for page in query.stream(notion):
+        ...
+"""
+from urllib.parse import unquote
+
+# Notion 单页最多返回 100 条
+PAGE_SIZE = 100
+
+_EXACT_MATCH_TYPES = ("select", "status", "multi_select")
+_TEXT_TYPES = ("rich_text", "title")
+
+
+def equals(prop, prop_type, value):
+    """属性等于 value；multi_select 为“包含该选项”"""
+    operator = "contains" if prop_type == "multi_select" else "equals"
+    return {"property": prop, prop_type: {operator: value}}
+
+
+def text_contains(prop, prop_type, text):
+    return {"property": prop, prop_type: {"contains": text}}
+
+
+def is_not_empty(prop, prop_type):
+    return {"property": prop, prop_type: {"is_not_empty": True}}
+
+
+def all_of(*filters):
+    filters = [f for f in filters if f]
+    if len(filters) <= 1:
+        return filters[0] if filters else None
+    return {"and": filters}
+
+
+def any_of(*filters):
+    # 嵌套的 OR 展开为一层（Notion 的复合条件最多嵌套两层）
+    filters = [g for f in filters if f for g in (f["or"] if list(f) == ["or"] else [f])]
+    if len(filters) <= 1:
+        return filters[0] if filters else None
+    return {"or": filters}
+
+
+def property_schema(client, data_source_id):
+    """数据源的属性定义 {属性名: 定义}；获取失败时返回空 dict（所有条件退回客户端过滤）"""
+    try:
+        return client.data_sources.retrieve(data_source_id=data_source_id).get("properties", {})
+    except Exception as e:
+        print(f"⚠️ 获取数据源属性定义失败，改为客户端过滤: {e}")
+        return {}
+
+
+def property_ids(schema, names):
+    """
+    属性名 → filter_properties 使用的属性 ID
+    属性定义中不存在的属性名会被忽略（如兼容列名 "Ticker"）；一个都解析不到时返回 None（不做投影）
+    """
+    ids = []
+    for name in names:
+        definition = schema.get(name)
+        if definition and definition.get("id"):
+            # 属性定义中的 ID 是 URL 编码过的，请求时会再编码一次
+            ids.append(unquote(definition["id"]))
+    return ids or None
+
+
+class MatchNothing(Exception):
+    """条件不可能匹配任何行（如没有任何选项包含指定文字）"""
+
+
+def contains_filter(schema, prop, text):
+    """
+    “属性值包含 text”的服务端过滤条件
+    返回 None 表示无法下推（属性不存在或类型不支持）；没有可能匹配的选项时抛出 MatchNothing
+    """
+    definition = schema.get(prop)
+    if not definition:
+        return None
+    prop_type = definition.get("type")
+    if prop_type in _TEXT_TYPES:
+        return text_contains(prop, prop_type, text)
+    if prop_type in _EXACT_MATCH_TYPES:
+        options = definition.get(prop_type, {}).get("options", [])
+        names = [o["name"] for o in options if text in o.get("name", "")]
+        if not names:
+            raise MatchNothing(f"{prop} 没有包含“{text}”的选项")
+        return any_of(*(equals(prop, prop_type, name) for name in names))
+    return None
+
+
+class Query:
+    def __init__(self, data_source_id, page_size=PAGE_SIZE):
+        self.data_source_id = data_source_id
+        self.page_size = page_size
+        self._filters = []
+        self._sorts = []
+        self._predicates = []
+        self._projection = None
+        self._empty = False
+
+    def where(self, notion_filter):
+        """追加服务端过滤条件（多个条件之间为 AND）"""
+        if notion_filter:
+            self._filters.append(notion_filter)
+        return self
+
+    def where_contains(self, schema, prop, text):
+        """属性值包含 text：能下推时在服务端过滤，否则在客户端过滤"""
+        try:
+            notion_filter = contains_filter(schema, prop, text)
+        except MatchNothing:
+            self._empty = True
+            return self
+        if notion_filter:
+            return self.where(notion_filter)
+        return self.matching(lambda page: text in (property_text(page["properties"].get(prop)) or ""))
+
+    def where_contains_any(self, schema, prop, texts):
+        """属性值包含 texts 中任意一段文字：能下推时在服务端过滤，否则在客户端过滤"""
+        filters = []
+        for text in texts:
+            try:
+                notion_filter = contains_filter(schema, prop, text)
+            except MatchNothing:
+                continue
+            if notion_filter is None:
+                return self.matching(
+                    lambda page: any(t in (property_text(page["properties"].get(prop)) or "") for t in texts))
+            filters.append(notion_filter)
+        if not filters:
+            self._empty = True
+            return self
+        return self.where(any_of(*filters))
+
+    def where_not_empty(self, schema, prop):
+        """属性不为空：属性定义可用时在服务端过滤，否则在客户端过滤"""
+        definition = schema.get(prop)
+        if definition and definition.get("type"):
+            return self.where(is_not_empty(prop, definition["type"]))
+        return self.matching(lambda page: _has_value(page["properties"].get(prop)))
+
+    def order_by(self, prop, descending=False):
+        self._sorts.append({"property": prop, "direction": "descending" if descending else "ascending"})
+        return self
+
+    def select(self, schema, *names):
+        """只返回 names 中的属性；属性定义不可用时返回全部属性"""
+        self._projection = property_ids(schema, names)
+        return self
+
+    def matching(self, predicate):
+        """客户端过滤条件：predicate(page) 为 True 的行才会返回"""
+        self._predicates.append(predicate)
+        return self
+
+    def payload(self, start_cursor=None):
+        """data_sources.query 的参数"""
+        kwargs = {"data_source_id": self.data_source_id, "page_size": self.page_size}
+        notion_filter = all_of(*self._filters)
+        if notion_filter:
+            kwargs["filter"] = notion_filter
+        if self._sorts:
+            kwargs["sorts"] = list(self._sorts)
+        if self._projection:
+            kwargs["filter_properties"] = list(self._projection)
+        if start_cursor:
+            kwargs["start_cursor"] = start_cursor
+        return kwargs
+
+    def stream(self, client):
+        """逐页查询并逐条返回匹配的行"""
+        if self._empty:
+            return
+        cursor = None
+        while True:
+            response = client.data_sources.query(**self.payload(cursor))
+            for page in response.get("results", []):
+                if all(predicate(page) for predicate in self._predicates):
+                    yield page
+            cursor = response.get("next_cursor")
+            if not response.get("has_more") or not cursor:
+                return
+
+    def all(self, client):
+        return list(self.stream(client))
+
+
+def _has_value(prop):
+    if not prop:
+        return False
+    prop_type = prop.get("type")
+    if prop_type:
+        return bool(prop.get(prop_type))
+    return any(bool(v) for k, v in prop.items() if k != "id")
+
+
+def property_text(prop):
+    """select/status/rich_text/title 属性的文字内容"""
+    if not prop:
+        return None
+    prop_type = prop.get("type")
+    value = prop.get(prop_type) if prop_type else None
+    if prop_type in ("select", "status"):
+        return value.get("name") if value else None
+    if prop_type == "multi_select":
+        return ",".join(o.get("name", "") for o in value or [])
+    if prop_type in _TEXT_TYPES:
+        return "".join(t.get("plain_text") or t.get("text", {}).get("content", "") for t in value or [])
+    # 未标注 type 的属性（与旧代码兼容）
+    if prop.get("select"):
+        return prop["select"].get("name")
+    for text_type in _TEXT_TYPES:
+        if prop.get(text_type):
+            return prop[text_type][0].get("text", {}).get("content")
+    return None
@@ -0,0 +1,345 @@
+"""
+单进程流水线：持仓同步、交易流水涨跌幅、债券收益率、平安证券组合在同一进程中按阶段执行
+
+以前 python main.py 和 python scripts/update_bond_etf_yield.py 是两个进程，各自导入 akshare/pandas、
+创建 Notion 客户端、获取数据库信息、查询整个持仓数据源；平安证券组合同步挂在 main.py 末尾，又查询一遍。
+现在各阶段共用：
+
+- 一个 Notion 客户端（同一个 HTTP 连接池）
+- 一个页面索引（PageIndex）：持仓数据源只查询一次，包含所有阶段读取的属性；
+  写入成功后索引中的属性同步更新，交易流水阶段直接读取最新现价，不再重新查询
+- 一个缓存层：内存热缓存（warm_cache）和本地状态库（state_store）
+- 一个写入队列（write_queue.WriteBehind）：所有阶段的 Notion 更新都经它限速、重试，同一页面的更新合并为一个请求。
+  交易流水阶段要读取写入后的现价，持仓阶段在它之前写入；其余更新（交易流水涨跌幅、债券 Yield、
+  平安证券组合 relation，以及没有交易流水阶段时的持仓更新）在所有阶段结束后一起写入一次
+
+    python pipeline.py                              # 全部阶段
+    python pipeline.py --stages holdings,trades     # 只执行指定阶段
+    python pipeline.py --stages bonds               # 单独执行某个阶段
+    python pipeline.py --profile                    # 性能分析模式（见 profiling.py）
+    python pipeline.py --shards 4                   # 持仓同步分给 4 个工作进程（见 sharding.py）
+"""
+import os
+import sys
+import datetime
+import tempfile
+import threading
+
+import main
+import profiling
+import metrics
+import resilience
+import sharding
+import warm_cache
+import write_queue
+from scripts import update_bond_etf_yield as bond_stage
+from scripts import update_pingan_portfolio as pingan_stage
+
+HOLDINGS = "holdings"
+TRADES = "trades"
+BONDS = "bonds"
+PINGAN = "pingan"
+STAGES = (HOLDINGS, TRADES, BONDS, PINGAN)
+
+# 页面索引包含的属性：所有阶段读取的属性的并集（债券阶段只读取股票代码）
+INDEX_PROPERTIES = list(dict.fromkeys(main.HOLDING_PROPERTIES + main.PRICE_PROPERTIES + pingan_stage.PINGAN_PROPERTIES))
+
+
+def parse_stages(selection):
+    """'holdings,trades' / 'all' / None → 按执行顺序排列的阶段元组；包含未知阶段时抛出 ValueError"""
+    if not selection or selection.strip().lower() == "all":
+        return STAGES
+    names = [s.strip().lower() for s in selection.split(",") if s.strip()]
+    unknown = [s for s in names if s not in STAGES]
+    if unknown:
+        raise ValueError(f"未知阶段: {', '.join(unknown)}（可选: {', '.join(STAGES)}）")
+    return tuple(s for s in STAGES if s in names)
+
+
+class PageIndex:
+    """持仓数据源的页面索引：所有阶段共用一次查询的结果"""
+
+    def __init__(self, properties=None):
+        self.properties = properties or INDEX_PROPERTIES
+        self.data_source_id = None
+        self.schema = None
+        self._pages = None
+        self._by_id = {}
+        self._lock = threading.Lock()
+
+    def pages(self):
+        """首次调用时查询持仓数据源"""
+        if self._pages is None:
+            self.data_source_id, self.schema, self._pages = main.load_holding_pages(self.properties)
+            self._by_id = {page["id"]: page for page in self._pages}
+        return self._pages
+
+    def refresh(self):
+        """下次调用 pages() 时重新查询（其他进程写入了持仓后）"""
+        self._pages = None
+
+    def apply(self, page_id, properties):
+        """把已写入 Notion 的属性同步到索引中的页面（不在索引中的页面忽略）"""
+        with self._lock:
+            page = self._by_id.get(page_id)
+            if page is not None:
+                main.apply_properties(page, properties)
+
+    def writer(self, write):
+        """包装写入函数：写入成功后更新索引"""
+        def write_and_apply(page_id, properties):
+            write(page_id, properties)
+            self.apply(page_id, properties)
+        return write_and_apply
+
+
+def run_holdings(index, writes, markets, flush=True):
+    run_started_at = datetime.datetime.now(datetime.timezone.utc)
+    markets = main.select_markets(markets, run_started_at)
+    main.sync_holdings(index.pages(), markets, writes, flush=flush)
+    main.save_market_runs(markets, run_started_at)
+
+
+def run_shard(shard, shards, markets, report_path):
+    """
+    分片工作进程：只同步属于 shard 的持仓，结果写入运行报告（见 sharding.py）
+    不检查信号变化、不保存市场运行记录、不导出指标，这些由合并步骤统一完成
+    返回：
+        是否成功
+    """
+    if not main.get_notion_client():
+        raise ValueError("❌ 错误: 未找到 NOTION_TOKEN 或 DATABASE_ID 环境变量")
+    if not warm_cache.is_active():
+        warm_cache.activate()
+
+    resilience.reset_breakers()
+    metrics.reset()
+    budget = resilience.start_budget()
+    started_at = datetime.datetime.now(datetime.timezone.utc)
+    report = {"shard": shard, "shards": shards, "markets": [], "started_at": started_at.isoformat(),
+              "pages": 0, "ok": False, "error": None}
+    try:
+        markets = main.select_markets(markets, started_at)
+        report["markets"] = list(markets)
+        _, _, pages = main.load_holding_pages()
+        holdings = sharding.select(pages, shard, shards)
+        report["pages"] = len(holdings)
+        print(f"🧩 分片 {shard}/{shards}: {len(holdings)}/{len(pages)} 条持仓")
+        # 所有分片共用一个 Notion 集成的限速
+        writes = write_queue.WriteBehind(main.write_notion_page, rate=write_queue.WRITE_RATE / shards)
+        main.sync_holdings(holdings, markets, writes, check_signals=False)
+        report["ok"] = True
+    except Exception as e:
+        print(f"⚠️ 分片 {shard}/{shards} 失败: {e}")
+        report["error"] = str(e)
+    profiling.checkpoint(HOLDINGS)
+
+    budget.pending = 0
+    budget.report()
+    resilience.end_budget()
+    report["elapsed"] = round(budget.elapsed(), 3)
+    report["holdings"] = {labels["result"]: count for labels, count in metrics.samples(metrics.HOLDINGS)}
+    report["metrics"] = metrics.dump()
+    sharding.write_report(report_path, report)
+    return report["ok"]
+
+
+def shard_worker_env(shards, started_at=None):
+    """
+    工作进程继承剩余的时间预算；性能分析结果按分片写入不同目录
+    started_at: 本次运行的开始时间，工作进程共用此后获取的指数估值等查询结果（见 main.shared_lookup）
+    """
+    env = {}
+    budget = resilience.budget()
+    for shard in range(1, shards + 1):
+        env[shard] = {}
+        if started_at is not None:
+            env[shard][main.SHARED_LOOKUPS_ENV] = repr(started_at.timestamp())
+        if budget is not None and budget.deadline is not None:
+            env[shard]["SYNC_DEADLINE_SECONDS"] = str(max(int(budget.remaining()), 1))
+        if profiling.is_active():
+            env[shard]["SYNC_PROFILE"] = "1"
+            env[shard]["SYNC_PROFILE_DIR"] = os.path.join(profiling.active().directory, f"shard-{shard}")
+    return env
+
+
+def run_sharded_holdings(index, markets, shards=None, report_paths=None):
+    """
+    分片运行的持仓阶段：启动 shards 个工作进程（report_paths 为 None 时），或合并已有的分片报告
+    合并各分片的指标，对全部持仓检查一次信号变化，刷新页面索引（后续阶段读取各分片写入的现价）；
+    所有分片成功时保存市场运行记录，否则抛出异常（本阶段失败，后续阶段照常执行）
+    """
+    run_started_at = datetime.datetime.now(datetime.timezone.utc)
+    if report_paths is None:
+        markets = main.select_markets(markets, run_started_at)
+        if not markets:
+            main.check_and_notify_signal_changes(index.pages())
+            return
+        # 共用数据先写入本地状态库，工作进程直接读取，不各自请求全市场快照
+        main.get_exchange_rates()
+        main.preload_snapshots(markets)
+        # 上次运行共用的查询结果已经过期
+        main.get_state_store().invalidate("lookups")
+        print(f"🧩 启动 {shards} 个分片工作进程...")
+        with tempfile.TemporaryDirectory(prefix="sync-shards-") as report_dir:
+            paths = sharding.spawn_workers(os.path.abspath(__file__), shards, markets, report_dir,
+                                           env=shard_worker_env(shards, run_started_at))
+            reports = sharding.load_reports(paths)
+    else:
+        reports = sharding.load_reports(report_paths)
+
+    print("🧩 合并分片报告:")
+    merged = sharding.merge_reports(reports, shards)
+    metrics.merge(merged["metrics"])
+    main.check_and_notify_signal_changes(index.pages())
+    index.refresh()
+    if merged["failed"]:
+        raise RuntimeError(f"分片 {', '.join(str(shard) for shard in merged['failed'])} 未成功完成")
+    if report_paths is not None:
+        markets = tuple(merged["markets"])
+        run_started_at = datetime.datetime.fromisoformat(merged["started_at"])
+    main.save_market_runs(markets, run_started_at)
+
+
+def run_trades(index, writes):
+    print("\n📊 正在更新交易流水表中的卖出后/买入后涨跌幅...")
+    main.update_trade_returns(index.data_source_id, index.schema, writes, price_pages=index.pages(), flush=False)
+
+
+def run(stages=STAGES, markets=None, tape=None, shards=None, report_paths=None):
+    """
+    按顺序执行 stages 中的阶段；单个阶段失败不影响后续阶段
+    参数：
+        shards: 持仓阶段分给多少个工作进程（见 sharding.py）；为 None 时在本进程中执行
+        report_paths: 已在其他地方运行的分片报告，持仓阶段只合并这些报告
+    返回：
+        {阶段: True/False}
+    """
+    client = main.get_notion_client()
+    if not client:
+        raise ValueError("❌ 错误: 未找到 NOTION_TOKEN 或 DATABASE_ID 环境变量")
+    # 所有阶段共用同一个 Notion 客户端
+    bond_stage.notion = pingan_stage.notion = client
+    if not warm_cache.is_active():
+        warm_cache.activate()
+
+    resilience.reset_breakers()
+    metrics.reset()
+    budget = resilience.start_budget()
+
+    index = PageIndex()
+    writes = write_queue.WriteBehind(index.writer(main.write_notion_page))
+    print(f"📥 正在查询 Notion 数据库: {main.DATABASE_ID} ...")
+    try:
+        index.pages()
+    except Exception as e:
+        print(f"❌ Notion 连接失败: {e}")
+        resilience.end_budget()
+        metrics.set_gauge(metrics.STAGE_SUCCESS, 0, stage="notion_query")
+        main.export_run_metrics("pipeline", budget)
+        return {stage: False for stage in stages}
+    profiling.checkpoint("notion_query")
+
+    stage_runners = {
+        HOLDINGS: (lambda: run_sharded_holdings(index, markets, shards, report_paths)) if shards or report_paths
+        else (lambda: run_holdings(index, writes, markets, flush=TRADES in stages)),
+        TRADES: lambda: run_trades(index, writes),
+        BONDS: lambda: bond_stage.main(pages=index.pages(), writes=writes),
+        PINGAN: lambda: pingan_stage.main(pages=index.pages(), writes=writes),
+    }
+    results = {}
+    for stage in stages:
+        if tape and tape.mode == "replay" and stage in (BONDS, PINGAN):
+            print(f"\n⚠️  回放模式: 跳过 {stage} 阶段（未录制）")
+            continue
+        print(f"\n{'=' * 60}\n▶️ 阶段: {stage}")
+        try:
+            stage_runners[stage]()
+            results[stage] = True
+        except Exception as e:
+            print(f"⚠️ {stage} 阶段失败: {e}")
+            results[stage] = False
+        metrics.set_gauge(metrics.STAGE_SUCCESS, int(results[stage]), stage=stage)
+        profiling.checkpoint(stage)
+
+    # 各阶段留在写入队列中的更新一起写入（同一页面合并为一个请求）
+    if writes.pending():
+        main.flush_writes(writes, "流水线")
+        profiling.checkpoint("writes")
+
+    budget.pending = 0
+    budget.report()
+    resilience.end_budget()
+    main.export_run_metrics("pipeline", budget)
+    main.save_cache_bundle()
+    summary = ", ".join(f"{stage} {'✅' if ok else '❌'}" for stage, ok in results.items())
+    print(f"🎉 流水线执行完毕: {summary}")
+    return results
+
+
+def parse_args(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="在一个进程中按阶段同步持仓、交易流水、债券收益率和平安证券组合")
+    parser.add_argument(
+        "--stages",
+        default="all",
+        help=f"要执行的阶段，逗号分隔: {', '.join(STAGES)}；默认 all",
+    )
+    parser.add_argument(
+        "--market",
+        default=None,
+        help="holdings 阶段要处理的市场（同 main.py --market）",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="性能分析模式（同 main.py --profile）",
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=None,
+        help="持仓阶段分给 N 个工作进程并行执行，结束后合并（见 sharding.py）",
+    )
+    parser.add_argument(
+        "--shard",
+        default=None,
+        help="作为分片工作进程运行，如 2/4：只同步属于该分片的持仓，结果写入 --report",
+    )
+    parser.add_argument(
+        "--report",
+        default=None,
+        help="分片工作进程的运行报告路径（JSON）",
+    )
+    parser.add_argument(
+        "--merge",
+        nargs="+",
+        default=None,
+        metavar="REPORT",
+        help="合并其他地方运行的分片报告，代替本进程的持仓同步，然后执行其余阶段",
+    )
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    main.check_runtime_environment()
+    args = parse_args()
+    try:
+        selected = parse_stages(args.stages)
+        shard = sharding.parse_shard(args.shard) if args.shard else None
+        if shard and not args.report:
+            raise ValueError("分片工作进程需要指定 --report")
+        if args.shards is not None and args.shards < 1:
+            raise ValueError(f"分片数应为正整数: {args.shards}")
+    except ValueError as e:
+        print(f"❌ {e}")
+        sys.exit(2)
+    tape = main.activate_cassette()
+    if tape and (shard or args.shards or args.merge):
+        print("❌ 录制/回放模式不支持分片运行")
+        sys.exit(2)
+    profiling.activate_from_env(args.profile)
+    if shard:
+        sys.exit(0 if run_shard(*shard, markets=args.market, report_path=args.report) else 1)
+    results = run(selected, markets=args.market, tape=tape, shards=args.shards, report_paths=args.merge)
+    sys.exit(0 if all(results.values()) else 1)
@@ -0,0 +1,174 @@
+"""
+性能分析模式（CPU + 内存）
+
+Actions 上的一次运行很慢或占用内存很多时，事后没有任何可以查看的数据。
+开启性能分析后，运行期间启用 cProfile 和 tracemalloc，在每个阶段边界（预加载行情后、查询 Notion 后、
+持仓循环后、交易流水等阶段后）调用 checkpoint(阶段名)，把上一个边界以来的数据写入文件并打印前 N 项：
+
+- NN-阶段.prof：该阶段的 cProfile 数据（python -m pstats 或 snakeviz 查看）
+- NN-阶段.tracemalloc：该时刻的 tracemalloc 快照（tracemalloc.Snapshot.load 读取）
+- summary.txt：每个阶段耗时最多的函数（累计耗时）、当前占用内存最多的代码行、相对上一阶段新增最多的代码行
+
+开启方式（main.py / pipeline.py / 两个脚本）：
+
+    python pipeline.py --profile
+    SYNC_PROFILE=1 python main.py
+
+环境变量：
+    SYNC_PROFILE      1 / true 时开启
+    SYNC_PROFILE_DIR  输出目录，默认 ./profiles（每次运行一个子目录）
+    SYNC_PROFILE_TOP  摘要中每项列出的条数，默认 15
+
+注：cProfile 只统计启用它的主线程；预取、写入队列等工作线程中的耗时在主线程中表现为等待（如 Future.result）。
+未开启时 checkpoint() 不做任何事。
+"""
+import os
+import time
+import cProfile
+import pstats
+import datetime
+import tracemalloc
+
+DEFAULT_PROFILE_DIR = "./profiles"
+DEFAULT_TOP = 15
+
+# 内存统计中忽略的导入机制和 tracemalloc 自身的分配
+_MEMORY_FILTERS = (
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, tracemalloc.__file__),
+)
+
+_active = None
+
+
+def _format_size(size):
+    for unit in ("B", "KiB", "MiB"):
+        if abs(size) < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GiB"
+
+
+def _location(frame):
+    return f"{frame.filename}:{frame.lineno}"
+
+
+class Profiler:
+    def __init__(self, directory, top=DEFAULT_TOP):
+        self.directory = directory
+        self.top = top
+        self.stages = []
+        self._profile = None
+        self._snapshot = None
+        self._started = None
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self._started = time.monotonic()
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+
+    def checkpoint(self, stage):
+        """结束当前阶段：保存 cProfile 数据和内存快照，打印摘要，然后开始统计下一阶段"""
+        self._profile.disable()
+        elapsed = time.monotonic() - self._started
+        self.stages.append(stage)
+        prefix = os.path.join(self.directory, f"{len(self.stages):02d}-{stage}")
+        try:
+            self._profile.dump_stats(prefix + ".prof")
+            snapshot = tracemalloc.take_snapshot().filter_traces(_MEMORY_FILTERS)
+            snapshot.dump(prefix + ".tracemalloc")
+
+            summary = self.summarize(stage, elapsed, pstats.Stats(self._profile), snapshot)
+            print(summary)
+            with open(os.path.join(self.directory, "summary.txt"), "a", encoding="utf-8") as f:
+                f.write(summary + "\n\n")
+            self._snapshot = snapshot
+        finally:
+            # 保存摘要的耗时不计入下一阶段
+            self._started = time.monotonic()
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        return prefix
+
+    def summarize(self, stage, elapsed, stats, snapshot):
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [f"🔬 性能分析 [{stage}]: {elapsed:.1f}s, 内存 {_format_size(current)} (峰值 {_format_size(peak)})"]
+
+        lines.append("   耗时最多的函数（累计 / 自身 / 调用次数）:")
+        for (filename, lineno, name), (_, calls, own, cumulative, _) in self._top_functions(stats):
+            lines.append(f"   {cumulative:8.3f}s {own:8.3f}s {calls:>8}  {name} ({os.path.basename(filename)}:{lineno})")
+
+        lines.append("   占用内存最多的代码行:")
+        for stat in snapshot.statistics("lineno")[:self.top]:
+            lines.append(f"   {_format_size(stat.size):>10} {stat.count:>8} 个对象  {_location(stat.traceback[0])}")
+
+        if self._snapshot is not None:
+            lines.append("   相对上一阶段新增:")
+            for stat in snapshot.compare_to(self._snapshot, "lineno")[:self.top]:
+                if stat.size_diff <= 0:
+                    break
+                lines.append(f"   {'+' + _format_size(stat.size_diff):>10} {stat.count_diff:>+8} 个对象  {_location(stat.traceback[0])}")
+        return "\n".join(lines)
+
+    def _top_functions(self, stats):
+        return sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:self.top]
+
+    def stop(self):
+        if self._profile is not None:
+            self._profile.disable()
+            self._profile = None
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+
+def activate(directory=None, top=DEFAULT_TOP):
+    """开始性能分析，输出到 directory（默认 ./profiles/运行时间）"""
+    global _active
+    if _active is not None:
+        return _active
+    if directory is None:
+        run_id = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        directory = os.path.join(os.getenv("SYNC_PROFILE_DIR") or DEFAULT_PROFILE_DIR, run_id)
+    _active = Profiler(directory, top)
+    _active.start()
+    print(f"🔬 性能分析模式: 各阶段的 cProfile 数据和内存快照写入 {directory}")
+    return _active
+
+
+def activate_from_env(flag=False):
+    """命令行指定 --profile（flag）或设置了 SYNC_PROFILE 时开始性能分析，否则返回 None"""
+    enabled = os.getenv("SYNC_PROFILE", "").strip().lower() in ("1", "true", "yes")
+    if not (flag or enabled):
+        return None
+    top = os.getenv("SYNC_PROFILE_TOP", "").strip()
+    return activate(top=int(top) if top else DEFAULT_TOP)
+
+
+def deactivate():
+    global _active
+    if _active is not None:
+        _active.stop()
+    _active = None
+
+
+def active():
+    return _active
+
+
+def is_active():
+    return _active is not None
+
+
+def checkpoint(stage):
+    """阶段边界；未开启性能分析时不做任何事"""
+    if _active is None:
+        return None
+    try:
+        return _active.checkpoint(stage)
+    except Exception as e:
+        print(f"⚠️ 性能分析 [{stage}] 保存失败: {e}")
+        return None
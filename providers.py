@@ -0,0 +1,403 @@
+"""
+批量行情数据源（provider）与预取计划
+
+以前价格和估值都按持仓逐个查询：每个代码调用一次 stock.fast_info、get_price_from_akshare(代码)、
+get_etf_index_pe_pb(代码)……即使数据源一次请求就能返回多个标的（yfinance 批量下载、东方财富全市场快照），
+跟踪同一指数的多只 ETF 也会把同一个指数的数据各查一遍。
+
+每个 Provider 声明自己覆盖的标的和字段，一次调用处理一批标的：
+
+- name: 数据源名称
+- fields: 能提供的字段（PRICE / NAME / PE / ...）
+- covers(symbol): 是否覆盖该标的
+- key(symbol): 请求的去重键（如 ETF 跟踪的指数代码），同一个键只请求一次
+- requests(keys): 这些键需要的远程请求数（批量接口为 1，本地快照为 0）
+- fetch(symbols, fields): 返回 {symbol: {field: value}}，没有数据的标的不出现在结果中；
+  逐个请求的 provider 返回 Results，其中 failed 为请求出错（如熔断、超时）的标的
+
+预取分两步：
+
+1. 计划（Plan）：add(代码, 字段) 登记所有持仓需要的数据；每个 (代码, 字段) 分配给第一个覆盖它的 provider，
+   按 provider 和去重键合并，print(plan) 可查看每个数据源将请求哪些键、多少次请求
+2. 执行（execute）：同一批次中不同 provider 并发执行，每个 provider 只调用一次；
+   第一个 provider 没有返回的 (代码, 字段) 在下一批次交给后面覆盖它的 provider（同一字段先返回的优先）
+
+    plan = Plan(providers)
+    plan.add("510300", [PRICE, INDEX_PE])
+    print(plan.describe())
+    quotes = execute(plan)
+"""
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+# 同一批次中并发执行的 provider 数，以及逐个请求的 provider 内部的并发数
+PREFETCH_WORKERS = 4
+
+PRICE = "price"
+NAME = "name"
+PE = "pe"
+# ETF 跟踪指数的估值（中证指数 / 乐咕乐股）
+INDEX_PE = "index_pe"
+INDEX_PB = "index_pb"
+INDEX_PE_PERCENTILE = "index_pe_percentile"
+INDEX_PB_PERCENTILE = "index_pb_percentile"
+# 恒生指数系 ETF 的指数估值
+HK_INDEX_PE = "hk_index_pe"
+HK_INDEX_PE_PERCENTILE = "hk_index_pe_percentile"
+# QDII ETF 参考的美股 ETF 的 PE 及百分位
+QDII_PE = "qdii_pe"
+QDII_PE_PERCENTILE = "qdii_pe_percentile"
+# 场外基金净值增长率 {'1y': ..., ...}
+NAV_GROWTH = "nav_growth"
+# A股/港股历史 PE 序列
+PE_HISTORY = "pe_history"
+# A股最新一期财务指标（ROE、PEG 共用）
+FUNDAMENTALS = "fundamentals"
+
+
+def has_data(value):
+    """None、空序列/空 dict 视为没有数据"""
+    if value is None:
+        return False
+    try:
+        return len(value) > 0
+    except TypeError:
+        return True
+
+
+class Results(dict):
+    """fetch() 的结果 {代码: {字段: 值}}；failed 为请求出错的标的，不算询问过，由 main.prefetched 逐个查询兜底"""
+
+    def __init__(self, values=(), failed=()):
+        super().__init__(values)
+        self.failed = set(failed)
+
+
+class Provider:
+    name = ""
+    fields = ()
+
+    def covers(self, symbol):
+        return True
+
+    def key(self, symbol):
+        return symbol
+
+    def requests(self, keys):
+        return len(keys)
+
+    def fetch(self, symbols, fields):
+        raise NotImplementedError
+
+
+class Quotes:
+    """预取的结果：各标的的字段值，以及每个 provider 被询问过（且调用成功）的标的"""
+
+    def __init__(self):
+        self._values = defaultdict(dict)
+        self._sources = {}
+        self._asked = defaultdict(set)
+        self._errors = defaultdict(set)
+        self.failed = set()
+        self.calls = {}
+
+    def get(self, symbol, field, default=None):
+        value = self._values.get(symbol, {}).get(field)
+        return default if value is None else value
+
+    def source(self, symbol, field):
+        """提供该字段的 provider 名称"""
+        return self._sources.get((symbol, field))
+
+    def asked(self, provider_name, symbol):
+        """
+        provider 是否已经查询过该标的（查询过但没有数据时，不必再用同一个 provider 查询）
+        yfinance 批量下载不报告单个代码的失败，查询过但没有价格的代码仍由 main.quoted_price 逐个查询
+        """
+        return symbol in self._asked.get(provider_name, ())
+
+    def errored(self, provider_name, symbol):
+        """provider 查询该标的时出错（本次预取不再用它重试）"""
+        return symbol in self._errors.get(provider_name, ())
+
+    def merge(self, provider_name, symbols, results):
+        errors = getattr(results, "failed", set())
+        self._errors[provider_name].update(errors)
+        self._asked[provider_name].update(symbol for symbol in symbols if symbol not in errors)
+        for symbol, values in results.items():
+            for field, value in values.items():
+                if not has_data(value) or self._values[symbol].get(field) is not None:
+                    continue
+                self._values[symbol][field] = value
+                self._sources[(symbol, field)] = provider_name
+
+
+class Plan:
+    """去重后的预取计划"""
+
+    def __init__(self, providers):
+        self.providers = list(providers)
+        self.wanted = {}
+
+    def add(self, symbol, fields):
+        self.wanted.setdefault(symbol, set()).update(fields)
+
+    def batch(self, quotes):
+        """
+        下一批次的调用：{provider 名称: (provider, {代码: 字段集合})}
+        每个还缺少的 (代码, 字段) 分配给第一个覆盖它、还没有询问过该代码、也没有失败的 provider
+        """
+        batches = {}
+        for symbol, fields in self.wanted.items():
+            for field in sorted(fields):
+                if quotes.get(symbol, field) is not None:
+                    continue
+                for provider in self.providers:
+                    if field not in provider.fields or provider.name in quotes.failed:
+                        continue
+                    if quotes.asked(provider.name, symbol) or quotes.errored(provider.name, symbol):
+                        continue
+                    if not provider.covers(symbol):
+                        continue
+                    entry = batches.setdefault(provider.name, (provider, {}))
+                    entry[1].setdefault(symbol, set()).add(field)
+                    break
+        return batches
+
+    def describe(self):
+        """第一批次的计划（按 provider 优先级排列），以及可以补缺的后备 provider"""
+        batches = self.batch(Quotes())
+        total = sum(provider.requests({provider.key(s) for s in symbols}) for provider, symbols in batches.values())
+        fields = sum(len(f) for f in self.wanted.values())
+        lines = [f"📋 预取计划: {len(self.wanted)} 个标的 / {fields} 个字段 → {len(batches)} 个数据源, 约 {total} 次请求"]
+        for provider in self.providers:
+            if provider.name not in batches:
+                continue
+            _, symbols = batches[provider.name]
+            keys = defaultdict(list)
+            for symbol in symbols:
+                keys[provider.key(symbol)].append(symbol)
+            provider_fields = sorted(set().union(*symbols.values()))
+            lines.append(f"   - {provider.name}: {len(keys)} 个键, {provider.requests(set(keys))} 次请求 [{', '.join(provider_fields)}]")
+            shared = {key: members for key, members in keys.items() if len(members) > 1 or key not in members}
+            for key, members in sorted(shared.items()):
+                lines.append(f"       {key} ← {', '.join(sorted(members))}")
+        fallbacks = [p.name for p in self.providers if p.name not in batches and any(
+            p.covers(s) and set(p.fields) & f for s, f in self.wanted.items())]
+        if fallbacks:
+            lines.append(f"   - 补缺: {', '.join(fallbacks)}")
+        return "\n".join(lines)
+
+    def __str__(self):
+        return self.describe()
+
+
+def execute(plan, workers=PREFETCH_WORKERS):
+    """
+    执行预取计划，返回 Quotes
+    单个 provider 失败时只打印警告，其覆盖的标的交给后面的 provider 或逐个查询的兜底逻辑
+    """
+    quotes = Quotes()
+    while True:
+        batches = plan.batch(quotes)
+        if not batches:
+            return quotes
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(batches))), thread_name_prefix="prefetch") as pool:
+            futures = {name: pool.submit(_run, provider, symbols) for name, (provider, symbols) in batches.items()}
+        for name, future in futures.items():
+            provider, symbols = batches[name]
+            results, elapsed, error = future.result()
+            metrics.observe(metrics.PREFETCH_DURATION, elapsed, provider=name)
+            if error is not None:
+                print(f"   ⚠️ {name} 批量获取失败: {error}")
+                quotes.failed.add(name)
+                metrics.inc(metrics.PREFETCH_FAILURES, provider=name)
+                continue
+            quotes.merge(name, symbols, results)
+            requests = provider.requests({provider.key(s) for s in symbols})
+            quotes.calls[name] = quotes.calls.get(name, 0) + requests
+            metrics.inc(metrics.PREFETCH_REQUESTS, requests, provider=name)
+            print(f"   - {name}: {len(results)}/{len(symbols)} 个标的, {requests} 次请求, {elapsed:.1f}s")
+
+
+def _run(provider, symbols):
+    """执行一个 provider 的批量获取，返回 (结果, 耗时, 异常)"""
+    started = time.monotonic()
+    fields = sorted(set().union(*symbols.values()))
+    try:
+        return provider.fetch(list(symbols), fields), time.monotonic() - started, None
+    except Exception as e:
+        return {}, time.monotonic() - started, e
+
+
+def fetch_all(providers, symbols, fields):
+    """向各 provider 批量获取 symbols 的 fields（所有标的需要相同字段时的简写）"""
+    plan = Plan(providers)
+    for symbol in symbols:
+        plan.add(symbol, fields)
+    return execute(plan)
+
+
+def _map_parallel(load, keys, workers):
+    """
+    并发调用 load(key)，返回 ({key: 结果}, 失败的 key 集合)
+    单个 key 失败（包括熔断、超时）时打印警告并跳过，由调用方交给逐个查询的兜底逻辑
+    """
+    def run(key):
+        try:
+            return key, load(key), False
+        except Exception as e:
+            print(f"   ⚠️ 预取 {key} 失败: {e}")
+            return key, None, True
+    if workers <= 1 or len(keys) <= 1:
+        outcomes = [run(key) for key in keys]
+    else:
+        with ThreadPoolExecutor(max_workers=min(workers, len(keys)), thread_name_prefix="prefetch-item") as pool:
+            outcomes = list(pool.map(run, keys))
+    return {key: value for key, value, _ in outcomes}, {key for key, _, failed in outcomes if failed}
+
+
+class YFinanceProvider(Provider):
+    """yfinance：一次 download 请求获取所有标的的最近收盘价/最新价"""
+    name = "yfinance"
+    fields = (PRICE,)
+
+    def __init__(self, to_yf_symbol, download):
+        """
+        to_yf_symbol: 持仓代码 → yfinance 代码
+        download: download(yf 代码列表) → yf.download 的结果（DataFrame）
+        """
+        self._to_yf_symbol = to_yf_symbol
+        self._download = download
+
+    def key(self, symbol):
+        return self._to_yf_symbol(symbol)
+
+    def requests(self, keys):
+        return 1 if keys else 0
+
+    def fetch(self, symbols, fields):
+        mapping = {}
+        for symbol in symbols:
+            mapping.setdefault(self._to_yf_symbol(symbol), []).append(symbol)
+        data = self._download(list(mapping))
+        results = {}
+        if data is None or data.empty:
+            return results
+        for yf_symbol, holders in mapping.items():
+            closes = _close_column(data, yf_symbol, single=len(mapping) == 1)
+            if closes is None:
+                continue
+            closes = closes.dropna()
+            if closes.empty or float(closes.iloc[-1]) <= 0:
+                continue
+            for symbol in holders:
+                results[symbol] = {PRICE: float(closes.iloc[-1])}
+        return results
+
+
+def _close_column(data, yf_symbol, single):
+    """yf.download 的结果按代码分组时为两级列（代码, 字段），单个代码时可能只有一级"""
+    columns = data.columns
+    if getattr(columns, "nlevels", 1) > 1:
+        if yf_symbol in columns.get_level_values(0):
+            return data[yf_symbol]["Close"]
+        if yf_symbol in columns.get_level_values(1):
+            return data["Close"][yf_symbol]
+        return None
+    if single and "Close" in columns:
+        return data["Close"]
+    return None
+
+
+class SnapshotProvider(Provider):
+    """
+    全市场快照（东方财富 A股/ETF/港股）：整个市场已在一次请求中预加载，查询只是本地查找
+    snapshot: {代码: QuoteRecord}（见 quote_record.py）；to_code: 持仓代码 → 快照中的代码
+    """
+    fields = (PRICE, NAME, PE)
+    ATTRIBUTES = {PRICE: "last", NAME: "name", PE: "pe_ttm"}
+
+    def __init__(self, name, snapshot, to_code=lambda symbol: symbol, fields=None):
+        self.name = name
+        self._snapshot = snapshot or {}
+        self._to_code = to_code
+        if fields is not None:
+            self.fields = tuple(fields)
+
+    def covers(self, symbol):
+        return self._to_code(symbol) in self._snapshot
+
+    def requests(self, keys):
+        return 0
+
+    def fetch(self, symbols, fields):
+        results = {}
+        for symbol in symbols:
+            record = self._snapshot.get(self._to_code(symbol))
+            if record is None:
+                continue
+            values = {f: getattr(record, self.ATTRIBUTES[f]) for f in fields}
+            values = {f: v for f, v in values.items() if v is not None and v != ""}
+            if values:
+                results[symbol] = values
+        return results
+
+
+class GroupedProvider(Provider):
+    """
+    按分组键合并请求的数据源：多个标的映射到同一个键（如跟踪同一指数的 ETF）时，每个键只请求一次，各键并发请求
+    mapping: {代码: 分组键}；load(代表代码) → 元组，按 fields 的顺序对应
+    """
+
+    def __init__(self, name, fields, mapping, load, workers=PREFETCH_WORKERS):
+        self.name = name
+        self.fields = tuple(fields)
+        self._mapping = mapping
+        self._load = load
+        self._workers = workers
+
+    def covers(self, symbol):
+        return symbol in self._mapping
+
+    def key(self, symbol):
+        return self._mapping[symbol]
+
+    def fetch(self, symbols, fields):
+        groups = defaultdict(list)
+        for symbol in symbols:
+            groups[self._mapping[symbol]].append(symbol)
+        loaded, failed = _map_parallel(lambda key: self._load(groups[key][0]), list(groups), self._workers)
+        results = Results(failed=(symbol for key in failed for symbol in groups[key]))
+        for key, members in groups.items():
+            values = loaded.get(key)
+            if values is None:
+                continue
+            if not isinstance(values, (tuple, list)):
+                values = (values,)
+            record = {f: v for f, v in zip(self.fields, values) if v is not None and f in fields}
+            if record:
+                for symbol in members:
+                    results[symbol] = dict(record)
+        return results
+
+
+class PerSymbolProvider(Provider):
+    """没有批量接口的数据源（如场外基金净值），逐个并发请求，但仍由预取计划统一调度"""
+
+    def __init__(self, name, field, covers, load, workers=PREFETCH_WORKERS):
+        self.name = name
+        self.fields = (field,)
+        self._covers = covers
+        self._load = load
+        self._workers = workers
+
+    def covers(self, symbol):
+        return self._covers(symbol)
+
+    def fetch(self, symbols, fields):
+        loaded, failed = _map_parallel(self._load, list(symbols), self._workers)
+        return Results(((symbol, {self.fields[0]: value}) for symbol, value in loaded.items() if has_data(value)), failed)
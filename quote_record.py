@@ -0,0 +1,106 @@
+"""
+全市场行情快照的紧凑行记录
+
+以前 spot_cache / etf_cache / hk_cache / open_fund_cache 的每个代码对应 DataFrame 的一整行（几十列的 dict），
+每次查询都要按 ['最新价', '收盘', '现价', 'current', 'close'] 等候选列名逐个尝试、逐个转换。
+现在在加载快照时把列名归一化一次，每行只保留用到的字段（已转换为 float），查询只是属性读取：
+
+    record = spot_cache["600000"]
+    record.name, record.last, record.pe_ttm, record.pb, record.market_cap
+
+本地状态库中每行保存为 [名称, 最新价, 市盈率, 市净率, 总市值] 数组（from_payload 兼容旧版保存的整行 dict）。
+"""
+
+# 各字段的候选列名（东方财富 A股/ETF/港股行情、开放式基金列表），按优先级排列
+NAME_COLUMNS = ("名称", "基金简称", "name")
+LAST_COLUMNS = ("最新价", "收盘", "现价", "current", "close")
+# 东方财富行情只有“市盈率-动态”，一直作为 PE 使用
+PE_COLUMNS = ("市盈率-TTM", "市盈率-动态", "市盈率")
+PB_COLUMNS = ("市净率",)
+MARKET_CAP_COLUMNS = ("总市值",)
+
+
+def _number(value):
+    """行情中的数值；'-'、空字符串、NaN 等返回 None"""
+    if value is None or isinstance(value, bool):
+        return None
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return None if number != number else number
+
+
+def _first(row, columns, parse):
+    for column in columns:
+        value = parse(row.get(column))
+        if value is not None:
+            return value
+    return None
+
+
+def _text(value):
+    if value is None or value == "-" or str(value) == "nan":
+        return None
+    return str(value) or None
+
+
+def _positive(value):
+    number = _number(value)
+    return number if number is not None and number > 0 else None
+
+
+class QuoteRecord:
+    __slots__ = ("code", "name", "last", "pe_ttm", "pb", "market_cap")
+
+    def __init__(self, code, name="", last=None, pe_ttm=None, pb=None, market_cap=None):
+        self.code = code
+        self.name = name
+        self.last = last
+        self.pe_ttm = pe_ttm
+        self.pb = pb
+        self.market_cap = market_cap
+
+    @classmethod
+    def from_row(cls, code, row):
+        """行情行（dict）→ 记录；最新价只接受正数（停牌时为 0 或 '-'），PE 可以为负（亏损）"""
+        return cls(
+            code,
+            name=_first(row, NAME_COLUMNS, _text) or "",
+            last=_first(row, LAST_COLUMNS, _positive),
+            pe_ttm=_first(row, PE_COLUMNS, _number),
+            pb=_first(row, PB_COLUMNS, _number),
+            market_cap=_first(row, MARKET_CAP_COLUMNS, _positive),
+        )
+
+    def to_payload(self):
+        """保存到状态库的数组"""
+        return [self.name, self.last, self.pe_ttm, self.pb, self.market_cap]
+
+    @classmethod
+    def from_payload(cls, code, payload):
+        if isinstance(payload, dict):
+            return cls.from_row(code, payload)
+        return cls(code, *payload)
+
+    def __eq__(self, other):
+        if not isinstance(other, QuoteRecord):
+            return NotImplemented
+        return self.code == other.code and self.to_payload() == other.to_payload()
+
+    def __repr__(self):
+        return (f"QuoteRecord({self.code!r}, name={self.name!r}, last={self.last!r}, "
+                f"pe_ttm={self.pe_ttm!r}, pb={self.pb!r}, market_cap={self.market_cap!r})")
+
+
+def from_records(rows, code_field):
+    """DataFrame.to_dict('records') 的结果 → {代码: QuoteRecord}"""
+    return {str(row[code_field]): QuoteRecord.from_row(str(row[code_field]), row) for row in rows}
+
+
+def to_payloads(records):
+    return {code: record.to_payload() for code, record in records.items()}
+
+
+def from_payloads(payloads):
+    return {code: QuoteRecord.from_payload(code, payload) for code, payload in payloads.items()}
@@ -0,0 +1,328 @@
+"""
+上游数据源熔断器（circuit breaker）与整次运行的时间预算（deadline budget）
+
+东方财富限流、乐咕乐股宕机时，如果每只股票都依次等待同样的超时，整次运行会被拖垮。
+每个上游数据源一个熔断器：连续失败 N 次后熔断（open），冷却期内直接跳过该数据源，
+让调用方立即切换到备选数据源；冷却期过后进入半开（half_open）状态只放行一个试探请求，
+试探结束前其他并发调用（如预取线程池中排队的请求）仍被跳过，试探成功则恢复（closed），失败则重新熔断。
+
+只有网络层面的失败（连接错误、超时、HTTP 错误，均为 OSError 子类）和限流返回的非法 JSON
+（json.JSONDecodeError：akshare 直接 json.loads(r.text) 时是 ValueError 子类，经 requests 解析时同时是 OSError 子类）
+才计入失败次数；KeyError / ValueError 这类“数据源正常响应但没有该品种数据”的异常不计入。
+
+时间预算：GitHub Actions 任务有硬性时间上限，而很多 akshare 接口本身没有超时。
+启用预算后，每次经熔断器的调用都会在后台线程中执行，超时时间由剩余时间推算；
+剩余时间不足以完成剩余持仓的价格写入时，跳过 PB/ROE/PEG/净值增长率等可选补充数据，
+并在运行结束时报告因预算跳过了哪些内容。
+"""
+import os
+import json
+import time
+import threading
+import functools
+import contextlib
+from collections import defaultdict
+
+import metrics
+
+# 连续失败多少次后熔断
+FAILURE_THRESHOLD = 3
+# 熔断后的冷却时间（秒），冷却期内跳过该数据源
+RESET_TIMEOUT = 60
+
+# 单次外部调用的默认超时（秒），以及预算耗尽后核心调用（价格）仍保留的最短超时
+DEFAULT_CALL_TIMEOUT = 30
+MIN_CALL_TIMEOUT = 5
+# 为每条尚未处理的持仓预留的价格获取+写入时间（秒）
+PRICE_WRITE_RESERVE = 2.0
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """数据源处于熔断状态，调用被跳过"""
+
+    def __init__(self, source):
+        super().__init__(f"数据源 {source} 已熔断，跳过")
+        self.source = source
+
+
+class CallTimeoutError(TimeoutError):
+    """外部调用超过了预算给出的超时时间"""
+
+
+def is_source_failure(exc):
+    """是否是应计入熔断的上游失败（网络/HTTP 层面）"""
+    # requests.RequestException、socket 错误、TimeoutError、ConnectionError 都是 OSError 子类；
+    # 限流时返回的 HTML 页面被 json.loads 解析失败
+    return isinstance(exc, (OSError, json.JSONDecodeError))
+
+
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT, clock=time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.trips = 0
+        self.skipped = 0
+        # 半开状态下是否已有试探请求在执行
+        self._probing = False
+
+    def allow(self):
+        """是否允许本次调用；冷却期结束后转为半开，只放行一个试探请求，直到它记录成功或失败"""
+        with self._lock:
+            if self.state == OPEN and self._clock() - self.opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+            if self.state == OPEN or (self.state == HALF_OPEN and self._probing):
+                self.skipped += 1
+                return False
+            if self.state == HALF_OPEN:
+                self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._probing = False
+            self.state = CLOSED
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._probing = False
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    self.trips += 1
+                    print(f"\n   🔌 数据源 {self.name} 连续失败 {self.failures} 次，熔断 {self.reset_timeout}s")
+                self.state = OPEN
+                self.opened_at = self._clock()
+
+    def remaining(self):
+        """距离冷却结束还有多少秒（未熔断时为 0）"""
+        with self._lock:
+            if self.state != OPEN:
+                return 0.0
+            return max(0.0, self.reset_timeout - (self._clock() - self.opened_at))
+
+    def call(self, func, *args, **kwargs):
+        if not self.allow():
+            raise CircuitOpenError(self.name)
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            if is_source_failure(e):
+                self.record_failure()
+            else:
+                self.record_success()
+            raise
+        except BaseException:
+            # 试探被中断（KeyboardInterrupt 等）时不记录结果，但要让下一个调用可以试探
+            with self._lock:
+                self._probing = False
+            raise
+        self.record_success()
+        return result
+
+
+_breakers = {}
+_registry_lock = threading.Lock()
+_tracking = threading.local()
+
+
+def get_breaker(source):
+    with _registry_lock:
+        breaker = _breakers.get(source)
+        if breaker is None:
+            breaker = _breakers[source] = CircuitBreaker(source)
+        return breaker
+
+
+def reset_breakers():
+    """清空所有熔断器（每次运行开始时调用）"""
+    with _registry_lock:
+        _breakers.clear()
+
+
+def breakers():
+    with _registry_lock:
+        return dict(_breakers)
+
+
+def guarded(source, func, *args, **kwargs):
+    """
+    通过 source 对应的熔断器调用 func；熔断中则抛出 CircuitOpenError
+    启用时间预算时，调用带有由剩余时间推算的超时，超时抛出 CallTimeoutError（计入熔断失败）
+    """
+    budget = _budget
+    started = time.monotonic()
+    try:
+        if budget is not None:
+            call = functools.partial(func, *args, **kwargs)
+            result = get_breaker(source).call(run_with_timeout, call, budget.call_timeout(), source)
+        else:
+            result = get_breaker(source).call(func, *args, **kwargs)
+    except CircuitOpenError:
+        metrics.inc(metrics.UPSTREAM_REQUESTS, source=source, outcome="circuit_open")
+        skipped = getattr(_tracking, "skipped", None)
+        if skipped is not None:
+            skipped.add(source)
+        raise
+    except Exception as e:
+        _record_call(source, started, "error" if is_source_failure(e) else "no_data")
+        raise
+    _record_call(source, started, "ok")
+    return result
+
+
+def _record_call(source, started, outcome):
+    metrics.observe(metrics.UPSTREAM_DURATION, time.monotonic() - started, source=source)
+    metrics.inc(metrics.UPSTREAM_REQUESTS, source=source, outcome=outcome)
+
+
+@contextlib.contextmanager
+def track_skips():
+    """收集代码块内因熔断而被跳过的数据源"""
+    previous = getattr(_tracking, "skipped", None)
+    _tracking.skipped = set()
+    try:
+        yield _tracking.skipped
+    finally:
+        if previous is not None:
+            previous.update(_tracking.skipped)
+        _tracking.skipped = previous
+
+
+def wait_for_recovery(sources, max_wait):
+    """等待给定数据源的冷却期结束（最多 max_wait 秒），返回实际等待秒数"""
+    pending = [get_breaker(s).remaining() for s in sources]
+    wait = min(max(pending, default=0.0), max_wait)
+    if wait > 0:
+        time.sleep(wait)
+    return wait
+
+
+def summary():
+    """返回发生过熔断或跳过的数据源统计，用于运行结束时的报告"""
+    return {
+        name: {"state": b.state, "trips": b.trips, "skipped": b.skipped}
+        for name, b in breakers().items()
+        if b.trips or b.skipped
+    }
+
+
+def run_with_timeout(func, timeout, label):
+    """
+    在守护线程中执行 func，最多等待 timeout 秒
+    超时后放弃等待（线程留在后台，不阻塞进程退出）并抛出 CallTimeoutError
+    """
+    outcome = {}
+
+    def target():
+        try:
+            outcome["value"] = func()
+        except BaseException as e:
+            outcome["error"] = e
+
+    worker = threading.Thread(target=target, name=f"call-{label}", daemon=True)
+    worker.start()
+    worker.join(timeout)
+    if worker.is_alive():
+        raise CallTimeoutError(f"{label} 调用超过 {timeout:.0f}s 未返回")
+    if "error" in outcome:
+        raise outcome["error"]
+    return outcome.get("value")
+
+
+class RunBudget:
+    """
+    整次运行的时间预算
+    deadline_seconds 为 None 时不限总时长，但外部调用仍有 DEFAULT_CALL_TIMEOUT 超时
+    """
+
+    def __init__(self, deadline_seconds=None, clock=time.monotonic):
+        self._clock = clock
+        self.started_at = clock()
+        self.deadline_seconds = deadline_seconds
+        self.deadline = self.started_at + deadline_seconds if deadline_seconds else None
+        # 尚未处理的持仓数（由主循环更新），用于为价格写入预留时间
+        self.pending = 0
+        self.skipped = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def elapsed(self):
+        return self._clock() - self.started_at
+
+    def remaining(self):
+        if self.deadline is None:
+            return float("inf")
+        return self.deadline - self._clock()
+
+    def reserve(self):
+        return self.pending * PRICE_WRITE_RESERVE
+
+    def call_timeout(self):
+        """单次调用的超时：默认值与剩余时间取小，但至少保留 MIN_CALL_TIMEOUT 保证价格能获取"""
+        return max(MIN_CALL_TIMEOUT, min(DEFAULT_CALL_TIMEOUT, self.remaining()))
+
+    def allow_optional(self, feature, item=None):
+        """
+        是否还有时间做可选的补充数据（PB/ROE/PEG/指数PE/净值增长率等）
+        剩余时间扣除价格写入预留后不足时返回 False，并记录被跳过的内容
+        """
+        if self.remaining() - self.reserve() > 0:
+            return True
+        with self._lock:
+            self.skipped[feature].append(item)
+        return False
+
+    def report(self):
+        """打印预算使用情况和因预算跳过的内容"""
+        line = f"⏱️ 运行耗时 {self.elapsed():.0f}s"
+        if self.deadline_seconds:
+            line += f" / 预算 {self.deadline_seconds:.0f}s"
+        print(line)
+        if not self.skipped:
+            return
+        print("⏱️ 因时间预算跳过的可选数据:")
+        for feature, items in self.skipped.items():
+            names = [str(i) for i in items if i is not None]
+            detail = f" ({', '.join(names[:10])}{' ...' if len(names) > 10 else ''})" if names else ""
+            print(f"   - {feature}: {len(items)} 次{detail}")
+
+
+_budget = None
+
+
+def start_budget(deadline_seconds=None):
+    """开始一次运行的时间预算；deadline_seconds 为空时读取环境变量 SYNC_DEADLINE_SECONDS"""
+    global _budget
+    if deadline_seconds is None:
+        env_value = os.getenv("SYNC_DEADLINE_SECONDS", "").strip()
+        deadline_seconds = float(env_value) if env_value else None
+    _budget = RunBudget(deadline_seconds)
+    return _budget
+
+
+def end_budget():
+    global _budget
+    budget, _budget = _budget, None
+    return budget
+
+
+def budget():
+    return _budget
+
+
+def allow_optional(feature, item=None):
+    """未启用预算时总是允许"""
+    if _budget is None:
+        return True
+    return _budget.allow_optional(feature, item)
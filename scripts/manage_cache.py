@@ -0,0 +1,243 @@
+"""
+缓存管理命令：查看各缓存命名空间的统计，按代码/命名空间失效或预热
+
+以前无法知道 akshare_cache/ 和 pe_cache/ 里有什么、多旧、多大、命中率如何，缓存过期只能手动删文件。
+现在缓存都在本地状态库中（state_store.CACHE_NAMESPACES），外加尚未清理的旧版缓存文件（legacy）：
+
+    python scripts/manage_cache.py list                         # 各命名空间的条目数、大小、新鲜度、最近运行的命中/未命中
+    python scripts/manage_cache.py list --json
+    python scripts/manage_cache.py invalidate pe_series 600519 0700.HK
+    python scripts/manage_cache.py invalidate snapshot hk_cache
+    python scripts/manage_cache.py invalidate fx                # 不指定键时清空整个命名空间
+    python scripts/manage_cache.py warm price_bars AAPL 600519
+    python scripts/manage_cache.py warm snapshot --refresh      # 先失效再重新获取
+    python scripts/manage_cache.py export state.tar.gz          # 导出缓存包（见 cache_bundle.py）
+    python scripts/manage_cache.py import state.tar.gz          # 校验并合并缓存包
+
+键：snapshot 为快照名（spot_cache / etf_cache / hk_cache / open_fund_cache），fx 为货币，run_meta 为键名，
+legacy 为文件名，其余为股票代码（与 Notion 中的写法相同，会按各命名空间的存储格式转换）。
+常驻模式进程内存中的热缓存（warm）只统计命中次数，不能从这里失效。
+"""
+import os
+import sys
+import json
+import time
+import datetime
+
+# 作为脚本运行时，允许导入项目根目录下的公共模块
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import state_store
+import cache_bundle
+
+LEGACY = "legacy"
+NAMESPACES = state_store.CACHE_NAMESPACES + (LEGACY,)
+# 可以预热的命名空间（其余由同步过程产生）
+WARMABLE = ("snapshot", "pe_series", "price_bars", "fundamentals", "fx")
+
+# 与 main.py 中的 AKSHARE_CACHE_DIR / CACHE_DIR / CACHE_STATS_KEY 相同（不导入 main，list/invalidate 不加载行情库）
+AKSHARE_CACHE_DIR = "./akshare_cache"
+PE_CACHE_DIR = "./pe_cache"
+CACHE_STATS_KEY = "cache_stats"
+
+
+def format_size(size):
+    for unit in ("B", "KiB", "MiB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GiB"
+
+
+def format_time(value, now=None):
+    """时间戳 → '10-19 15:03 (2.1h 前)'；日期字符串原样返回"""
+    if value is None:
+        return "-"
+    if isinstance(value, str):
+        return value
+    age = (now or time.time()) - value
+    when = datetime.datetime.fromtimestamp(value).strftime("%m-%d %H:%M")
+    if age < 3600:
+        return f"{when} ({age / 60:.0f}m 前)"
+    if age < 86400 * 2:
+        return f"{when} ({age / 3600:.1f}h 前)"
+    return f"{when} ({age / 86400:.0f}d 前)"
+
+
+def legacy_files():
+    """旧版缓存文件（已导入状态库或当天有效的 pickle/JSON）：[(路径, 字节数, 修改时间)]"""
+    files = []
+    state_db = os.path.basename(state_store.DEFAULT_PATH)
+    for directory in (AKSHARE_CACHE_DIR, PE_CACHE_DIR):
+        if not os.path.isdir(directory):
+            continue
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if os.path.isfile(path) and not name.startswith(state_db):
+                stat = os.stat(path)
+                files.append((path, stat.st_size, stat.st_mtime))
+    return files
+
+
+def recent_lookups(store):
+    """最近几次运行各缓存的命中/未命中次数之和：(运行次数, {缓存: {'hit': n, 'miss': n}})"""
+    history = store.get_meta(CACHE_STATS_KEY, [])
+    totals = {}
+    for run in history:
+        for cache, counts in run.get("lookups", {}).items():
+            for result, count in counts.items():
+                totals.setdefault(cache, {}).setdefault(result, 0)
+                totals[cache][result] += count
+    return len(history), totals
+
+
+def collect_stats(store):
+    stats = store.cache_stats()
+    files = legacy_files()
+    if files:
+        stats.append({"namespace": LEGACY, "part": None, "entries": len(files), "keys": len(files),
+                      "bytes": sum(size for _, size, _ in files),
+                      "oldest": min(mtime for _, _, mtime in files), "newest": max(mtime for _, _, mtime in files)})
+    runs, lookups = recent_lookups(store)
+    for row in stats:
+        counts = lookups.get(row["namespace"])
+        row["hits"] = counts.get("hit", 0) if counts else None
+        row["misses"] = counts.get("miss", 0) if counts else None
+    if "warm" in lookups:
+        stats.append({"namespace": "warm", "part": "内存", "entries": None, "keys": None, "bytes": None,
+                      "oldest": None, "newest": None, "hits": lookups["warm"].get("hit", 0), "misses": lookups["warm"].get("miss", 0)})
+    return runs, stats
+
+
+def print_stats(runs, stats):
+    now = time.time()
+    print(f"🗄️ 状态库: {store_path()} ({format_size(os.path.getsize(store_path())) if os.path.exists(store_path()) else '不存在'})")
+    header = f"{'命名空间':<28}{'条目':>9}{'代码':>8}{'大小':>11}  {'最早':<22}{'最新':<22}命中/未命中（最近 {runs} 次运行）"
+    print(header)
+    for row in stats:
+        name = row["namespace"] + (f"/{row['part']}" if row["part"] else "")
+        entries = "-" if row["entries"] is None else row["entries"]
+        keys = "-" if row["keys"] is None else row["keys"]
+        size = "-" if row["bytes"] is None else format_size(row["bytes"])
+        hits = "-" if row["hits"] is None else f"{row['hits']}/{row['misses']}"
+        print(f"{name:<30}{entries:>9}{keys:>8}{size:>11}  {format_time(row['oldest'], now):<22}{format_time(row['newest'], now):<22}{hits}")
+
+
+def store_path():
+    return state_store.get_store().path
+
+
+def normalize_keys(namespace, keys):
+    """按命名空间的存储格式转换股票代码（港股历史 PE 为 5 位代码，K线为 yfinance 代码）"""
+    if not keys:
+        return keys
+    if namespace == "pe_series":
+        return [key if key.isdigit() and len(key) == 6 else key.replace(".HK", "").zfill(5) for key in keys]
+    if namespace == "price_bars":
+        import main
+        return [main.to_yf_symbol(key) for key in keys]
+    return keys
+
+
+def invalidate(namespace, keys):
+    if namespace == LEGACY:
+        removed = 0
+        for path, _, _ in legacy_files():
+            if not keys or os.path.basename(path) in keys:
+                os.remove(path)
+                removed += 1
+        return removed
+    return state_store.get_store().invalidate(namespace, normalize_keys(namespace, keys))
+
+
+def warm(namespace, keys):
+    """重新获取并写入缓存（已有且未过期的数据不重复请求），返回预热的键"""
+    import main
+    import market_calendar
+
+    if namespace == "snapshot":
+        names = keys or list(main.SNAPSHOT_SOURCES)
+        for name in names:
+            if name not in main.SNAPSHOT_SOURCES:
+                raise ValueError(f"未知快照: {name}（可选: {', '.join(main.SNAPSHOT_SOURCES)}）")
+            main.preload_akshare_cache(name, *main.SNAPSHOT_SOURCES[name])
+        return names
+    if namespace == "fx":
+        main.get_exchange_rates()
+        return ["fx"]
+    if not keys:
+        raise ValueError(f"预热 {namespace} 需要指定股票代码")
+    for ticker in keys:
+        _, currency = main.resolve_currency({}, ticker)
+        if namespace == "pe_series":
+            series = main.get_pe_series_cached(ticker) if currency == "CNY" else main.get_hk_pe_series_cached(ticker)
+            print(f"   - {ticker}: {len(series)} 个 PE 数据点")
+        elif namespace == "fundamentals":
+            print(f"   - {ticker}: {len(main.get_cn_financial_indicator(ticker))} 个财务指标")
+        elif namespace == "price_bars":
+            yf_symbol = main.to_yf_symbol(ticker)
+            market = market_calendar.market_of(ticker, currency, main.CRYPTO_SYMBOLS)
+            closes = main.get_history_closes(yf_symbol, main._yf_ticker(yf_symbol), market)
+            print(f"   - {ticker}: {len(closes)} 根K线")
+    return keys
+
+
+def print_manifest(manifest):
+    exported_at = datetime.datetime.fromtimestamp(manifest["exported_at"]).strftime("%Y-%m-%d %H:%M")
+    print(f"📦 缓存包: 导出于 {exported_at}，状态库结构版本 {manifest['schema_version']}，"
+          f"{format_size(manifest['database']['bytes'])}")
+    for row in manifest["namespaces"]:
+        name = row["namespace"] + (f"/{row['part']}" if row["part"] else "")
+        print(f"   - {name}: {row['entries']} 条，最新 {format_time(row['newest'])}")
+
+
+def parse_args(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="查看、失效、预热本地缓存（状态库和旧版缓存文件）")
+    commands = parser.add_subparsers(dest="command", required=True)
+    list_parser = commands.add_parser("list", help="各缓存命名空间的条目数、大小、新鲜度和最近运行的命中/未命中")
+    list_parser.add_argument("--json", action="store_true", help="以 JSON 输出")
+    for name, help_text in (("invalidate", "删除指定命名空间中的缓存"), ("warm", "获取并写入指定命名空间的缓存")):
+        sub = commands.add_parser(name, help=help_text)
+        sub.add_argument("namespace", choices=NAMESPACES if name == "invalidate" else WARMABLE)
+        sub.add_argument("keys", nargs="*", help="股票代码 / 快照名 / 货币等；不指定时为整个命名空间")
+        if name == "warm":
+            sub.add_argument("--refresh", action="store_true", help="先失效再获取（否则已有的未过期数据不重新请求）")
+    for name, help_text in (("export", "把状态库导出为缓存包"), ("import", "校验缓存包并合并到状态库（本地更新的数据优先）")):
+        commands.add_parser(name, help=help_text).add_argument("path", help="缓存包路径（.tar.gz）")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        if args.command == "list":
+            runs, stats = collect_stats(state_store.get_store())
+            if args.json:
+                print(json.dumps({"path": store_path(), "runs": runs, "namespaces": stats}, ensure_ascii=False, indent=2))
+            else:
+                print_stats(runs, stats)
+        elif args.command == "invalidate":
+            removed = invalidate(args.namespace, args.keys)
+            print(f"🧹 {args.namespace}: 已删除 {removed} 条{'（' + ', '.join(args.keys) + '）' if args.keys else ''}")
+        elif args.command == "export":
+            print_manifest(cache_bundle.export_bundle(state_store.get_store(), args.path))
+            print(f"✅ 已导出 {args.path}")
+        elif args.command == "import":
+            manifest, changes = cache_bundle.import_bundle(state_store.get_store(), args.path)
+            print_manifest(manifest)
+            print("✅ 已合并: " + (", ".join(f"{ns} {count} 行" for ns, count in changes.items() if count) or "没有更新的数据"))
+        else:
+            if args.refresh:
+                removed = invalidate(args.namespace, args.keys)
+                print(f"🧹 {args.namespace}: 已删除 {removed} 条")
+            warmed = warm(args.namespace, args.keys)
+            print(f"🔥 {args.namespace}: 已预热 {', '.join(warmed)}")
+    except ValueError as e:
+        print(f"❌ {e}")
+        return 2
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,46 +1,170 @@
 import os
-import akshare as ak
-from notion_client import Client
+import sys
+import datetime
+
+# Allow importing shared helpers from the project root when run as a script
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lazy_import import LazyModule
+import state_store
+import notion_query
+import profiling
+import write_queue
+
+# akshare is imported on first use (it takes seconds to import)
+ak = LazyModule("akshare")
 
 # Configuration
 NOTION_TOKEN = os.getenv("NOTION_TOKEN")
 DATABASE_ID = os.getenv("DATABASE_ID")
 
-# Initialize Notion client
+# Bond ETFs by bond maturity (years) used as their yield
+BOND_ETF_TENORS = {
+    "511520": 10,
+    "511260": 10,
+    "511010": 5,
+    "511090": 30,
+}
+
+# Fixed yield bonds (特别国债等固定收益率品种)
+FIXED_YIELD_TICKERS = {
+    "102277": 2.33,  # 特别国债
+}
+
+# Notion client is created on first use, not at import time
 notion = None
-if NOTION_TOKEN:
-    notion = Client(auth=NOTION_TOKEN, notion_version="2025-09-03")
 
-def get_china_bond_yield(years=10):
-    """
-    Fetches the latest China government bond yield using akshare.
-    Uses bond_zh_us_rate API which provides up-to-date data.
 
-    Args:
-        years: Bond maturity in years (5 or 10)
+def get_notion_client():
+    """Creates the Notion client on first use. Returns None if NOTION_TOKEN is not set."""
+    global notion
+    if notion is None and NOTION_TOKEN:
+        from notion_client import Client
+        notion = Client(auth=NOTION_TOKEN, notion_version="2025-09-03")
+    return notion
+
+# Columns of ak.bond_zh_us_rate() by bond maturity (years)
+TENOR_COLUMNS = {years: f'中国国债收益率{years}年' for years in (2, 5, 10, 30)}
+
+# Series name in the shared state store (one symbol per tenor, e.g. "10Y")
+YIELD_SERIES = "cn_bond_yield"
+
+
+class YieldCurve:
     """
-    column_name = f'中国国债收益率{years}年'
-    try:
-        # Fetch bond yield data from akshare (中美国债收益率)
-        df = ak.bond_zh_us_rate()
+    China government bond yield curve, fetched once per run.
 
-        # Filter out rows with NaN values for the specified yield
-        df_valid = df.dropna(subset=[column_name])
+    ak.bond_zh_us_rate() returns the whole CN/US rate history since 1990 for all tenors.
+    The history is kept in the state store; each run only downloads the rows since the
+    last stored date and serves every tenor from memory.
+    """
 
-        if df_valid.empty:
-            print(f"No valid data found for China {years}Y bond yield")
+    def __init__(self, store=None):
+        self._store = store
+        self._history = None
+
+    def _get_store(self):
+        if self._store is None:
+            self._store = state_store.get_store()
+        return self._store
+
+    def _stored_history(self):
+        try:
+            store = self._get_store()
+            return {years: store.get_series(YIELD_SERIES, f"{years}Y") for years in TENOR_COLUMNS}
+        except Exception as e:
+            print(f"Failed to read stored bond yields: {e}")
+            return {years: [] for years in TENOR_COLUMNS}
+
+    def _fetch(self, start_date=None):
+        """Downloads rows since start_date (YYYY-MM-DD, inclusive), or the full history."""
+        if start_date:
+            df = ak.bond_zh_us_rate(start_date=start_date.replace("-", ""))
+        else:
+            df = ak.bond_zh_us_rate()
+        fetched = {}
+        for years, column in TENOR_COLUMNS.items():
+            if column not in df.columns:
+                continue
+            valid = df.dropna(subset=[column])
+            fetched[years] = [(str(date)[:10], float(value)) for date, value in zip(valid['日期'], valid[column])]
+        return fetched
+
+    def load(self):
+        """Loads the curve (once); returns {years: [(date, yield), ...]} in date order."""
+        if self._history is not None:
+            return self._history
+
+        history = self._stored_history()
+        last_dates = [points[-1][0] for points in history.values() if points]
+        # Re-fetch from the oldest "latest" date so every tenor catches up
+        start_date = min(last_dates) if last_dates else None
+        try:
+            fetched = self._fetch(start_date)
+        except Exception as e:
+            print(f"Error fetching bond yield: {e}")
+            if last_dates:
+                print(f"Using stored bond yields (up to {max(last_dates)})")
+            fetched = {}
+
+        for years, points in fetched.items():
+            if not points:
+                continue
+            merged = dict(history.get(years, []))
+            merged.update(points)
+            history[years] = sorted(merged.items())
+            try:
+                self._get_store().upsert_series(YIELD_SERIES, f"{years}Y", points)
+            except Exception as e:
+                print(f"Failed to store {years}Y bond yields: {e}")
+
+        self._history = history
+        return history
+
+    def history(self, years):
+        """[(date, yield), ...] for the given tenor, oldest first."""
+        return self.load().get(years, [])
+
+    def latest(self, years):
+        """Most recent non-null yield for the given tenor, or None."""
+        points = self.history(years)
+        if not points:
             return None
+        return points[-1][1]
 
-        # Get the most recent valid data point
-        latest_data = df_valid.iloc[-1]
 
-        # Extract the yield value
-        yield_value = latest_data[column_name]
+_yield_curve = None
 
-        return float(yield_value)
-    except Exception as e:
-        print(f"Error fetching bond yield: {e}")
+
+def get_yield_curve():
+    """The yield curve shared by all tenors in this run."""
+    global _yield_curve
+    if _yield_curve is None:
+        _yield_curve = YieldCurve()
+    return _yield_curve
+
+
+def reset_yield_curve():
+    """Forgets the in-memory curve (the next lookup fetches again)."""
+    global _yield_curve
+    _yield_curve = None
+
+
+def get_china_bond_yield(years=10):
+    """
+    Returns the latest China government bond yield for a tenor.
+    All tenors share one bond_zh_us_rate download per run (see YieldCurve).
+
+    Args:
+        years: Bond maturity in years (2, 5, 10 or 30)
+    """
+    if years not in TENOR_COLUMNS:
+        print(f"Unsupported bond maturity: {years}Y")
         return None
+    value = get_yield_curve().latest(years)
+    if value is None:
+        print(f"No valid data found for China {years}Y bond yield")
+    return value
 
 
 def get_china_10y_bond_yield():
@@ -58,148 +182,137 @@ def get_china_30y_bond_yield():
     return get_china_bond_yield(30)
 
 
-def find_page_id_by_ticker(ticker):
+def find_page_ids_by_tickers(tickers, pages=None):
     """
-    Searches the Notion database for a page with the specific ticker name.
-    Uses multi-datasource query (same as main.py).
+    Finds the Notion pages for several tickers with a single (paginated) query.
+    Returns {ticker: page_id} for the tickers that were found.
+
+    Args:
+        pages: Already queried holding pages (pipeline mode); searched instead of querying
     """
-    if not notion:
+    notion = get_notion_client()
+    if not notion and pages is None:
         print("Notion client not initialized")
-        return None
+        return {}
 
+    wanted = set(tickers)
     try:
-        # Get database info
-        database = notion.databases.retrieve(database_id=DATABASE_ID)
-
-        # Check if it has data sources (multi-datasource database)
-        if 'data_sources' in database and database['data_sources']:
-            data_source_id = database['data_sources'][0]['id']
-            response = notion.data_sources.query(data_source_id=data_source_id)
-            pages = response.get("results", [])
-        else:
-            raise Exception("Single datasource database not supported")
+        if pages is None:
+            # Get database info
+            database = notion.databases.retrieve(database_id=DATABASE_ID)
+
+            # Check if it has data sources (multi-datasource database)
+            if 'data_sources' in database and database['data_sources']:
+                data_source_id = database['data_sources'][0]['id']
+            else:
+                raise Exception("Single datasource database not supported")
+            pages = notion_query.Query(data_source_id).stream(notion)
 
-        # Find the page with matching ticker
+        page_ids = {}
         for page in pages:
             props = page.get("properties", {})
             # Try both "股票代码" and "Ticker" as title property
             ticker_obj = props.get("股票代码") or props.get("Ticker")
             if ticker_obj and ticker_obj.get("title"):
                 ticker_list = ticker_obj["title"]
-                if ticker_list and ticker_list[0].get("text", {}).get("content") == ticker:
-                    return page["id"]
-
-        print(f"No page found for ticker: {ticker}")
-        return None
+                ticker = ticker_list[0].get("text", {}).get("content") if ticker_list else None
+                if ticker in wanted and ticker not in page_ids:
+                    page_ids[ticker] = page["id"]
+                    if len(page_ids) == len(wanted):
+                        break
+
+        for ticker in tickers:
+            if ticker not in page_ids:
+                print(f"No page found for ticker: {ticker}")
+        return page_ids
     except Exception as e:
         print(f"Error searching Notion database: {e}")
-        return None
+        return {}
 
-def update_notion_yield(page_id, yield_value):
+
+def find_page_id_by_ticker(ticker):
     """
-    Updates the 'Yield' property of a specific Notion page.
+    Searches the Notion database for a page with the specific ticker name.
+    Uses multi-datasource query (same as main.py).
     """
-    if not notion:
-        print("Notion client not initialized")
-        return False
+    return find_page_ids_by_tickers([ticker]).get(ticker)
+
+
+def write_notion_page(page_id, properties):
+    """Writes properties to a Notion page; raises on failure (retried by the write queue)."""
+    get_notion_client().pages.update(page_id=page_id, properties=properties)
+
+
+def update_yield(ticker, page_id, yield_value, description, writes):
+    """Queues the 'Yield' update of a bond ETF page."""
+    if not page_id:
+        print(f"Skipping {ticker} due to missing page ID.")
+        return
+    print(f"Queueing {ticker} (page {page_id}) Yield field with {description}.")
+    writes.put(page_id, {"Yield": {"number": yield_value}}, label=ticker)
+
+
+def flush_yield_writes(writes):
+    """Writes the queued Yield updates and reports the result."""
+    stats = writes.flush()
+    print(f"\nUpdated {stats['requests'] - len(stats['failed'])}/{stats['requests']} Yield fields.")
+    for ticker, error in stats["failed"]:
+        print(f"Failed to update {ticker} Yield field: {error}")
+
+
+def main(pages=None, writes=None):
+    """
+    Updates the Yield field of every bond ETF.
 
+    Args:
+        pages: Already queried holding pages (pipeline mode); None to query Notion
+        writes: Shared write queue (pipeline mode), flushed by the caller together with the
+            other stages' updates; None to write through a queue of this run
+    """
+    own_writes = writes is None
+    if own_writes:
+        writes = write_queue.WriteBehind(write_notion_page)
+
+    # One download of the yield curve serves every tenor
+    print("Fetching China bond yield curve...")
+    yields = {}
+    for years in sorted(set(BOND_ETF_TENORS.values()), reverse=True):
+        yields[years] = get_china_bond_yield(years)
+        if yields[years] is not None:
+            print(f"{years}Y Yield: {yields[years]}%")
+        else:
+            print(f"Failed to fetch {years}-year bond yield.")
+
+    # Resolve every bond ETF page in one pass over the database
+    print("\nSearching for bond ETF pages in Notion...")
+    page_ids = find_page_ids_by_tickers(list(BOND_ETF_TENORS) + list(FIXED_YIELD_TICKERS), pages)
+    if pages is None:
+        profiling.checkpoint("notion_query")
+
+    for ticker, years in BOND_ETF_TENORS.items():
+        if yields[years] is not None:
+            update_yield(ticker, page_ids.get(ticker), yields[years], f"{years}Y rate", writes)
+
+    # Record the fetched yields in the shared state store
     try:
-        notion.pages.update(
-            page_id=page_id,
-            properties={
-                "Yield": {"number": yield_value}
-            }
-        )
-        return True
+        state_store.get_store().set_meta("bond_etf_yield", {
+            **{f"{years}Y": value for years, value in sorted(yields.items(), reverse=True)},
+            "updated_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        })
     except Exception as e:
-        print(f"Error updating Notion page: {e}")
-        return False
-
-if __name__ == "__main__":
-    # Bond ETFs grouped by bond maturity
-    TICKERS_10Y = ["511520", "511260"]  # Use 10-year bond yield
-    TICKERS_5Y = ["511010"]  # Use 5-year bond yield
-    TICKERS_30Y = ["511090"]  # Use 30-year bond yield
-
-    # Fixed yield bonds (特别国债等固定收益率品种)
-    FIXED_YIELD_TICKERS = {
-        "102277": 2.33,  # 特别国债
-    }
-
-    # Fetch 10-year bond yield
-    print("Fetching 10-year China bond yield...")
-    yield_10y = get_china_10y_bond_yield()
-
-    if yield_10y is not None:
-        print(f"10Y Yield: {yield_10y}%")
-        for ticker in TICKERS_10Y:
-            print(f"\nSearching for page {ticker} in Notion...")
-            page_id = find_page_id_by_ticker(ticker)
-            if page_id:
-                print(f"Found page ID: {page_id}. Updating Yield field...")
-                success = update_notion_yield(page_id, yield_10y)
-                if success:
-                    print(f"Successfully updated {ticker} Yield field with 10Y rate.")
-                else:
-                    print(f"Failed to update {ticker} Yield field.")
-            else:
-                print(f"Skipping {ticker} due to missing page ID.")
-    else:
-        print("Failed to fetch 10-year bond yield.")
-
-    # Fetch 5-year bond yield
-    print("\nFetching 5-year China bond yield...")
-    yield_5y = get_china_5y_bond_yield()
-
-    if yield_5y is not None:
-        print(f"5Y Yield: {yield_5y}%")
-        for ticker in TICKERS_5Y:
-            print(f"\nSearching for page {ticker} in Notion...")
-            page_id = find_page_id_by_ticker(ticker)
-            if page_id:
-                print(f"Found page ID: {page_id}. Updating Yield field...")
-                success = update_notion_yield(page_id, yield_5y)
-                if success:
-                    print(f"Successfully updated {ticker} Yield field with 5Y rate.")
-                else:
-                    print(f"Failed to update {ticker} Yield field.")
-            else:
-                print(f"Skipping {ticker} due to missing page ID.")
-    else:
-        print("Failed to fetch 5-year bond yield.")
-
-    # Fetch 30-year bond yield
-    print("\nFetching 30-year China bond yield...")
-    yield_30y = get_china_30y_bond_yield()
-
-    if yield_30y is not None:
-        print(f"30Y Yield: {yield_30y}%")
-        for ticker in TICKERS_30Y:
-            print(f"\nSearching for page {ticker} in Notion...")
-            page_id = find_page_id_by_ticker(ticker)
-            if page_id:
-                print(f"Found page ID: {page_id}. Updating Yield field...")
-                success = update_notion_yield(page_id, yield_30y)
-                if success:
-                    print(f"Successfully updated {ticker} Yield field with 30Y rate.")
-                else:
-                    print(f"Failed to update {ticker} Yield field.")
-            else:
-                print(f"Skipping {ticker} due to missing page ID.")
-    else:
-        print("Failed to fetch 30-year bond yield.")
+        print(f"Failed to record bond yields in state store: {e}")
 
     # Update fixed yield bonds (特别国债)
     print("\nUpdating fixed yield bonds...")
     for ticker, fixed_yield in FIXED_YIELD_TICKERS.items():
-        print(f"\nSearching for page {ticker} in Notion...")
-        page_id = find_page_id_by_ticker(ticker)
-        if page_id:
-            print(f"Found page ID: {page_id}. Updating Yield field with fixed rate {fixed_yield}%...")
-            success = update_notion_yield(page_id, fixed_yield)
-            if success:
-                print(f"Successfully updated {ticker} Yield field with fixed rate.")
-            else:
-                print(f"Failed to update {ticker} Yield field.")
-        else:
-            print(f"Skipping {ticker} due to missing page ID.")
+        update_yield(ticker, page_ids.get(ticker), fixed_yield, f"fixed rate {fixed_yield}%", writes)
+
+    if own_writes:
+        flush_yield_writes(writes)
+
+
+if __name__ == "__main__":
+    # Profiling mode: --profile or SYNC_PROFILE=1 (see profiling.py)
+    profiling.activate_from_env("--profile" in sys.argv[1:])
+    main()
+    profiling.checkpoint("bonds")
@@ -1,58 +1,79 @@
 import os
 import sys
-from notion_client import Client
+import datetime
+
+# 作为脚本运行时，允许导入项目根目录下的公共模块
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import state_store
+import notion_query
+import profiling
+import write_queue
 
 # 环境变量配置
 NOTION_TOKEN = os.getenv("NOTION_TOKEN")
 DATABASE_ID = os.getenv("DATABASE_ID")
 
-# 初始化 Notion 客户端
-if not NOTION_TOKEN or not DATABASE_ID:
-    print("❌ 错误: 未找到环境变量")
-    sys.exit(1)
+# Notion 客户端在 main() 中创建（导入本模块时不检查环境变量、不创建客户端）
+notion = None
+
+# 本脚本读取的持仓属性（流水线模式下页面索引需要包含这些属性）
+PINGAN_PROPERTIES = ["账户", "股票代码", "账户总览"]
+
+
+def get_notion_client():
+    """按需创建 Notion 客户端；环境变量缺失时返回 None"""
+    global notion
+    if notion is None and NOTION_TOKEN and DATABASE_ID:
+        from notion_client import Client
+        notion = Client(auth=NOTION_TOKEN, notion_version="2025-09-03")
+    return notion
 
-notion = Client(auth=NOTION_TOKEN, notion_version="2025-09-03")
+def get_data_source_id():
+    """获取持仓数据库的数据源 ID"""
+    database = notion.databases.retrieve(database_id=DATABASE_ID)
+    if 'data_sources' in database and database['data_sources']:
+        return database['data_sources'][0]['id']
+    raise Exception("不支持单数据源数据库")
 
-def get_pingan_stock_pages():
-    """从数据库查询账户=平安证券的所有记录（返回page ID和股票代码）"""
+def is_pingan_page(page):
+    return "平安" in (notion_query.property_text(page["properties"].get("账户")) or "")
+
+
+def get_pingan_stock_pages(pages=None):
+    """
+    从数据库查询账户=平安证券的所有记录（返回page ID和股票代码）
+    pages: 已查询的持仓页面（流水线模式），提供时直接在其中筛选，不再查询
+    """
     print("📥 正在查询平安证券的股票...")
 
     try:
-        database = notion.databases.retrieve(database_id=DATABASE_ID)
-
-        if 'data_sources' in database and database['data_sources']:
-            data_source_id = database['data_sources'][0]['id']
-            response = notion.data_sources.query(data_source_id=data_source_id)
-            pages = response.get("results", [])
+        if pages is None:
+            data_source_id = get_data_source_id()
+            schema = notion_query.property_schema(notion, data_source_id)
+
+            # 账户包含“平安”的条件在服务端过滤，只有这些记录会被下载
+            query = (notion_query.Query(data_source_id)
+                     .where_contains(schema, "账户", "平安")
+                     .where_not_empty(schema, "股票代码")
+                     .select(schema, "账户", "股票代码"))
+            candidates = query.stream(notion)
         else:
-            raise Exception("不支持单数据源数据库")
-
-        print(f"🔍 找到 {len(pages)} 条记录")
+            candidates = (page for page in pages if is_pingan_page(page))
 
         stock_pages = []  # 存储 (page_id, stock_code) 元组
-        for page in pages:
+        for page in candidates:
             page_id = page["id"]
             props = page["properties"]
 
-            # 获取账户字段
-            account_prop = props.get("账户")
-            if account_prop:
-                account_name = ""
-                if account_prop.get("select"):
-                    account_name = account_prop["select"]["name"]
-                elif account_prop.get("rich_text") and len(account_prop["rich_text"]) > 0:
-                    account_name = account_prop["rich_text"][0]["text"]["content"]
-
-                # 判断是否为平安证券
-                if "平安证券" in account_name or "平安" in account_name:
-                    # 获取股票代码
-                    ticker_obj = props.get("股票代码")
-                    if ticker_obj and ticker_obj.get("title"):
-                        ticker_list = ticker_obj["title"]
-                        if ticker_list:
-                            stock_code = ticker_list[0]["text"]["content"]
-                            stock_pages.append((page_id, stock_code))
-                            print(f"   ✓ {stock_code} (ID: {page_id[:8]}...)")
+            # 获取股票代码
+            ticker_obj = props.get("股票代码")
+            if ticker_obj and ticker_obj.get("title"):
+                ticker_list = ticker_obj["title"]
+                if ticker_list:
+                    stock_code = ticker_list[0]["text"]["content"]
+                    stock_pages.append((page_id, stock_code))
+                    print(f"   ✓ {stock_code} (ID: {page_id[:8]}...)")
 
         print(f"\n📊 共找到 {len(stock_pages)} 条平安证券记录")
         return stock_pages
@@ -61,28 +82,37 @@ def get_pingan_stock_pages():
         print(f"❌ 查询失败: {e}")
         return []
 
-def find_overview_page_with_pingan():
-    """找到包含'平安证券总仓'字段的账户总览页面"""
+def find_overview_page_with_pingan(pages=None):
+    """
+    找到包含'平安证券总仓'字段的账户总览页面
+    pages: 已查询的持仓页面（流水线模式），提供时直接在其中查找，不再查询
+    """
     print("\n🔍 正在查找平安证券总仓页面...")
 
     try:
-        database = notion.databases.retrieve(database_id=DATABASE_ID)
-
-        if 'data_sources' in database and database['data_sources']:
-            data_source_id = database['data_sources'][0]['id']
-            response = notion.data_sources.query(data_source_id=data_source_id)
-            pages = response.get("results", [])
+        if pages is None:
+            data_source_id = get_data_source_id()
+            schema = notion_query.property_schema(notion, data_source_id)
+
+            # 只查询有账户总览关联的记录
+            query = (notion_query.Query(data_source_id)
+                     .where_not_empty(schema, "账户总览")
+                     .select(schema, "账户总览"))
+            candidates = query.stream(notion)
         else:
-            raise Exception("不支持单数据源数据库")
+            candidates = pages
 
-        # 遍历查找有账户总览关联的记录
-        for page in pages:
+        checked = set()
+        for page in candidates:
             props = page["properties"]
             overview_prop = props.get("账户总览")
 
             if overview_prop and overview_prop.get("relation") and len(overview_prop["relation"]) > 0:
-                # 获取关联的页面ID
+                # 获取关联的页面ID（多条记录通常关联同一个账户总览页面，只检查一次）
                 related_page_id = overview_prop["relation"][0]["id"]
+                if related_page_id in checked:
+                    continue
+                checked.add(related_page_id)
 
                 try:
                     # 获取关联页面的详细信息
@@ -106,59 +136,75 @@ def find_overview_page_with_pingan():
         print(f"❌ 查找失败: {e}")
         return None
 
-def update_portfolio_field(page_id, stock_pages):
-    """更新页面的股票投资组合字段（relation类型）"""
+def write_notion_page(page_id, properties):
+    notion.pages.update(page_id=page_id, properties=properties)
+
+
+def update_portfolio_field(page_id, stock_pages, writes, on_success=None):
+    """股票投资组合字段（relation类型）的更新放入写入队列；on_success 在写入成功后调用"""
     print(f"\n📝 正在更新股票投资组合字段...")
+    # 将page ID列表转换为relation格式
+    relation_items = [{"id": pid} for pid, _ in stock_pages]
+    writes.put(page_id, {"股票投资组合": {"relation": relation_items}}, label="平安证券总仓", on_success=on_success)
+    print(f"   股票代码: {', '.join(code for _, code in stock_pages)}")
 
-    try:
-        # 将page ID列表转换为relation格式
-        relation_items = [{"id": pid} for pid, _ in stock_pages]
-
-        # 更新字段（relation类型）
-        update_props = {
-            "股票投资组合": {
-                "relation": relation_items
-            }
-        }
-
-        notion.pages.update(
-            page_id=page_id,
-            properties=update_props
-        )
-
-        stock_codes = [code for _, code in stock_pages]
-        print(f"✅ 成功更新! 写入了 {len(stock_pages)} 条记录")
-        print(f"   股票代码: {', '.join(stock_codes)}")
-        return True
 
+def record_sync(overview_page_id, stock_pages):
+    """记录本次同步结果到本地状态库"""
+    try:
+        state_store.get_store().set_meta("pingan_portfolio", {
+            "overview_page_id": overview_page_id,
+            "stock_codes": [code for _, code in stock_pages],
+            "synced_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        })
     except Exception as e:
-        print(f"❌ 更新失败: {e}")
-        return False
+        print(f"⚠️ 记录同步结果失败: {e}")
+    print(f"✅ 成功更新! 写入了 {len(stock_pages)} 条记录")
+
 
-def main():
+def main(pages=None, writes=None):
+    """
+    pages: 已查询的持仓页面（流水线模式，需包含 PINGAN_PROPERTIES），为 None 时自行查询
+    writes: 共用的写入队列（流水线模式，由流水线与其他阶段的更新一起写入），为 None 时使用本次运行的写入队列
+    """
     print("=" * 60)
     print("同步平安证券股票代码到账户总览")
     print("=" * 60)
 
+    if not get_notion_client():
+        print("❌ 错误: 未找到环境变量")
+        sys.exit(1)
+
     # 1. 获取平安证券的股票记录（page ID + 股票代码）
-    stock_pages = get_pingan_stock_pages()
+    stock_pages = get_pingan_stock_pages(pages)
     if not stock_pages:
         print("\n⚠️  未找到平安证券的股票记录")
         return
 
     # 2. 找到平安证券总仓的账户总览页面
-    overview_page_id = find_overview_page_with_pingan()
+    overview_page_id = find_overview_page_with_pingan(pages)
+    if pages is None:
+        profiling.checkpoint("notion_query")
     if not overview_page_id:
         print("\n⚠️  未找到平安证券总仓页面")
         return
 
-    # 3. 更新股票投资组合字段（使用relation）
-    success = update_portfolio_field(overview_page_id, stock_pages)
+    # 3. 更新股票投资组合字段（使用relation）；写入成功后记录本次同步结果
+    own_writes = writes is None
+    if own_writes:
+        writes = write_queue.WriteBehind(write_notion_page)
+    update_portfolio_field(overview_page_id, stock_pages, writes,
+                           on_success=lambda: record_sync(overview_page_id, stock_pages))
+    if not own_writes:
+        return
 
-    if success:
-        print("\n🎉 任务完成!")
-    else:
-        print("\n❌ 任务失败")
+    stats = writes.flush()
+    for _, error in stats["failed"]:
+        print(f"❌ 更新失败: {error}")
+    print("\n❌ 任务失败" if stats["failed"] else "\n🎉 任务完成!")
 
 if __name__ == "__main__":
+    # 性能分析模式：--profile 或 SYNC_PROFILE=1（见 profiling.py）
+    profiling.activate_from_env("--profile" in sys.argv[1:])
     main()
+    profiling.checkpoint("pingan")
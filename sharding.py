@@ -0,0 +1,162 @@
+"""
+分片运行：把持仓页面按页面 ID 一致性哈希分给 N 个工作进程，各自执行持仓同步，最后合并一次
+
+持仓和自选增长到几千条时，单个进程会碰到 Notion / 东方财富的限速和任务的时间上限。分片运行时：
+
+- 协调进程选定市场，预先加载共用的数据（汇率、全市场行情快照写入本地状态库），再启动 N 个工作进程
+- 每个工作进程查询持仓数据源，只处理 shard_of(页面 ID) 属于自己的页面，执行完整的逐条同步流程；
+  行情快照、PE 历史、K线等从共用的本地状态库（SQLite WAL，多进程安全）读取和增量写入，
+  同一缓存未命中时只有一个进程请求上游（file_lock.single_writer）；
+  指数估值、QDII 参考 ETF、基金净值增长率只采用本次运行中获取的结果（main.shared_lookup），
+  单独运行的工作进程（--shard）各自请求
+- 工作进程不检查信号变化、不保存市场运行记录、不导出指标，而是把结果写入运行报告（JSON）
+- 合并步骤读取所有报告，合并指标，对全部持仓检查一次信号变化；所有分片成功时才保存市场运行记录；
+  之后交易流水、债券收益率、平安证券组合阶段只执行一次，读取的是各分片写入后的最新现价
+
+    python pipeline.py --shards 4                                   # 本机启动 4 个工作进程并合并
+    python pipeline.py --shard 2/4 --market CN,HK --report shard-2.json   # 单个工作进程（可在不同机器上运行）
+    python pipeline.py --merge shard-*.json                         # 合并报告，并执行其余阶段
+
+分片用 rendezvous（最高随机权重）哈希：同一页面总是落在同一分片，分片数从 N 变为 N+1 时只有约 1/(N+1) 的页面移动。
+所有工作进程共用一个 Notion 集成，写入速率按分片数平分（write_queue.WRITE_RATE / N）。
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import threading
+import subprocess
+
+import file_lock
+
+REPORT_VERSION = 1
+
+
+def parse_shard(value):
+    """'2/4' → (2, 4)；分片编号从 1 开始"""
+    try:
+        shard, shards = (int(part) for part in value.split("/"))
+    except (AttributeError, ValueError):
+        raise ValueError(f"分片格式应为 序号/总数，如 2/4: {value}")
+    if not 1 <= shard <= shards:
+        raise ValueError(f"分片序号应在 1 到 {shards} 之间: {value}")
+    return shard, shards
+
+
+def _weight(shard, page_id):
+    key = page_id.replace("-", "").lower()
+    return hashlib.blake2b(f"{shard}:{key}".encode("utf-8"), digest_size=8).digest()
+
+
+def shard_of(page_id, shards):
+    """页面所属的分片（1..shards）；不依赖进程的 hash 随机化，各进程、各机器结果相同"""
+    return max(range(1, shards + 1), key=lambda shard: _weight(shard, page_id))
+
+
+def select(pages, shard, shards):
+    """属于 shard 的页面（保持原顺序）"""
+    return [page for page in pages if shard_of(page["id"], shards) == shard]
+
+
+def write_report(path, report):
+    """先写临时文件再替换，合并步骤不会读到写了一半的报告"""
+    with file_lock.atomic_write(path) as f:
+        json.dump(dict(report, version=REPORT_VERSION), f, ensure_ascii=False)
+
+
+def load_reports(paths):
+    """读取运行报告；不存在或无法解析的报告（工作进程崩溃）打印警告后跳过"""
+    reports = []
+    for path in paths:
+        try:
+            with open(path, encoding="utf-8") as f:
+                reports.append(json.load(f))
+        except (OSError, ValueError) as e:
+            print(f"⚠️ 无法读取分片报告 {path}: {e}")
+    return reports
+
+
+def merge_reports(reports, shards=None):
+    """
+    合并各分片的运行报告
+    参数：
+        shards: 预期的分片数；为 None 时取报告中记录的分片数
+    返回：
+        {"shards", "pages", "markets", "started_at", "holdings": {结果: 数量}, "metrics": [...], "failed": [分片序号]}
+        failed 包括报告失败的分片和缺少报告的分片
+    """
+    counts = {report["shards"] for report in reports}
+    if shards is None:
+        if len(counts) > 1:
+            raise ValueError(f"分片报告的分片数不一致: {sorted(counts)}")
+        shards = counts.pop() if counts else 0
+    elif counts - {shards}:
+        raise ValueError(f"分片报告的分片数 {sorted(counts)} 与预期的 {shards} 不一致")
+
+    by_shard = {}
+    for report in reports:
+        if report["shard"] in by_shard:
+            raise ValueError(f"分片 {report['shard']}/{shards} 有多份报告")
+        by_shard[report["shard"]] = report
+
+    merged = {"shards": shards, "pages": 0, "markets": [], "started_at": None, "holdings": {}, "metrics": [], "failed": []}
+    for shard in range(1, shards + 1):
+        report = by_shard.get(shard)
+        if report is None:
+            merged["failed"].append(shard)
+            print(f"   - 分片 {shard}/{shards}: ❌ 没有报告")
+            continue
+        if not report["ok"]:
+            merged["failed"].append(shard)
+        merged["pages"] += report["pages"]
+        merged["markets"] += [m for m in report["markets"] if m not in merged["markets"]]
+        if merged["started_at"] is None or report["started_at"] < merged["started_at"]:
+            merged["started_at"] = report["started_at"]
+        for result, count in report["holdings"].items():
+            merged["holdings"][result] = merged["holdings"].get(result, 0) + count
+        merged["metrics"] += report["metrics"]
+        detail = ", ".join(f"{result} {count}" for result, count in sorted(report["holdings"].items()))
+        status = "✅" if report["ok"] else f"❌ {report.get('error') or '失败'}"
+        print(f"   - 分片 {shard}/{shards}: {report['pages']} 条持仓 ({detail or '无'})，耗时 {report['elapsed']:.0f}s {status}")
+    return merged
+
+
+def worker_command(script, shard, shards, markets, report_path):
+    return [sys.executable, script, "--shard", f"{shard}/{shards}", "--market", ",".join(markets), "--report", report_path]
+
+
+def _relay(shard, shards, stream):
+    """把工作进程的输出逐行加上分片前缀转发到本进程"""
+    for line in stream:
+        print(f"[{shard}/{shards}] {line}", end="", flush=True)
+
+
+def spawn_workers(script, shards, markets, report_dir, env=None):
+    """
+    启动 shards 个工作进程并等待结束
+    参数：
+        env: 每个分片的环境变量 {分片序号: {名称: 值}}，在当前环境的基础上覆盖
+    返回：
+        各分片报告的路径（工作进程失败时报告可能不存在）
+    """
+    paths, processes, relays = [], [], []
+    for shard in range(1, shards + 1):
+        path = os.path.join(report_dir, f"shard-{shard}.json")
+        worker_env = dict(os.environ, PYTHONUNBUFFERED="1", **(env or {}).get(shard, {}))
+        process = subprocess.Popen(worker_command(script, shard, shards, markets, path), env=worker_env,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, encoding="utf-8")
+        relay = threading.Thread(target=_relay, args=(shard, shards, process.stdout), daemon=True)
+        relay.start()
+        paths.append(path)
+        processes.append(process)
+        relays.append(relay)
+
+    started = time.monotonic()
+    for shard, (process, relay) in enumerate(zip(processes, relays), start=1):
+        code = process.wait()
+        relay.join()
+        if code:
+            print(f"⚠️ 分片 {shard}/{shards} 的工作进程退出码 {code}")
+    print(f"🧩 {shards} 个分片执行完毕，耗时 {time.monotonic() - started:.0f}s")
+    return paths
@@ -0,0 +1,572 @@
+"""
+统一的本地状态存储（SQLite，WAL 模式）
+
+以前的运行状态散落在多个文件中，各自有一套新鲜度判断：
+akshare_cache/*.pkl（行情快照）、pe_cache/*_pe.csv（PE 历史）、signal_cache.json、exchange_rates.json、
+market_runs.json。每次读写都要整体加载/重写文件，也不能安全地并发写入。
+现在统一保存在 akshare_cache/state.db（可通过环境变量 STATE_DB 指定路径）：
+
+| 表 | 内容 | 主键 |
+|----|------|------|
+| snapshots / quotes | 全市场行情快照（每行一个代码，payload 为 JSON） | (snapshot, code) |
+| valuation_series | PE/PB 等历史估值序列 | (series, symbol, date) |
+| price_bars / price_bar_sync | 行情K线（OHLCV）及每个代码上次增量更新的时间 | (symbol, interval, date) |
+| fundamentals | 基本面数据（如 A股财务指标最新一期） | (symbol, field) |
+| fx | 汇率（基准 CNY） | currency |
+| signals | 信号字段上次的值 | (ticker, field) |
+| run_meta | 运行元数据（各市场上次运行时间等），值为 JSON | key |
+| lookups | 分片工作进程共用的上游查询结果（指数估值、QDII 参考 ETF、基金净值增长率），值为 JSON | (name, key) |
+
+缓存命名空间（CACHE_NAMESPACES，scripts/manage_cache.py 按命名空间查看统计、失效）：
+snapshot（行情快照，按快照名）、pe_series（A股/港股历史 PE）、valuation_history（每日估值轨迹）、
+price_bars、fundamentals、fx、signals、run_meta、lookups（只在一次分片运行内有效，见 main.shared_lookup）。
+
+WAL 模式下读写互不阻塞；每个线程使用自己的连接（预算超时的调用在后台线程执行，常驻模式有 HTTP 线程）。
+多个进程可以同时打开同一个状态库；同一缓存的上游请求由 file_lock.single_writer() 保证只有一个进程执行。
+首次打开时自动导入旧的 JSON/CSV 状态文件（旧文件保留不删）。
+"""
+import os
+import csv
+import glob
+import json
+import time
+import atexit
+import sqlite3
+import threading
+
+import file_lock
+
+DEFAULT_PATH = os.path.join(".", "akshare_cache", "state.db")
+
+SCHEMA_VERSION = 1
+
+# 历史 PE 序列（A股 pe_ttm、港股 hk_pe_ratio）；valuation_series 中其余序列（daily_*）为每日估值轨迹
+PE_SERIES = ("pe_ttm", "hk_pe_ratio")
+
+CACHE_NAMESPACES = ("snapshot", "pe_series", "valuation_history", "price_bars", "fundamentals", "fx", "signals", "run_meta", "lookups")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    snapshot TEXT PRIMARY KEY,
+    fetched_at REAL NOT NULL,
+    row_count INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS quotes (
+    snapshot TEXT NOT NULL,
+    code TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    PRIMARY KEY (snapshot, code)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS valuation_series (
+    series TEXT NOT NULL,
+    symbol TEXT NOT NULL,
+    date TEXT NOT NULL,
+    value REAL,
+    PRIMARY KEY (series, symbol, date)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS price_bars (
+    symbol TEXT NOT NULL,
+    interval TEXT NOT NULL,
+    date TEXT NOT NULL,
+    open REAL,
+    high REAL,
+    low REAL,
+    close REAL,
+    volume REAL,
+    PRIMARY KEY (symbol, interval, date)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS price_bar_sync (
+    symbol TEXT NOT NULL,
+    interval TEXT NOT NULL,
+    checked_at REAL NOT NULL,
+    PRIMARY KEY (symbol, interval)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS fundamentals (
+    symbol TEXT NOT NULL,
+    field TEXT NOT NULL,
+    value TEXT,
+    fetched_at REAL NOT NULL,
+    PRIMARY KEY (symbol, field)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS fx (
+    currency TEXT PRIMARY KEY,
+    rate REAL NOT NULL,
+    fetched_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS signals (
+    ticker TEXT NOT NULL,
+    field TEXT NOT NULL,
+    value TEXT,
+    PRIMARY KEY (ticker, field)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS run_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS lookups (
+    name TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    PRIMARY KEY (name, key)
+) WITHOUT ROWID;
+"""
+
+
+def _json_default(value):
+    """numpy 标量、Timestamp 等转换为 JSON 可表示的值"""
+    if hasattr(value, "item"):
+        return value.item()
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return str(value)
+
+
+def _dumps(value):
+    return json.dumps(value, ensure_ascii=False, default=_json_default)
+
+
+class StateStore:
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self._initialized = False
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # isolation_level=None: 自动提交，写入批次由 _transaction() 显式包裹
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with self._lock:
+                if not self._initialized:
+                    conn.executescript(SCHEMA)
+                    conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+                    self._initialized = True
+                self._connections.append(conn)
+            self._local.conn = conn
+        return conn
+
+    def lock_dir(self):
+        """跨进程缓存锁的目录（与状态库同目录，见 file_lock.py）"""
+        return os.path.join(os.path.dirname(self.path) or ".", "locks")
+
+    def backup(self, path):
+        """把状态库的一致副本写入 path（SQLite 备份接口，写入中的事务和 WAL 不影响副本）"""
+        target = sqlite3.connect(path)
+        try:
+            self._conn().backup(target)
+        finally:
+            target.close()
+
+    def merge_database(self, path, statements):
+        """
+        把 path 的状态库附加为 b，在一个事务中依次执行 statements [(名称, SQL)]（见 cache_bundle.py）
+        返回 {名称: 写入的行数}；任一语句失败时整体回滚
+        """
+        conn = self._conn()
+        changes = {}
+        conn.execute("ATTACH DATABASE ? AS b", (path,))
+        try:
+            with self._transaction():
+                for name, sql in statements:
+                    before = conn.total_changes
+                    conn.execute(sql)
+                    changes[name] = changes.get(name, 0) + conn.total_changes - before
+        finally:
+            conn.execute("DETACH DATABASE b")
+        return changes
+
+    def _transaction(self):
+        conn = self._conn()
+        return _Transaction(conn)
+
+    def close(self):
+        """关闭所有线程的连接（最后一个连接关闭时 SQLite 会把 WAL 合并回主库文件）"""
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        self._local = threading.local()
+
+    # --- 行情快照 ---
+
+    def put_snapshot(self, snapshot, rows, fetched_at=None):
+        """整体替换一个全市场快照；rows: {代码: 行字典}"""
+        fetched_at = fetched_at or time.time()
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM quotes WHERE snapshot = ?", (snapshot,))
+            conn.executemany(
+                "INSERT INTO quotes (snapshot, code, payload) VALUES (?, ?, ?)",
+                ((snapshot, code, _dumps(row)) for code, row in rows.items()),
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO snapshots (snapshot, fetched_at, row_count) VALUES (?, ?, ?)",
+                (snapshot, fetched_at, len(rows)),
+            )
+
+    def snapshot_fetched_at(self, snapshot):
+        row = self._conn().execute("SELECT fetched_at FROM snapshots WHERE snapshot = ?", (snapshot,)).fetchone()
+        return row[0] if row else None
+
+    def get_snapshot(self, snapshot, fresh_after=None):
+        """返回 {代码: 行字典}；快照不存在或早于 fresh_after（时间戳）时返回 None"""
+        fetched_at = self.snapshot_fetched_at(snapshot)
+        if fetched_at is None or (fresh_after is not None and fetched_at < fresh_after):
+            return None
+        rows = self._conn().execute("SELECT code, payload FROM quotes WHERE snapshot = ?", (snapshot,))
+        return {code: json.loads(payload) for code, payload in rows}
+
+    def get_quote(self, snapshot, code):
+        """单个代码的行情（主键查找，不加载整个快照）"""
+        row = self._conn().execute(
+            "SELECT payload FROM quotes WHERE snapshot = ? AND code = ?", (snapshot, code)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    # --- 估值历史序列 ---
+
+    def upsert_series(self, series, symbol, points):
+        """增量写入序列数据点；points: [(日期字符串, 数值), ...]，同一日期覆盖"""
+        with self._transaction() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO valuation_series (series, symbol, date, value) VALUES (?, ?, ?, ?)",
+                ((series, symbol, str(date), None if value is None else float(value)) for date, value in points),
+            )
+
+    def get_series(self, series, symbol):
+        """按日期升序返回 [(日期, 数值), ...]"""
+        return self._conn().execute(
+            "SELECT date, value FROM valuation_series WHERE series = ? AND symbol = ? ORDER BY date",
+            (series, symbol),
+        ).fetchall()
+
+    # --- 行情K线 ---
+
+    def upsert_bars(self, symbol, interval, bars, checked_at=None):
+        """
+        增量写入K线并记录本次更新时间；bars: [(日期字符串, open, high, low, close, volume), ...]
+        同一日期覆盖（未收盘的当期K线在下次更新时被替换）
+        """
+        checked_at = checked_at or time.time()
+        with self._transaction() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO price_bars (symbol, interval, date, open, high, low, close, volume) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                ((symbol, interval, str(bar[0]), *(None if v is None else float(v) for v in bar[1:])) for bar in bars),
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO price_bar_sync (symbol, interval, checked_at) VALUES (?, ?, ?)",
+                (symbol, interval, checked_at),
+            )
+
+    def get_bars(self, symbol, interval, since=None):
+        """按日期升序返回 [(日期, open, high, low, close, volume), ...]；since: 只返回该日期及之后的K线"""
+        return self._conn().execute(
+            "SELECT date, open, high, low, close, volume FROM price_bars "
+            "WHERE symbol = ? AND interval = ? AND date >= ? ORDER BY date",
+            (symbol, interval, str(since or "")),
+        ).fetchall()
+
+    def last_bar_date(self, symbol, interval):
+        row = self._conn().execute(
+            "SELECT MAX(date) FROM price_bars WHERE symbol = ? AND interval = ?", (symbol, interval)
+        ).fetchone()
+        return row[0] if row else None
+
+    def bars_checked_at(self, symbol, interval):
+        """上次增量更新 symbol 的时间戳；从未更新过返回 None"""
+        row = self._conn().execute(
+            "SELECT checked_at FROM price_bar_sync WHERE symbol = ? AND interval = ?", (symbol, interval)
+        ).fetchone()
+        return row[0] if row else None
+
+    # --- 基本面 ---
+
+    def put_fundamentals(self, symbol, values, fetched_at=None):
+        """整体替换 symbol 的基本面数据；values: {字段: 值}"""
+        fetched_at = fetched_at or time.time()
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM fundamentals WHERE symbol = ?", (symbol,))
+            conn.executemany(
+                "INSERT INTO fundamentals (symbol, field, value, fetched_at) VALUES (?, ?, ?, ?)",
+                ((symbol, field, _dumps(value), fetched_at) for field, value in values.items()),
+            )
+
+    def get_fundamentals(self, symbol, fresh_after=None):
+        """返回 {字段: 值}；不存在或早于 fresh_after 时返回 None"""
+        rows = self._conn().execute(
+            "SELECT field, value, fetched_at FROM fundamentals WHERE symbol = ?", (symbol,)
+        ).fetchall()
+        if not rows:
+            return None
+        if fresh_after is not None and min(r[2] for r in rows) < fresh_after:
+            return None
+        return {field: json.loads(value) for field, value, _ in rows}
+
+    # --- 汇率 ---
+
+    def put_rates(self, rates, fetched_at=None):
+        fetched_at = fetched_at or time.time()
+        with self._transaction() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO fx (currency, rate, fetched_at) VALUES (?, ?, ?)",
+                ((currency, float(rate), fetched_at) for currency, rate in rates.items()),
+            )
+
+    def get_rates(self, fresh_after=None):
+        """返回 {货币: 汇率}；没有数据或早于 fresh_after 时返回 None"""
+        rows = self._conn().execute("SELECT currency, rate, fetched_at FROM fx").fetchall()
+        if not rows:
+            return None
+        if fresh_after is not None and min(r[2] for r in rows) < fresh_after:
+            return None
+        return {currency: rate for currency, rate, _ in rows}
+
+    # --- 信号 ---
+
+    def get_signals(self):
+        """返回 {(代码, 字段): 值}"""
+        rows = self._conn().execute("SELECT ticker, field, value FROM signals")
+        return {(ticker, field): value for ticker, field, value in rows}
+
+    def replace_signals(self, values):
+        """整体替换信号值；values: {(代码, 字段): 值}"""
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM signals")
+            conn.executemany(
+                "INSERT INTO signals (ticker, field, value) VALUES (?, ?, ?)",
+                ((ticker, field, value) for (ticker, field), value in values.items()),
+            )
+
+    # --- 运行元数据 ---
+
+    def get_meta(self, key, default=None):
+        row = self._conn().execute("SELECT value FROM run_meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_meta(self, key, value):
+        self._conn().execute(
+            "INSERT OR REPLACE INTO run_meta (key, value, updated_at) VALUES (?, ?, ?)",
+            (key, _dumps(value), time.time()),
+        )
+
+    # --- 共用的查询结果 ---
+
+    def put_lookup(self, name, key, value, fetched_at=None):
+        """保存查询 name（函数名）以参数 key 获取的结果"""
+        self._conn().execute(
+            "INSERT OR REPLACE INTO lookups (name, key, value, fetched_at) VALUES (?, ?, ?, ?)",
+            (name, key, _dumps(value), fetched_at or time.time()),
+        )
+
+    def get_lookup(self, name, key, fresh_after=None):
+        """返回保存的结果（JSON 解码后）；不存在或早于 fresh_after 时返回 None"""
+        row = self._conn().execute(
+            "SELECT value, fetched_at FROM lookups WHERE name = ? AND key = ?", (name, key)
+        ).fetchone()
+        if row is None or (fresh_after is not None and row[1] < fresh_after):
+            return None
+        return json.loads(row[0])
+
+    # --- 缓存统计与失效 ---
+
+    def cache_stats(self):
+        """
+        各缓存命名空间的统计，每项为 dict：
+            namespace, part（快照名 / 序列名，没有时为 None）, entries（行数）, keys（代码数）,
+            bytes（内容字节数，估算）, oldest / newest（获取时间戳；序列为最早/最新数据日期）
+        """
+        conn = self._conn()
+        stats = []
+
+        def add(namespace, part, entries, keys, size, oldest, newest):
+            stats.append({"namespace": namespace, "part": part, "entries": entries or 0, "keys": keys or 0,
+                          "bytes": int(size or 0), "oldest": oldest, "newest": newest})
+
+        for snapshot, row_count, fetched_at, size in conn.execute(
+                "SELECT s.snapshot, s.row_count, s.fetched_at, SUM(LENGTH(q.code) + LENGTH(q.payload)) "
+                "FROM snapshots s LEFT JOIN quotes q ON q.snapshot = s.snapshot GROUP BY s.snapshot ORDER BY s.snapshot"):
+            add("snapshot", snapshot, row_count, row_count, size, fetched_at, fetched_at)
+        for series, entries, keys, size, oldest, newest in conn.execute(
+                "SELECT series, COUNT(*), COUNT(DISTINCT symbol), SUM(LENGTH(symbol) + LENGTH(date) + 8), MIN(date), MAX(date) "
+                "FROM valuation_series GROUP BY series ORDER BY series"):
+            add("pe_series" if series in PE_SERIES else "valuation_history", series, entries, keys, size, oldest, newest)
+        entries, keys, size = conn.execute(
+            "SELECT COUNT(*), COUNT(DISTINCT symbol), SUM(LENGTH(symbol) + LENGTH(interval) + LENGTH(date) + 40) FROM price_bars").fetchone()
+        oldest, newest = conn.execute("SELECT MIN(checked_at), MAX(checked_at) FROM price_bar_sync").fetchone()
+        add("price_bars", None, entries, keys, size, oldest, newest)
+        add("fundamentals", None, *conn.execute(
+            "SELECT COUNT(*), COUNT(DISTINCT symbol), SUM(LENGTH(symbol) + LENGTH(field) + LENGTH(value) + 8), "
+            "MIN(fetched_at), MAX(fetched_at) FROM fundamentals").fetchone())
+        add("fx", None, *conn.execute(
+            "SELECT COUNT(*), COUNT(*), SUM(LENGTH(currency) + 16), MIN(fetched_at), MAX(fetched_at) FROM fx").fetchone())
+        add("signals", None, *conn.execute(
+            "SELECT COUNT(*), COUNT(DISTINCT ticker), SUM(LENGTH(ticker) + LENGTH(field) + LENGTH(value)), NULL, NULL FROM signals").fetchone())
+        add("run_meta", None, *conn.execute(
+            "SELECT COUNT(*), COUNT(*), SUM(LENGTH(key) + LENGTH(value) + 8), MIN(updated_at), MAX(updated_at) FROM run_meta").fetchone())
+        add("lookups", None, *conn.execute(
+            "SELECT COUNT(*), COUNT(DISTINCT name), SUM(LENGTH(name) + LENGTH(key) + LENGTH(value) + 8), "
+            "MIN(fetched_at), MAX(fetched_at) FROM lookups").fetchone())
+        return stats
+
+    def invalidate(self, namespace, keys=None):
+        """
+        删除命名空间中 keys 对应的缓存（keys 为空时删除整个命名空间），返回删除的行数
+        keys：snapshot 为快照名，fx 为货币，run_meta 为键名，lookups 为查询函数名，其余为代码（价格K线为 yfinance 代码）
+        """
+        keys = list(keys or [])
+
+        def matching(column):
+            if not keys:
+                return "1 = 1", ()
+            return f"{column} IN ({', '.join('?' * len(keys))})", tuple(keys)
+
+        deleted = 0
+        with self._transaction() as conn:
+            if namespace == "snapshot":
+                where, args = matching("snapshot")
+                deleted = conn.execute(f"DELETE FROM quotes WHERE {where}", args).rowcount
+                conn.execute(f"DELETE FROM snapshots WHERE {where}", args)
+            elif namespace in ("pe_series", "valuation_history"):
+                where, args = matching("symbol")
+                series_filter = f"series {'' if namespace == 'pe_series' else 'NOT '}IN ({', '.join('?' * len(PE_SERIES))})"
+                deleted = conn.execute(f"DELETE FROM valuation_series WHERE {series_filter} AND {where}", PE_SERIES + args).rowcount
+            elif namespace == "price_bars":
+                where, args = matching("symbol")
+                deleted = conn.execute(f"DELETE FROM price_bars WHERE {where}", args).rowcount
+                conn.execute(f"DELETE FROM price_bar_sync WHERE {where}", args)
+            elif namespace == "fundamentals":
+                where, args = matching("symbol")
+                deleted = conn.execute(f"DELETE FROM fundamentals WHERE {where}", args).rowcount
+            elif namespace == "fx":
+                where, args = matching("currency")
+                deleted = conn.execute(f"DELETE FROM fx WHERE {where}", args).rowcount
+            elif namespace == "signals":
+                where, args = matching("ticker")
+                deleted = conn.execute(f"DELETE FROM signals WHERE {where}", args).rowcount
+            elif namespace == "run_meta":
+                where, args = matching("key")
+                deleted = conn.execute(f"DELETE FROM run_meta WHERE {where}", args).rowcount
+            elif namespace == "lookups":
+                where, args = matching("name")
+                deleted = conn.execute(f"DELETE FROM lookups WHERE {where}", args).rowcount
+            else:
+                raise ValueError(f"未知缓存命名空间: {namespace}（可选: {', '.join(CACHE_NAMESPACES)}）")
+        return deleted
+
+
+class _Transaction:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
+
+
+def import_legacy_files(store, akshare_cache_dir, pe_cache_dir):
+    """
+    一次性导入旧的状态文件：signal_cache.json、market_runs.json、pe_cache/*_pe.csv
+    （行情快照 pickle 和汇率 JSON 是当天缓存，不导入）
+    """
+    if store.get_meta("legacy_imported"):
+        return
+    # 多个进程同时首次打开状态库时只导入一次
+    with file_lock.FileLock(file_lock.lock_path(store.lock_dir(), "legacy_import")):
+        if not store.get_meta("legacy_imported"):
+            _import_legacy_files(store, akshare_cache_dir, pe_cache_dir)
+
+
+def _import_legacy_files(store, akshare_cache_dir, pe_cache_dir):
+    imported = []
+
+    signal_file = os.path.join(akshare_cache_dir, "signal_cache.json")
+    if os.path.exists(signal_file):
+        try:
+            with open(signal_file, "r", encoding="utf-8") as f:
+                cache = json.load(f)
+            store.replace_signals({tuple(k.split("|", 1)): v for k, v in cache.items() if "|" in k})
+            imported.append(f"{len(cache)} 个信号值")
+        except Exception as e:
+            print(f"⚠️ 导入信号缓存失败: {e}")
+
+    runs_file = os.path.join(akshare_cache_dir, "market_runs.json")
+    if os.path.exists(runs_file):
+        try:
+            with open(runs_file, "r", encoding="utf-8") as f:
+                store.set_meta("market_runs", json.load(f))
+            imported.append("市场运行记录")
+        except Exception as e:
+            print(f"⚠️ 导入市场运行记录失败: {e}")
+
+    # A股: date,pe_ttm；港股: trade_date,pe_ratio
+    series_count = 0
+    for path in glob.glob(os.path.join(pe_cache_dir, "*_pe.csv")):
+        symbol = os.path.basename(path)[:-len("_pe.csv")]
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                reader = csv.DictReader(f)
+                if "pe_ttm" in (reader.fieldnames or []):
+                    series, date_col, value_col = "pe_ttm", "date", "pe_ttm"
+                else:
+                    series, date_col, value_col = "hk_pe_ratio", "trade_date", "pe_ratio"
+                points = [(r[date_col], float(r[value_col]) if r[value_col] else None) for r in reader]
+            store.upsert_series(series, symbol, points)
+            series_count += 1
+        except Exception as e:
+            print(f"⚠️ 导入 PE 历史失败 {path}: {e}")
+    if series_count:
+        imported.append(f"{series_count} 个 PE 历史序列")
+
+    store.set_meta("legacy_imported", True)
+    if imported:
+        print(f"🗄️ 已导入旧状态文件: {', '.join(imported)}")
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store(path=None):
+    """进程内共享的状态存储；路径默认读取环境变量 STATE_DB"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = StateStore(path or os.getenv("STATE_DB") or DEFAULT_PATH)
+        return _store
+
+
+def use_store(path):
+    """切换到指定路径的存储（测试、快照导入等场景），返回新的存储"""
+    global _store
+    with _store_lock:
+        if _store is not None:
+            _store.close()
+        _store = StateStore(path)
+        return _store
+
+
+def close_store():
+    global _store
+    with _store_lock:
+        if _store is not None:
+            _store.close()
+        _store = None
+
+
+atexit.register(close_store)
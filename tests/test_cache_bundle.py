@@ -0,0 +1,104 @@
+import unittest
+import io
+import os
+import sys
+import json
+import tarfile
+import tempfile
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import state_store
+import cache_bundle
+
+
+class TestCacheBundle(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmpdir = tmp.name
+        self.path = os.path.join(tmp.name, "bundle", "state.tar.gz")
+        self.source = self.open_store("source.db")
+        self.source.put_snapshot("spot_cache", {"600519": ["贵州茅台", 1500.5]}, fetched_at=2000)
+        self.source.put_snapshot("hk_cache", {"00700": ["腾讯控股", 400.0]}, fetched_at=1000)
+        self.source.upsert_series("pe_ttm", "600519", [("2026-10-01", 30.0), ("2026-10-02", 31.0)])
+        self.source.upsert_bars("AAPL", "1mo", [("2026-10-01", 1, 2, 0.5, 1.5, 100)], checked_at=3000)
+        self.source.put_fundamentals("600519", {"ROE": 30.1}, fetched_at=5000)
+        self.source.put_rates({"CNY": 1.0, "USD": 7.1}, fetched_at=5000)
+        self.source.replace_signals({("AAPL", "🚦雪盈风险等级"): "低"})
+        self.manifest = cache_bundle.export_bundle(self.source, self.path)
+
+    def open_store(self, name):
+        store = state_store.StateStore(os.path.join(self.tmpdir, name))
+        self.addCleanup(store.close)
+        return store
+
+    def test_fresh_store_warm_starts_from_bundle(self):
+        self.assertEqual(cache_bundle.read_manifest(self.path)["schema_version"], state_store.SCHEMA_VERSION)
+        namespaces = {(row["namespace"], row["part"]): row for row in self.manifest["namespaces"]}
+        self.assertEqual(namespaces[("snapshot", "spot_cache")]["newest"], 2000)
+
+        target = self.open_store("target.db")
+        _, changes = cache_bundle.import_bundle(target, self.path)
+        self.assertEqual(target.get_snapshot("spot_cache", fresh_after=2000), {"600519": ["贵州茅台", 1500.5]})
+        self.assertEqual(len(target.get_series("pe_ttm", "600519")), 2)
+        self.assertEqual(target.bars_checked_at("AAPL", "1mo"), 3000)
+        self.assertEqual(target.get_rates(fresh_after=5000), {"CNY": 1.0, "USD": 7.1})
+        self.assertEqual(target.get_signals(), {("AAPL", "🚦雪盈风险等级"): "低"})
+        self.assertEqual(changes["pe_series"], 2)
+
+    def test_newer_local_data_wins(self):
+        target = self.open_store("target.db")
+        target.put_snapshot("hk_cache", {"00700": ["本地", 410.0]}, fetched_at=1500)
+        target.put_fundamentals("600519", {"ROE": 31.0}, fetched_at=6000)
+        target.put_fundamentals("000001", {"ROE": 9.0}, fetched_at=100)
+        target.replace_signals({("AAPL", "🚦雪盈风险等级"): "高"})
+        target.upsert_series("pe_ttm", "600519", [("2026-10-02", 32.0)])
+
+        cache_bundle.import_bundle(target, self.path)
+        self.assertEqual(target.get_snapshot("hk_cache"), {"00700": ["本地", 410.0]})
+        self.assertEqual(target.get_fundamentals("600519"), {"ROE": 31.0})
+        self.assertEqual(target.get_fundamentals("000001"), {"ROE": 9.0})
+        self.assertEqual(target.get_signals(), {("AAPL", "🚦雪盈风险等级"): "高"})
+        self.assertEqual(target.get_series("pe_ttm", "600519"), [("2026-10-01", 30.0), ("2026-10-02", 32.0)])
+        # 包中更新的快照仍然导入
+        self.assertIsNotNone(target.get_snapshot("spot_cache"))
+
+    def rewrite_bundle(self, manifest_changes=None, database=None):
+        with tarfile.open(self.path, "r:gz") as bundle:
+            manifest = json.load(bundle.extractfile("manifest.json"))
+            data = database if database is not None else bundle.extractfile("state.db").read()
+        manifest.update(manifest_changes or {})
+        with tarfile.open(self.path, "w:gz") as bundle:
+            for name, payload in (("manifest.json", json.dumps(manifest).encode("utf-8")), ("state.db", data)):
+                info = tarfile.TarInfo(name)
+                info.size = len(payload)
+                bundle.addfile(info, io.BytesIO(payload))
+
+    def test_rejects_invalid_bundles_without_touching_store(self):
+        target = self.open_store("target.db")
+        target.put_rates({"USD": 7.0}, fetched_at=100)
+        for changes, database in (({"schema_version": state_store.SCHEMA_VERSION + 1}, None),
+                                  ({"format": "pickle"}, None),
+                                  (None, b"SQLite format 3\x00" + b"\x00" * 100)):
+            self.rewrite_bundle(changes, database)
+            with self.assertRaises(cache_bundle.BundleError):
+                cache_bundle.import_bundle(target, self.path)
+        self.assertEqual(target.get_rates(), {"USD": 7.0})
+        with open(self.path, "wb") as f:
+            f.write(b"truncated")
+        with self.assertRaises(cache_bundle.BundleError):
+            cache_bundle.read_manifest(self.path)
+
+    def test_import_once_skips_already_imported_bundle(self):
+        target = self.open_store("target.db")
+        _, changes = cache_bundle.import_once(target, self.path)
+        self.assertTrue(changes)
+        target.invalidate("snapshot")
+        self.assertEqual(cache_bundle.import_once(target, self.path)[1], None)
+        self.assertIsNone(target.get_snapshot("spot_cache"))
+
+
+if __name__ == '__main__':
+    unittest.main()
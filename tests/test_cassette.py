@@ -0,0 +1,111 @@
+import unittest
+import os
+import sys
+import tempfile
+from unittest.mock import MagicMock
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import cassette
+
+
+class TestCassette(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "run.cassette")
+
+    def tearDown(self):
+        cassette.deactivate()
+        self.tmpdir.cleanup()
+
+    def test_passthrough_when_inactive(self):
+        """Without an active cassette, calls go straight to the function."""
+        fetch = MagicMock(return_value=42)
+        self.assertEqual(cassette.call("fetch", fetch, "510300"), 42)
+        fetch.assert_called_once_with("510300")
+
+    def test_record_then_replay_roundtrip(self):
+        """Recorded results and errors are replayed in order without calling the source."""
+        tape = cassette.activate(self.path, "record")
+        fetch = MagicMock(side_effect=[1.5, 2.5, ValueError("boom")])
+        self.assertEqual(cassette.call("price", fetch, "510300"), 1.5)
+        self.assertEqual(cassette.call("price", fetch, "510300"), 2.5)
+        with self.assertRaises(ValueError):
+            cassette.call("price", fetch, "510300")
+        tape.save()
+
+        cassette.activate(self.path, "replay")
+        live = MagicMock()
+        self.assertEqual(cassette.call("price", live, "510300"), 1.5)
+        self.assertEqual(cassette.call("price", live, "510300"), 2.5)
+        with self.assertRaises(ValueError):
+            cassette.call("price", live, "510300")
+        live.assert_not_called()
+
+    def test_replay_miss_raises(self):
+        """Unknown requests in replay mode raise CassetteMiss."""
+        cassette.activate(self.path, "record").save()
+        cassette.activate(self.path, "replay")
+        with self.assertRaises(cassette.CassetteMiss):
+            cassette.call("price", MagicMock(), "999999")
+
+    def test_tape_decorator_ignores_cache_arguments(self):
+        """Ignored arguments do not change the request key."""
+        calls = []
+
+        @cassette.tape("lookup", ignore=("cache",))
+        def lookup(symbol, cache=None):
+            calls.append(symbol)
+            return len(cache or {})
+
+        tape = cassette.activate(self.path, "record")
+        self.assertEqual(lookup("510300", cache={"a": 1}), 1)
+        tape.save()
+
+        cassette.activate(self.path, "replay")
+        self.assertEqual(lookup("510300", cache={"a": 1, "b": 2}), 1)
+        self.assertEqual(calls, ["510300"])
+
+    def test_ticker_and_notion_proxies(self):
+        """yfinance and Notion calls are replayable without the live objects."""
+        tape = cassette.activate(self.path, "record")
+        real_ticker = MagicMock()
+        real_ticker.fast_info.last_price = 101.0
+        real_ticker.info = {"trailingPE": 25.0}
+        stock = cassette.ticker("QQQ", lambda symbol: real_ticker)
+        self.assertEqual(stock.fast_info.last_price, 101.0)
+        self.assertEqual(stock.info["trailingPE"], 25.0)
+
+        client = MagicMock()
+        client.data_sources.query.return_value = {"results": [{"id": "p1"}]}
+        notion = cassette.wrap_notion(client)
+        self.assertEqual(notion.data_sources.query(data_source_id="ds")["results"][0]["id"], "p1")
+        tape.save()
+
+        cassette.activate(self.path, "replay")
+        stock = cassette.ticker("QQQ", MagicMock(side_effect=AssertionError("network")))
+        self.assertEqual(stock.fast_info.last_price, 101.0)
+        notion = cassette.wrap_notion(None)
+        self.assertEqual(notion.data_sources.query(data_source_id="ds")["results"][0]["id"], "p1")
+
+
+    def test_ticker_history_key_includes_arguments(self):
+        """history() calls with different arguments replay their own frames."""
+        tape = cassette.activate(self.path, "record")
+        real_ticker = MagicMock()
+        real_ticker.history.side_effect = lambda period=None, interval="1d": f"{period}/{interval}"
+        stock = cassette.ticker("QQQ", lambda symbol: real_ticker)
+        self.assertEqual(stock.history(period="1d"), "1d/1d")
+        self.assertEqual(stock.history(period="5y", interval="1mo"), "5y/1mo")
+        tape.save()
+
+        cassette.activate(self.path, "replay")
+        stock = cassette.ticker("QQQ", MagicMock(side_effect=AssertionError("network")))
+        self.assertEqual(stock.history(period="5y", interval="1mo"), "5y/1mo")
+        self.assertEqual(stock.history("1d"), "1d/1d")
+        with self.assertRaises(cassette.CassetteMiss):
+            stock.history(period="1mo")
+
+if __name__ == '__main__':
+    unittest.main()
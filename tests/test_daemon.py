@@ -0,0 +1,104 @@
+import unittest
+import os
+import sys
+import json
+import datetime
+import threading
+import urllib.request
+import urllib.error
+from unittest.mock import patch, MagicMock
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import daemon
+import warm_cache
+import main
+
+UTC = datetime.timezone.utc
+
+
+class TestSyncDaemon(unittest.TestCase):
+
+    def setUp(self):
+        self.clock_now = datetime.datetime(2026, 10, 14, 6, 0, tzinfo=UTC)  # 周三，A股收盘前
+        self.synced = []
+        self.service = daemon.SyncDaemon(self.synced.append, port=0, clock=lambda: self.clock_now)
+
+    def tearDown(self):
+        self.service.server.server_close()
+
+    def test_next_wake_follows_market_closes(self):
+        """Wakes after CN close, then HK close, then US close (plus grace)."""
+        grace = daemon.SESSION_GRACE
+        self.assertEqual(self.service.next_wake(), datetime.datetime(2026, 10, 14, 7, 0, tzinfo=UTC) + grace)
+        wake = self.service.next_wake(datetime.datetime(2026, 10, 14, 7, 5, tzinfo=UTC))
+        self.assertEqual(wake, datetime.datetime(2026, 10, 14, 7, 0, tzinfo=UTC) + grace)
+        wake = self.service.next_wake(datetime.datetime(2026, 10, 14, 9, 0, tzinfo=UTC))
+        self.assertEqual(wake, datetime.datetime(2026, 10, 14, 20, 0, tzinfo=UTC) + grace)
+
+    def test_http_trigger_queues_sync(self):
+        thread = threading.Thread(target=self.service.server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            request = urllib.request.Request(f"{self.service.address}/sync?markets=CN,HK", method="POST")
+            with urllib.request.urlopen(request) as resp:
+                self.assertEqual(resp.status, 202)
+
+            bad = urllib.request.Request(f"{self.service.address}/sync?markets=JP", method="POST")
+            with self.assertRaises(urllib.error.HTTPError) as ctx:
+                urllib.request.urlopen(bad)
+            self.assertEqual(ctx.exception.code, 400)
+
+            self.assertEqual(self.service.next_request(), "CN,HK")
+            self.service.run_once("CN,HK")
+            with urllib.request.urlopen(f"{self.service.address}/status") as resp:
+                status = json.load(resp)
+        finally:
+            self.service.server.shutdown()
+
+        self.assertEqual(self.synced, ["CN,HK"])
+        self.assertTrue(status["history"][0]["ok"])
+
+    def test_failed_sync_is_recorded(self):
+        service = daemon.SyncDaemon(lambda m: 1 / 0, port=0)
+        try:
+            record = service.run_once("all")
+        finally:
+            service.server.server_close()
+        self.assertFalse(record["ok"])
+
+
+class TestResidentPageIndex(unittest.TestCase):
+
+    def setUp(self):
+        warm_cache.activate()
+        self.addCleanup(warm_cache.deactivate)
+        self.pages = [{"id": "p1", "properties": {"现价": {"type": "number", "number": 1.0}}}]
+        patcher = patch.object(main, "load_holding_pages", MagicMock(side_effect=lambda: ("ds", {}, self.pages)))
+        self.load = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_pages_stay_resident_between_syncs(self):
+        """Later syncs reuse the page index and see values written by earlier syncs."""
+        _, _, pages = main.load_resident_holding_pages()
+        main.resident_writer(pages, MagicMock())("p1", {"现价": {"number": 2.0}})
+        _, _, pages = main.load_resident_holding_pages()
+        self.assertEqual(self.load.call_count, 1)
+        self.assertEqual(pages[0]["properties"]["现价"], {"type": "number", "number": 2.0})
+
+    def test_failed_write_and_refresh_trigger_reload(self):
+        _, _, pages = main.load_resident_holding_pages()
+        with self.assertRaises(ConnectionError):
+            main.resident_writer(pages, MagicMock(side_effect=ConnectionError()))("p1", {"现价": {"number": 2.0}})
+        main.load_resident_holding_pages()
+        self.assertEqual(self.load.call_count, 2)
+
+        service = daemon.SyncDaemon(MagicMock(), port=0)
+        self.addCleanup(service.server.server_close)
+        service.trigger("all", refresh=True)
+        main.load_resident_holding_pages()
+        self.assertEqual(self.load.call_count, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
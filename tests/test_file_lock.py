@@ -0,0 +1,98 @@
+import unittest
+import os
+import sys
+import time
+import tempfile
+import threading
+from contextlib import redirect_stdout
+from io import StringIO
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import file_lock
+
+
+class TestAtomicWrite(unittest.TestCase):
+
+    def test_failed_write_keeps_previous_file(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "report.json")
+            with file_lock.atomic_write(path) as f:
+                f.write("完整的旧内容")
+            with self.assertRaises(RuntimeError):
+                with file_lock.atomic_write(path) as f:
+                    f.write("写到一半")
+                    raise RuntimeError("crash")
+            with open(path, encoding="utf-8") as f:
+                self.assertEqual(f.read(), "完整的旧内容")
+            self.assertEqual(os.listdir(tmpdir), ["report.json"])
+
+
+@unittest.skipIf(file_lock.fcntl is None, "没有 fcntl 时锁为空操作")
+class TestFileLock(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.lock_dir = os.path.join(tmp.name, "locks")
+
+    def test_exclusive_lock_times_out_and_shared_locks_coexist(self):
+        path = file_lock.lock_path(self.lock_dir, "snapshot-spot_cache")
+        with file_lock.FileLock(path):
+            with self.assertRaises(file_lock.LockTimeout):
+                file_lock.FileLock(path, timeout=0.2, poll=0.05).acquire()
+        with file_lock.FileLock(path, shared=True), file_lock.FileLock(path, shared=True, timeout=0.2):
+            with self.assertRaises(file_lock.LockTimeout):
+                file_lock.FileLock(path, timeout=0.2, poll=0.05).acquire()
+        self.assertEqual(os.path.basename(file_lock.lock_path(self.lock_dir, "price_bars-0700.HK/1mo")), "price_bars-0700.HK_1mo.lock")
+
+    def test_single_writer_fills_once_and_others_reuse(self):
+        cache = {}
+        fills = []
+
+        def fill():
+            fills.append(threading.get_ident())
+            time.sleep(0.3)
+            cache["fx"] = {"USD": 7.1}
+            return cache["fx"]
+
+        results = []
+
+        def reader():
+            results.append(file_lock.single_writer(self.lock_dir, "fx", lambda: cache.get("fx"), fill))
+
+        threads = [threading.Thread(target=reader) for _ in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(fills), 1)
+        self.assertEqual(sorted(fetched for _, fetched in results), [False, False, True])
+        self.assertTrue(all(value == {"USD": 7.1} for value, _ in results))
+
+    def test_single_writer_fills_itself_after_timeout(self):
+        with file_lock.FileLock(file_lock.lock_path(self.lock_dir, "fx")):
+            with redirect_stdout(StringIO()) as output:
+                value, fetched = file_lock.single_writer(self.lock_dir, "fx", lambda: None, lambda: {"USD": 7.1}, timeout=0.2)
+        self.assertEqual((value, fetched), ({"USD": 7.1}, True))
+        self.assertIn("等待锁超时", output.getvalue())
+
+
+    def test_single_writer_does_not_retry_fill_on_inner_timeout(self):
+        fills = []
+
+        def fill():
+            fills.append(1)
+            raise file_lock.LockTimeout("嵌套缓存等待锁超时")
+
+        with self.assertRaises(file_lock.LockTimeout):
+            file_lock.single_writer(self.lock_dir, "fx", lambda: None, fill)
+        self.assertEqual(len(fills), 1)
+        # 锁已释放
+        with file_lock.FileLock(file_lock.lock_path(self.lock_dir, "fx"), timeout=0.2):
+            pass
+
+
+if __name__ == '__main__':
+    unittest.main()
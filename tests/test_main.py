@@ -1,9 +1,11 @@
 import unittest
 import sys
 import os
-from unittest.mock import patch, MagicMock, mock_open
+from unittest.mock import patch, MagicMock, PropertyMock
+import time
 import datetime
-import json
+import tempfile
+import threading
 
 # --- 虚拟环境检查 ---
 if os.getenv("SKIP_VENV_CHECK") != "1" and sys.prefix == sys.base_prefix:
@@ -22,6 +24,7 @@ except ImportError:
     print("🛑 错误: 'pandas' 模块未找到。请在激活虚拟环境后，运行 'pip install -r requirements.txt' 安装依赖。")
     sys.exit(1)
 
+import state_store
 from main import get_price_from_akshare, get_exchange_rates
 
 class TestAkshare(unittest.TestCase):
@@ -77,30 +80,29 @@ class TestAkshare(unittest.TestCase):
 class TestExchangeRates(unittest.TestCase):
     """Test cases for the get_exchange_rates function with caching."""
 
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.store = state_store.use_store(os.path.join(self.tmpdir.name, "state.db"))
+
+    def tearDown(self):
+        state_store.close_store()
+        self.tmpdir.cleanup()
+
     @patch('main.yf.Ticker')
-    @patch('os.path.exists')
-    @patch('os.path.getmtime')
-    @patch('builtins.open', new_callable=mock_open, read_data=json.dumps({'USD': 7.1, 'HKD': 0.91, 'CNY': 1.0}))
-    def test_loads_from_valid_cache(self, mock_file, mock_getmtime, mock_exists, mock_ticker):
-        """Should load rates from a valid (today's) cache file."""
-        mock_exists.return_value = True
-        mock_getmtime.return_value = datetime.datetime.now().timestamp()
+    def test_loads_from_valid_cache(self, mock_ticker):
+        """Should load rates cached earlier today."""
+        self.store.put_rates({'USD': 7.1, 'HKD': 0.91, 'CNY': 1.0})
 
         rates = get_exchange_rates()
 
         self.assertEqual(rates, {'USD': 7.1, 'HKD': 0.91, 'CNY': 1.0})
-        mock_file.assert_called_once_with('./akshare_cache/exchange_rates.json', 'r')
         mock_ticker.assert_not_called()
 
     @patch('main.yf.Ticker')
-    @patch('os.path.exists')
-    @patch('os.path.getmtime')
-    @patch('builtins.open', new_callable=mock_open)
-    def test_fetches_when_cache_is_stale(self, mock_file, mock_getmtime, mock_exists, mock_ticker):
-        """Should fetch new rates if the cache file is from a previous day."""
-        mock_exists.return_value = True
+    def test_fetches_when_cache_is_stale(self, mock_ticker):
+        """Should fetch new rates if the cached rates are from a previous day."""
         one_day_ago = (datetime.datetime.now() - datetime.timedelta(days=1)).timestamp()
-        mock_getmtime.return_value = one_day_ago
+        self.store.put_rates({'USD': 7.1, 'HKD': 0.91, 'CNY': 1.0}, fetched_at=one_day_ago)
 
         # Mock yfinance Ticker responses
         mock_usd_ticker = MagicMock()
@@ -113,15 +115,11 @@ class TestExchangeRates(unittest.TestCase):
 
         self.assertEqual(rates, {'CNY': 1.0, 'USD': 7.25, 'HKD': 0.92})
         self.assertEqual(mock_ticker.call_count, 2)
-        mock_file.assert_called_with('./akshare_cache/exchange_rates.json', 'w')
+        self.assertEqual(self.store.get_rates(), rates)
 
     @patch('main.yf.Ticker')
-    @patch('os.path.exists')
-    @patch('builtins.open', new_callable=mock_open)
-    def test_fetches_when_no_cache(self, mock_file, mock_exists, mock_ticker):
-        """Should fetch new rates if no cache file exists."""
-        mock_exists.return_value = False
-
+    def test_fetches_when_no_cache(self, mock_ticker):
+        """Should fetch new rates if nothing is cached."""
         # Mock yfinance Ticker responses
         mock_usd_ticker = MagicMock()
         mock_usd_ticker.fast_info.last_price = 7.28
@@ -133,7 +131,293 @@ class TestExchangeRates(unittest.TestCase):
 
         self.assertEqual(rates, {'CNY': 1.0, 'USD': 7.28, 'HKD': 0.93})
         self.assertEqual(mock_ticker.call_count, 2)
-        mock_file.assert_called_with('./akshare_cache/exchange_rates.json', 'w')
+        self.assertEqual(self.store.get_rates(), rates)
+
+
+def _trade(page_id, action, price, related, sold=None, bought=None):
+    props = {
+        "动作类型": {"type": "select", "select": {"name": action}},
+        "交易日期": {"type": "title", "title": [{"text": {"content": page_id}}]},
+        "成交单价": {"type": "number", "number": price},
+        "关联标的": {"type": "relation", "relation": [{"id": related}] if related else []},
+        "卖出后涨跌幅": {"type": "number", "number": sold},
+        "买入后涨跌幅": {"type": "number", "number": bought},
+    }
+    return {"id": page_id, "properties": props}
+
+
+def _holding(page_id, price, qty):
+    return {"id": page_id, "properties": {
+        "现价": {"type": "number", "number": price},
+        "持仓数量 (自动)": {"type": "rollup", "rollup": {"type": "number", "number": qty}},
+    }}
+
+
+class TestTradeReturns(unittest.TestCase):
+
+    def setUp(self):
+        import main
+        self.main = main
+        self.prices = main.decode_holding_prices([_holding("s1", 4.0, 100), _holding("s2", 210.0, 0), _holding("s3", None, 5)])
+
+    def compute(self, trades):
+        return self.main.compute_trade_returns(self.main.decode_trade_log(trades), self.prices).set_index("page_id")
+
+    def test_computes_both_returns_in_one_pass(self):
+        frame = self.compute([_trade("t1", "卖出", 3.5, "s1"), _trade("t2", "买入", 3.0, "s1")])
+        self.assertAlmostEqual(frame.loc["t1", "new_卖出后涨跌幅"], 0.1429)
+        self.assertTrue(pd.isna(frame.loc["t1", "new_买入后涨跌幅"]))
+        self.assertAlmostEqual(frame.loc["t2", "new_买入后涨跌幅"], 0.3333)
+        self.assertTrue(frame.loc["t1", "changed_卖出后涨跌幅"])
+        self.assertTrue(frame.loc["t2", "changed_买入后涨跌幅"])
+
+    def test_unchanged_values_are_not_written(self):
+        frame = self.compute([_trade("t1", "卖出", 3.5, "s1", sold=0.1429), _trade("t2", "买入", 3.0, "s1", bought=0.3)])
+        self.assertFalse(frame.loc["t1", "changed_卖出后涨跌幅"])
+        self.assertTrue(frame.loc["t2", "changed_买入后涨跌幅"])
+
+    def test_skips_fully_sold_invalid_price_and_missing_current_price(self):
+        frame = self.compute([
+            _trade("t1", "买入", 150.0, "s2"),   # 已清仓
+            _trade("t2", "卖出", 150.0, "s2"),   # 清仓不影响卖出记录
+            _trade("t3", "买入", 0, "s1"),
+            _trade("t4", "买入", 3.0, "s3"),     # 无现价
+            _trade("t5", "买入", 3.0, None),     # 无关联标的
+        ])
+        self.assertTrue(frame.loc["t1", "skipped_买入"])
+        self.assertAlmostEqual(frame.loc["t2", "new_卖出后涨跌幅"], 0.4)
+        self.assertFalse(frame.loc[["t1", "t3", "t4", "t5"], "changed_买入后涨跌幅"].any())
+
+    def test_update_writes_only_changed_rows(self):
+        trades = [_trade("t1", "卖出", 3.5, "s1", sold=0.1429), _trade("t2", "买入", 3.0, "s1")]
+        notion = MagicMock()
+        with patch.object(self.main, "notion", notion), \
+                patch.object(self.main, "get_property_schema", return_value={}), \
+                patch.object(self.main.notion_query.Query, "all", return_value=[_holding("s1", 4.0, 100)]), \
+                patch.object(self.main.notion_query.Query, "stream", return_value=iter(trades)), \
+                patch("time.sleep"):
+            self.main.update_trade_returns("ds", {}, self.main.write_queue.WriteBehind(self.main.write_notion_page))
+        notion.pages.update.assert_called_once_with(page_id="t2", properties={"买入后涨跌幅": {"number": 0.3333}})
+
+
+class TestHistoryCloses(unittest.TestCase):
+
+    def setUp(self):
+        import main
+        self.main = main
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.store = state_store.use_store(os.path.join(self.tmpdir.name, "state.db"))
+
+    def tearDown(self):
+        state_store.close_store()
+        self.tmpdir.cleanup()
+
+    def _stock(self, closes, start):
+        stock = MagicMock()
+        index = pd.date_range(start, periods=len(closes), freq="MS")
+        stock.history.return_value = pd.DataFrame({"Close": closes}, index=index)
+        return stock
+
+    def test_downloads_full_history_once_then_increments(self):
+        today = datetime.date.today().replace(day=1)
+        start = (pd.Timestamp(today) - pd.DateOffset(months=2)).strftime("%Y-%m-%d")
+        stock = self._stock([100.0, 150.0, 200.0], start)
+        closes = self.main.get_history_closes("AAPL", stock, "US")
+        self.assertEqual(list(closes), [100.0, 150.0, 200.0])
+        stock.history.assert_called_once_with(period="5y", interval="1mo")
+
+        # 本次收盘后已更新过：不再下载
+        stock.history.reset_mock()
+        self.main.get_history_closes("AAPL", stock, "US")
+        stock.history.assert_not_called()
+
+        # 下一次收盘后：只下载最后一根K线及之后的数据
+        last_date = (pd.Timestamp(today)).strftime("%Y-%m-%d")
+        self.store.upsert_bars("AAPL", "1mo", [], checked_at=1)
+        stock.history.return_value = pd.DataFrame({"Close": [210.0]}, index=pd.DatetimeIndex([last_date]))
+        closes = self.main.get_history_closes("AAPL", stock, "US")
+        stock.history.assert_called_once_with(start=last_date, interval="1mo")
+        self.assertEqual(list(closes), [100.0, 150.0, 210.0])
+
+    def test_pe_percentile_from_closes(self):
+        closes = pd.Series([100.0, 150.0, 210.0])
+        percentile, estimated = self.main.price_proxy_pe_percentile(closes, 30.0, 7.0)
+        self.assertFalse(estimated)
+        self.assertAlmostEqual(percentile, 200.0 / 3)
+        percentile, estimated = self.main.price_proxy_pe_percentile(closes, 30.0, None)
+        self.assertTrue(estimated)
+        self.assertAlmostEqual(percentile, 200.0 / 3)
+        self.assertEqual(self.main.price_proxy_pe_percentile(pd.Series([], dtype=float), 30.0, 7.0), (None, False))
+
+
+class TestQuotedPrice(unittest.TestCase):
+
+    def setUp(self):
+        import main
+        self.main = main
+
+    def test_falls_back_per_ticker_when_batch_has_no_price(self):
+        """yf.download returns NaN columns for throttled symbols; those are still priced one by one."""
+        def download(symbols):
+            columns = pd.MultiIndex.from_product([symbols, ["Close"]])
+            return pd.DataFrame([[210.0, None]], columns=columns)
+
+        provider = self.main.providers.YFinanceProvider(str, download)
+        quotes = self.main.providers.fetch_all([provider], ["AAPL", "MSFT"], {self.main.providers.PRICE})
+        stock = MagicMock()
+        fast_info = PropertyMock(return_value=MagicMock(last_price=420.0))
+        type(stock).fast_info = fast_info
+
+        self.assertEqual(self.main.quoted_price("AAPL", stock, quotes), (210.0, "yfinance"))
+        fast_info.assert_not_called()
+        self.assertEqual(self.main.quoted_price("MSFT", stock, quotes), (420.0, "yfinance-fast-info"))
+
+        fast_info.return_value = MagicMock(last_price=None)
+        stock.history.return_value = pd.DataFrame({"Close": [415.0]})
+        self.assertEqual(self.main.quoted_price("MSFT", stock, quotes), (415.0, "yfinance-history"))
+
+    def test_prefetch_plan_keeps_per_ticker_fallback(self):
+        """Holdings routed to yfinance by the prefetch plan are still priced when the batch drops them."""
+        def page(ticker):
+            return {"id": ticker, "properties": {
+                "股票代码": {"type": "title", "title": [{"text": {"content": ticker}}]},
+                "货币": {"type": "select", "select": {"name": "USD"}}}}
+
+        def download(symbols):
+            columns = pd.MultiIndex.from_product([symbols, ["Close"]])
+            return pd.DataFrame([[210.0 if s == "AAPL" else None for s in symbols]], columns=columns)
+
+        with patch.object(self.main, "download_yf_prices", side_effect=download) as batch:
+            plan = self.main.plan_prefetch([page("AAPL"), page("MSFT")], {}, {}, {})
+            quotes = self.main.providers.execute(plan)
+        batch.assert_called_once()
+        stock = MagicMock()
+        stock.fast_info.last_price = 420.0
+        self.assertEqual(self.main.quoted_price("AAPL", stock, quotes)[0], 210.0)
+        self.assertEqual(self.main.quoted_price("MSFT", stock, quotes), (420.0, "yfinance-fast-info"))
+
+    def test_prefetch_error_falls_back_to_per_ticker_load(self):
+        """An index lookup that fails during prefetch (e.g. open breaker) is loaded again for the holding."""
+        def load(symbol):
+            raise self.main.resilience.CircuitOpenError("legulegu")
+
+        fields = (self.main.providers.INDEX_PE, self.main.providers.INDEX_PB)
+        provider = self.main.providers.GroupedProvider("index", fields, {"510300": "000300"}, load)
+        with patch("sys.stdout"):
+            quotes = self.main.providers.fetch_all([provider], ["510300"], set(fields))
+        self.assertEqual(self.main.prefetched(quotes, "index", "510300", fields, lambda: (12.5, 1.4)), (12.5, 1.4))
+
+
+class TestSyncHoldings(unittest.TestCase):
+
+    def setUp(self):
+        import main
+        self.main = main
+        self.addCleanup(main.metrics.reset)
+        self.addCleanup(main.resilience.reset_breakers)
+
+    def test_retried_holding_counts_once(self):
+        """A holding that fails on an open breaker and succeeds in the retry pass is only counted as updated."""
+        attempts = []
+
+        def raise_open():
+            raise self.main.resilience.CircuitOpenError("legulegu")
+
+        def update_holding(page, *args):
+            attempts.append(page["id"])
+            if page["id"] == "p1" and attempts.count("p1") == 1:
+                with self.assertRaises(self.main.resilience.CircuitOpenError):
+                    self.main.resilience.guarded("legulegu", raise_open)
+                return False
+            return None if page["id"] == "p3" else True
+
+        pages = [{"id": page_id, "properties": {}} for page_id in ("p1", "p2", "p3")]
+        with patch.object(self.main, "get_exchange_rates", return_value={}), \
+                patch.object(self.main, "preload_snapshots", return_value=({}, {}, {}, {})), \
+                patch.object(self.main, "prefetch_quotes", return_value=None), \
+                patch.object(self.main, "holding_market", return_value="US"), \
+                patch.object(self.main, "update_holding", side_effect=update_holding), \
+                patch.object(self.main.resilience, "wait_for_recovery", return_value=0), \
+                patch("sys.stdout"):
+            self.main.sync_holdings(pages, ("US",), MagicMock(), check_signals=False, flush=False)
+
+        self.assertEqual(attempts, ["p1", "p2", "p3", "p1"])
+        counts = {result: self.main.metrics.value(self.main.metrics.HOLDINGS, result=result) for result in ("updated", "failed", "skipped")}
+        self.assertEqual(counts, {"updated": 2, "failed": 0, "skipped": 1})
+
+
+class TestSharedLookup(unittest.TestCase):
+
+    def setUp(self):
+        import main
+        self.main = main
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.store = state_store.use_store(os.path.join(self.tmpdir.name, "state.db"))
+        # 与分片运行相同：协调进程先创建状态库并清空上次的结果，工作进程再并发打开
+        self.store.invalidate("lookups")
+        self.started_at = time.time()
+        self.calls = []
+
+        @main.shared_lookup
+        def index_pe(etf_code):
+            self.calls.append(etf_code)
+            time.sleep(0.1)
+            return self.results.get(etf_code, (None, None))
+
+        self.index_pe = index_pe
+        self.results = {"510300": (12.5, 40.0)}
+
+    def tearDown(self):
+        state_store.close_store()
+        self.tmpdir.cleanup()
+
+    def run_workers(self, etf_code, workers=3):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.index_pe(etf_code))) for _ in range(workers)]
+        with patch.dict(os.environ, {self.main.SHARED_LOOKUPS_ENV: repr(self.started_at)}):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        return results
+
+    def test_shard_workers_share_one_fetch(self):
+        self.assertEqual(self.run_workers("510300"), [(12.5, 40.0)] * 3)
+        self.assertEqual(self.calls, ["510300"])
+
+    def test_failed_and_stale_results_are_fetched_again(self):
+        # 获取失败不保存，其他工作进程自己请求
+        self.assertEqual(self.run_workers("159915", workers=2), [(None, None)] * 2)
+        self.assertEqual(self.calls, ["159915"] * 2)
+        # 上次运行保存的结果不采用
+        self.calls.clear()
+        self.store.put_lookup("index_pe", "('510300',)", [11.0, 35.0], fetched_at=self.started_at - 86400)
+        self.assertEqual(self.run_workers("510300", workers=1), [(12.5, 40.0)])
+        self.assertEqual(self.calls, ["510300"])
+
+    def test_single_process_run_calls_through(self):
+        with patch.dict(os.environ):
+            os.environ.pop(self.main.SHARED_LOOKUPS_ENV, None)
+            self.assertEqual(self.index_pe("510300"), (12.5, 40.0))
+        self.assertIsNone(self.store.get_lookup("index_pe", "('510300',)"))
+
+
+class TestImportSideEffects(unittest.TestCase):
+    """Importing main must stay cheap: no heavy data libraries, no Notion client."""
+
+    def test_import_does_not_load_heavy_modules(self):
+        import subprocess
+        root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+        code = (
+            "import sys, main; "
+            "print(sorted(m for m in ('pandas', 'akshare', 'yfinance', 'notion_client') if m in sys.modules)); "
+            "print(main.notion)"
+        )
+        env = dict(os.environ, NOTION_TOKEN="token", DATABASE_ID="db")
+        env.pop("SKIP_VENV_CHECK", None)
+        result = subprocess.run([sys.executable, "-c", code], cwd=root, env=env, capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.split("\n")[:2], ["[]", "None"])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,75 @@
+import unittest
+import os
+import sys
+import time
+import tempfile
+from contextlib import redirect_stdout
+from io import StringIO
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'scripts')))
+
+import state_store
+import manage_cache
+
+
+class TestManageCache(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmpdir = tmp.name
+        self.store = state_store.use_store(os.path.join(tmp.name, "akshare_cache", "state.db"))
+        self.addCleanup(state_store.close_store)
+        for name, value in (("AKSHARE_CACHE_DIR", os.path.join(tmp.name, "akshare_cache")),
+                            ("PE_CACHE_DIR", os.path.join(tmp.name, "pe_cache"))):
+            patcher = patch.object(manage_cache, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        os.makedirs(manage_cache.PE_CACHE_DIR)
+        with open(os.path.join(manage_cache.PE_CACHE_DIR, "600519_pe.csv"), "w") as f:
+            f.write("date,pe_ttm\n2026-10-01,30.0\n")
+
+    def test_list_includes_legacy_files_and_recent_hits(self):
+        self.store.put_snapshot("spot_cache", {"600519": ["贵州茅台", 1500.5]})
+        self.store.set_meta(manage_cache.CACHE_STATS_KEY, [
+            {"runner": "main", "finished_at": time.time(), "lookups": {"snapshot": {"hit": 3, "miss": 1}, "warm": {"hit": 5}}},
+            {"runner": "pipeline", "finished_at": time.time(), "lookups": {"snapshot": {"hit": 4}}},
+        ])
+        runs, stats = manage_cache.collect_stats(self.store)
+        rows = {(row["namespace"], row["part"]): row for row in stats}
+
+        self.assertEqual(runs, 2)
+        self.assertEqual((rows[("snapshot", "spot_cache")]["hits"], rows[("snapshot", "spot_cache")]["misses"]), (7, 1))
+        self.assertIsNone(rows[("fx", None)]["hits"])
+        self.assertEqual(rows[("warm", "内存")]["hits"], 5)
+        # 状态库文件本身不算旧版缓存
+        self.assertEqual(rows[("legacy", None)]["entries"], 1)
+        with redirect_stdout(StringIO()) as output:
+            self.assertEqual(manage_cache.main(["list"]), 0)
+        self.assertIn("snapshot/spot_cache", output.getvalue())
+
+    def test_invalidate_normalizes_keys(self):
+        self.store.upsert_series("hk_pe_ratio", "00700", [("2026-10-02", 15.0)])
+        self.store.upsert_series("pe_ttm", "600519", [("2026-10-02", 31.0)])
+        with redirect_stdout(StringIO()):
+            self.assertEqual(manage_cache.main(["invalidate", "pe_series", "0700.HK"]), 0)
+            self.assertEqual(manage_cache.main(["invalidate", "legacy"]), 0)
+        self.assertEqual(self.store.get_series("hk_pe_ratio", "00700"), [])
+        self.assertEqual(len(self.store.get_series("pe_ttm", "600519")), 1)
+        self.assertEqual(manage_cache.legacy_files(), [])
+
+    def test_export_and_import_bundle(self):
+        path = os.path.join(self.tmpdir, "state.tar.gz")
+        self.store.put_rates({"USD": 7.1}, fetched_at=5000)
+        with redirect_stdout(StringIO()) as output:
+            self.assertEqual(manage_cache.main(["export", path]), 0)
+            self.store.invalidate("fx")
+            self.assertEqual(manage_cache.main(["import", path]), 0)
+            self.assertEqual(manage_cache.main(["import", os.path.join(self.tmpdir, "missing.tar.gz")]), 2)
+        self.assertEqual(self.store.get_rates(), {"USD": 7.1})
+        self.assertIn("fx 1 行", output.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import unittest
+import os
+import sys
+import datetime
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import market_calendar
+from market_calendar import CN, HK, US, CRYPTO
+
+UTC = datetime.timezone.utc
+
+
+def utc(*args):
+    return datetime.datetime(*args, tzinfo=UTC)
+
+
+class TestTradingCalendar(unittest.TestCase):
+
+    def test_weekends_and_holidays(self):
+        self.assertFalse(market_calendar.is_trading_day(CN, datetime.date(2026, 10, 1)))  # 国庆
+        self.assertFalse(market_calendar.is_trading_day(US, datetime.date(2026, 10, 17)))  # 周六
+        self.assertTrue(market_calendar.is_trading_day(US, datetime.date(2026, 10, 1)))
+        self.assertTrue(market_calendar.is_trading_day(CRYPTO, datetime.date(2026, 10, 17)))
+
+    def test_last_session_close_skips_holidays(self):
+        # 2026-10-08 (周四) 02:00 UTC 在 A股收盘前，最近一次收盘是节前的 09-30
+        close = market_calendar.last_session_close(CN, utc(2026, 10, 8, 2, 0))
+        self.assertEqual(close.astimezone(UTC), utc(2026, 9, 30, 7, 0))
+
+    def test_next_session_close(self):
+        # 2026-10-16 (周五) 美股收盘后，下一次收盘是下周一
+        close = market_calendar.next_session_close(US, utc(2026, 10, 16, 21, 0))
+        self.assertEqual(close.astimezone(UTC), utc(2026, 10, 19, 20, 0))
+
+    def test_parse_market_selection(self):
+        self.assertEqual(market_calendar.parse_market_selection(None), market_calendar.MARKETS)
+        self.assertEqual(market_calendar.parse_market_selection("auto"), "auto")
+        self.assertEqual(market_calendar.parse_market_selection("cn, hk"), (CN, HK))
+        with self.assertRaises(ValueError):
+            market_calendar.parse_market_selection("JP")
+
+
+class TestSelectDueMarkets(unittest.TestCase):
+
+    def test_asia_run_processes_only_closed_markets(self):
+        """The 07:00 UTC run picks up CN; HK closes at 08:00 UTC and US already ran."""
+        now = utc(2026, 10, 14, 7, 5)  # 周三
+        last_runs = {US: "2026-10-13T21:05:00+00:00"}
+        due, skipped = market_calendar.select_due_markets(now, last_runs)
+        self.assertIn(CN, due)
+        self.assertIn(CRYPTO, due)
+        self.assertIn(US, skipped)
+
+    def test_holiday_market_skipped(self):
+        now = utc(2026, 10, 1, 8, 30)  # 国庆：A股、港股休市，美股正常
+        last_runs = {CN: "2026-09-30T08:05:00+00:00", HK: "2026-09-30T08:05:00+00:00"}
+        due, skipped = market_calendar.select_due_markets(now, last_runs)
+        self.assertIn("尚未收盘", skipped[CN])
+        self.assertIn("尚未收盘", skipped[HK])
+        self.assertIn(US, due)
+
+    def test_friday_evening_run_picks_up_asia_close(self):
+        """At Friday 21:00 UTC it is already Saturday in Asia, but Friday's CN/HK close has not been processed."""
+        now = utc(2026, 10, 16, 21, 0)  # 周五，当地时间周六 05:00
+        last_runs = {CN: "2026-10-16T07:05:00+00:00", HK: "2026-10-16T07:05:00+00:00", US: "2026-10-15T21:05:00+00:00"}
+        due, skipped = market_calendar.select_due_markets(now, last_runs)
+        self.assertEqual(due, (HK, US, CRYPTO))
+        self.assertIn(CN, skipped)
+
+    def test_holiday_eve_close_processed_during_holiday(self):
+        """The last close before a holiday is still due when the next run falls on the holiday."""
+        now = utc(2026, 10, 1, 7, 5)  # 国庆第一天
+        due, _ = market_calendar.select_due_markets(now, {HK: "2026-09-30T07:05:00+00:00"})
+        self.assertIn(HK, due)
+
+    def test_market_of(self):
+        self.assertEqual(market_calendar.market_of("BTC-USD", "USD"), CRYPTO)
+        self.assertEqual(market_calendar.market_of("600519", "CNY"), CN)
+        self.assertEqual(market_calendar.market_of("00700", "HKD"), HK)
+        self.assertEqual(market_calendar.market_of("AAPL", "USD"), US)
+
+
+if __name__ == '__main__':
+    unittest.main()
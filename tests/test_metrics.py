@@ -0,0 +1,107 @@
+import unittest
+import os
+import sys
+import json
+import tempfile
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import metrics
+import resilience
+
+
+class TestRegistry(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+
+    def tearDown(self):
+        metrics.reset()
+
+    def test_renders_openmetrics(self):
+        metrics.inc(metrics.UPSTREAM_REQUESTS, source="eastmoney", outcome="ok")
+        metrics.inc(metrics.UPSTREAM_REQUESTS, 2, source="eastmoney", outcome="ok")
+        metrics.observe(metrics.UPSTREAM_DURATION, 0.3, source="eastmoney")
+        metrics.observe(metrics.UPSTREAM_DURATION, 120, source="eastmoney")
+        metrics.set_gauge(metrics.RUN_DURATION, 12.5, runner="pipeline")
+
+        text = metrics.render()
+        self.assertIn("# TYPE stock_sync_upstream_requests counter", text)
+        self.assertIn('stock_sync_upstream_requests_total{outcome="ok",source="eastmoney"} 3', text)
+        self.assertIn('stock_sync_upstream_request_duration_seconds_bucket{source="eastmoney",le="0.25"} 0', text)
+        self.assertIn('stock_sync_upstream_request_duration_seconds_bucket{source="eastmoney",le="0.5"} 1', text)
+        self.assertIn('stock_sync_upstream_request_duration_seconds_bucket{source="eastmoney",le="+Inf"} 2', text)
+        self.assertIn('stock_sync_upstream_request_duration_seconds_count{source="eastmoney"} 2', text)
+        self.assertIn('stock_sync_upstream_request_duration_seconds_sum{source="eastmoney"} 120.3', text)
+        self.assertIn('stock_sync_run_duration_seconds{runner="pipeline"} 12.5', text)
+        self.assertTrue(text.endswith("# EOF\n"))
+        # 没有记录的指标不输出
+        self.assertNotIn("stock_sync_holdings", text)
+
+        prometheus = metrics.render(openmetrics=False)
+        self.assertIn("# TYPE stock_sync_upstream_requests_total counter", prometheus)
+        self.assertNotIn("# EOF", prometheus)
+
+    def test_rejects_wrong_type_and_escapes_labels(self):
+        with self.assertRaises(ValueError):
+            metrics.observe(metrics.HOLDINGS, 1.0)
+        metrics.inc(metrics.NOTION_WRITES, stage='持仓"\\', result="sent")
+        self.assertIn('stage="持仓\\"\\\\"', metrics.render())
+
+    def test_dump_and_merge_across_processes(self):
+        worker = metrics.Registry()
+        worker.inc(metrics.HOLDINGS, 3, result="updated")
+        worker.observe(metrics.UPSTREAM_DURATION, 0.3, source="eastmoney")
+        worker.set(metrics.STAGE_SUCCESS, 1, stage="holdings")
+        metrics.inc(metrics.HOLDINGS, result="updated")
+        metrics.observe(metrics.UPSTREAM_DURATION, 2.0, source="eastmoney")
+
+        metrics.merge(json.loads(json.dumps(worker.dump())))
+        self.assertEqual(metrics.value(metrics.HOLDINGS, result="updated"), 4)
+        self.assertEqual(metrics.value(metrics.UPSTREAM_DURATION, source="eastmoney"), 2)
+        self.assertEqual(metrics.value(metrics.STAGE_SUCCESS, stage="holdings"), 1)
+        self.assertIn('stock_sync_upstream_request_duration_seconds_sum{source="eastmoney"} 2.3', metrics.render())
+
+    def test_write_textfile_replaces_file(self):
+        metrics.inc(metrics.HOLDINGS, result="updated")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "collector", "stock_sync.prom")
+            metrics.export(path=path)
+            with open(path, encoding="utf-8") as f:
+                self.assertIn('stock_sync_holdings_total{result="updated"} 1', f.read())
+            self.assertEqual(os.listdir(os.path.dirname(path)), ["stock_sync.prom"])
+
+
+class TestGuardedMetrics(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        resilience.reset_breakers()
+
+    def tearDown(self):
+        metrics.reset()
+        resilience.reset_breakers()
+
+    def test_records_outcomes_and_latency(self):
+        def fail(exc):
+            raise exc
+
+        self.assertEqual(resilience.guarded("sina", lambda: 1), 1)
+        with self.assertRaises(KeyError):
+            resilience.guarded("sina", fail, KeyError("600000"))
+        for _ in range(resilience.FAILURE_THRESHOLD):
+            with self.assertRaises(ConnectionError):
+                resilience.guarded("sina", fail, ConnectionError("reset"))
+        with self.assertRaises(resilience.CircuitOpenError):
+            resilience.guarded("sina", lambda: 1)
+
+        self.assertEqual(metrics.value(metrics.UPSTREAM_REQUESTS, source="sina", outcome="ok"), 1)
+        self.assertEqual(metrics.value(metrics.UPSTREAM_REQUESTS, source="sina", outcome="no_data"), 1)
+        self.assertEqual(metrics.value(metrics.UPSTREAM_REQUESTS, source="sina", outcome="error"), resilience.FAILURE_THRESHOLD)
+        self.assertEqual(metrics.value(metrics.UPSTREAM_REQUESTS, source="sina", outcome="circuit_open"), 1)
+        # 熔断跳过的调用不计入延迟
+        self.assertEqual(metrics.value(metrics.UPSTREAM_DURATION, source="sina"), 2 + resilience.FAILURE_THRESHOLD)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import notifier
+
+
+class TestSplitMessage(unittest.TestCase):
+
+    def test_splits_on_paragraph_boundaries(self):
+        blocks = [f"📌 <b>股票{i}</b>\n   🚦平安动态信号\n   买入 → 卖出" for i in range(400)]
+        chunks = notifier.split_message("\n\n".join(blocks))
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(all(len(c) <= notifier.TELEGRAM_LIMIT for c in chunks))
+        # 每个变化块完整地落在某一段中
+        self.assertEqual(sum(c.count("📌") for c in chunks), 400)
+        self.assertTrue(all(c.startswith("📌") for c in chunks))
+
+    def test_hard_splits_overlong_line(self):
+        chunks = notifier.split_message("x" * 10000, limit=4096)
+        self.assertEqual([len(c) for c in chunks], [4096, 4096, 1808])
+
+
+class TestNotifier(unittest.TestCase):
+
+    def test_batches_and_retries_with_backoff(self):
+        sent = []
+        failures = [notifier.SendError("429", retry_after=3), notifier.SendError("502")]
+        sleeps = []
+
+        def send(text):
+            if failures:
+                raise failures.pop(0)
+            sent.append(text)
+
+        queue = notifier.Notifier(send, batch_window=0.2, sleep=sleeps.append)
+        queue.notify("第一条")
+        queue.notify("第二条")
+        self.assertTrue(queue.flush(timeout=5))
+
+        self.assertEqual(sent, ["第一条\n\n第二条"])
+        self.assertEqual(sleeps, [3, 2.0])
+
+    def test_non_retryable_error_is_dropped(self):
+        calls = []
+
+        def send(text):
+            calls.append(text)
+            raise notifier.SendError("400 bad request", retryable=False)
+
+        queue = notifier.Notifier(send, batch_window=0, sleep=lambda s: None)
+        queue.notify("x")
+        self.assertTrue(queue.flush(timeout=5))
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(queue.failed, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
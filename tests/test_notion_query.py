@@ -0,0 +1,153 @@
+import unittest
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import notion_query
+
+
+def page(action, ticker="AAPL"):
+    return {"id": f"{action}-{ticker}", "properties": {
+        "动作类型": {"type": "select", "select": {"name": action}},
+        "股票代码": {"type": "title", "title": [{"plain_text": ticker}]},
+    }}
+
+
+class FakeDataSources:
+    def __init__(self, pages, page_size=2):
+        self.pages = pages
+        self.page_size = page_size
+        self.calls = []
+
+    def query(self, **kwargs):
+        self.calls.append(kwargs)
+        start = int(kwargs.get("start_cursor") or 0)
+        end = start + self.page_size
+        has_more = end < len(self.pages)
+        return {"results": self.pages[start:end], "has_more": has_more,
+                "next_cursor": str(end) if has_more else None}
+
+
+class FakeClient:
+    def __init__(self, pages, page_size=2):
+        self.data_sources = FakeDataSources(pages, page_size)
+
+
+SELECT_SCHEMA = {
+    "动作类型": {"id": "%3AUPp", "type": "select", "select": {"options": [
+        {"name": "买入"}, {"name": "卖出"}, {"name": "部分卖出"}, {"name": "分红"}]}},
+    "股票代码": {"id": "title", "type": "title", "title": {}},
+}
+
+
+class TestContainsFilter(unittest.TestCase):
+
+    def test_select_expands_matching_options(self):
+        f = notion_query.contains_filter(SELECT_SCHEMA, "动作类型", "卖出")
+        self.assertEqual(f, {"or": [
+            {"property": "动作类型", "select": {"equals": "卖出"}},
+            {"property": "动作类型", "select": {"equals": "部分卖出"}},
+        ]})
+
+    def test_single_option_is_not_wrapped(self):
+        f = notion_query.contains_filter(SELECT_SCHEMA, "动作类型", "买入")
+        self.assertEqual(f, {"property": "动作类型", "select": {"equals": "买入"}})
+
+    def test_text_property_uses_contains(self):
+        schema = {"动作类型": {"type": "rich_text", "rich_text": {}}}
+        f = notion_query.contains_filter(schema, "动作类型", "卖出")
+        self.assertEqual(f, {"property": "动作类型", "rich_text": {"contains": "卖出"}})
+
+    def test_no_matching_option(self):
+        with self.assertRaises(notion_query.MatchNothing):
+            notion_query.contains_filter(SELECT_SCHEMA, "动作类型", "转托管")
+
+    def test_unknown_property_cannot_push_down(self):
+        self.assertIsNone(notion_query.contains_filter({}, "动作类型", "卖出"))
+
+
+class TestQuery(unittest.TestCase):
+
+    def test_paginates_until_has_more_is_false(self):
+        pages = [page("买入", f"T{i}") for i in range(5)]
+        client = FakeClient(pages)
+        result = notion_query.Query("ds").all(client)
+        self.assertEqual([p["id"] for p in result], [p["id"] for p in pages])
+        self.assertEqual(len(client.data_sources.calls), 3)
+        self.assertEqual(client.data_sources.calls[1]["start_cursor"], "2")
+
+    def test_payload_combines_filters_and_sorts(self):
+        query = (notion_query.Query("ds")
+                 .where_contains(SELECT_SCHEMA, "动作类型", "买入")
+                 .where_not_empty(SELECT_SCHEMA, "股票代码")
+                 .order_by("交易日期", descending=True))
+        payload = query.payload()
+        self.assertEqual(payload["filter"], {"and": [
+            {"property": "动作类型", "select": {"equals": "买入"}},
+            {"property": "股票代码", "title": {"is_not_empty": True}},
+        ]})
+        self.assertEqual(payload["sorts"], [{"property": "交易日期", "direction": "descending"}])
+        self.assertNotIn("start_cursor", payload)
+
+    def test_contains_any_flattens_options(self):
+        query = notion_query.Query("ds").where_contains_any(SELECT_SCHEMA, "动作类型", ["卖出", "买入", "转托管"])
+        self.assertEqual(query.payload()["filter"], {"or": [
+            {"property": "动作类型", "select": {"equals": "卖出"}},
+            {"property": "动作类型", "select": {"equals": "部分卖出"}},
+            {"property": "动作类型", "select": {"equals": "买入"}},
+        ]})
+
+    def test_contains_any_falls_back_without_schema(self):
+        client = FakeClient([page("买入"), page("分红"), page("部分卖出")])
+        query = notion_query.Query("ds").where_contains_any({}, "动作类型", ["卖出", "买入"])
+        self.assertEqual([p["id"] for p in query.all(client)], ["买入-AAPL", "部分卖出-AAPL"])
+
+    def test_falls_back_to_client_predicate_without_schema(self):
+        client = FakeClient([page("买入"), page("卖出"), page("部分卖出"), page("分红")])
+        query = notion_query.Query("ds").where_contains({}, "动作类型", "卖出")
+        self.assertNotIn("filter", query.payload())
+        self.assertEqual([p["id"] for p in query.all(client)], ["卖出-AAPL", "部分卖出-AAPL"])
+
+    def test_match_nothing_skips_request(self):
+        client = FakeClient([page("买入")])
+        query = notion_query.Query("ds").where_contains(SELECT_SCHEMA, "动作类型", "转托管")
+        self.assertEqual(query.all(client), [])
+        self.assertEqual(client.data_sources.calls, [])
+
+    def test_not_empty_fallback(self):
+        empty = page("买入")
+        empty["properties"]["股票代码"]["title"] = []
+        client = FakeClient([empty, page("买入", "MSFT")])
+        result = notion_query.Query("ds").where_not_empty({}, "股票代码").all(client)
+        self.assertEqual([p["id"] for p in result], ["买入-MSFT"])
+
+
+class TestProjection(unittest.TestCase):
+
+    def test_select_resolves_property_ids(self):
+        query = notion_query.Query("ds").select(SELECT_SCHEMA, "股票代码", "Ticker", "动作类型")
+        # 不存在的属性被忽略，ID 解码后交给客户端编码
+        self.assertEqual(query.payload()["filter_properties"], ["title", ":UPp"])
+
+    def test_no_projection_without_schema(self):
+        query = notion_query.Query("ds").select({}, "股票代码")
+        self.assertNotIn("filter_properties", query.payload())
+
+    def test_projection_kept_across_pages(self):
+        client = FakeClient([page("买入", f"T{i}") for i in range(3)])
+        notion_query.Query("ds").select(SELECT_SCHEMA, "股票代码").all(client)
+        self.assertEqual([c["filter_properties"] for c in client.data_sources.calls], [["title"], ["title"]])
+
+
+class TestPropertyText(unittest.TestCase):
+
+    def test_reads_select_and_text(self):
+        self.assertEqual(notion_query.property_text({"type": "select", "select": {"name": "卖出"}}), "卖出")
+        self.assertEqual(notion_query.property_text({"type": "rich_text", "rich_text": [{"text": {"content": "卖"}}, {"plain_text": "出"}]}), "卖出")
+        self.assertIsNone(notion_query.property_text({"type": "select", "select": None}))
+        self.assertEqual(notion_query.property_text({"select": {"name": "买入"}}), "买入")
+
+
+if __name__ == '__main__':
+    unittest.main()
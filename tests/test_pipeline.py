@@ -0,0 +1,173 @@
+import unittest
+import os
+import sys
+import datetime
+import tempfile
+from contextlib import redirect_stdout
+from io import StringIO
+from unittest.mock import patch, MagicMock
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import metrics
+import pipeline
+import sharding
+import warm_cache
+
+
+def holding(page_id, price):
+    return {"id": page_id, "properties": {"现价": {"type": "number", "number": price}}}
+
+
+class TestParseStages(unittest.TestCase):
+
+    def test_default_is_all_stages(self):
+        self.assertEqual(pipeline.parse_stages(None), pipeline.STAGES)
+        self.assertEqual(pipeline.parse_stages("all"), pipeline.STAGES)
+
+    def test_keeps_pipeline_order(self):
+        self.assertEqual(pipeline.parse_stages("pingan, holdings"), ("holdings", "pingan"))
+
+    def test_rejects_unknown_stage(self):
+        with self.assertRaises(ValueError):
+            pipeline.parse_stages("holdings,prices")
+
+
+class TestPageIndex(unittest.TestCase):
+
+    def test_queries_once_and_applies_successful_writes(self):
+        pages = [holding("p1", 4.0), holding("p2", 10.0)]
+        with patch.object(pipeline.main, "load_holding_pages", return_value=("ds", {}, pages)) as load:
+            index = pipeline.PageIndex()
+            index.pages()
+            index.pages()
+        load.assert_called_once_with(pipeline.INDEX_PROPERTIES)
+        self.assertEqual(index.data_source_id, "ds")
+
+        written = []
+        write = index.writer(lambda page_id, props: written.append(page_id))
+        write("p1", {"现价": {"number": 4.1}, "PE": {"number": 12.0}})
+        write("t1", {"卖出后涨跌幅": {"number": 0.1}})
+        self.assertEqual(written, ["p1", "t1"])
+        self.assertEqual(pages[0]["properties"]["现价"], {"type": "number", "number": 4.1})
+        self.assertEqual(pages[0]["properties"]["PE"], {"number": 12.0})
+
+    def test_failed_write_is_not_applied(self):
+        pages = [holding("p1", 4.0)]
+        with patch.object(pipeline.main, "load_holding_pages", return_value=("ds", {}, pages)):
+            index = pipeline.PageIndex()
+            index.pages()
+
+        def fail(page_id, props):
+            raise RuntimeError("boom")
+
+        with self.assertRaises(RuntimeError):
+            index.writer(fail)("p1", {"现价": {"number": 5.0}})
+        self.assertEqual(pages[0]["properties"]["现价"]["number"], 4.0)
+
+
+class TestRun(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(warm_cache.deactivate)
+        self.pages = [holding("p1", 4.0)]
+        patches = [
+            patch.object(pipeline.main, "get_notion_client", return_value=MagicMock()),
+            patch.object(pipeline.main, "load_holding_pages", return_value=("ds", {}, self.pages)),
+            patch.object(pipeline, "run_holdings"),
+            patch.object(pipeline, "run_trades"),
+            patch.object(pipeline.bond_stage, "main"),
+            patch.object(pipeline.pingan_stage, "main"),
+        ]
+        self.mocks = [p.start() for p in patches]
+        for p in patches:
+            self.addCleanup(p.stop)
+
+    def test_runs_selected_stages_with_shared_index(self):
+        _, load, holdings, trades, bonds, pingan = self.mocks
+        results = pipeline.run(("bonds", "pingan"))
+        self.assertEqual(results, {"bonds": True, "pingan": True})
+        holdings.assert_not_called()
+        trades.assert_not_called()
+        bonds.assert_called_once()
+        pingan.assert_called_once()
+        self.assertIs(bonds.call_args.kwargs["pages"], self.pages)
+        self.assertIs(bonds.call_args.kwargs["writes"], pingan.call_args.kwargs["writes"])
+        load.assert_called_once()
+
+    def test_stage_updates_share_one_flush(self):
+        """Yield, relation and holding updates for the same page are merged into one request at the end."""
+        _, _, holdings, _, bonds, pingan = self.mocks
+        holdings.side_effect = lambda index, writes, markets, flush: writes.put("p1", {"现价": {"number": 5.0}})
+        bonds.side_effect = lambda pages, writes: writes.put("p1", {"Yield": {"number": 1.8}}, label="511260")
+        pingan.side_effect = lambda pages, writes: writes.put("overview", {"股票投资组合": {"relation": []}})
+        with patch.object(pipeline.main, "write_notion_page") as write:
+            pipeline.run(("holdings", "bonds", "pingan"))
+        self.assertEqual(holdings.call_args.kwargs["flush"], False)
+        self.assertEqual(sorted(call.args for call in write.call_args_list), [
+            ("overview", {"股票投资组合": {"relation": []}}),
+            ("p1", {"现价": {"number": 5.0}, "Yield": {"number": 1.8}}),
+        ])
+        self.assertEqual(self.pages[0]["properties"]["现价"]["number"], 5.0)
+
+    def test_failed_stage_does_not_stop_later_stages(self):
+        _, _, holdings, trades, _, _ = self.mocks
+        holdings.side_effect = RuntimeError("boom")
+        results = pipeline.run(("holdings", "trades"))
+        self.assertEqual(results, {"holdings": False, "trades": True})
+        trades.assert_called_once()
+
+
+class TestShardedHoldings(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.addCleanup(metrics.reset)
+        self.index = pipeline.PageIndex()
+        self.index._pages = [holding("p1", 4.0)]
+
+    def write_reports(self, *shards_ok):
+        paths = []
+        for shard, ok in enumerate(shards_ok, start=1):
+            path = os.path.join(self.tmpdir.name, f"shard-{shard}.json")
+            sharding.write_report(path, {
+                "shard": shard, "shards": len(shards_ok), "markets": ["US"], "started_at": "2026-10-19T21:00:00+00:00",
+                "pages": 1, "ok": ok, "error": None, "elapsed": 1.0, "holdings": {"updated": 1},
+                "metrics": [[metrics.HOLDINGS, [["result", "updated"]], 1]],
+            })
+            paths.append(path)
+        return paths
+
+    def test_merge_checks_signals_once_and_saves_market_runs(self):
+        paths = self.write_reports(True, True)
+        with patch.object(pipeline.main, "check_and_notify_signal_changes") as signals, \
+                patch.object(pipeline.main, "save_market_runs") as save_runs, \
+                redirect_stdout(StringIO()):
+            pipeline.run_sharded_holdings(self.index, None, report_paths=paths)
+        signals.assert_called_once_with([holding("p1", 4.0)])
+        save_runs.assert_called_once()
+        self.assertEqual(save_runs.call_args[0][0], ("US",))
+        self.assertEqual(metrics.value(metrics.HOLDINGS, result="updated"), 2)
+        # 后续阶段重新查询各分片写入后的现价
+        self.assertIsNone(self.index._pages)
+
+    def test_workers_share_lookups_fetched_in_this_run(self):
+        started_at = datetime.datetime(2026, 10, 19, 21, 0, tzinfo=datetime.timezone.utc)
+        env = pipeline.shard_worker_env(2, started_at)
+        self.assertEqual({shard: float(values[pipeline.main.SHARED_LOOKUPS_ENV]) for shard, values in env.items()},
+                         {1: started_at.timestamp(), 2: started_at.timestamp()})
+
+    def test_failed_shard_fails_stage_without_saving_market_runs(self):
+        paths = self.write_reports(True, False)
+        with patch.object(pipeline.main, "check_and_notify_signal_changes") as signals, \
+                patch.object(pipeline.main, "save_market_runs") as save_runs, \
+                redirect_stdout(StringIO()):
+            with self.assertRaises(RuntimeError):
+                pipeline.run_sharded_holdings(self.index, None, report_paths=paths)
+        signals.assert_called_once()
+        save_runs.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import unittest
+import os
+import sys
+import pstats
+import tempfile
+import tracemalloc
+from contextlib import redirect_stdout
+from io import StringIO
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import profiling
+
+
+def build_cache():
+    return {str(i): [f"name-{i}", float(i)] for i in range(2000)}
+
+
+class TestProfiling(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        profiling.deactivate()
+        self.tmpdir.cleanup()
+
+    def test_checkpoint_is_noop_when_inactive(self):
+        self.assertFalse(profiling.is_active())
+        self.assertIsNone(profiling.checkpoint("preload"))
+        with patch.dict(os.environ, {"SYNC_PROFILE": ""}):
+            self.assertIsNone(profiling.activate_from_env())
+
+    def test_writes_profile_snapshot_and_summary_per_stage(self):
+        output = StringIO()
+        with redirect_stdout(output):
+            profiler = profiling.activate(self.tmpdir.name, top=5)
+            cache = build_cache()
+            first = profiling.checkpoint("preload")
+            sum(range(1000))
+            second = profiling.checkpoint("holdings")
+
+        self.assertEqual(profiler.stages, ["preload", "holdings"])
+        self.assertEqual(os.path.basename(first), "01-preload")
+        self.assertEqual(os.path.basename(second), "02-holdings")
+        functions = {name for _, _, name in pstats.Stats(first + ".prof").stats}
+        self.assertIn("build_cache", functions)
+        snapshot = tracemalloc.Snapshot.load(first + ".tracemalloc")
+        self.assertTrue(any(frame.filename == __file__ for stat in snapshot.statistics("lineno") for frame in stat.traceback))
+
+        with open(os.path.join(self.tmpdir.name, "summary.txt"), encoding="utf-8") as f:
+            summary = f.read()
+        self.assertIn("🔬 性能分析 [preload]", summary)
+        self.assertIn("build_cache (test_profiling.py", summary)
+        self.assertIn("相对上一阶段新增", summary)
+        self.assertIn("🔬 性能分析 [holdings]", output.getvalue())
+        self.assertEqual(len(cache), 2000)
+
+        profiling.deactivate()
+        self.assertFalse(tracemalloc.is_tracing())
+
+
+if __name__ == '__main__':
+    unittest.main()
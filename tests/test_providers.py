@@ -0,0 +1,175 @@
+import unittest
+import os
+import sys
+from contextlib import redirect_stdout
+from io import StringIO
+
+import pandas as pd
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import providers
+import resilience
+import quote_record
+
+
+class StaticProvider(providers.Provider):
+    def __init__(self, name, fields, data, fail=False):
+        self.name = name
+        self.fields = fields
+        self.data = data
+        self.fail = fail
+        self.batches = []
+
+    def covers(self, symbol):
+        return symbol in self.data
+
+    def fetch(self, symbols, fields):
+        self.batches.append(list(symbols))
+        if self.fail:
+            raise RuntimeError("down")
+        return {s: {f: self.data[s].get(f) for f in fields} for s in symbols if self.data[s]}
+
+
+class TestFetchAll(unittest.TestCase):
+
+    def test_one_call_per_provider_and_priority(self):
+        first = StaticProvider("first", (providers.PRICE,), {"AAPL": {providers.PRICE: 210.0}, "510300": {}})
+        second = StaticProvider("second", (providers.PRICE, providers.NAME),
+                                {"510300": {providers.PRICE: 4.1, providers.NAME: "沪深300ETF"}, "AAPL": {providers.PRICE: 1.0}})
+        quotes = providers.fetch_all([first, second], ["AAPL", "510300", "AAPL"], {providers.PRICE})
+
+        self.assertEqual(first.batches, [["AAPL", "510300"]])
+        # 已有价格的 AAPL 不再询问后面的数据源；未请求的字段（NAME）不获取
+        self.assertEqual(second.batches, [["510300"]])
+        self.assertEqual(quotes.get("AAPL", providers.PRICE), 210.0)
+        self.assertEqual(quotes.get("510300", providers.PRICE), 4.1)
+        self.assertIsNone(quotes.get("510300", providers.NAME))
+        self.assertEqual(quotes.source("510300", providers.PRICE), "second")
+        self.assertTrue(quotes.asked("first", "510300"))
+        self.assertFalse(quotes.asked("second", "AAPL"))
+
+    def test_failed_provider_is_not_marked_asked(self):
+        broken = StaticProvider("broken", (providers.PRICE,), {"AAPL": {}}, fail=True)
+        quotes = providers.fetch_all([broken], ["AAPL"], {providers.PRICE})
+        self.assertFalse(quotes.asked("broken", "AAPL"))
+        self.assertIsNone(quotes.get("AAPL", providers.PRICE))
+
+
+class TestPlan(unittest.TestCase):
+
+    def test_describe_deduplicates_by_key(self):
+        index = providers.GroupedProvider("index", (providers.INDEX_PE,), {"510300": "000300", "159919": "000300"}, lambda s: (1.0,))
+        snapshot = StaticProvider("snapshot", (providers.PRICE,), {"510300": {}, "159919": {}})
+        plan = providers.Plan([index, snapshot])
+        plan.add("510300", [providers.PRICE, providers.INDEX_PE])
+        plan.add("159919", [providers.PRICE, providers.INDEX_PE])
+        plan.add("510300", [providers.PRICE])
+
+        text = plan.describe()
+        self.assertIn("2 个标的 / 4 个字段 → 2 个数据源, 约 3 次请求", text)
+        self.assertIn("index: 1 个键, 1 次请求 [index_pe]", text)
+        self.assertIn("000300 ← 159919, 510300", text)
+        self.assertIn("snapshot: 2 个键, 2 次请求 [price]", text)
+        self.assertEqual(str(plan), text)
+
+    def test_execute_runs_fallback_in_next_wave(self):
+        fast = StaticProvider("fast", (providers.PRICE, providers.NAME), {"AAPL": {providers.PRICE: 210.0}, "600000": {}})
+        slow = StaticProvider("slow", (providers.PRICE, providers.NAME),
+                              {"600000": {providers.PRICE: 10.5, providers.NAME: "浦发银行"}, "AAPL": {providers.NAME: "Apple"}})
+        plan = providers.Plan([fast, slow])
+        plan.add("AAPL", [providers.PRICE, providers.NAME])
+        plan.add("600000", [providers.PRICE])
+        self.assertNotIn("slow", plan.batch(providers.Quotes()))
+        self.assertIn("补缺: slow", plan.describe())
+
+        quotes = providers.execute(plan)
+        self.assertEqual(fast.batches, [["AAPL", "600000"]])
+        # 第二批次只请求第一个数据源没有返回的 (代码, 字段)
+        self.assertEqual(sorted(slow.batches[0]), ["600000", "AAPL"])
+        self.assertEqual(quotes.get("AAPL", providers.NAME), "Apple")
+        self.assertEqual(quotes.source("AAPL", providers.PRICE), "fast")
+        self.assertEqual(quotes.get("600000", providers.PRICE), 10.5)
+        self.assertEqual(quotes.calls, {"fast": 2, "slow": 2})
+
+
+class TestGroupedProvider(unittest.TestCase):
+
+    def test_loads_each_group_once(self):
+        loaded = []
+
+        def load(symbol):
+            loaded.append(symbol)
+            return (12.0, None)
+
+        provider = providers.GroupedProvider("index", (providers.HK_INDEX_PE, providers.HK_INDEX_PE_PERCENTILE),
+                                             {"159920": "HSI", "513660": "HSI", "513180": "HSTECH"}, load)
+        quotes = providers.fetch_all([provider], ["159920", "513660", "513180", "AAPL"],
+                                     {providers.HK_INDEX_PE, providers.HK_INDEX_PE_PERCENTILE})
+        self.assertEqual(loaded, ["159920", "513180"])
+        self.assertEqual(quotes.calls["index"], 2)
+        self.assertEqual(quotes.get("513660", providers.HK_INDEX_PE), 12.0)
+        self.assertIsNone(quotes.get("513660", providers.HK_INDEX_PE_PERCENTILE))
+        self.assertFalse(quotes.asked("index", "AAPL"))
+
+    def test_failed_group_is_left_to_per_ticker_fallback(self):
+        calls = []
+
+        def load(symbol):
+            calls.append(symbol)
+            if symbol == "513180":
+                raise resilience.CircuitOpenError("legulegu")
+            return (12.0, 40.0)
+
+        provider = providers.GroupedProvider("index", (providers.HK_INDEX_PE, providers.HK_INDEX_PE_PERCENTILE),
+                                             {"159920": "HSI", "513180": "HSTECH", "513130": "HSTECH"}, load)
+        with redirect_stdout(StringIO()):
+            quotes = providers.fetch_all([provider], ["159920", "513180", "513130"], {providers.HK_INDEX_PE})
+        self.assertTrue(quotes.asked("index", "159920"))
+        # 熔断的分组不算询问过（main.prefetched 逐个查询），本次预取也不再重试
+        self.assertFalse(quotes.asked("index", "513180"))
+        self.assertFalse(quotes.asked("index", "513130"))
+        self.assertEqual(sorted(calls), ["159920", "513180"])
+
+
+
+class TestYFinanceProvider(unittest.TestCase):
+
+    def test_reads_grouped_download(self):
+        requested = []
+
+        def download(symbols):
+            requested.append(symbols)
+            columns = pd.MultiIndex.from_product([["AAPL", "BRK-B"], ["Open", "Close"]])
+            return pd.DataFrame([[1.0, 200.0, 1.0, 400.0], [1.0, 210.0, 1.0, None]], columns=columns)
+
+        provider = providers.YFinanceProvider(lambda s: s.replace(".", "-"), download)
+        quotes = providers.fetch_all([provider], ["AAPL", "BRK.B", "MISSING"], {providers.PRICE})
+        self.assertEqual(requested, [["AAPL", "BRK-B", "MISSING"]])
+        self.assertEqual(quotes.get("AAPL", providers.PRICE), 210.0)
+        # 最新一行缺失时取最近的有效收盘价
+        self.assertEqual(quotes.get("BRK.B", providers.PRICE), 400.0)
+        self.assertIsNone(quotes.get("MISSING", providers.PRICE))
+        self.assertTrue(quotes.asked("yfinance", "MISSING"))
+
+    def test_reads_single_symbol_download(self):
+        provider = providers.YFinanceProvider(str, lambda symbols: pd.DataFrame({"Close": [5.0, 0.0]}))
+        self.assertEqual(provider.fetch(["X"], [providers.PRICE]), {})
+        provider = providers.YFinanceProvider(str, lambda symbols: pd.DataFrame({"Close": [5.0, 6.0]}))
+        self.assertEqual(provider.fetch(["X"], [providers.PRICE]), {"X": {providers.PRICE: 6.0}})
+
+
+class TestSnapshotProvider(unittest.TestCase):
+
+    def test_reads_snapshot_rows(self):
+        snapshot = quote_record.from_records(
+            [{"代码": "00700", "名称": "腾讯控股", "最新价": "-", "收盘": 400.0, "市盈率-动态": -3.5}], "代码")
+        provider = providers.SnapshotProvider("hk", snapshot, to_code=lambda s: s.replace(".HK", "").zfill(5))
+        self.assertTrue(provider.covers("0700.HK"))
+        self.assertFalse(provider.covers("AAPL"))
+        result = provider.fetch(["0700.HK"], [providers.PRICE, providers.NAME, providers.PE])
+        self.assertEqual(result, {"0700.HK": {providers.PRICE: 400.0, providers.NAME: "腾讯控股", providers.PE: -3.5}})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import unittest
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from quote_record import QuoteRecord, from_records, to_payloads, from_payloads
+
+
+class TestQuoteRecord(unittest.TestCase):
+
+    def test_normalises_columns_at_ingest(self):
+        rows = [
+            {"代码": "600000", "名称": "浦发银行", "最新价": 10.5, "市盈率-动态": 5.2, "市净率": 0.4, "总市值": 3.1e11, "涨跌幅": 1.0},
+            {"代码": "00700", "名称": "腾讯控股", "最新价": "-", "收盘": "400.0", "市盈率-动态": float("nan")},
+            {"代码": "000001", "基金简称": "华夏成长"},
+            {"代码": "600001", "名称": "停牌股", "最新价": 0.0, "市盈率-动态": -12.0},
+        ]
+        cache = from_records(rows, "代码")
+        self.assertEqual(cache["600000"], QuoteRecord("600000", "浦发银行", 10.5, 5.2, 0.4, 3.1e11))
+        self.assertEqual(cache["00700"].last, 400.0)
+        self.assertIsNone(cache["00700"].pe_ttm)
+        self.assertEqual(cache["000001"].name, "华夏成长")
+        self.assertIsNone(cache["000001"].last)
+        # 停牌时最新价为 0 视为没有价格；亏损的负 PE 保留
+        self.assertIsNone(cache["600001"].last)
+        self.assertEqual(cache["600001"].pe_ttm, -12.0)
+
+    def test_payload_round_trip(self):
+        cache = {"600000": QuoteRecord("600000", "浦发银行", 10.5, 5.2, None, None)}
+        payloads = to_payloads(cache)
+        self.assertEqual(payloads, {"600000": ["浦发银行", 10.5, 5.2, None, None]})
+        self.assertEqual(from_payloads(payloads), cache)
+
+    def test_reads_legacy_row_payloads(self):
+        cache = from_payloads({"510300": {"名称": "沪深300ETF", "最新价": 4.1}})
+        self.assertEqual(cache["510300"], QuoteRecord("510300", "沪深300ETF", 4.1))
+
+    def test_has_no_instance_dict(self):
+        self.assertFalse(hasattr(QuoteRecord("600000"), "__dict__"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,196 @@
+import unittest
+import os
+import sys
+import json
+import threading
+from unittest.mock import patch, MagicMock
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import pandas as pd
+
+import resilience
+from main import get_price_from_akshare
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.breaker = resilience.CircuitBreaker("eastmoney", failure_threshold=2, reset_timeout=30, clock=self.clock)
+
+    def test_opens_after_consecutive_source_failures(self):
+        """Network failures trip the breaker; later calls are skipped without running."""
+        failing = MagicMock(side_effect=ConnectionError("throttled"))
+        for _ in range(2):
+            with self.assertRaises(ConnectionError):
+                self.breaker.call(failing)
+        self.assertEqual(self.breaker.state, resilience.OPEN)
+
+        with self.assertRaises(resilience.CircuitOpenError):
+            self.breaker.call(failing)
+        self.assertEqual(failing.call_count, 2)
+
+    def test_data_errors_do_not_count(self):
+        """A source that answers with unusable data is healthy, so the breaker stays closed."""
+        for _ in range(5):
+            with self.assertRaises(KeyError):
+                self.breaker.call(MagicMock(side_effect=KeyError("单位净值")))
+        self.assertEqual(self.breaker.state, resilience.CLOSED)
+
+    def test_invalid_json_from_throttling_counts(self):
+        """akshare parses some responses with json.loads, so a throttled HTML page surfaces as a plain JSONDecodeError."""
+        def throttled():
+            return json.loads("<html>访问过于频繁</html>")
+
+        for _ in range(2):
+            with self.assertRaises(ValueError):
+                self.breaker.call(throttled)
+        self.assertEqual(self.breaker.state, resilience.OPEN)
+
+    def test_half_open_after_cooldown(self):
+        """After the cooldown one trial call is allowed; success closes the breaker."""
+        for _ in range(2):
+            with self.assertRaises(TimeoutError):
+                self.breaker.call(MagicMock(side_effect=TimeoutError()))
+        self.clock.now = 31
+        self.assertEqual(self.breaker.call(lambda: "ok"), "ok")
+        self.assertEqual(self.breaker.state, resilience.CLOSED)
+
+    def test_failed_trial_reopens(self):
+        for _ in range(2):
+            with self.assertRaises(TimeoutError):
+                self.breaker.call(MagicMock(side_effect=TimeoutError()))
+        self.clock.now = 31
+        with self.assertRaises(TimeoutError):
+            self.breaker.call(MagicMock(side_effect=TimeoutError()))
+        self.assertEqual(self.breaker.state, resilience.OPEN)
+        self.assertAlmostEqual(self.breaker.remaining(), 30)
+
+    def test_half_open_allows_single_concurrent_probe(self):
+        """While half-open only one caller probes the source; concurrent callers are skipped until it finishes."""
+        for _ in range(2):
+            self.breaker.record_failure()
+        self.clock.now = 31
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def probe():
+            calls.append("probe")
+            started.set()
+            release.wait(5)
+            return "ok"
+
+        results = []
+        prober = threading.Thread(target=lambda: results.append(self.breaker.call(probe)))
+        prober.start()
+        self.assertTrue(started.wait(5))
+
+        def queued():
+            try:
+                results.append(self.breaker.call(lambda: calls.append("queued")))
+            except resilience.CircuitOpenError:
+                results.append("skipped")
+
+        others = [threading.Thread(target=queued) for _ in range(4)]
+        for t in others:
+            t.start()
+        for t in others:
+            t.join()
+        release.set()
+        prober.join()
+
+        self.assertEqual(calls, ["probe"])
+        self.assertEqual(sorted(results), ["ok"] + ["skipped"] * 4)
+        self.assertEqual(self.breaker.state, resilience.CLOSED)
+        self.assertIsNone(self.breaker.call(lambda: None))
+
+
+class TestGuardedAkshare(unittest.TestCase):
+
+    def setUp(self):
+        resilience.reset_breakers()
+
+    def tearDown(self):
+        resilience.reset_breakers()
+
+    def test_track_skips_collects_open_sources(self):
+        breaker = resilience.get_breaker("legulegu")
+        for _ in range(resilience.FAILURE_THRESHOLD):
+            breaker.record_failure()
+        with resilience.track_skips() as skipped:
+            with self.assertRaises(resilience.CircuitOpenError):
+                resilience.guarded("legulegu", MagicMock())
+        self.assertEqual(skipped, {"legulegu"})
+
+    @patch('main.AKSHARE_AVAILABLE', True)
+    @patch('main.ak.fund_etf_hist_sina')
+    @patch('main.ak.fund_etf_hist_em')
+    @patch('main.ak.fund_etf_spot_em')
+    def test_open_eastmoney_routes_to_sina(self, mock_etf_spot, mock_etf_hist, mock_sina):
+        """With eastmoney tripped, get_price_from_akshare goes straight to the sina fallback."""
+        breaker = resilience.get_breaker("eastmoney")
+        for _ in range(resilience.FAILURE_THRESHOLD):
+            breaker.record_failure()
+        mock_sina.return_value = pd.DataFrame({'close': [3.9, 4.02]})
+
+        price = get_price_from_akshare('510300')
+
+        self.assertEqual(price, 4.02)
+        mock_etf_spot.assert_not_called()
+        mock_etf_hist.assert_not_called()
+
+
+class TestRunBudget(unittest.TestCase):
+
+    def tearDown(self):
+        resilience.end_budget()
+        resilience.reset_breakers()
+
+    def test_optional_work_skipped_when_reserve_exceeds_time_left(self):
+        """Enrichments are skipped once the remaining time is needed for price writes."""
+        clock = FakeClock()
+        budget = resilience.RunBudget(deadline_seconds=100, clock=clock)
+        budget.pending = 10
+        self.assertTrue(budget.allow_optional("ROE", "600519"))
+
+        clock.now = 85  # 15s left, 10 pending holdings need 20s
+        self.assertFalse(budget.allow_optional("ROE", "600519"))
+        self.assertFalse(budget.allow_optional("PB", "AAPL"))
+        self.assertEqual(dict(budget.skipped), {"ROE": ["600519"], "PB": ["AAPL"]})
+
+    def test_call_timeout_shrinks_but_keeps_floor(self):
+        clock = FakeClock()
+        budget = resilience.RunBudget(deadline_seconds=100, clock=clock)
+        self.assertEqual(budget.call_timeout(), resilience.DEFAULT_CALL_TIMEOUT)
+        clock.now = 90
+        self.assertEqual(budget.call_timeout(), 10)
+        clock.now = 200
+        self.assertEqual(budget.call_timeout(), resilience.MIN_CALL_TIMEOUT)
+
+    def test_hanging_call_times_out_and_counts_as_failure(self):
+        """With a budget active, guarded calls cannot hang past their timeout."""
+        import threading
+        release = threading.Event()
+        resilience.start_budget(deadline_seconds=1000)
+        with patch.object(resilience, 'DEFAULT_CALL_TIMEOUT', 0.05), patch.object(resilience, 'MIN_CALL_TIMEOUT', 0.05):
+            with self.assertRaises(resilience.CallTimeoutError):
+                resilience.guarded("csindex", release.wait, 5)
+        release.set()
+        self.assertEqual(resilience.get_breaker("csindex").failures, 1)
+
+    def test_allow_optional_without_budget(self):
+        self.assertTrue(resilience.allow_optional("PEG", "AAPL"))
+
+
+if __name__ == '__main__':
+    unittest.main()
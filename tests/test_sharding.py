@@ -0,0 +1,86 @@
+import unittest
+import os
+import sys
+import uuid
+import tempfile
+from contextlib import redirect_stdout
+from io import StringIO
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import sharding
+
+
+def report(shard, shards=3, ok=True, pages=10, holdings=None, started_at="2026-10-19T07:00:00+00:00"):
+    return {"shard": shard, "shards": shards, "markets": ["CN", "HK"], "started_at": started_at, "pages": pages,
+            "ok": ok, "error": None if ok else "boom", "elapsed": 12.0,
+            "holdings": holdings or {"updated": pages}, "metrics": [["stock_sync_holdings", [["result", "updated"]], pages]]}
+
+
+class TestShardOf(unittest.TestCase):
+
+    def setUp(self):
+        self.page_ids = [str(uuid.UUID(int=i * 7919 + 1)) for i in range(2000)]
+
+    def test_partition_is_complete_and_balanced(self):
+        pages = [{"id": page_id} for page_id in self.page_ids]
+        shards = [sharding.select(pages, shard, 4) for shard in range(1, 5)]
+        self.assertEqual(sorted(p["id"] for shard in shards for p in shard), sorted(self.page_ids))
+        for shard in shards:
+            self.assertGreater(len(shard), 400)
+        # 带不带连字符、大小写都是同一个页面
+        page_id = self.page_ids[0]
+        self.assertEqual(sharding.shard_of(page_id, 4), sharding.shard_of(page_id.replace("-", "").upper(), 4))
+
+    def test_adding_a_shard_only_moves_pages_to_it(self):
+        moved = 0
+        for page_id in self.page_ids:
+            before, after = sharding.shard_of(page_id, 4), sharding.shard_of(page_id, 5)
+            if before != after:
+                self.assertEqual(after, 5)
+                moved += 1
+        self.assertLess(moved, len(self.page_ids) * 0.3)
+
+    def test_parse_shard(self):
+        self.assertEqual(sharding.parse_shard("2/4"), (2, 4))
+        for value in ("0/4", "5/4", "2", "a/b"):
+            with self.assertRaises(ValueError):
+                sharding.parse_shard(value)
+
+
+class TestReports(unittest.TestCase):
+
+    def test_merge_sums_results_and_flags_failed_and_missing_shards(self):
+        reports = [report(1, pages=5, started_at="2026-10-19T07:00:02+00:00"),
+                   report(3, ok=False, pages=4, holdings={"updated": 3, "failed": 1})]
+        with redirect_stdout(StringIO()):
+            merged = sharding.merge_reports(reports)
+        self.assertEqual(merged["failed"], [2, 3])
+        self.assertEqual(merged["pages"], 9)
+        self.assertEqual(merged["holdings"], {"updated": 8, "failed": 1})
+        self.assertEqual(merged["markets"], ["CN", "HK"])
+        self.assertEqual(merged["started_at"], "2026-10-19T07:00:00+00:00")
+        self.assertEqual(len(merged["metrics"]), 2)
+
+    def test_rejects_inconsistent_reports(self):
+        with self.assertRaises(ValueError):
+            sharding.merge_reports([report(1, shards=2), report(2, shards=3)])
+        with self.assertRaises(ValueError):
+            sharding.merge_reports([report(1), report(1)])
+        with self.assertRaises(ValueError):
+            sharding.merge_reports([report(1, shards=2)], shards=3)
+
+    def test_write_and_load_reports(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "shard-1.json")
+            sharding.write_report(path, report(1))
+            with redirect_stdout(StringIO()) as output:
+                loaded = sharding.load_reports([path, os.path.join(tmpdir, "shard-2.json")])
+            self.assertEqual(os.listdir(tmpdir), ["shard-1.json"])
+        self.assertEqual([r["shard"] for r in loaded], [1])
+        self.assertEqual(loaded[0]["version"], sharding.REPORT_VERSION)
+        self.assertIn("shard-2.json", output.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
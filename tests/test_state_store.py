@@ -0,0 +1,148 @@
+import unittest
+import os
+import sys
+import json
+import time
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import numpy as np
+
+import state_store
+
+
+class TestStateStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.store = state_store.StateStore(os.path.join(self.tmpdir.name, "state.db"))
+
+    def tearDown(self):
+        self.store.close()
+        self.tmpdir.cleanup()
+
+    def test_snapshot_roundtrip_and_freshness(self):
+        rows = {"600519": {"名称": "贵州茅台", "最新价": np.float64(1500.5), "市盈率-动态": float("nan")}}
+        self.store.put_snapshot("spot_cache", rows, fetched_at=1000)
+
+        snapshot = self.store.get_snapshot("spot_cache", fresh_after=900)
+        self.assertEqual(snapshot["600519"]["最新价"], 1500.5)
+        self.assertTrue(np.isnan(snapshot["600519"]["市盈率-动态"]))
+        self.assertIsNone(self.store.get_snapshot("spot_cache", fresh_after=1100))
+        self.assertEqual(self.store.get_quote("spot_cache", "600519")["名称"], "贵州茅台")
+
+        # 替换快照时旧代码被删除
+        self.store.put_snapshot("spot_cache", {"000001": {"名称": "平安银行"}})
+        self.assertIsNone(self.store.get_quote("spot_cache", "600519"))
+
+    def test_series_upsert_is_incremental(self):
+        self.store.upsert_series("pe_ttm", "600519", [("2026-10-13", 30.0), ("2026-10-14", 31.0)])
+        self.store.upsert_series("pe_ttm", "600519", [("2026-10-14", 31.5), ("2026-10-15", None)])
+        self.assertEqual(
+            self.store.get_series("pe_ttm", "600519"),
+            [("2026-10-13", 30.0), ("2026-10-14", 31.5), ("2026-10-15", None)],
+        )
+
+    def test_price_bars_upsert_is_incremental(self):
+        self.assertIsNone(self.store.last_bar_date("AAPL", "1mo"))
+        self.assertIsNone(self.store.bars_checked_at("AAPL", "1mo"))
+        self.store.upsert_bars("AAPL", "1mo", [("2026-08-01", 1, 2, 0.5, 1.5, 100), ("2026-09-01", 1.5, 3, 1, 2.0, None)],
+                               checked_at=1000)
+        # 当月K线被覆盖，新K线追加
+        self.store.upsert_bars("AAPL", "1mo", [("2026-09-01", 1.5, 3, 1, 2.5, 300), ("2026-10-01", 2.5, 3, 2, 2.8, 50)],
+                               checked_at=2000)
+        bars = self.store.get_bars("AAPL", "1mo")
+        self.assertEqual([(b[0], b[4]) for b in bars], [("2026-08-01", 1.5), ("2026-09-01", 2.5), ("2026-10-01", 2.8)])
+        self.assertEqual([b[0] for b in self.store.get_bars("AAPL", "1mo", since="2026-09-01")], ["2026-09-01", "2026-10-01"])
+        self.assertEqual(self.store.last_bar_date("AAPL", "1mo"), "2026-10-01")
+        self.assertEqual(self.store.bars_checked_at("AAPL", "1mo"), 2000)
+        self.assertEqual(self.store.get_bars("AAPL", "1d"), [])
+
+    def test_fundamentals_rates_signals_meta(self):
+        self.store.put_fundamentals("600519", {"ROE": 30.1, "PEG": "-"}, fetched_at=time.time())
+        self.assertEqual(self.store.get_fundamentals("600519"), {"ROE": 30.1, "PEG": "-"})
+        self.assertIsNone(self.store.get_fundamentals("600519", fresh_after=time.time() + 60))
+
+        self.store.put_rates({"CNY": 1.0, "USD": 7.1})
+        self.assertEqual(self.store.get_rates(), {"CNY": 1.0, "USD": 7.1})
+
+        self.store.replace_signals({("AAPL", "🚦雪盈风险等级"): "低"})
+        self.assertEqual(self.store.get_signals(), {("AAPL", "🚦雪盈风险等级"): "低"})
+
+        self.store.set_meta("market_runs", {"CN": "2026-10-14T07:05:00+00:00"})
+        self.assertEqual(self.store.get_meta("market_runs")["CN"], "2026-10-14T07:05:00+00:00")
+        self.assertEqual(self.store.get_meta("missing", {}), {})
+
+    def test_cache_stats_and_invalidate(self):
+        self.store.put_snapshot("spot_cache", {"600519": ["贵州茅台", 1500.5]}, fetched_at=1000)
+        self.store.put_snapshot("hk_cache", {"00700": ["腾讯控股", 400.0]}, fetched_at=2000)
+        self.store.upsert_series("pe_ttm", "600519", [("2026-10-01", 30.0), ("2026-10-02", 31.0)])
+        self.store.upsert_series("hk_pe_ratio", "00700", [("2026-10-02", 15.0)])
+        self.store.upsert_series("daily_pe", "600519", [("2026-10-02", 31.0)])
+        self.store.upsert_bars("AAPL", "1mo", [("2026-10-01", 1, 2, 0.5, 1.5, 100)], checked_at=3000)
+
+        stats = {(row["namespace"], row["part"]): row for row in self.store.cache_stats()}
+        self.assertEqual(stats[("snapshot", "hk_cache")]["newest"], 2000)
+        self.assertGreater(stats[("snapshot", "spot_cache")]["bytes"], 0)
+        self.assertEqual((stats[("pe_series", "pe_ttm")]["entries"], stats[("pe_series", "pe_ttm")]["newest"]), (2, "2026-10-02"))
+        self.assertEqual(stats[("valuation_history", "daily_pe")]["keys"], 1)
+        self.assertEqual(stats[("price_bars", None)]["oldest"], 3000)
+        self.assertEqual(stats[("signals", None)]["entries"], 0)
+
+        self.assertEqual(self.store.invalidate("snapshot", ["hk_cache"]), 1)
+        self.assertIsNone(self.store.get_snapshot("hk_cache"))
+        self.assertIsNotNone(self.store.get_snapshot("spot_cache"))
+        # PE 历史与每日估值轨迹共用一张表，互不影响
+        self.assertEqual(self.store.invalidate("pe_series", ["600519"]), 2)
+        self.assertEqual(self.store.get_series("daily_pe", "600519"), [("2026-10-02", 31.0)])
+        self.assertEqual(self.store.invalidate("pe_series"), 1)
+        self.assertEqual(self.store.invalidate("price_bars", ["AAPL"]), 1)
+        self.assertIsNone(self.store.bars_checked_at("AAPL", "1mo"))
+        with self.assertRaises(ValueError):
+            self.store.invalidate("pickles")
+
+    def test_lookups(self):
+        self.store.put_lookup("get_etf_index_pe_pb", "('510300',)", (12.5, 1.4, 40.0, 30.0), fetched_at=2000)
+        self.assertEqual(self.store.get_lookup("get_etf_index_pe_pb", "('510300',)"), [12.5, 1.4, 40.0, 30.0])
+        self.assertIsNone(self.store.get_lookup("get_etf_index_pe_pb", "('510300',)", fresh_after=3000))
+        self.assertIsNone(self.store.get_lookup("get_etf_index_pe_pb", "('159915',)"))
+
+        stats = {(row["namespace"], row["part"]): row for row in self.store.cache_stats()}
+        self.assertEqual((stats[("lookups", None)]["entries"], stats[("lookups", None)]["newest"]), (1, 2000))
+        self.assertEqual(self.store.invalidate("lookups", ["get_etf_index_pe_pb"]), 1)
+        self.assertIsNone(self.store.get_lookup("get_etf_index_pe_pb", "('510300',)"))
+
+    def test_concurrent_writers(self):
+        """Each thread uses its own connection; WAL lets them write without errors."""
+        def writer(n):
+            for i in range(20):
+                self.store.upsert_series("pe_ttm", f"S{n}", [(f"2026-01-{i + 1:02d}", float(i))])
+
+        threads = [threading.Thread(target=writer, args=(n,)) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(self.store.get_series("pe_ttm", "S3")), 20)
+
+    def test_import_legacy_files(self):
+        akshare_dir = os.path.join(self.tmpdir.name, "akshare_cache")
+        pe_dir = os.path.join(self.tmpdir.name, "pe_cache")
+        os.makedirs(akshare_dir)
+        os.makedirs(pe_dir)
+        with open(os.path.join(akshare_dir, "signal_cache.json"), "w", encoding="utf-8") as f:
+            json.dump({"AAPL|🚦雪盈风险等级": "低"}, f, ensure_ascii=False)
+        with open(os.path.join(pe_dir, "00700_pe.csv"), "w", encoding="utf-8") as f:
+            f.write("trade_date,pe_ratio\n2026-10-13,18.5\n")
+
+        state_store.import_legacy_files(self.store, akshare_dir, pe_dir)
+
+        self.assertEqual(self.store.get_signals(), {("AAPL", "🚦雪盈风险等级"): "低"})
+        self.assertEqual(self.store.get_series("hk_pe_ratio", "00700"), [("2026-10-13", 18.5)])
+        self.assertTrue(self.store.get_meta("legacy_imported"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,11 +3,15 @@ from unittest.mock import patch, MagicMock
 import pandas as pd
 import os
 import sys
+import tempfile
 
 # Add scripts directory to path
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'scripts')))
 
+import state_store
+import update_bond_etf_yield
 from update_bond_etf_yield import (
+    YieldCurve,
     get_china_bond_yield,
     get_china_10y_bond_yield,
     get_china_5y_bond_yield,
@@ -15,8 +19,21 @@ from update_bond_etf_yield import (
 )
 
 
+def _use_temp_store(test):
+    """Each test gets its own state store and a fresh in-memory yield curve."""
+    tmp = tempfile.TemporaryDirectory()
+    test.addCleanup(tmp.cleanup)
+    test.store = state_store.use_store(os.path.join(tmp.name, "state.db"))
+    test.addCleanup(state_store.close_store)
+    update_bond_etf_yield.reset_yield_curve()
+    test.addCleanup(update_bond_etf_yield.reset_yield_curve)
+
+
 class TestBondYieldUpdate(unittest.TestCase):
 
+    def setUp(self):
+        _use_temp_store(self)
+
     @patch('update_bond_etf_yield.ak.bond_zh_us_rate')
     def test_get_china_10y_bond_yield_success(self, mock_akshare):
         """Test successful fetching of 10-year bond yield."""
@@ -92,5 +109,54 @@ class TestBondYieldUpdate(unittest.TestCase):
         self.assertIsNone(result)
 
 
+
+class TestYieldCurve(unittest.TestCase):
+
+    def setUp(self):
+        _use_temp_store(self)
+        self.df = pd.DataFrame({
+            '日期': ['2025-12-30', '2025-12-31'],
+            '中国国债收益率10年': [1.85, 1.8473],
+            '中国国债收益率5年': [1.62, 1.6309],
+            '中国国债收益率30年': [2.25, None],
+        })
+
+    @patch('update_bond_etf_yield.ak.bond_zh_us_rate')
+    def test_all_tenors_share_one_download(self, mock_akshare):
+        mock_akshare.return_value = self.df
+
+        self.assertEqual(get_china_10y_bond_yield(), 1.8473)
+        self.assertEqual(get_china_5y_bond_yield(), 1.6309)
+        # Latest non-null value for the tenor
+        self.assertEqual(get_china_30y_bond_yield(), 2.25)
+        mock_akshare.assert_called_once_with()
+
+    @patch('update_bond_etf_yield.ak.bond_zh_us_rate')
+    def test_incremental_fetch_from_stored_history(self, mock_akshare):
+        mock_akshare.return_value = self.df
+        YieldCurve(self.store).load()
+
+        mock_akshare.return_value = pd.DataFrame({
+            '日期': ['2025-12-31', '2026-01-02'],
+            '中国国债收益率10年': [1.8473, 1.83],
+            '中国国债收益率5年': [1.6309, 1.61],
+            '中国国债收益率30年': [2.26, 2.24],
+        })
+        curve = YieldCurve(self.store)
+        self.assertEqual(curve.latest(10), 1.83)
+        # Starts from the oldest per-tenor latest date (30Y stopped at 12-30)
+        mock_akshare.assert_called_with(start_date="20251230")
+        self.assertEqual(curve.history(30), [('2025-12-30', 2.25), ('2025-12-31', 2.26), ('2026-01-02', 2.24)])
+        self.assertEqual(self.store.get_series(update_bond_etf_yield.YIELD_SERIES, "10Y")[-1], ('2026-01-02', 1.83))
+
+    @patch('update_bond_etf_yield.ak.bond_zh_us_rate')
+    def test_falls_back_to_stored_history(self, mock_akshare):
+        mock_akshare.return_value = self.df
+        YieldCurve(self.store).load()
+
+        mock_akshare.side_effect = Exception("Network error")
+        self.assertEqual(YieldCurve(self.store).latest(5), 1.6309)
+
+
 if __name__ == '__main__':
     unittest.main()
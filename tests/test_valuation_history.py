@@ -0,0 +1,76 @@
+import unittest
+import os
+import sys
+import tempfile
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import state_store
+import valuation_history
+from valuation_history import Trajectory, PE, PB, PE_PERCENTILE, PB_PERCENTILE
+
+
+class TestTrajectory(unittest.TestCase):
+
+    def test_insert_keeps_dates_sorted_and_overwrites_same_day(self):
+        trajectory = Trajectory([("2026-10-02", 2.0), ("2026-10-01", 1.0)])
+        trajectory.insert("2026-10-04", 4.0)
+        trajectory.insert("2026-10-03", 3.0)
+        trajectory.insert("2026-10-02", 2.5)
+        self.assertEqual(trajectory.since(), [("2026-10-01", 1.0), ("2026-10-02", 2.5), ("2026-10-03", 3.0), ("2026-10-04", 4.0)])
+        self.assertEqual(trajectory.since("2026-10-03"), [("2026-10-03", 3.0), ("2026-10-04", 4.0)])
+        self.assertEqual(len(trajectory), 4)
+
+
+class TestValuationHistory(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "state.db")
+        state_store.use_store(self.path)
+
+    def tearDown(self):
+        state_store.close_store()
+        self.tmpdir.cleanup()
+
+    def test_records_daily_points_and_persists(self):
+        history = valuation_history.get_history()
+        self.assertEqual(history.record("600519", date="2026-10-14", pe=30.0, pe_percentile=40.0, pb=None), 2)
+        history.record("600519", date="2026-10-15", pe=31.0, pe_percentile=45.0)
+        history.record("600519", date="2026-10-15", pe_percentile=46.0)
+        history.record(valuation_history.index_symbol("000300"), date="2026-10-15", pb=1.3, pb_percentile=20.0)
+
+        self.assertEqual(history.trajectory("600519"), [("2026-10-14", 40.0), ("2026-10-15", 46.0)])
+        self.assertEqual(history.trajectory("600519", PE, since="2026-10-15"), [("2026-10-15", 31.0)])
+        self.assertEqual(history.latest("index:000300", PB_PERCENTILE), ("2026-10-15", 20.0))
+        self.assertEqual(history.trajectory("600519", PB), [])
+
+        # 重新打开状态库后从本地读取
+        state_store.close_store()
+        state_store.use_store(self.path)
+        self.assertIsNot(valuation_history.get_history(), history)
+        self.assertEqual(valuation_history.trajectory("600519", PE_PERCENTILE), [("2026-10-14", 40.0), ("2026-10-15", 46.0)])
+
+    def test_record_does_not_load_stored_trajectory(self):
+        history = valuation_history.get_history()
+        history.record("600519", date="2026-10-14", pe=30.0)
+        fresh = valuation_history.ValuationHistory(history.store)
+        with patch.object(history.store, "get_series", wraps=history.store.get_series) as load:
+            fresh.record("600519", date="2026-10-15", pe=31.0)
+            load.assert_not_called()
+            self.assertEqual(fresh.trajectory("600519", PE), [("2026-10-14", 30.0), ("2026-10-15", 31.0)])
+            fresh.record("600519", date="2026-10-16", pe=32.0)
+            self.assertEqual(load.call_count, 1)
+        self.assertEqual(fresh.latest("600519", PE), ("2026-10-16", 32.0))
+
+    def test_rejects_unknown_fields(self):
+        history = valuation_history.get_history()
+        with self.assertRaises(ValueError):
+            history.record("600519", roe=12.0)
+        with self.assertRaises(ValueError):
+            history.trajectory("600519", "roe")
+
+
+if __name__ == '__main__':
+    unittest.main()
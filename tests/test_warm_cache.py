@@ -0,0 +1,81 @@
+import unittest
+import os
+import sys
+import datetime
+from unittest.mock import MagicMock
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import warm_cache
+from market_calendar import CN
+
+UTC = datetime.timezone.utc
+
+
+class FakeClock:
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class TestWarmCache(unittest.TestCase):
+
+    def setUp(self):
+        # 2026-10-14 (周三) 06:00 UTC，A股收盘 (07:00 UTC) 之前
+        self.clock = FakeClock(datetime.datetime(2026, 10, 14, 6, 0, tzinfo=UTC))
+        self.cache = warm_cache.WarmCache(clock=self.clock)
+
+    def tearDown(self):
+        warm_cache.deactivate()
+
+    def test_session_entries_expire_at_market_close(self):
+        loader = MagicMock(return_value={"600519": 1})
+        self.cache.get(warm_cache.SESSION, "spot", loader, market=CN)
+        self.clock.now = self.clock.now.replace(hour=6, minute=59)
+        self.cache.get(warm_cache.SESSION, "spot", loader, market=CN)
+        self.assertEqual(loader.call_count, 1)
+
+        self.clock.now = self.clock.now.replace(hour=7, minute=10)
+        self.cache.get(warm_cache.SESSION, "spot", loader, market=CN)
+        self.assertEqual(loader.call_count, 2)
+
+    def test_monthly_entries_survive_days(self):
+        loader = MagicMock(return_value=(12.5, 40.0))
+        self.cache.get(warm_cache.MONTHLY, "index_pe", loader)
+        self.clock.now += datetime.timedelta(days=10)
+        self.cache.get(warm_cache.MONTHLY, "index_pe", loader)
+        self.assertEqual(loader.call_count, 1)
+        self.clock.now += datetime.timedelta(days=20)
+        self.cache.get(warm_cache.MONTHLY, "index_pe", loader)
+        self.assertEqual(loader.call_count, 2)
+
+    def test_failed_results_are_not_cached(self):
+        loader = MagicMock(side_effect=[(None, None), None, 0.18])
+        for _ in range(3):
+            self.cache.get(warm_cache.DAILY, "roe", loader)
+        self.assertEqual(self.cache.get(warm_cache.DAILY, "roe", loader), 0.18)
+        self.assertEqual(loader.call_count, 3)
+
+    def test_memoize_only_when_active(self):
+        calls = []
+
+        @warm_cache.memoize(warm_cache.DAILY, ignore=("stock",))
+        def get_roe(symbol, stock):
+            calls.append(symbol)
+            return 0.2
+
+        get_roe("AAPL", object())
+        get_roe("AAPL", object())
+        self.assertEqual(len(calls), 2)
+
+        warm_cache.activate()
+        get_roe("AAPL", object())
+        get_roe("AAPL", object())
+        get_roe("MSFT", object())
+        self.assertEqual(calls[2:], ["AAPL", "MSFT"])
+
+
+if __name__ == '__main__':
+    unittest.main()
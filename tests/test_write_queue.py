@@ -0,0 +1,104 @@
+import unittest
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import write_queue
+
+
+class APIError(Exception):
+    def __init__(self, status, code):
+        super().__init__(code)
+        self.status = status
+        self.code = code
+
+
+class Recorder:
+    def __init__(self, failures=None):
+        self.calls = []
+        self.failures = dict(failures or {})
+        self.lock = threading.Lock()
+
+    def __call__(self, page_id, properties):
+        with self.lock:
+            self.calls.append((page_id, dict(properties)))
+            errors = self.failures.get(page_id)
+            if errors:
+                raise errors.pop(0)
+
+
+def make_queue(write, **kwargs):
+    return write_queue.WriteBehind(write, rate=0, sleep=lambda s: None, **kwargs)
+
+
+class TestWriteBehind(unittest.TestCase):
+
+    def test_merges_updates_per_page(self):
+        write = Recorder()
+        writes = make_queue(write)
+        writes.put("p1", {"现价": {"number": 1.0}, "PE": {"number": 10.0}})
+        writes.put("p1", {"PE": {"number": 12.0}, "PB": {"number": 2.0}})
+        writes.put("p2", {"现价": {"number": 3.0}})
+        self.assertEqual(writes.pending(), 2)
+
+        stats = writes.flush()
+        self.assertEqual(stats, {"updates": 3, "requests": 2, "coalesced": 1, "failed": []})
+        self.assertEqual(sorted(write.calls), [
+            ("p1", {"现价": {"number": 1.0}, "PE": {"number": 12.0}, "PB": {"number": 2.0}}),
+            ("p2", {"现价": {"number": 3.0}}),
+        ])
+        self.assertEqual(writes.pending(), 0)
+        self.assertEqual(writes.flush()["requests"], 0)
+
+    def test_retries_rate_limited_writes(self):
+        write = Recorder({"p1": [APIError(429, "rate_limited")]})
+        writes = make_queue(write)
+        writes.put("p1", {"现价": {"number": 1.0}})
+        stats = writes.flush()
+        self.assertEqual(stats["failed"], [])
+        self.assertEqual(len(write.calls), 2)
+
+    def test_reports_failures_with_label(self):
+        error = APIError(400, "validation_error")
+        write = Recorder({"p1": [error]})
+        writes = make_queue(write)
+        writes.put("p1", {"现价": {"number": 1.0}}, label="AAPL")
+        writes.put("p2", {"现价": {"number": 2.0}})
+        stats = writes.flush()
+        self.assertEqual(stats["failed"], [("AAPL", error)])
+        # 不可重试的错误只尝试一次
+        self.assertEqual(len(write.calls), 2)
+
+    def test_success_callbacks_run_only_after_successful_write(self):
+        write = Recorder({"p1": [APIError(400, "validation_error")]})
+        writes = make_queue(write)
+        done = []
+        writes.put("p1", {"Yield": {"number": 2.0}}, on_success=lambda: done.append("p1"))
+        writes.put("p2", {"股票投资组合": {"relation": []}}, on_success=lambda: done.append("p2"))
+        writes.flush()
+        self.assertEqual(done, ["p2"])
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_spaces_permits(self):
+        now = [0.0]
+        waits = []
+
+        def sleep(seconds):
+            waits.append(seconds)
+
+        limiter = write_queue.RateLimiter(4, clock=lambda: now[0], sleep=sleep)
+        for _ in range(3):
+            limiter.acquire()
+        self.assertEqual(waits, [0.25, 0.5])
+
+        now[0] = 10.0
+        limiter.acquire()
+        self.assertEqual(len(waits), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+"""
+每日估值轨迹：每个代码（持仓 / 指数）每天的 PE、PB 及其百分位
+
+以前每次同步只把当天的 PE百分位 写入 Notion，不保留历史，看不到估值和百分位的变化。
+现在每次同步后把当天的值记录到本地状态库（valuation_series 表，序列名见 SERIES）：
+
+- 代码：持仓用股票代码（如 AAPL、600519），指数用 "index:指数代码"（如 index:000300、index:HSI）
+- 增量：每次只写入当天的一个点（同一天重复运行覆盖），不重算历史。record() 只按主键 (series, symbol, date)
+  upsert 到状态库（索引定位 O(log n)），不加载已有轨迹；同步时每个持仓每天记录一次，不读取历史
+- 查询：trajectory(代码, 字段) 首次查询时从状态库加载整条轨迹（O(n)）到内存，按日期排序；
+  之后 record() 的新点同步插入已加载的轨迹（二分定位，当天的点追加在末尾）
+
+    history = get_history()
+    history.record("600519", pe=30.1, pe_percentile=45.2)
+    history.trajectory("600519", PE_PERCENTILE, since="2026-01-01")
+"""
+import bisect
+import datetime
+import threading
+
+import state_store
+
+PE = "pe"
+PB = "pb"
+PE_PERCENTILE = "pe_percentile"
+PB_PERCENTILE = "pb_percentile"
+FIELDS = (PE, PB, PE_PERCENTILE, PB_PERCENTILE)
+
+# 字段 → valuation_series 中的序列名（与 A股/港股原始 PE 序列 pe_ttm / hk_pe_ratio 区分）
+SERIES = {field: f"daily_{field}" for field in FIELDS}
+
+
+def index_symbol(index_code):
+    return f"index:{index_code}"
+
+
+class Trajectory:
+    """一个代码一个字段的每日数值，按日期升序"""
+    __slots__ = ("dates", "values")
+
+    def __init__(self, points=()):
+        self.dates = []
+        self.values = []
+        for date, value in sorted(points):
+            self.dates.append(date)
+            self.values.append(value)
+
+    def insert(self, date, value):
+        """插入或覆盖 date 的值"""
+        i = bisect.bisect_left(self.dates, date)
+        if i < len(self.dates) and self.dates[i] == date:
+            self.values[i] = value
+        else:
+            self.dates.insert(i, date)
+            self.values.insert(i, value)
+
+    def since(self, date=None):
+        i = bisect.bisect_left(self.dates, date) if date else 0
+        return list(zip(self.dates[i:], self.values[i:]))
+
+    def __len__(self):
+        return len(self.dates)
+
+
+class ValuationHistory:
+    def __init__(self, store):
+        self.store = store
+        self._trajectories = {}
+        self._lock = threading.Lock()
+
+    def _trajectory(self, symbol, field):
+        """内存中的轨迹；首次查询时从状态库加载"""
+        key = (symbol, field)
+        trajectory = self._trajectories.get(key)
+        if trajectory is None:
+            trajectory = self._trajectories[key] = Trajectory(self.store.get_series(SERIES[field], symbol))
+        return trajectory
+
+    def record(self, symbol, date=None, **values):
+        """
+        记录 symbol 在 date（默认今天）的估值；values: pe / pb / pe_percentile / pb_percentile，None 的字段不记录
+        返回记录的字段数
+        """
+        unknown = set(values) - set(FIELDS)
+        if unknown:
+            raise ValueError(f"未知估值字段: {', '.join(sorted(unknown))}")
+        date = str(date or datetime.date.today().isoformat())
+        recorded = 0
+        with self._lock:
+            for field, value in values.items():
+                if value is None:
+                    continue
+                value = float(value)
+                self.store.upsert_series(SERIES[field], symbol, [(date, value)])
+                # 只更新已加载的轨迹，未查询过的代码不为插入一个点加载整条轨迹
+                trajectory = self._trajectories.get((symbol, field))
+                if trajectory is not None:
+                    trajectory.insert(date, value)
+                recorded += 1
+        return recorded
+
+    def trajectory(self, symbol, field=PE_PERCENTILE, since=None):
+        """symbol 的 field 轨迹 [(日期, 数值), ...]，按日期升序；since: 只返回该日期及之后"""
+        if field not in SERIES:
+            raise ValueError(f"未知估值字段: {field}")
+        with self._lock:
+            return self._trajectory(symbol, field).since(since)
+
+    def latest(self, symbol, field=PE_PERCENTILE):
+        points = self.trajectory(symbol, field)
+        return points[-1] if points else None
+
+
+_history = None
+_history_lock = threading.Lock()
+
+
+def get_history():
+    """当前状态库对应的估值轨迹（切换状态库后重新创建）"""
+    global _history
+    store = state_store.get_store()
+    with _history_lock:
+        if _history is None or _history.store is not store:
+            _history = ValuationHistory(store)
+        return _history
+
+
+def trajectory(symbol, field=PE_PERCENTILE, since=None):
+    """从本地状态库查询 symbol 的估值轨迹"""
+    return get_history().trajectory(symbol, field, since)
@@ -0,0 +1,162 @@
+"""
+常驻模式下的内存热缓存
+
+每次 cron 运行都是冷启动：导入、汇率、全市场快照、指数历史、基本面、Notion 数据源解析全部重来。
+常驻服务模式（daemon.py）下进程不退出，这些数据保存在内存中，按各自的更新频率失效：
+
+- SESSION：行情快照，对应市场收盘后失效（收盘时间见 market_calendar）
+- DAILY：基本面（PB/ROE/PEG）、汇率、场外基金净值增长率，跨天失效
+- MONTHLY：指数 PE/PB 及其历史百分位、个股 PE 历史，跨月失效
+- FOREVER：不会变化的数据，如 Notion 数据库对应的数据源 ID
+
+持仓页面索引（PAGE_INDEX_KEY）按 DAILY 缓存，本进程写入的属性直接同步到缓存的页面，写入失败时丢弃（见 main.py）。
+
+未激活时（普通单次运行）cached()/memoize 直接调用原函数，行为不变。
+返回 None、空 dict（或全为 None 的元组）的结果视为获取失败，不缓存，下次同步重新获取。
+"""
+import datetime
+import functools
+import inspect
+import threading
+
+import market_calendar
+import metrics
+
+SESSION = "session"
+DAILY = "daily"
+MONTHLY = "monthly"
+FOREVER = "forever"
+
+# 持仓页面索引（数据源 ID、属性定义、页面列表）的缓存键
+PAGE_INDEX_KEY = "holding_pages"
+
+
+def _utcnow():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def is_empty(value):
+    if value is None or (isinstance(value, dict) and not value):
+        return True
+    return isinstance(value, tuple) and all(v is None for v in value)
+
+
+class WarmCache:
+    def __init__(self, clock=_utcnow):
+        self._clock = clock
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def is_fresh(self, kind, loaded_at, market=None):
+        now = self._clock()
+        if kind == FOREVER:
+            return True
+        if kind == SESSION:
+            close = market_calendar.last_session_close(market, now)
+            return close is None or loaded_at >= close
+        local_loaded, local_now = loaded_at.astimezone(), now.astimezone()
+        if kind == DAILY:
+            return local_loaded.date() == local_now.date()
+        if kind == MONTHLY:
+            return (local_loaded.year, local_loaded.month) == (local_now.year, local_now.month)
+        raise ValueError(f"未知缓存类型: {kind}")
+
+    def get(self, kind, key, loader, market=None):
+        """
+        返回 key 对应的缓存值；不存在或已失效时调用 loader() 重新加载
+        market: SESSION 类型必填，决定按哪个市场的收盘时间失效
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.is_fresh(kind, entry[1], market):
+                self.hits += 1
+                metrics.inc(metrics.CACHE_LOOKUPS, cache="warm", result="hit")
+                return entry[0]
+            self.misses += 1
+        metrics.inc(metrics.CACHE_LOOKUPS, cache="warm", result="miss")
+        loaded_at = self._clock()
+        value = loader()
+        if not is_empty(value):
+            with self._lock:
+                self._entries[key] = (value, loaded_at, kind)
+        return value
+
+    def invalidate(self, kind=None):
+        """清除指定类型（默认全部）的缓存"""
+        with self._lock:
+            if kind is None:
+                self._entries.clear()
+            else:
+                self._entries = {k: e for k, e in self._entries.items() if e[2] != kind}
+
+    def discard(self, key):
+        """清除单个缓存键（不存在时忽略）"""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            by_kind = {}
+            for _, _, kind in self._entries.values():
+                by_kind[kind] = by_kind.get(kind, 0) + 1
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses, "by_kind": by_kind}
+
+
+_active = None
+
+
+def activate(clock=_utcnow):
+    global _active
+    _active = WarmCache(clock)
+    return _active
+
+
+def deactivate():
+    global _active
+    _active = None
+
+
+def active():
+    return _active
+
+
+def is_active():
+    return _active is not None
+
+
+def cached(kind, key, loader, market=None):
+    """未激活热缓存时直接调用 loader()"""
+    if _active is None:
+        return loader()
+    return _active.get(kind, key, loader, market)
+
+
+def discard(key):
+    """清除单个缓存键；未激活热缓存时为空操作"""
+    if _active is not None:
+        _active.discard(key)
+
+
+def memoize(kind, ignore=()):
+    """
+    按参数缓存函数结果（仅在热缓存激活时生效）
+
+    ignore: 不参与缓存键计算的参数名（如行情缓存 dict、yfinance Ticker 对象）
+    """
+    def decorator(func):
+        sig = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _active is None:
+                return func(*args, **kwargs)
+            bound = sig.bind(*args, **kwargs)
+            key = (func.__name__,) + tuple(
+                (k, repr(v)) for k, v in bound.arguments.items() if k not in ignore
+            )
+            return _active.get(kind, key, lambda: func(*args, **kwargs))
+
+        return wrapper
+    return decorator
@@ -0,0 +1,112 @@
+"""
+Notion 写入队列（write-behind）：按页面合并更新，限速并发写入
+
+以前每条持仓在处理完后立即 pages.update，并固定 sleep 0.5s 防止限速；交易流水也是逐条写入、逐条 sleep。
+现在各阶段只把要写入的属性 put() 到队列：
+
+- 合并：同一页面的多次更新合并为一个请求，后入队的同名属性覆盖先入队的值（与依次写入的最终结果一致）
+- 限速并发：flush() 时用 WRITE_WORKERS 个线程并发写入，总速率不超过 WRITE_RATE 次/秒（Notion 平均限速约 3 次/秒）
+- 顺序：每个页面在一次 flush 中只有一个请求；flush 期间新入队的更新留到下一次 flush，同一页面的写入不会乱序
+- 重试：限速（429）、冲突（409）、5xx 和超时按指数退避重试，最多 MAX_ATTEMPTS 次
+
+    writes = WriteBehind(lambda page_id, properties: notion.pages.update(page_id=page_id, properties=properties))
+    writes.put(page_id, {"现价": {"number": 1.23}}, label="AAPL")
+    stats = writes.flush()   # {"updates": 入队次数, "requests": 请求数, "coalesced": 合并掉的次数, "failed": [...]}
+"""
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+WRITE_RATE = 3.0
+WRITE_WORKERS = 3
+MAX_ATTEMPTS = 3
+BACKOFF_BASE = 1.0
+
+_RETRYABLE_STATUS = (409, 429, 500, 502, 503, 504)
+_RETRYABLE_CODES = ("rate_limited", "conflict_error", "service_unavailable", "notionhq_client_request_timeout")
+
+
+def is_retryable(error):
+    """notion_client 的 APIResponseError 带有 status / code；网络超时带有 code"""
+    if getattr(error, "status", None) in _RETRYABLE_STATUS:
+        return True
+    return getattr(error, "code", None) in _RETRYABLE_CODES or isinstance(error, (TimeoutError, ConnectionError))
+
+
+class RateLimiter:
+    """多线程共享的限速器：相邻两次许可至少间隔 1/rate 秒"""
+
+    def __init__(self, rate, clock=time.monotonic, sleep=time.sleep):
+        self._interval = 1.0 / rate if rate else 0.0
+        self._clock = clock
+        self._sleep = sleep
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = self._clock()
+            start = max(now, self._next)
+            self._next = start + self._interval
+        if start > now:
+            self._sleep(start - now)
+
+
+class WriteBehind:
+    def __init__(self, write, workers=WRITE_WORKERS, rate=WRITE_RATE, clock=time.monotonic, sleep=time.sleep):
+        """write: 写入一个页面的函数 write(page_id, properties)，失败时抛出异常"""
+        self._write = write
+        self._workers = workers
+        self._sleep = sleep
+        self._limiter = RateLimiter(rate, clock, sleep)
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def put(self, page_id, properties, label=None, on_success=None):
+        """
+        合并入队；label 用于失败时的提示（如股票代码），默认为页面 ID
+        on_success: 该页面写入成功后调用的函数（无参数），如记录同步结果；写入失败时不调用
+        """
+        with self._lock:
+            entry = self._pending.get(page_id)
+            if entry is None:
+                entry = self._pending[page_id] = {"properties": {}, "updates": 0, "label": label or page_id, "callbacks": []}
+            entry["properties"].update(properties)
+            entry["updates"] += 1
+            if on_success is not None:
+                entry["callbacks"].append(on_success)
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self):
+        """写入所有待写入的页面，返回本次的统计"""
+        with self._lock:
+            batch, self._pending = self._pending, {}
+        stats = {"updates": sum(e["updates"] for e in batch.values()), "requests": len(batch), "coalesced": 0, "failed": []}
+        stats["coalesced"] = stats["updates"] - stats["requests"]
+        if not batch:
+            return stats
+
+        with ThreadPoolExecutor(max_workers=min(self._workers, len(batch)), thread_name_prefix="notion-write") as pool:
+            errors = pool.map(lambda item: self._send(*item), batch.items())
+            for (page_id, entry), error in zip(batch.items(), errors):
+                if error is not None:
+                    stats["failed"].append((entry["label"], error))
+                    continue
+                for callback in entry["callbacks"]:
+                    callback()
+        return stats
+
+    def _send(self, page_id, entry):
+        """写入一个页面，返回 None 或最后一次的异常"""
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            self._limiter.acquire()
+            try:
+                self._write(page_id, entry["properties"])
+                return None
+            except Exception as e:
+                if attempt == MAX_ATTEMPTS or not is_retryable(e):
+                    return e
+                self._sleep(BACKOFF_BASE * 2 ** (attempt - 1))